@@ -1,24 +1,42 @@
-from fastapi import FastAPI, HTTPException, Depends, status, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, HTTPException, Depends, status, WebSocket, WebSocketDisconnect, Request, Response
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field, validator
 from typing import Optional, List, Dict, Any, Set
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import os
 import jwt
 import bcrypt
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument, UpdateOne, InsertOne, ReplaceOne, DeleteOne
+from pymongo.collection import Collection
+from pymongo.database import Database
+from pymongo.errors import DuplicateKeyError, OperationFailure, BulkWriteError, CollectionInvalid
 import uuid
 from enum import Enum
 import qrcode
+from qrcode.exceptions import DataOverflowError
 from io import BytesIO
 import base64
+import bisect
+import heapq
+import itertools
+import hashlib
+import hmac
 from PIL import Image
 import re
 import math  # Добавляем для пагинации
+import numpy as np
 from bson import ObjectId
 import json
 import asyncio
+import threading
+import time
+from urllib.parse import urlencode
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import traceback
+from anyio import to_thread
+from fastapi.concurrency import run_in_threadpool
 
 app = FastAPI()
 
@@ -34,8 +52,297 @@ app.add_middleware(
 # MongoDB подключение
 MONGO_URL = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
 DB_NAME = os.environ.get('DB_NAME', 'cargo_transport')
-client = MongoClient(MONGO_URL)
-db = client[DB_NAME]  # Используем имя базы из переменной окружения
+# Размер пула потоков для работы с MongoDB: синхронные обработчики (def) FastAPI
+# выполняются в пуле потоков AnyIO и не блокируют event loop
+MONGO_THREADPOOL_SIZE = int(os.environ.get('MONGO_THREADPOOL_SIZE', '64'))
+client = MongoClient(MONGO_URL, maxPoolSize=MONGO_THREADPOOL_SIZE)
+
+class TrackedInsertOne(InsertOne):
+    """InsertOne для bulk_write в ChangeTrackedCollection: документ доступен подписчикам"""
+    filter = None
+    
+    def __init__(self, document, *args, **kwargs):
+        super().__init__(document, *args, **kwargs)
+        self.document = document
+
+class TrackedUpdateOne(UpdateOne):
+    """UpdateOne для bulk_write в ChangeTrackedCollection: фильтр нужен для образов документов до записи"""
+    def __init__(self, filter, update, *args, **kwargs):
+        super().__init__(filter, update, *args, **kwargs)
+        self.filter = filter
+
+class TrackedReplaceOne(ReplaceOne):
+    def __init__(self, filter, replacement, *args, **kwargs):
+        super().__init__(filter, replacement, *args, **kwargs)
+        self.filter = filter
+
+class TrackedDeleteOne(DeleteOne):
+    def __init__(self, filter, *args, **kwargs):
+        super().__init__(filter, *args, **kwargs)
+        self.filter = filter
+
+TRACKED_WRITE_OPERATIONS = (TrackedInsertOne, TrackedUpdateOne, TrackedReplaceOne, TrackedDeleteOne)
+
+class ChangeTrackedCollection(Collection):
+    """Коллекция, уведомляющая подписчиков об изменениях документов.
+    
+    Для insert/update/replace/delete/bulk_write подписчики получают пары (до, после) только
+    с нужными им полями. Образ "после" для update вычисляется из образа "до" для $set/$unset/$inc,
+    иначе перечитывается по _id. Образы читаются отдельно от записи, поэтому производные
+    данные подписчиков сверяются с исходными коллекциями их заполнением (BackfillState);
+    ошибка подписчика не прерывает запись, а помечает его данные для пересборки.
+    bulk_write принимает только операции Tracked*: их фильтры и документы нужны для образов.
+    """
+    
+    def _tracked_projection(self) -> Optional[dict]:
+        fields = ChangeTrackedDatabase.tracked_fields(self.name)
+        return {field: 1 for field in fields} if fields else None
+    
+    def _notify(self, changes: list):
+        changes = [change for change in changes if change[0] is not None or change[1] is not None]
+        if changes:
+            ChangeTrackedDatabase.notify(self.name, changes)
+    
+    def _after_image(self, before: dict, update) -> Optional[dict]:
+        """Применить простые операторы обновления к образу документа; None - нужно перечитать"""
+        if not isinstance(update, dict):
+            return None
+        fields = ChangeTrackedDatabase.tracked_fields(self.name)
+        after = dict(before)
+        for operator, values in update.items():
+            for key, value in values.items():
+                root = key.split(".", 1)[0]
+                if root not in fields:
+                    continue
+                if "." in key:
+                    return None
+                if operator == "$set":
+                    after[key] = value
+                elif operator == "$unset":
+                    after.pop(key, None)
+                elif operator == "$inc" and isinstance(after.get(key, 0), (int, float)):
+                    after[key] = after.get(key, 0) + value
+                elif operator != "$setOnInsert":
+                    return None
+        return after
+    
+    def _read_images(self, ids: list, projection: dict) -> dict:
+        return {doc["_id"]: doc for doc in Collection.find(self, {"_id": {"$in": ids}}, projection)}
+    
+    def insert_one(self, document, *args, **kwargs):
+        result = super().insert_one(document, *args, **kwargs)
+        if self._tracked_projection():
+            self._notify([(None, document)])
+        return result
+    
+    def insert_many(self, documents, *args, **kwargs):
+        documents = list(documents)
+        result = super().insert_many(documents, *args, **kwargs)
+        if self._tracked_projection():
+            self._notify([(None, document) for document in documents])
+        return result
+    
+    def _tracked_update(self, method, many: bool, filter, update, *args, **kwargs):
+        # Имя _update занято внутренним методом pymongo Collection
+        projection = self._tracked_projection()
+        if not projection:
+            return method(filter, update, *args, **kwargs)
+        if many:
+            befores = list(Collection.find(self, filter, projection))
+        else:
+            before = Collection.find_one(self, filter, projection)
+            befores = [before] if before else []
+        result = method(filter, update, *args, **kwargs)
+        
+        changes = []
+        reread = []
+        if result.modified_count:
+            for before in befores:
+                after = self._after_image(before, update)
+                if after is None:
+                    reread.append(before)
+                else:
+                    changes.append((before, after))
+        if reread:
+            images = self._read_images([before["_id"] for before in reread], projection)
+            changes.extend((before, images.get(before["_id"])) for before in reread)
+        if result.upserted_id is not None:
+            changes.append((None, Collection.find_one(self, {"_id": result.upserted_id}, projection)))
+        self._notify(changes)
+        return result
+    
+    def update_one(self, filter, update, *args, **kwargs):
+        return self._tracked_update(super().update_one, False, filter, update, *args, **kwargs)
+    
+    def update_many(self, filter, update, *args, **kwargs):
+        return self._tracked_update(super().update_many, True, filter, update, *args, **kwargs)
+    
+    def replace_one(self, filter, replacement, *args, **kwargs):
+        projection = self._tracked_projection()
+        if not projection:
+            return super().replace_one(filter, replacement, *args, **kwargs)
+        before = Collection.find_one(self, filter, projection)
+        result = super().replace_one(filter, replacement, *args, **kwargs)
+        if result.modified_count and before:
+            self._notify([(before, dict(replacement, _id=before["_id"]))])
+        elif result.upserted_id is not None:
+            self._notify([(None, dict(replacement, _id=result.upserted_id))])
+        return result
+    
+    def delete_one(self, filter, *args, **kwargs):
+        projection = self._tracked_projection()
+        if not projection:
+            return super().delete_one(filter, *args, **kwargs)
+        before = Collection.find_one(self, filter, projection)
+        result = super().delete_one(filter, *args, **kwargs)
+        if result.deleted_count and before:
+            self._notify([(before, None)])
+        return result
+    
+    def delete_many(self, filter, *args, **kwargs):
+        projection = self._tracked_projection()
+        if not projection:
+            return super().delete_many(filter, *args, **kwargs)
+        befores = list(Collection.find(self, filter, projection))
+        result = super().delete_many(filter, *args, **kwargs)
+        if result.deleted_count and befores:
+            remaining = self._read_images([before["_id"] for before in befores], {"_id": 1})
+            self._notify([(before, None) for before in befores if before["_id"] not in remaining])
+        return result
+    
+    def bulk_write(self, requests, *args, **kwargs):
+        """Образы "до" читаются одним $or по фильтрам операций, "после" - одним $in по _id"""
+        requests = list(requests)
+        projection = self._tracked_projection()
+        if not projection:
+            return super().bulk_write(requests, *args, **kwargs)
+        untracked = [type(request).__name__ for request in requests if not isinstance(request, TRACKED_WRITE_OPERATIONS)]
+        if untracked:
+            raise TypeError(f"bulk_write в {self.name} принимает только операции Tracked*, получены: {', '.join(sorted(set(untracked)))}")
+        filters = [request.filter for request in requests if request.filter is not None]
+        befores = {doc["_id"]: doc for doc in Collection.find(self, {"$or": filters}, projection)} if filters else {}
+        
+        error = None
+        try:
+            result = super().bulk_write(requests, *args, **kwargs)
+            upserted_ids = list(result.upserted_ids.values())
+            failed_indexes = set()
+        except BulkWriteError as e:
+            # Неупорядоченная запись: успешные операции применены, уведомляем о них и пробрасываем ошибку
+            error = e
+            upserted_ids = [item["_id"] for item in e.details.get("upserted", [])]
+            failed_indexes = {item["index"] for item in e.details.get("writeErrors", [])}
+        
+        afters = self._read_images(list(befores) + upserted_ids, projection) if befores or upserted_ids else {}
+        changes = [(before, afters.get(_id)) for _id, before in befores.items() if afters.get(_id) != before]
+        changes.extend((None, afters[_id]) for _id in upserted_ids if _id in afters)
+        changes.extend(
+            (None, request.document) for index, request in enumerate(requests)
+            if isinstance(request, TrackedInsertOne) and index not in failed_indexes
+        )
+        self._notify(changes)
+        if error:
+            raise error
+        return result
+
+class ChangeTrackedDatabase(Database):
+    """База, выдающая ChangeTrackedCollection для коллекций, на изменения которых есть подписчики"""
+    _listeners: Dict[str, list] = {}
+    # Отложенные подписчики (кэши, которым допустимо отставание) вызываются по порядку в одном фоновом потоке
+    _deferred = ThreadPoolExecutor(max_workers=1, thread_name_prefix="change-listeners")
+    
+    @classmethod
+    def subscribe(cls, collection_name: str, fields, callback, on_error=None, deferred: bool = False):
+        """Подписаться на изменения: callback(collection_name, [(до, после), ...]).
+        
+        on_error(причина) вызывается, если callback упал: производные данные подписчика
+        помечаются для пересборки. deferred=True - вызывать callback вне пути запроса.
+        """
+        cls._listeners.setdefault(collection_name, []).append((set(fields) | {"_id"}, callback, on_error, deferred))
+    
+    @classmethod
+    def tracked_fields(cls, collection_name: str) -> set:
+        fields = set()
+        for listener_fields, *_ in cls._listeners.get(collection_name, []):
+            fields |= listener_fields
+        return fields
+    
+    @classmethod
+    def _deliver(cls, collection_name: str, callback, on_error, changes: list):
+        try:
+            callback(collection_name, changes)
+        except Exception as e:
+            reason = f"{collection_name}: {type(e).__name__}: {e}"
+            print(f"❌ Ошибка подписчика {getattr(callback, '__qualname__', callback)} ({reason})")
+            traceback.print_exc()
+            if on_error is None:
+                return
+            try:
+                on_error(reason)
+            except Exception as mark_error:
+                print(f"❌ Не удалось пометить данные подписчика для пересборки: {mark_error}")
+    
+    @classmethod
+    def notify(cls, collection_name: str, changes: list):
+        for _, callback, on_error, deferred in cls._listeners.get(collection_name, []):
+            if deferred:
+                snapshot = [(dict(before) if before else None, dict(after) if after else None) for before, after in changes]
+                cls._deferred.submit(cls._deliver, collection_name, callback, on_error, snapshot)
+            else:
+                cls._deliver(collection_name, callback, on_error, changes)
+    
+    @classmethod
+    def drain(cls):
+        """Дождаться обработки уже поставленных отложенных уведомлений"""
+        cls._deferred.submit(lambda: None).result()
+    
+    def get_collection(self, name, codec_options=None, read_preference=None, write_concern=None, read_concern=None):
+        return ChangeTrackedCollection(
+            self, name,
+            codec_options=codec_options,
+            read_preference=read_preference,
+            write_concern=write_concern,
+            read_concern=read_concern
+        )
+    
+    def __getitem__(self, name):
+        return self.get_collection(name)
+
+db = ChangeTrackedDatabase(client, DB_NAME)  # Используем имя базы из переменной окружения
+
+class AsyncCollection:
+    """Асинхронная обертка над коллекцией pymongo: каждая операция выполняется в пуле потоков"""
+    def __init__(self, collection):
+        self._collection = collection
+    
+    def __getattr__(self, name):
+        method = getattr(self._collection, name)
+        
+        async def call(*args, **kwargs):
+            return await run_in_threadpool(method, *args, **kwargs)
+        return call
+    
+    async def find_list(self, *args, **kwargs):
+        """find() с материализацией курсора в пуле потоков"""
+        return await run_in_threadpool(lambda: list(self._collection.find(*args, **kwargs)))
+
+class AsyncDatabase:
+    """Асинхронный доступ к базе для обработчиков, которые должны оставаться async (WebSocket, GPS)"""
+    def __init__(self, database):
+        self._database = database
+    
+    def __getattr__(self, name):
+        return AsyncCollection(self._database[name])
+    
+    def __getitem__(self, name):
+        return AsyncCollection(self._database[name])
+
+adb = AsyncDatabase(db)
+
+@app.on_event("startup")
+async def configure_db_threadpool():
+    """Ограничить пул потоков, в котором выполняются синхронные обработчики и запросы к MongoDB"""
+    to_thread.current_default_thread_limiter().total_tokens = MONGO_THREADPOOL_SIZE
 
 # JWT настройки
 SECRET_KEY = "cargo_transport_secret_key_2025"
@@ -112,12 +419,13 @@ class ConnectionManager:
         for user_id in disconnected:
             self.disconnect(user_id)
     
-    async def broadcast_courier_location_update(self, location_data: dict):
+    async def broadcast_courier_location_update(self, location_data: dict, courier: Optional[dict] = None):
         """Отправить обновление местоположения курьера всем заинтересованным клиентам"""
         courier_id = location_data.get("courier_id")
         
-        # Получить информацию о курьере для определения склада
-        courier = db.couriers.find_one({"id": courier_id}, {"_id": 0, "assigned_warehouse_id": 1})
+        # Получить информацию о курьере для определения склада (если профиль не передан)
+        if courier is None:
+            courier = await adb.couriers.find_one({"id": courier_id}, {"_id": 0, "assigned_warehouse_id": 1})
         warehouse_id = courier.get("assigned_warehouse_id") if courier else None
         
         message = {
@@ -359,6 +667,12 @@ class CourierLocationUpdate(BaseModel):
     speed: Optional[float] = None  # Скорость в км/ч
     heading: Optional[float] = None  # Направление движения в градусах
 
+class CourierLocationBatchPoint(CourierLocationUpdate):
+    timestamp: datetime  # Время фиксации точки на устройстве
+
+class CourierLocationBatch(BaseModel):
+    points: List[CourierLocationBatchPoint] = Field(..., min_length=1, max_length=1000)  # В порядке записи на устройстве
+
 class CourierLocation(BaseModel):
     id: str
     courier_id: str
@@ -430,7 +744,7 @@ class AdvancedSearchResponse(BaseModel):
     per_page: int
     total_pages: int
     search_time_ms: int
-    suggestions: List[str] = []  # Предложения для автодополнения
+    suggestions: List[str] = []  # Не заполняется: подсказки выдает /api/search/suggest
 
 class CargoCreate(BaseModel):
     recipient_name: str
@@ -1086,6 +1400,134 @@ def create_user_token(user_id: str, phone: str, token_version: int = 1, expires_
     }
     return create_access_token(token_data, expires_delta)
 
+# Кэш аутентифицированных пользователей: get_current_user вызывается на каждый запрос,
+# а сканеры операторов обращаются к API несколько раз в секунду
+# Поля users, изменение которых сбрасывает кэш пользователя
+PRINCIPAL_USER_FIELDS = ["id", "user_number", "full_name", "phone", "role", "email", "address", "is_active", "token_version"]
+
+class PrincipalCache:
+    """Ограниченный LRU-кэш пользователей с TTL по ключу (user_id, token_version).
+    
+    Любая запись в users, меняющая PRINCIPAL_USER_FIELDS (в том числе удаление), сбрасывает
+    записи пользователя подпиской на users и увеличивает штамп версии в schema_meta. Другие
+    процессы проверяют штамп не чаще одного раза в check_interval секунд и при его изменении
+    очищают кэш целиком.
+    """
+    META_ID = "principal_cache"
+    
+    def __init__(self, database, max_size: int, ttl_seconds: float, check_interval: float):
+        self._meta = database.schema_meta
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.check_interval = check_interval
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()  # (user_id, token_version) -> (expires_at, User)
+        self._lock = threading.Lock()
+        self._version = None
+        self._checked_at = 0.0
+        # Растет при каждом сбросе: пользователь, прочитанный до сброса, в кэш не кладется
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+    
+    def _read_version(self) -> int:
+        stamp = self._meta.find_one({"_id": self.META_ID}, {"version": 1})
+        return stamp.get("version", 0) if stamp else 0
+    
+    def _ensure_fresh(self):
+        if self._version is not None and time.monotonic() - self._checked_at < self.check_interval:
+            return
+        version = self._read_version()
+        with self._lock:
+            if version != self._version:
+                self._entries.clear()
+                self.generation += 1
+                self._version = version
+            self._checked_at = time.monotonic()
+    
+    def get(self, user_id: str, token_version: int, phone: str):
+        self._ensure_fresh()
+        key = (user_id, token_version)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic() or entry[1].phone != phone:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+    
+    def put(self, user: "User", generation: int):
+        """Положить пользователя, прочитанного при поколении generation (если с тех пор не было сброса)"""
+        key = (user.id, user.token_version)
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, user)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+    
+    def invalidate(self, user_ids):
+        """Удалить все версии пользователей из кэша текущего процесса"""
+        user_ids = set(user_ids)
+        with self._lock:
+            for key in [key for key in self._entries if key[0] in user_ids]:
+                del self._entries[key]
+            self.generation += 1
+            self.invalidations += 1
+    
+    def _bump_version(self):
+        stamp = self._meta.find_one_and_update(
+            {"_id": self.META_ID},
+            {"$inc": {"version": 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        with self._lock:
+            # Версия выросла больше чем на 1 - пользователей менял другой процесс
+            if self._version is None or stamp["version"] != self._version + 1:
+                self._entries.clear()
+                self.generation += 1
+            self._version = stamp["version"]
+            self._checked_at = time.monotonic()
+    
+    def on_user_changes(self, collection_name: str, changes: list):
+        user_ids = {image.get("id") for change in changes for image in change if image} - {None}
+        if user_ids:
+            self.invalidate(user_ids)
+            self._bump_version()
+    
+    def clear(self):
+        """Очистить кэш во всех процессах"""
+        with self._lock:
+            self._entries.clear()
+            self.generation += 1
+        self._bump_version()
+    
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0
+            }
+
+principal_cache = PrincipalCache(
+    db,
+    max_size=int(os.environ.get('AUTH_CACHE_SIZE', '10000')),
+    ttl_seconds=float(os.environ.get('AUTH_CACHE_TTL_SECONDS', '30')),
+    check_interval=float(os.environ.get('AUTH_CACHE_CHECK_SECONDS', '2'))
+)
+ChangeTrackedDatabase.subscribe("users", PRINCIPAL_USER_FIELDS, principal_cache.on_user_changes, on_error=lambda reason: principal_cache.clear())
+
 def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     credentials_exception = HTTPException(
         status_code=401,
@@ -1103,7 +1545,12 @@ def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(securit
     except jwt.PyJWTError:
         raise credentials_exception
     
-    user = db.users.find_one({"phone": phone, "id": user_id})
+    cached_user = principal_cache.get(user_id, token_version, phone)
+    if cached_user is not None:
+        return cached_user
+    
+    generation = principal_cache.generation
+    user = find_user_by_phone(phone, {"id": user_id})
     if user is None:
         raise HTTPException(status_code=401, detail="User not found")
     
@@ -1128,7 +1575,7 @@ def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(securit
         )
         user["user_number"] = user_number
         
-    return User(
+    authenticated_user = User(
         id=user["id"],
         user_number=user_number,
         full_name=user["full_name"],
@@ -1140,6 +1587,8 @@ def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(securit
         token_version=user.get("token_version", 1),
         created_at=user["created_at"]
     )
+    principal_cache.put(authenticated_user, generation)
+    return authenticated_user
 
 def require_role(role: UserRole):
     def role_checker(current_user: User = Depends(get_current_user)):
@@ -1148,153 +1597,92 @@ def require_role(role: UserRole):
         return current_user
     return role_checker
 
+# СЧЕТЧИКИ НОМЕРОВ (грузы, пользователи, склады, заявки)
+class SequenceService:
+    """Атомарные последовательности в коллекции counters.
+    
+    Значение выдается через find_one_and_update с $inc, поэтому номера не повторяются
+    при параллельных запросах и между процессами uvicorn. Для частых последовательностей
+    процесс резервирует сразу блок значений и раздает его из памяти.
+    """
+    def __init__(self, database):
+        self._counters = database.counters
+        self._lock = threading.Lock()
+        self._blocks: Dict[str, List[int]] = {}  # имя -> [следующее значение, последнее значение блока]
+        self._seeded: Set[str] = set()
+    
+    def _ensure_seeded(self, name: str, seed):
+        """Один раз инициализировать счетчик текущим максимумом из данных (продолжение старой нумерации)"""
+        if name in self._seeded:
+            return
+        if seed is not None and self._counters.find_one({"_id": name}, {"_id": 1}) is None:
+            # $max не уменьшит счетчик, если другой процесс уже успел его увеличить
+            self._counters.update_one({"_id": name}, {"$max": {"value": seed()}}, upsert=True)
+        self._seeded.add(name)
+    
+    def next_value(self, name: str, seed=None, block_size: int = 1) -> int:
+        """Следующее значение последовательности name; seed() вызывается только для нового счетчика"""
+        with self._lock:
+            block = self._blocks.get(name)
+            if block is None or block[0] > block[1]:
+                self._ensure_seeded(name, seed)
+                counter = self._counters.find_one_and_update(
+                    {"_id": name},
+                    {"$inc": {"value": block_size}},
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER
+                )
+                block = [counter["value"] - block_size + 1, counter["value"]]
+                self._blocks[name] = block
+            value = block[0]
+            block[0] += 1
+            return value
+
+sequences = SequenceService(db)
+
+# Размер блока номеров грузов, резервируемого одним процессом (номера уникальны, но между
+# процессами идут не строго по порядку, а при перезапуске часть блока пропускается)
+CARGO_NUMBER_BLOCK_SIZE = int(os.environ.get('CARGO_NUMBER_BLOCK_SIZE', '10'))
+
+def _max_numeric_suffix(collections: list, field: str, prefix: str, digits_pattern: str) -> int:
+    """Максимальный числовой суффикс значений field вида prefix+цифры (используется только для seed)"""
+    max_number = 0
+    for collection_name in collections:
+        last = list(db[collection_name].aggregate([
+            {"$match": {field: {"$regex": f"^{prefix}{digits_pattern}$"}}},
+            {"$project": {"_id": 0, field: 1, "length": {"$strLenCP": f"${field}"}}},
+            {"$sort": {"length": -1, field: -1}},
+            {"$limit": 1}
+        ]))
+        if last:
+            max_number = max(max_number, int(last[0][field][len(prefix):]))
+    return max_number
+
 def generate_cargo_number() -> str:
-    """Генерируем индивидуальный номер груза от 4-значных до 10-значных цифр"""
-    try:
-        import random
-        
-        # ФИКСИРОВАННЫЙ ФОРМАТ для января 2025: используем 2501 как префикс
-        year_month = "2501"  # Январь 2025
-        
-        # Ищем последний груз с номерами, начинающимися на 2501
-        pattern = f"^{year_month}[0-9]{{2,6}}$"  # 2501XX до 2501XXXXXX
-        
-        last_cargo_user = db.cargo.find({
-            "cargo_number": {"$regex": pattern}
-        }).sort("cargo_number", -1).limit(1)
-        
-        last_cargo_operator = db.operator_cargo.find({
-            "cargo_number": {"$regex": pattern}
-        }).sort("cargo_number", -1).limit(1)
-        
-        last_cargo_user_list = list(last_cargo_user)
-        last_cargo_operator_list = list(last_cargo_operator)
-        
-        # Находим максимальный номер для префикса 2501
-        max_number = 0
-        
-        if last_cargo_user_list:
-            user_number_str = last_cargo_user_list[0]["cargo_number"]
-            if len(user_number_str) > 4:
-                user_sequence = int(user_number_str[4:])  # Убираем префикс 2501
-                max_number = max(max_number, user_sequence)
-                
-        if last_cargo_operator_list:
-            operator_number_str = last_cargo_operator_list[0]["cargo_number"]
-            if len(operator_number_str) > 4:
-                operator_sequence = int(operator_number_str[4:])  # Убираем префикс 2501
-                max_number = max(max_number, operator_sequence)
-        
-        # Следующий номер в последовательности
-        next_sequence = max_number + 1
-        
-        # Формируем полный номер груза (от 4 до 10 цифр общих)
-        if next_sequence <= 99:
-            # 6-значный номер: 2501XX (01-99)
-            cargo_number = f"{year_month}{next_sequence:02d}"
-        elif next_sequence <= 999:
-            # 7-значный номер: 2501XXX (100-999)  
-            cargo_number = f"{year_month}{next_sequence:03d}"
-        elif next_sequence <= 9999:
-            # 8-значный номер: 2501XXXX (1000-9999)
-            cargo_number = f"{year_month}{next_sequence:04d}"
-        elif next_sequence <= 99999:
-            # 9-значный номер: 2501XXXXX (10000-99999)
-            cargo_number = f"{year_month}{next_sequence:05d}"
-        else:
-            # 10-значный номер: 2501XXXXXX (100000-999999)
-            cargo_number = f"{year_month}{next_sequence:06d}"
-            
-        # Максимум 10 цифр общих, значит максимум 6 цифр после 2501
-        if next_sequence > 999999:
-            # Если превысили лимит, используем случайный номер
-            cargo_number = f"{year_month}{random.randint(100000, 999999):06d}"
-        
-        # Проверяем уникальность номера в обеих коллекциях
-        attempts = 0
-        while (db.cargo.find_one({"cargo_number": cargo_number}) or 
-               db.operator_cargo.find_one({"cargo_number": cargo_number})) and attempts < 100:
-            # Генерируем случайный номер если найден дубликат
-            random_suffix = random.randint(1000, 999999)
-            cargo_number = f"{year_month}{random_suffix:06d}"
-            attempts += 1
-        
-        return cargo_number
-        
-    except Exception as e:
-        # В случае ошибки, генерируем случайный номер для января 2025
-        import random
-        year_month = "2501"
-        random_suffix = random.randint(1000, 9999)
-        return f"{year_month}{random_suffix:04d}"
+    """Генерируем номер груза: префикс ГГММ текущего месяца + порядковый номер (минимум 2 цифры)"""
+    year_month = datetime.utcnow().strftime("%y%m")
+    next_sequence = sequences.next_value(
+        f"cargo_number:{year_month}",
+        seed=lambda: _max_numeric_suffix(["cargo", "operator_cargo"], "cargo_number", year_month, "[0-9]{2,6}"),
+        block_size=CARGO_NUMBER_BLOCK_SIZE
+    )
+    return f"{year_month}{next_sequence:02d}"
 
 def generate_user_number() -> str:
     """Генерируем индивидуальный номер пользователя формата USR001234"""
-    try:
-        # Ищем последний пользователь с номером для определения следующего номера
-        last_user = db.users.find_one(
-            {"user_number": {"$regex": "^USR[0-9]{6}$"}},
-            sort=[("user_number", -1)]
-        )
-        
-        if last_user and "user_number" in last_user:
-            # Извлекаем числовую часть и увеличиваем на 1
-            last_number = int(last_user["user_number"][3:])  # Убираем префикс USR
-            next_number = last_number + 1
-        else:
-            # Начинаем с номера 1
-            next_number = 1
-        
-        # Формируем номер пользователя с префиксом USR и 6 цифрами
-        user_number = f"USR{next_number:06d}"
-        
-        # Проверяем уникальность номера
-        attempts = 0
-        while db.users.find_one({"user_number": user_number}) and attempts < 100:
-            next_number += 1
-            user_number = f"USR{next_number:06d}"
-            attempts += 1
-        
-        return user_number
-        
-    except Exception as e:
-        # В случае ошибки, генерируем случайный номер
-        import random
-        return f"USR{random.randint(1, 999999):06d}"
+    next_number = sequences.next_value(
+        "user_number",
+        seed=lambda: _max_numeric_suffix(["users"], "user_number", "USR", "[0-9]{6}")
+    )
+    return f"USR{next_number:06d}"
 
 def generate_warehouse_id_number() -> str:
     """Генерируем ID номер склада формата 001, 002, 003..."""
-    try:
-        # Ищем последний склад с ID номером для определения следующего номера
-        last_warehouse = db.warehouses.find_one(
-            {"warehouse_id_number": {"$regex": "^[0-9]{3}$"}},
-            sort=[("warehouse_id_number", -1)]
-        )
-        
-        if last_warehouse and "warehouse_id_number" in last_warehouse:
-            # Извлекаем числовую часть и увеличиваем на 1
-            last_number = int(last_warehouse["warehouse_id_number"])
-            next_number = last_number + 1
-        else:
-            # Начинаем с номера 1
-            next_number = 1
-        
-        # Формируем номер склада с 3 цифрами
-        warehouse_id_number = f"{next_number:03d}"
-        
-        # Проверяем уникальность номера
-        attempts = 0
-        while db.warehouses.find_one({"warehouse_id_number": warehouse_id_number}) and attempts < 100:
-            next_number += 1
-            warehouse_id_number = f"{next_number:03d}"
-            attempts += 1
-        
-        return warehouse_id_number
-        
-    except Exception as e:
-        # В случае ошибки, генерируем случайный номер
-        import random
-        return f"{random.randint(1, 999):03d}"
+    next_number = sequences.next_value(
+        "warehouse_id_number",
+        seed=lambda: _max_numeric_suffix(["warehouses"], "warehouse_id_number", "", "[0-9]{3}")
+    )
+    return f"{next_number:03d}"
 
 def generate_block_id_number(warehouse_id_number: str) -> str:
     """Генерируем ID номер блока формата 01, 02, 03... внутри склада"""
@@ -1422,6 +1810,225 @@ def generate_cell_id_number(warehouse_id_number: str, block_id_number: str, shel
         import random
         return f"{random.randint(1, 999):03d}"
 
+# КЭШ QR-ИЗОБРАЖЕНИЙ
+# Содержимое QR (номер груза, код ячейки) неизменно, поэтому PNG рендерится один раз
+# на ключ (payload, box_size, border, error_correction). Первый уровень - LRU в памяти
+# с ограничением по байтам, второй - файлы на диске (общие для всех воркеров).
+# Ключ - sha256 параметров, он же ETag и имя файла для GET /api/qr/{key}.png.
+# Файлы старше QR_CACHE_DISK_MAX_AGE_SECONDS удаляются, а при превышении
+# QR_CACHE_DISK_MAX_BYTES удаляются давно не читавшиеся. Ссылки на PNG подписываются
+# HMAC с SECRET_KEY, действуют QR_URL_TTL_SECONDS и содержат параметры рендеринга:
+# если файл уже вытеснен или лежит на другом хосте, PNG рендерится заново.
+# /api/qr/render.png принимает данные не длиннее QR_MAX_DATA_LENGTH и сохраняет
+# в кэш только номера грузов и коды ячеек.
+QR_CACHE_MEMORY_BYTES = int(os.environ.get('QR_CACHE_MEMORY_BYTES', str(64 * 1024 * 1024)))
+QR_CACHE_DIR = os.environ.get('QR_CACHE_DIR', '/tmp/tajline_qr_cache')
+QR_CACHE_DISK_MAX_BYTES = int(os.environ.get('QR_CACHE_DISK_MAX_BYTES', str(512 * 1024 * 1024)))
+QR_CACHE_DISK_MAX_AGE_SECONDS = int(os.environ.get('QR_CACHE_DISK_MAX_AGE_SECONDS', str(30 * 24 * 3600)))
+QR_CACHE_PRUNE_SECONDS = int(os.environ.get('QR_CACHE_PRUNE_SECONDS', '3600'))
+QR_URL_TTL_SECONDS = int(os.environ.get('QR_URL_TTL_SECONDS', str(7 * 24 * 3600)))
+QR_ERROR_CORRECTION_LEVELS = {
+    "L": qrcode.constants.ERROR_CORRECT_L,
+    "M": qrcode.constants.ERROR_CORRECT_M,
+    "Q": qrcode.constants.ERROR_CORRECT_Q,
+    "H": qrcode.constants.ERROR_CORRECT_H
+}
+QR_KEY_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+QR_MAX_DATA_LENGTH = int(os.environ.get('QR_MAX_DATA_LENGTH', '1024'))
+QR_CACHED_NUMBER_PATTERN = re.compile(r"^\d+(?:/\d+){0,2}$")  # Номер груза или единицы груза
+
+class QRImageCache:
+    """Двухуровневый кэш PNG-изображений QR кодов (LRU в памяти + диск)"""
+    
+    def __init__(self, max_bytes: int, directory: Optional[str], disk_max_bytes: int, disk_max_age_seconds: int):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.disk_max_bytes = disk_max_bytes
+        self.disk_max_age_seconds = disk_max_age_seconds
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, bytes]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.renders = 0
+        self.disk_evictions = 0
+    
+    @staticmethod
+    def key(payload: str, box_size: int, border: int, error_correction: str) -> str:
+        raw = json.dumps([payload, box_size, border, error_correction], ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+    
+    def _path(self, key: str) -> Optional[str]:
+        return os.path.join(self.directory, key[:2], f"{key}.png") if self.directory else None
+    
+    def _remember(self, key: str, png: bytes):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+            self._entries[key] = png
+            self._bytes += len(png)
+            while self._bytes > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+    
+    def _render(self, payload: str, box_size: int, border: int, error_correction: str) -> bytes:
+        qr = qrcode.QRCode(
+            version=1,
+            error_correction=QR_ERROR_CORRECTION_LEVELS[error_correction],
+            box_size=box_size,
+            border=border,
+        )
+        qr.add_data(payload)
+        qr.make(fit=True)
+        img = qr.make_image(fill_color="black", back_color="white")
+        buffer = BytesIO()
+        img.save(buffer, format="PNG")
+        return buffer.getvalue()
+    
+    def lookup(self, key: str) -> Optional[bytes]:
+        """PNG по ключу из памяти или с диска (None, если еще не рендерился)"""
+        with self._lock:
+            png = self._entries.get(key)
+            if png is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return png
+        path = self._path(key)
+        if path and os.path.exists(path):
+            try:
+                with open(path, "rb") as f:
+                    png = f.read()
+                # Время изменения файла - время последнего чтения для вытеснения давно не читавшихся
+                os.utime(path)
+            except OSError:
+                return None
+            self.disk_hits += 1
+            self._remember(key, png)
+            return png
+        return None
+    
+    def png(self, payload: str, box_size: int = 10, border: int = 4, error_correction: str = "L", store: bool = True):
+        """(ключ, PNG) для QR кода; store=False для одноразовых данных (с отметкой времени)"""
+        key = self.key(payload, box_size, border, error_correction)
+        png = self.lookup(key) if store else None
+        if png is not None:
+            return key, png
+        
+        png = self._render(payload, box_size, border, error_correction)
+        self.renders += 1
+        if store:
+            self._remember(key, png)
+            path = self._path(key)
+            if path:
+                try:
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                    with open(tmp_path, "wb") as f:
+                        f.write(png)
+                    os.replace(tmp_path, path)
+                except OSError as e:
+                    print(f"⚠️ Не удалось сохранить QR в {path}: {e}")
+        return key, png
+    
+    def prune_disk(self) -> dict:
+        """Удалить с диска файлы старше disk_max_age_seconds, затем давно не читавшиеся сверх disk_max_bytes"""
+        if not self.directory or not os.path.isdir(self.directory):
+            return {"files": 0, "bytes": 0, "removed": 0}
+        expires_before = time.time() - self.disk_max_age_seconds
+        files = []
+        removed = 0
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    info = os.stat(path)
+                    if info.st_mtime < expires_before:
+                        os.remove(path)
+                        removed += 1
+                    else:
+                        files.append((info.st_mtime, info.st_size, path))
+                except OSError:
+                    continue
+        total = sum(size for _, size, _ in files)
+        files.sort()
+        while files and total > self.disk_max_bytes:
+            _, size, path = files.pop(0)
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        with self._lock:
+            self.disk_evictions += removed
+        return {"files": len(files), "bytes": total, "removed": removed}
+    
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "memory_items": len(self._entries),
+                "memory_bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "directory": self.directory,
+                "disk_max_bytes": self.disk_max_bytes,
+                "disk_max_age_seconds": self.disk_max_age_seconds,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "disk_evictions": self.disk_evictions,
+                "renders": self.renders
+            }
+
+qr_image_cache = QRImageCache(QR_CACHE_MEMORY_BYTES, QR_CACHE_DIR or None, QR_CACHE_DISK_MAX_BYTES, QR_CACHE_DISK_MAX_AGE_SECONDS)
+
+async def periodic_qr_cache_prune():
+    """Очистка дискового кэша QR каждые QR_CACHE_PRUNE_SECONDS"""
+    while True:
+        try:
+            report = await run_in_threadpool(qr_image_cache.prune_disk)
+            if report["removed"]:
+                print(f"🧹 Кэш QR: удалено {report['removed']} файлов, осталось {report['files']} ({report['bytes']} байт)")
+        except Exception as e:
+            print(f"❌ Ошибка очистки кэша QR: {str(e)}")
+        await asyncio.sleep(QR_CACHE_PRUNE_SECONDS)
+
+@app.on_event("startup")
+async def bootstrap_qr_cache_prune():
+    asyncio.create_task(periodic_qr_cache_prune())
+
+def qr_url_signature(key: str, expires: int) -> str:
+    return hmac.new(SECRET_KEY.encode(), f"{key}:{expires}".encode(), hashlib.sha256).hexdigest()
+
+def render_qr_base64(payload: str, box_size: int = 10, border: int = 4, error_correction: str = "L", store: bool = True) -> str:
+    """PNG QR кода в base64 (через кэш изображений)"""
+    _, png = qr_image_cache.png(payload, box_size, border, error_correction, store)
+    return base64.b64encode(png).decode()
+
+def render_qr_data_url(payload: str, box_size: int = 10, border: int = 4, error_correction: str = "L") -> str:
+    """QR код как data URL (через кэш изображений)"""
+    return f"data:image/png;base64,{render_qr_base64(payload, box_size, border, error_correction)}"
+
+def qr_image_url(payload: str, box_size: int = 10, border: int = 4, error_correction: str = "L") -> str:
+    """Подписанная ссылка на PNG QR кода в кэше: GET /api/qr/{key}.png, действует QR_URL_TTL_SECONDS.
+    
+    Параметры рендеринга входят в ссылку, чтобы PNG можно было отрисовать заново после вытеснения из кэша.
+    """
+    key, _ = qr_image_cache.png(payload, box_size, border, error_correction)
+    expires = int(time.time()) + QR_URL_TTL_SECONDS
+    query = urlencode({
+        "expires": expires,
+        "signature": qr_url_signature(key, expires),
+        "data": payload,
+        "box_size": box_size,
+        "border": border,
+        "ec": error_correction
+    })
+    return f"/api/qr/{key}.png?{query}"
+
+def qr_payload_is_cacheable(payload: str) -> bool:
+    """Сохранять ли PNG в кэш: только номера грузов и коды ячеек, а не произвольный текст"""
+    return bool(QR_CACHED_NUMBER_PATTERN.match(payload)) or classify_scan_payload(payload)[0] in SCAN_CELL_KINDS
+
 def generate_cargo_qr_code(cargo_data: dict) -> str:
     """Генерировать QR код для груза только с номером груза"""
     try:
@@ -1432,27 +2039,7 @@ def generate_cargo_qr_code(cargo_data: dict) -> str:
             raise ValueError("Cargo number is required for QR code generation")
         
         # QR код содержит только номер груза
-        qr_text = cargo_number
-        
-        # Генерируем QR код
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_L,
-            box_size=10,
-            border=4,
-        )
-        qr.add_data(qr_text)
-        qr.make(fit=True)
-        
-        # Создаем изображение
-        img = qr.make_image(fill_color="black", back_color="white")
-        
-        # Конвертируем в base64
-        buffer = BytesIO()
-        img.save(buffer, format="PNG")
-        img_data = base64.b64encode(buffer.getvalue()).decode()
-        
-        return f"data:image/png;base64,{img_data}"
+        return render_qr_data_url(cargo_number, box_size=10, border=4)
         
     except Exception as e:
         print(f"Error generating QR code for cargo: {e}")
@@ -1500,32 +2087,97 @@ def generate_warehouse_cell_qr_code(warehouse_data: dict, block: int, shelf: int
             cell_code = f"{warehouse_id}-Б{block}-П{shelf}-Я{cell}"
         
         # QR код содержит только код ячейки
-        qr_data = cell_code
-        
-        # Генерируем QR код
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_L,
-            box_size=8,
-            border=3,
-        )
-        qr.add_data(qr_data)
-        qr.make(fit=True)
-        
-        # Создаем изображение
-        img = qr.make_image(fill_color="black", back_color="white")
-        
-        # Конвертируем в base64
-        buffer = BytesIO()
-        img.save(buffer, format="PNG")
-        img_data = base64.b64encode(buffer.getvalue()).decode()
-        
-        return f"data:image/png;base64,{img_data}"
+        return render_qr_data_url(cell_code, box_size=8, border=3)
         
     except Exception as e:
         print(f"Error generating QR code for warehouse cell: {e}")
         return ""
 
+# Индекс привязок операторов к складам в памяти процесса.
+# Проверки доступа выполняются на каждый запрос оператора, а сами привязки меняются редко
+class OperatorWarehouseBindingIndex:
+    """Привязки оператор -> склады и склад -> операторы в памяти процесса.
+    
+    Загружается при старте и перечитывается после изменения привязок через invalidate().
+    Другие процессы узнают об изменениях по штампу версии в schema_meta, который
+    проверяется не чаще одного раза в check_interval секунд.
+    """
+    META_ID = "operator_warehouse_bindings"
+    
+    def __init__(self, database, check_interval: float):
+        self._collection = database.operator_warehouse_bindings
+        self._meta = database.schema_meta
+        self._lock = threading.Lock()
+        self._by_operator: Dict[str, Dict[str, dict]] = {}
+        self._by_warehouse: Dict[str, Dict[str, dict]] = {}
+        self._version = None
+        self._checked_at = 0.0
+        self.check_interval = check_interval
+    
+    def _read_version(self) -> int:
+        stamp = self._meta.find_one({"_id": self.META_ID}, {"version": 1})
+        return stamp.get("version", 0) if stamp else 0
+    
+    def reload(self):
+        """Полностью перечитать привязки из MongoDB"""
+        version = self._read_version()
+        by_operator: Dict[str, Dict[str, dict]] = {}
+        by_warehouse: Dict[str, Dict[str, dict]] = {}
+        for binding in self._collection.find({}, {"_id": 0}):
+            by_operator.setdefault(binding.get("operator_id"), {})[binding.get("warehouse_id")] = binding
+            by_warehouse.setdefault(binding.get("warehouse_id"), {})[binding.get("operator_id")] = binding
+        with self._lock:
+            self._by_operator = by_operator
+            self._by_warehouse = by_warehouse
+            self._version = version
+            self._checked_at = time.monotonic()
+    
+    def invalidate(self):
+        """Вызывать после любого изменения operator_warehouse_bindings"""
+        self._meta.update_one({"_id": self.META_ID}, {"$inc": {"version": 1}}, upsert=True)
+        self.reload()
+    
+    def _ensure_fresh(self):
+        if self._version is not None and time.monotonic() - self._checked_at < self.check_interval:
+            return
+        if self._version is None or self._read_version() != self._version:
+            self.reload()
+        else:
+            self._checked_at = time.monotonic()
+    
+    def warehouse_ids_for_operator(self, operator_id: str) -> List[str]:
+        self._ensure_fresh()
+        return list(self._by_operator.get(operator_id, {}).keys())
+    
+    def operator_ids_for_warehouse(self, warehouse_id: str) -> List[str]:
+        self._ensure_fresh()
+        return list(self._by_warehouse.get(warehouse_id, {}).keys())
+    
+    def bindings_for_operator(self, operator_id: str) -> List[dict]:
+        self._ensure_fresh()
+        return [dict(binding) for binding in self._by_operator.get(operator_id, {}).values()]
+    
+    def bindings_for_warehouse(self, warehouse_id: str) -> List[dict]:
+        self._ensure_fresh()
+        return [dict(binding) for binding in self._by_warehouse.get(warehouse_id, {}).values()]
+    
+    def is_bound(self, operator_id: str, warehouse_id: str) -> bool:
+        self._ensure_fresh()
+        return warehouse_id in self._by_operator.get(operator_id, {})
+
+operator_bindings = OperatorWarehouseBindingIndex(
+    db,
+    check_interval=float(os.environ.get('BINDING_CACHE_CHECK_SECONDS', '5'))
+)
+
+@app.on_event("startup")
+def load_operator_bindings():
+    """Загрузка привязок операторов к складам при старте сервера"""
+    try:
+        operator_bindings.reload()
+    except Exception as e:
+        print(f"❌ Ошибка загрузки привязок операторов: {str(e)}")
+
 def get_warehouses_by_route_for_notifications(route: str) -> list:
     """Определить склады по маршруту для отправки уведомлений"""
     route_lower = route.lower()
@@ -1561,12 +2213,10 @@ def get_operators_by_warehouses(warehouse_ids: list) -> list:
         return []
     
     # Находим привязки операторов к складам
-    bindings = db.operator_warehouse_bindings.find({
-        "warehouse_id": {"$in": warehouse_ids}
-    })
-    
-    operator_ids = list(set([binding["operator_id"] for binding in bindings]))
-    return operator_ids
+    operator_ids = set()
+    for warehouse_id in warehouse_ids:
+        operator_ids.update(operator_bindings.operator_ids_for_warehouse(warehouse_id))
+    return list(operator_ids)
 
 def create_notification(user_id, message, related_id=None):
     """Создание уведомления"""
@@ -1638,16 +2288,11 @@ def create_personal_notification(user_id: str, title: str, message: str, notific
 
 def get_operator_warehouse_ids(operator_id: str) -> list:
     """Получить список ID складов, привязанных к оператору"""
-    bindings = list(db.operator_warehouse_bindings.find({"operator_id": operator_id}))
-    return [b["warehouse_id"] for b in bindings]
+    return operator_bindings.warehouse_ids_for_operator(operator_id)
 
 def check_operator_warehouse_binding(operator_id: str, warehouse_id: str) -> bool:
     """Проверить, привязан ли оператор к складу"""
-    binding = db.operator_warehouse_bindings.find_one({
-        "operator_id": operator_id,
-        "warehouse_id": warehouse_id
-    })
-    return binding is not None
+    return operator_bindings.is_bound(operator_id, warehouse_id)
 
 def generate_request_number() -> str:
     """Генерировать номер заявки"""
@@ -1655,75 +2300,23 @@ def generate_request_number() -> str:
 
 def generate_courier_request_number() -> str:
     """Генерируем читаемый номер заявки курьера формата 100001, 100002, 100003..."""
-    try:
-        # Ищем последнюю заявку курьера с номером для определения следующего номера
-        last_request = db.courier_requests.find_one(
-            {"request_number": {"$regex": "^[0-9]{6}$"}},
-            sort=[("request_number", -1)]
-        )
-        
-        if last_request and last_request.get("request_number"):
-            # Получаем следующий номер
-            last_number = int(last_request["request_number"])
-            new_number = last_number + 1
-        else:
-            # Начинаем с номера 100001
-            new_number = 100001
-        
-        return f"{new_number:06d}"
-        
-    except Exception as e:
-        # В случае ошибки, генерируем случайный номер начиная с 100001
-        import random
-        return f"{random.randint(100001, 999999):06d}"
+    new_number = sequences.next_value(
+        "courier_request_number",
+        seed=lambda: max(100000, _max_numeric_suffix(["courier_requests"], "request_number", "", "[0-9]{6}"))
+    )
+    return f"{new_number:06d}"
 
 def generate_pickup_request_number() -> str:
     """Генерируем читаемый номер заявки на забор груза формата 200001, 200002, 200003..."""
-    try:
-        # Ищем последнюю заявку на забор груза с номером для определения следующего номера
-        last_request = db.courier_pickup_requests.find_one(
-            {"request_number": {"$regex": "^[0-9]{6}$"}},
-            sort=[("request_number", -1)]
-        )
-        
-        if last_request and last_request.get("request_number"):
-            # Получаем следующий номер
-            last_number = int(last_request["request_number"])
-            new_number = last_number + 1
-        else:
-            # Начинаем с номера 200001 для заявок на забор груза
-            new_number = 200001
-        
-        return f"{new_number:06d}"
-        
-    except Exception as e:
-        # В случае ошибки, генерируем случайный номер начиная с 200001
-        import random
-        return f"{random.randint(200001, 299999):06d}"
+    new_number = sequences.next_value(
+        "pickup_request_number",
+        seed=lambda: max(200000, _max_numeric_suffix(["courier_pickup_requests"], "request_number", "", "[0-9]{6}"))
+    )
+    return f"{new_number:06d}"
 
 def generate_readable_request_number() -> str:
-    """Генерируем читаемый номер заявки формата 100001, 100002, 100003..."""
-    try:
-        # Ищем последнюю заявку курьера с номером для определения следующего номера
-        last_request = db.courier_requests.find_one(
-            {"request_number": {"$regex": "^[0-9]{6}$"}},
-            sort=[("request_number", -1)]
-        )
-        
-        if last_request and last_request.get("request_number"):
-            # Получаем следующий номер
-            last_number = int(last_request["request_number"])
-            new_number = last_number + 1
-        else:
-            # Начинаем с номера 100001
-            new_number = 100001
-        
-        return f"{new_number:06d}"
-        
-    except Exception as e:
-        # В случае ошибки, генерируем случайный номер начиная с 100001
-        import random
-        return f"{random.randint(100001, 999999):06d}"
+    """Генерируем читаемый номер заявки формата 100001, 100002, 100003... (общая последовательность с заявками курьеров)"""
+    return generate_courier_request_number()
 
 def generate_warehouse_structure(warehouse_id: str, warehouse_id_number: str, blocks_count: int, shelves_per_block: int, cells_per_shelf: int):
     """Generate warehouse structure with blocks, shelves and cells using ID numbers"""
@@ -1796,18 +2389,9 @@ def generate_warehouse_structure(warehouse_id: str, warehouse_id_number: str, bl
     
     return len(cells)
 
-def get_operator_warehouses(operator_id: str) -> List[str]:
-    """Получить список складов, к которым привязан оператор"""
-    bindings = list(db.operator_warehouse_bindings.find({"operator_id": operator_id}))
-    return [binding["warehouse_id"] for binding in bindings]
-
 def is_operator_allowed_for_warehouse(operator_id: str, warehouse_id: str) -> bool:
     """Проверить, имеет ли оператор доступ к складу"""
-    binding = db.operator_warehouse_bindings.find_one({
-        "operator_id": operator_id, 
-        "warehouse_id": warehouse_id
-    })
-    return binding is not None
+    return operator_bindings.is_bound(operator_id, warehouse_id)
 
 def get_operator_name_by_id(operator_id: str) -> str:
     """Получить ФИО оператора по ID"""
@@ -1824,7 +2408,7 @@ def get_available_cargo_for_transport(operator_id: str = None, user_role: str =
         }
     elif user_role == UserRole.WAREHOUSE_OPERATOR and operator_id:
         # Операторы видят только грузы со своих складов
-        operator_warehouses = get_operator_warehouses(operator_id)
+        operator_warehouses = get_operator_warehouse_ids(operator_id)
         if not operator_warehouses:
             return []
         
@@ -1842,45 +2426,3903 @@ def get_available_cargo_for_transport(operator_id: str = None, user_role: str =
     
     return user_cargo + operator_cargo
 
-# API Routes
+# ЕДИНАЯ МОДЕЛЬ ЧТЕНИЯ ГРУЗОВ
+# Грузы хранятся в двух коллекциях (cargo - заказы клиентов, operator_cargo - принятые
+# оператором). Все чтения "найти груз где угодно" выполняются одним aggregate с $unionWith,
+# поэтому вместо двух последовательных find_one нужен один запрос к базе
+CARGO_COLLECTIONS = ("cargo", "operator_cargo")
+CARGO_UNIFIED_VIEW = "cargo_unified"
+CARGO_SOURCE_FIELD = "_collection"
+
+def _cargo_branch(collection_name: str, query: dict, projection: Optional[dict] = None, extra_stages: Optional[list] = None) -> list:
+    """Стадии выборки из одной коллекции грузов с пометкой коллекции-источника"""
+    stages = [{"$match": query}]
+    if extra_stages:
+        stages.extend(extra_stages)
+    if projection:
+        stages.append({"$project": projection})
+    stages.append({"$addFields": {CARGO_SOURCE_FIELD: collection_name}})
+    return stages
+
+def _cargo_union_pipeline(query: dict, projection: Optional[dict] = None, collections=CARGO_COLLECTIONS, extra_stages: Optional[list] = None) -> list:
+    """Pipeline для первой коллекции, остальные коллекции подключаются через $unionWith"""
+    pipeline = _cargo_branch(collections[0], query, projection, extra_stages)
+    for collection_name in collections[1:]:
+        pipeline.append({"$unionWith": {
+            "coll": collection_name,
+            "pipeline": _cargo_branch(collection_name, query, projection, extra_stages)
+        }})
+    return pipeline
+
+def locate_cargo(query: dict, projection: Optional[dict] = None, collections=CARGO_COLLECTIONS):
+    """Найти груз во всех коллекциях за один запрос. Возвращает (груз, имя коллекции) или (None, None)"""
+    pipeline = _cargo_union_pipeline(query, projection, collections, extra_stages=[{"$limit": 1}])
+    pipeline.append({"$limit": 1})
+    found = list(db[collections[0]].aggregate(pipeline))
+    if not found:
+        return None, None
+    cargo = found[0]
+    return cargo, cargo.pop(CARGO_SOURCE_FIELD)
+
+def find_cargo(query: dict, projection: Optional[dict] = None, collections=CARGO_COLLECTIONS) -> Optional[dict]:
+    """Найти груз в cargo или operator_cargo (приоритет - порядок collections)"""
+    cargo, _ = locate_cargo(query, projection, collections)
+    return cargo
 
-@app.get("/api/health")
-async def health_check():
-    return {"status": "ok"}
+def locate_cargo_many(field: str, values: list, projection: Optional[dict] = None, collections=CARGO_COLLECTIONS) -> Dict[str, tuple]:
+    """Найти грузы по списку значений поля одним запросом. Возвращает {значение: (груз, коллекция)}"""
+    if not values:
+        return {}
+    if projection and any(value for key, value in projection.items() if key != "_id"):
+        # Включающая проекция должна содержать поле, по которому сопоставляются результаты
+        projection = {**projection, field: 1}
+    found = {}
+    for cargo in db[collections[0]].aggregate(_cargo_union_pipeline({field: {"$in": list(values)}}, projection, collections)):
+        collection_name = cargo.pop(CARGO_SOURCE_FIELD)
+        # Первая коллекция в списке имеет приоритет, как и при последовательном поиске
+        found.setdefault(cargo.get(field), (cargo, collection_name))
+    return found
+
+def find_cargo_many(field: str, values: list, projection: Optional[dict] = None, collections=CARGO_COLLECTIONS) -> Dict[str, dict]:
+    """Найти грузы по списку значений поля одним запросом. Возвращает {значение: груз}"""
+    return {value: cargo for value, (cargo, _) in locate_cargo_many(field, values, projection, collections).items()}
+
+def encode_cargo_cursor(cargo: dict) -> str:
+    """Курсор пагинации по ключу сортировки (created_at, _id)"""
+    created_at = cargo.get("created_at")
+    payload = {
+        "created_at": created_at.isoformat() if isinstance(created_at, datetime) else None,
+        "oid": str(cargo["_id"])
+    }
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode()
 
-# Аутентификация
-@app.post("/api/auth/register")
-async def register(user_data: UserCreate):
-    # Проверка существования пользователя
-    if db.users.find_one({"phone": user_data.phone}):
-        raise HTTPException(status_code=400, detail="User with this phone already exists")
-    
-    # Создание пользователя с ролью по умолчанию USER (функция 3)
-    user_role = UserRole.USER  # Всегда USER для обычной регистрации
+def decode_cargo_cursor(cursor: str) -> dict:
+    """Условие $match для документов, идущих после курсора при сортировке created_at desc, _id desc"""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        oid = ObjectId(payload["oid"])
+        created_at = datetime.fromisoformat(payload["created_at"]) if payload.get("created_at") else None
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid pagination cursor")
+    
+    if created_at is None:
+        return {"created_at": None, "_id": {"$lt": oid}}
+    return {"$or": [
+        {"created_at": {"$lt": created_at}},
+        {"created_at": created_at, "_id": {"$lt": oid}},
+        {"created_at": None}
+    ]}
+
+def paginate_cargo(query: dict, page: int = 1, per_page: int = 25, cursor: Optional[str] = None, collections=CARGO_COLLECTIONS) -> dict:
+    """Объединенная пагинация грузов из нескольких коллекций, отсортированных по created_at desc.
+    
+    Каждая коллекция отдает не больше skip + per_page документов, после чего результаты
+    сливаются и сортируются в MongoDB. С cursor (из next_cursor предыдущей страницы)
+    skip не нужен вовсе.
+    """
+    sort_stage = {"$sort": {"created_at": -1, "_id": -1}}
+    branch_query = {"$and": [query, decode_cargo_cursor(cursor)]} if cursor else query
+    skip = 0 if cursor else (page - 1) * per_page
+    branch_limit = skip + per_page + 1
     
-    user_id = str(uuid.uuid4())
-    user_number = generate_user_number()  # Генерируем индивидуальный номер
-    token_version = 1  # Начальная версия токена
-    user = {
-        "id": user_id,
-        "user_number": user_number,  # Добавляем индивидуальный номер
-        "full_name": user_data.full_name,
-        "phone": user_data.phone,
-        "password": hash_password(user_data.password),
-        "role": user_role.value,  # Роль всегда USER
-        "is_active": True,
-        "token_version": token_version,  # Добавляем версию токена
-        "created_at": datetime.utcnow()
-    }
+    pipeline = _cargo_union_pipeline(branch_query, None, collections, extra_stages=[sort_stage, {"$limit": branch_limit}])
+    pipeline.extend([sort_stage, {"$skip": skip}, {"$limit": per_page + 1}])
+    items = list(db[collections[0]].aggregate(pipeline))
     
-    db.users.insert_one(user)
+    has_more = len(items) > per_page
+    items = items[:per_page]
+    total_count = sum(db[collection_name].count_documents(query) for collection_name in collections)
     
-    # Создание токена
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_user_token(
-        user_id=user_id,
-        phone=user_data.phone,
-        token_version=1,  # Новые пользователи начинают с версии 1
+    return {
+        "items": items,
+        "total_count": total_count,
+        "next_cursor": encode_cargo_cursor(items[-1]) if has_more and items else None
+    }
+
+def ensure_cargo_unified_view():
+    """Создать представление cargo_unified (cargo + operator_cargo) для отчетов и миграции"""
+    pipeline = [{"$addFields": {CARGO_SOURCE_FIELD: "cargo"}}, {"$unionWith": {
+        "coll": "operator_cargo",
+        "pipeline": [{"$addFields": {CARGO_SOURCE_FIELD: "operator_cargo"}}]
+    }}]
+    if CARGO_UNIFIED_VIEW in db.list_collection_names(filter={"name": CARGO_UNIFIED_VIEW}):
+        db.command("collMod", CARGO_UNIFIED_VIEW, viewOn="cargo", pipeline=pipeline)
+    else:
+        db.command("create", CARGO_UNIFIED_VIEW, viewOn="cargo", pipeline=pipeline)
+
+@app.on_event("startup")
+def bootstrap_cargo_unified_view():
+    """Создание представления cargo_unified при старте сервера"""
+    try:
+        ensure_cargo_unified_view()
+    except Exception as e:
+        print(f"❌ Ошибка создания представления {CARGO_UNIFIED_VIEW}: {str(e)}")
+
+@app.get("/api/admin/cargo/unified/conflicts")
+def get_cargo_unification_conflicts(
+    limit: int = 100,
+    current_user: User = Depends(require_role(UserRole.ADMIN))
+):
+    """Миграция к единой коллекции: номера и ID грузов, которые есть одновременно в cargo и operator_cargo.
+    
+    Пока список не пуст, коллекции нельзя слить в одну с уникальными индексами.
+    """
+    conflicts = {}
+    for field in ("cargo_number", "id"):
+        conflicts[field] = [
+            doc[field] for doc in db.cargo.aggregate([
+                {"$match": {field: {"$exists": True}}},
+                {"$project": {"_id": 0, field: 1}},
+                {"$lookup": {"from": "operator_cargo", "localField": field, "foreignField": field, "as": "duplicates"}},
+                {"$match": {"duplicates.0": {"$exists": True}}},
+                {"$project": {field: 1}},
+                {"$limit": max(1, min(limit, 1000))}
+            ])
+        ]
+    
+    return {
+        "view": CARGO_UNIFIED_VIEW,
+        "cargo_count": db.cargo.estimated_document_count(),
+        "operator_cargo_count": db.operator_cargo.estimated_document_count(),
+        "duplicate_cargo_numbers": conflicts["cargo_number"],
+        "duplicate_ids": conflicts["id"],
+        "ready_to_merge": not conflicts["cargo_number"] and not conflicts["id"]
+    }
+
+# ПАКЕТНАЯ ЗАГРУЗКА СВЯЗАННЫХ СУЩНОСТЕЙ
+# Списки грузов/складов/пользователей обогащаются данными пользователей и складов.
+# Вместо find_one на каждую строку идентификаторы страницы собираются заранее (prime),
+# и каждый тип сущности загружается одним запросом с $in. Загрузчики живут один запрос
+# (Depends(get_request_loaders) кэшируется FastAPI в пределах запроса) и служат его мемо.
+
+class EntityLoader:
+    """Загрузчик документов коллекции по ключевому полю с пакетированием и мемоизацией"""
+    
+    def __init__(self, collection, key: str = "id", projection: Optional[dict] = None):
+        self.collection = collection
+        self.key = key
+        self.projection = projection
+        self._cache: Dict[Any, Optional[dict]] = {}
+        self._pending: Set[Any] = set()
+        self.round_trips = 0
+    
+    def prime(self, *ids):
+        """Запомнить идентификаторы для загрузки следующим пакетом"""
+        for entity_id in ids:
+            if entity_id and entity_id not in self._cache:
+                self._pending.add(entity_id)
+    
+    def _load_pending(self):
+        if not self._pending:
+            return
+        ids = list(self._pending)
+        self._pending.clear()
+        self.round_trips += 1
+        found = {doc[self.key]: doc for doc in self.collection.find({self.key: {"$in": ids}}, self.projection)}
+        for entity_id in ids:
+            self._cache[entity_id] = found.get(entity_id)
+    
+    def get(self, entity_id) -> Optional[dict]:
+        """Документ по идентификатору (None, если не найден)"""
+        if not entity_id:
+            return None
+        if entity_id not in self._cache:
+            self._pending.add(entity_id)
+            self._load_pending()
+        return self._cache.get(entity_id)
+    
+    def get_many(self, ids) -> Dict[Any, dict]:
+        """Найденные документы по списку идентификаторов"""
+        self.prime(*ids)
+        self._load_pending()
+        return {entity_id: self._cache[entity_id] for entity_id in ids if entity_id and self._cache.get(entity_id)}
+
+class RequestLoaders:
+    """Загрузчики пользователей, складов и транспортов на время одного запроса"""
+    
+    def __init__(self, database):
+        self.users = EntityLoader(database.users, projection={"_id": 0, "password": 0})
+        self.warehouses = EntityLoader(database.warehouses, projection={"_id": 0})
+        self.transports = EntityLoader(database.transports, projection={"_id": 0})
+
+def count_by_field(collection, field: str, values: list, extra_query: Optional[dict] = None) -> Dict[Any, int]:
+    """Количество документов на каждое значение поля одним $group вместо count_documents на строку"""
+    if not values:
+        return {}
+    match = {field: {"$in": list(values)}, **(extra_query or {})}
+    return {row["_id"]: row["count"] for row in collection.aggregate([
+        {"$match": match},
+        {"$group": {"_id": f"${field}", "count": {"$sum": 1}}}
+    ])}
+
+def get_request_loaders() -> RequestLoaders:
+    """Зависимость FastAPI: новые загрузчики на каждый запрос"""
+    return RequestLoaders(db)
+
+# Индексы MongoDB для горячих коллекций
+# При изменении набора индексов нужно увеличить INDEX_SET_VERSION: при старте
+# сервер создаст недостающие индексы и удалит устаревшие индексы с префиксом tl_.
+# Пока версия в schema_meta совпадает с объявленной, сверка не выполняется.
+# Если уникальный индекс нельзя построить из-за дубликатов, вместо него создается
+# обычный индекс с суффиксом INDEX_FALLBACK_SUFFIX; уникальный пробуется снова
+# при следующей смене версии. Поле expire_after создает TTL-индекс (expireAfterSeconds).
+INDEX_SET_VERSION = 10
+INDEX_NAME_PREFIX = "tl_"
+INDEX_FALLBACK_SUFFIX = "_nonunique"
+
+CARGO_COLLECTION_INDEXES = [
+    {"name": "tl_cargo_number_unique", "keys": [("cargo_number", 1)], "unique": True, "partial": {"cargo_number": {"$exists": True}}},
+    {"name": "tl_id_unique", "keys": [("id", 1)], "unique": True, "partial": {"id": {"$exists": True}}},
+    {"name": "tl_warehouse_id", "keys": [("warehouse_id", 1)]},
+    {"name": "tl_created_by", "keys": [("created_by", 1)]},
+    {"name": "tl_sender_id", "keys": [("sender_id", 1)]},
+    {"name": "tl_placed_by", "keys": [("placed_by", 1)]},
+    {"name": "tl_status_created_at", "keys": [("status", 1), ("created_at", -1)]},
+    {"name": "tl_individual_number", "keys": [("cargo_items.individual_items.individual_number", 1)]},
+    {"name": "tl_sender_phone_key", "keys": [("sender_phone_key", 1)]},
+    {"name": "tl_sender_phone_rkey", "keys": [("sender_phone_rkey", 1)]},
+    {"name": "tl_recipient_phone_key", "keys": [("recipient_phone_key", 1)]},
+    {"name": "tl_recipient_phone_rkey", "keys": [("recipient_phone_rkey", 1)]},
+]
+
+INDEX_DEFINITIONS = {
+    "cargo": CARGO_COLLECTION_INDEXES,
+    "operator_cargo": CARGO_COLLECTION_INDEXES,
+    "users": [
+        {"name": "tl_phone_key", "keys": [("phone_key", 1)]},
+        {"name": "tl_phone_rkey", "keys": [("phone_rkey", 1)]},
+    ],
+    "couriers": [
+        {"name": "tl_phone_key", "keys": [("phone_key", 1)]},
+        {"name": "tl_phone_rkey", "keys": [("phone_rkey", 1)]},
+    ],
+    "debts": [
+        {"name": "tl_debtor_phone_key", "keys": [("debtor_phone_key", 1)]},
+        {"name": "tl_debtor_phone_rkey", "keys": [("debtor_phone_rkey", 1)]},
+    ],
+    "warehouse_cells": [
+        {"name": "tl_cell_id_numbers", "keys": [("warehouse_id_number", 1), ("block_id_number", 1), ("shelf_id_number", 1), ("cell_id_number", 1)]},
+        {"name": "tl_warehouse_location", "keys": [("warehouse_id", 1), ("location_code", 1)]},
+        {"name": "tl_warehouse_occupied", "keys": [("warehouse_id", 1), ("is_occupied", 1)]},
+        {"name": "tl_cargo_id", "keys": [("cargo_id", 1)]},
+        {"name": "tl_placed_by_placed_at", "keys": [("placed_by", 1), ("placed_at", -1)]},
+    ],
+    "operator_warehouse_bindings": [
+        {"name": "tl_id_unique", "keys": [("id", 1)], "unique": True, "partial": {"id": {"$exists": True}}},
+        {"name": "tl_operator_id", "keys": [("operator_id", 1)]},
+        {"name": "tl_warehouse_id", "keys": [("warehouse_id", 1)]},
+    ],
+    "courier_locations": [
+        {"name": "tl_courier_id_unique", "keys": [("courier_id", 1)], "unique": True, "partial": {"courier_id": {"$exists": True}}},
+        {"name": "tl_status", "keys": [("status", 1)]},
+        {"name": "tl_location_2dsphere", "keys": [("location", "2dsphere")]},
+    ],
+    "courier_location_history": [
+        {"name": "tl_courier_timestamp", "keys": [("courier_id", 1), ("timestamp", -1)]},
+    ],
+    "notifications": [
+        {"name": "tl_user_created_at", "keys": [("user_id", 1), ("created_at", -1)]},
+        {"name": "tl_id", "keys": [("id", 1)]},
+    ],
+    "stats_phone_refs": [
+        {"name": "tl_scope_role", "keys": [("scope", 1), ("role", 1)]},
+    ],
+    "placement_history": [
+        {"name": "tl_session_placed_by", "keys": [("session_id", 1), ("placed_by_id", 1), ("placement_timestamp", -1)]},
+        {"name": "tl_placed_by_timestamp", "keys": [("placed_by_id", 1), ("placement_timestamp", -1)]},
+        {"name": "tl_id", "keys": [("id", 1)]},
+    ],
+    "placement_records": [
+        {"name": "tl_individual_number", "keys": [("individual_number", 1)]},
+    ],
+    "search_index": [
+        {"name": "tl_entity_grams", "keys": [("entity", 1), ("grams", 1)]},
+        {"name": "tl_entity_words", "keys": [("entity", 1), ("words", 1)]},
+        {"name": "tl_synced_at", "keys": [("synced_at", 1)]},
+    ],
+    "courier_daily_rollups": [
+        {"name": "tl_courier_date", "keys": [("courier_id", 1), ("date", 1)]},
+    ],
+    "cargo_units": [
+        {"name": "tl_individual_number", "keys": [("individual_number", 1)]},
+        {"name": "tl_cargo_id", "keys": [("cargo_id", 1)]},
+        {"name": "tl_awaiting_order", "keys": [("awaiting_placement", 1), ("cargo_number", 1), ("source_collection", 1), ("item_index", 1), ("unit_position", 1)]},
+        {"name": "tl_synced_at", "keys": [("synced_at", 1)]},
+    ],
+    "scan_token_uses": [
+        {"name": "tl_expires_at_ttl", "keys": [("expires_at", 1)], "expire_after": 0},
+    ],
+    "search_suggestion_deltas": [
+        {"name": "tl_created_at_ttl", "keys": [("created_at", 1)], "expire_after": 86400},
+    ],
+    "gps_point_claims": [
+        {"name": "tl_claimed_at_ttl", "keys": [("claimed_at", 1)], "expire_after": 604800},
+    ],
+}
+
+def _index_matches(existing: dict, definition: dict) -> bool:
+    """Совпадает ли существующий индекс с объявленным (ключи, уникальность, частичный фильтр, TTL)"""
+    existing_keys = [
+        (field, direction if isinstance(direction, str) else int(direction))
+        for field, direction in existing.get("key", [])
+    ]
+    return (
+        existing_keys == definition["keys"]
+        and bool(existing.get("unique", False)) == bool(definition.get("unique", False))
+        and existing.get("partialFilterExpression") == definition.get("partial")
+        and existing.get("expireAfterSeconds") == definition.get("expire_after")
+    )
+
+def _fallback_definition(definition: dict) -> dict:
+    """Обычный индекс вместо уникального, который не удалось построить из-за дубликатов"""
+    return {"name": definition["name"] + INDEX_FALLBACK_SUFFIX, "keys": definition["keys"]}
+
+def _create_declared_index(collection, definition: dict):
+    """Создать индекс по описанию из INDEX_DEFINITIONS"""
+    options = {"name": definition["name"], "unique": bool(definition.get("unique", False))}
+    if options["unique"] and definition.get("partial"):
+        options["partialFilterExpression"] = definition["partial"]
+    if definition.get("expire_after") is not None:
+        options["expireAfterSeconds"] = definition["expire_after"]
+    collection.create_index(definition["keys"], **options)
+
+def ensure_indexes(force: bool = False) -> dict:
+    """Создать недостающие индексы, пересоздать измененные и удалить устаревшие индексы tl_*.
+    
+    Без force ничего не делает, если набор индексов текущей версии уже применен.
+    """
+    meta = db.schema_meta.find_one({"_id": "indexes"}, {"version": 1}) or {}
+    if not force and meta.get("version") == INDEX_SET_VERSION:
+        return {"version": INDEX_SET_VERSION, "skipped": True, "created": [], "dropped": [], "errors": []}
+    
+    report = {"version": INDEX_SET_VERSION, "created": [], "dropped": [], "errors": []}
+    
+    for collection_name, definitions in INDEX_DEFINITIONS.items():
+        collection = db[collection_name]
+        existing_indexes = collection.index_information()
+        declared = {definition["name"]: definition for definition in definitions}
+        fallbacks = {
+            _fallback_definition(definition)["name"]: _fallback_definition(definition)
+            for definition in definitions if definition.get("unique")
+        }
+        
+        # Удаляем устаревшие и измененные индексы, созданные этим механизмом;
+        # запасной обычный индекс остается, пока не построен уникальный
+        for index_name, index_info in list(existing_indexes.items()):
+            if not index_name.startswith(INDEX_NAME_PREFIX):
+                continue
+            definition = declared.get(index_name) or fallbacks.get(index_name)
+            if definition is None or not _index_matches(index_info, definition):
+                collection.drop_index(index_name)
+                existing_indexes.pop(index_name)
+                report["dropped"].append(f"{collection_name}.{index_name}")
+        
+        for definition in definitions:
+            fallback = _fallback_definition(definition)
+            if definition["name"] not in existing_indexes:
+                try:
+                    _create_declared_index(collection, definition)
+                    report["created"].append(f"{collection_name}.{definition['name']}")
+                except OperationFailure as e:
+                    # Дубликаты в данных не должны ломать запуск: создаем обычный индекс
+                    # под отдельным именем, чтобы запросы не делали COLLSCAN, и сообщаем о проблеме
+                    report["errors"].append(f"{collection_name}.{definition['name']}: {str(e)}")
+                    if not definition.get("unique") or fallback["name"] in existing_indexes:
+                        continue
+                    try:
+                        _create_declared_index(collection, fallback)
+                        report["created"].append(f"{collection_name}.{fallback['name']}")
+                    except OperationFailure as fallback_error:
+                        report["errors"].append(f"{collection_name}.{fallback['name']}: {str(fallback_error)}")
+                    continue
+            if definition.get("unique") and fallback["name"] in existing_indexes:
+                collection.drop_index(fallback["name"])
+                report["dropped"].append(f"{collection_name}.{fallback['name']}")
+    
+    db.schema_meta.update_one(
+        {"_id": "indexes"},
+        {"$set": {"version": INDEX_SET_VERSION, "applied_at": datetime.utcnow(), "errors": report["errors"]}},
+        upsert=True
+    )
+    return report
+
+@app.on_event("startup")
+def bootstrap_indexes():
+    """Сверка индексов при старте сервера"""
+    try:
+        # Коллекция истории GPS создается как time-series до того, как индекс создаст ее обычной
+        print(f"🛰️ Коллекция истории GPS: {ensure_gps_history_collection()}")
+    except Exception as e:
+        print(f"❌ Ошибка создания коллекции истории GPS: {str(e)}")
+    try:
+        report = ensure_indexes()
+        if report.get("skipped"):
+            print(f"🗂️ Индексы v{report['version']} уже применены")
+            return
+        print(f"🗂️ Индексы v{report['version']}: создано {len(report['created'])}, удалено {len(report['dropped'])}, ошибок {len(report['errors'])}")
+        for error in report["errors"]:
+            print(f"⚠️ Ошибка индекса: {error}")
+    except Exception as e:
+        print(f"❌ Ошибка создания индексов: {str(e)}")
+
+# Типовые запросы маршрутов для проверки планов выполнения (explain)
+INDEX_ADVISOR_QUERIES = [
+    {"route": "POST /api/cargo/scan-qr", "collection": "cargo", "filter": {"cargo_number": "0"}},
+    {"route": "POST /api/cargo/scan-qr", "collection": "operator_cargo", "filter": {"cargo_number": "0"}},
+    {"route": "GET /api/operator/cargo/{cargo_id}/full-info", "collection": "operator_cargo", "filter": {"id": "0"}},
+    {"route": "GET /api/operator/cargo/list", "collection": "operator_cargo", "filter": {"warehouse_id": {"$in": ["0"]}}, "sort": [("created_at", -1)]},
+    {"route": "GET /api/cargo/my", "collection": "cargo", "filter": {"sender_id": "0"}},
+    {"route": "POST /api/scan", "collection": "operator_cargo", "filter": {"cargo_items.individual_items.individual_number": "0"}},
+    {"route": "POST /api/operator/qr/generate-batch", "collection": "cargo_units", "filter": {"individual_number": {"$in": ["0"]}}},
+    {"route": "GET /api/operator/cargo/{cargo_id}/placement-status", "collection": "cargo_units", "filter": {"cargo_id": "0"}},
+    {"route": "GET /api/operator/cargo/individual-units-for-placement", "collection": "cargo_units", "filter": {"awaiting_placement": True}, "sort": [("cargo_number", 1), ("source_collection", 1), ("item_index", 1), ("unit_position", 1)]},
+    {"route": "GET /api/cargo/search", "collection": "search_index", "filter": {"entity": "cargo", "grams": {"$all": ["number:000"]}}},
+    {"route": "GET /api/cargo/search", "collection": "search_index", "filter": {"entity": "cargo", "words": {"$regex": "^number:0"}}},
+    {"route": "GET /api/cashier/search-by-phone", "collection": "operator_cargo", "filter": {"recipient_phone_rkey": {"$regex": "^0000"}}},
+    {"route": "POST /api/auth/login", "collection": "users", "filter": {"phone_key": "0"}},
+    {"route": "POST /api/cargo/place-in-cell", "collection": "warehouse_cells", "filter": {"warehouse_id_number": "0", "block_id_number": "0", "shelf_id_number": "0", "cell_id_number": "0"}},
+    {"route": "POST /api/cargo/place-in-cell", "collection": "warehouse_cells", "filter": {"warehouse_id": "0", "location_code": "0", "is_occupied": True}},
+    {"route": "GET /api/operator/placement-statistics", "collection": "warehouse_cells", "filter": {"placed_by": "0"}},
+    {"route": "operator warehouse access checks", "collection": "operator_warehouse_bindings", "filter": {"operator_id": "0"}},
+    {"route": "POST /api/courier/location/update", "collection": "courier_locations", "filter": {"courier_id": "0"}},
+    {"route": "GET /api/couriers/nearest", "collection": "courier_locations", "filter": {"location": {"$near": {"$geometry": {"type": "Point", "coordinates": [68.78, 38.56]}}}, "status": {"$ne": "offline"}}},
+    {"route": "GET /api/admin/couriers/{courier_id}/history", "collection": "courier_location_history", "filter": {"courier_id": "0"}, "sort": [("timestamp", -1)]},
+    {"route": "GET /api/notifications", "collection": "notifications", "filter": {"user_id": "0"}, "sort": [("created_at", -1)]},
+    {"route": "DELETE /api/operator/placement/undo-last", "collection": "placement_history", "filter": {"session_id": "0", "placed_by_id": "0"}, "sort": [("placement_timestamp", -1)]},
+]
+
+def _collect_plan_stages(plan: dict) -> List[str]:
+    """Собрать все стадии плана выполнения (включая вложенные)"""
+    if not isinstance(plan, dict):
+        return []
+    stages = [plan["stage"]] if "stage" in plan else []
+    for key in ("inputStage", "queryPlan"):
+        stages.extend(_collect_plan_stages(plan.get(key)))
+    for child in plan.get("inputStages", []):
+        stages.extend(_collect_plan_stages(child))
+    return stages
+
+@app.post("/api/admin/indexes/apply")
+def apply_indexes(current_user: User = Depends(require_role(UserRole.ADMIN))):
+    """Принудительно сверить индексы с INDEX_DEFINITIONS (например, после ручного удаления дубликатов)"""
+    return ensure_indexes(force=True)
+
+@app.get("/api/admin/indexes/advisor")
+def get_index_advisor_report(current_user: User = Depends(require_role(UserRole.ADMIN))):
+    """Проверить через explain(), какие типовые запросы маршрутов все еще выполняют COLLSCAN"""
+    results = []
+    for query in INDEX_ADVISOR_QUERIES:
+        cursor = db[query["collection"]].find(query["filter"])
+        if query.get("sort"):
+            cursor = cursor.sort(query["sort"])
+        try:
+            plan = cursor.explain().get("queryPlanner", {}).get("winningPlan", {})
+        except OperationFailure as e:
+            results.append({"route": query["route"], "collection": query["collection"], "error": str(e)})
+            continue
+        stages = _collect_plan_stages(plan)
+        results.append({
+            "route": query["route"],
+            "collection": query["collection"],
+            "filter_fields": list(query["filter"].keys()),
+            "stages": stages,
+            "collscan": "COLLSCAN" in stages
+        })
+    
+    meta = db.schema_meta.find_one({"_id": "indexes"}) or {}
+    return {
+        "declared_version": INDEX_SET_VERSION,
+        "applied_version": meta.get("version"),
+        "applied_at": meta.get("applied_at"),
+        "index_errors": meta.get("errors", []),
+        "collscan_queries": [r for r in results if r.get("collscan")],
+        "queries": results
+    }
+
+# ==================== ЗАПОЛНЕНИЕ ПРОИЗВОДНЫХ ДАННЫХ ====================
+# Производные коллекции и поля (cargo_units, search_index, ключи телефонов, сводки
+# треков, поля подбора курьеров) поддерживаются подписками на изменения, а при смене
+# версии заполняются backfill'ом. BackfillState хранит отчет заполнения в schema_meta
+# {"_id": <имя>}, а захват запуска - в {"_id": "<имя>_lock"}: запуск выполняет один
+# воркер. При ошибке захват снимается, захват процесса, упавшего посреди заполнения,
+# перехватывается через BACKFILL_CLAIM_STALE_SECONDS. Незаполненные данные
+# повторно пробуются каждые BACKFILL_RETRY_SECONDS; пока данные не заполнены,
+# чтения идут по исходным коллекциям. Ошибка подписчика помечает его данные для
+# пересборки (dirty_at), и они заполняются заново при следующей попытке.
+
+BACKFILL_CLAIM_STALE_SECONDS = int(os.environ.get('BACKFILL_CLAIM_STALE_SECONDS', '1800'))
+BACKFILL_RETRY_SECONDS = int(os.environ.get('BACKFILL_RETRY_SECONDS', '300'))
+BACKFILL_BUILT_CACHE_SECONDS = 30
+
+class BackfillState:
+    """Версия, готовность и захват заполнения производных данных в schema_meta"""
+    
+    def __init__(self, meta, name: str, version: int, stale_seconds: int = BACKFILL_CLAIM_STALE_SECONDS):
+        self.meta = meta
+        self.name = name
+        self.version = version
+        self.stale_seconds = stale_seconds
+        self._built_until = 0.0
+        self._started_at = None
+    
+    @property
+    def lock_id(self) -> str:
+        return f"{self.name}_lock"
+    
+    def is_built(self) -> bool:
+        """Заполнены ли данные текущей версии и не помечены ли они для пересборки
+        (положительный ответ кэшируется на BACKFILL_BUILT_CACHE_SECONDS)"""
+        if self._built_until > time.monotonic():
+            return True
+        meta = self.meta.find_one({"_id": self.name}, {"version": 1, "dirty_at": 1})
+        if not meta or meta.get("version") != self.version or meta.get("dirty_at"):
+            return False
+        self._built_until = time.monotonic() + BACKFILL_BUILT_CACHE_SECONDS
+        return True
+    
+    def mark_built(self, report: dict):
+        """Сохранить отчет заполнения текущей версии.
+        
+        Пометка для пересборки снимается, только если она поставлена до начала заполнения.
+        """
+        self.meta.update_one({"_id": self.name}, {"$set": dict(report, version=self.version)}, upsert=True)
+        self.meta.update_one(
+            {"_id": self.name, "dirty_at": {"$lte": self._started_at or datetime.utcnow()}},
+            {"$unset": {"dirty_at": "", "dirty_reason": ""}}
+        )
+        self._built_until = 0.0
+    
+    def mark_dirty(self, reason: str):
+        """Пометить данные для пересборки: до ее окончания чтения идут по исходным коллекциям"""
+        self.meta.update_one(
+            {"_id": self.name},
+            {"$set": {"dirty_at": datetime.utcnow(), "dirty_reason": reason}},
+            upsert=True
+        )
+        self._built_until = 0.0
+    
+    def claim(self, run_key: Optional[str] = None) -> bool:
+        """Захватить запуск run_key (по умолчанию - заполнение текущей версии) для одного воркера.
+        
+        Завершенный запуск с тем же ключом повторно не захватывается; запуск, завершившийся
+        ошибкой или не завершенный за stale_seconds, перехватывается.
+        """
+        run_key = run_key or f"v{self.version}"
+        now = datetime.utcnow()
+        try:
+            result = self.meta.update_one(
+                {"_id": self.lock_id, "$or": [
+                    {"run_key": {"$ne": run_key}, "state": {"$ne": "running"}},
+                    {"state": "failed"},
+                    {"state": "running", "claimed_at": {"$lt": now - timedelta(seconds=self.stale_seconds)}}
+                ]},
+                {"$set": {"run_key": run_key, "state": "running", "claimed_at": now}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            return False
+        return bool(result.modified_count or result.upserted_id)
+    
+    def _finish(self, run_key: str, state: str, **fields):
+        self.meta.update_one(
+            {"_id": self.lock_id, "run_key": run_key},
+            {"$set": dict(fields, state=state, finished_at=datetime.utcnow())}
+        )
+    
+    def run(self, job, run_key: Optional[str] = None):
+        """Выполнить job под захватом; None - запуск уже выполняет или выполнил другой воркер"""
+        run_key = run_key or f"v{self.version}"
+        if not self.claim(run_key):
+            return None
+        self._started_at = datetime.utcnow()
+        try:
+            result = job()
+        except Exception as e:
+            self._finish(run_key, "failed", error=str(e))
+            raise
+        self._finish(run_key, "done")
+        return result
+    
+    def ensure(self, backfill):
+        """Заполнить данные, если текущая версия еще не заполнена или помечена для пересборки"""
+        if self.is_built():
+            return None
+        meta = self.meta.find_one({"_id": self.name}, {"version": 1, "dirty_at": 1}) or {}
+        run_key = f"v{self.version}"
+        if meta.get("version") == self.version and meta.get("dirty_at"):
+            run_key = f"{run_key}:{meta['dirty_at'].isoformat()}"
+        return self.run(backfill, run_key)
+
+# Зарегистрированные заполнения: (состояние, функция заполнения, название для журнала)
+DERIVED_BACKFILLS: List[tuple] = []
+
+def register_backfill(state: BackfillState, backfill, label: str):
+    DERIVED_BACKFILLS.append((state, backfill, label))
+
+def ensure_backfills():
+    """Заполнить все производные данные, текущая версия которых еще не заполнена"""
+    for state, backfill, label in DERIVED_BACKFILLS:
+        try:
+            state.ensure(backfill)
+        except Exception as e:
+            print(f"❌ Ошибка заполнения ({label}): {str(e)}")
+
+async def periodic_backfill_retry():
+    """Повторять незавершенные заполнения каждые BACKFILL_RETRY_SECONDS"""
+    while True:
+        await run_in_threadpool(ensure_backfills)
+        await asyncio.sleep(BACKFILL_RETRY_SECONDS)
+
+@app.on_event("startup")
+async def bootstrap_backfills():
+    """Запустить заполнение производных данных в фоне: до его окончания чтения идут по исходным коллекциям"""
+    asyncio.create_task(periodic_backfill_retry())
+
+# ==================== СЧЕТЧИКИ ДАШБОРДОВ ====================
+# Коллекция stats_counters хранит готовые счетчики в документах "global",
+# "warehouse:<id>" и "operator:<id>". Они поддерживаются на каждой записи в cargo,
+# operator_cargo, warehouse_cells и transports (подписка через ChangeTrackedDatabase):
+# вклад документа "до" вычитается, вклад документа "после" прибавляется.
+# Дашборды читают O(1) документов; пока счетчики не построены или помечены для
+# пересборки, они считаются по исходным коллекциям. Ночная сверка пересчитывает
+# все с нуля, исправляет расхождения условными записями (не затирая живые $inc)
+# и сохраняет отчет в schema_meta {"_id": "stats_reconcile"}.
+
+STATS_GLOBAL_SCOPE = "global"
+STATS_RECONCILE_HOUR_UTC = int(os.environ.get('STATS_RECONCILE_HOUR_UTC', '3'))
+STATS_PLACEMENT_DAYS_KEPT = int(os.environ.get('STATS_PLACEMENT_DAYS_KEPT', '7'))
+STATS_DRIFT_TOLERANCE = 0.01
+
+STATS_CARGO_FIELDS = [
+    "warehouse_id", "created_by", "weight", "declared_value", "total_cost", "status", "processing_status",
+    "payment_method", "payment_status", "sender_phone", "recipient_phone", "destination_warehouse_id",
+    "destination_city", "recipient_address", "recipient_name", "recipient_full_name", "route"
+]
+STATS_CELL_FIELDS = ["warehouse_id", "is_occupied", "placed_by", "placed_at"]
+STATS_TRANSPORT_FIELDS = ["status", "direction", "source_warehouse_id", "destination_warehouse_id"]
+
+ACTIVE_TRANSPORT_STATUSES = ["loading", "in_transit", "active"]
+# Статусы, по которым /api/warehouses/{id}/statistics считает грузы "на складе"
+WAREHOUSE_STOCK_STATUSES = {
+    "cargo": ["awaiting_placement", "in_transit", "ready_for_delivery"],
+    "operator_cargo": ["IN_TRANSIT", "READY_FOR_DELIVERY"]
+}
+DESTINATION_ADDRESS_CITIES = [
+    (("москв", "moscow"), "Москва"),
+    (("душанбе", "dushanbe"), "Душанбе"),
+    (("худжанд", "khujand"), "Худжанд"),
+    (("кулоб", "kulob"), "Кулоб"),
+    (("курган", "kurgan"), "Курган-Тюбе")
+]
+
+def _stats_key(value) -> str:
+    """Значение как безопасный сегмент имени поля MongoDB"""
+    return str(value).replace(".", "_").replace("$", "_") or "unknown"
+
+def _stats_float(value) -> float:
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return 0.0
+
+def _cargo_stats_value(cargo: dict) -> float:
+    """Стоимость груза: объявленная, иначе расчетная"""
+    if cargo.get("declared_value"):
+        return _stats_float(cargo.get("declared_value"))
+    if cargo.get("total_cost"):
+        return _stats_float(cargo.get("total_cost"))
+    return 0.0
+
+def _cargo_stats_weight(cargo: dict) -> float:
+    weight = cargo.get("weight", 0)
+    return weight if isinstance(weight, (int, float)) else 0
+
+def cargo_destination_label(cargo: dict) -> str:
+    """Пункт назначения груза для дашборда оператора ("warehouse:<id>" для склада назначения)"""
+    if cargo.get("destination_warehouse_id"):
+        return f"warehouse:{cargo['destination_warehouse_id']}"
+    if cargo.get("destination_city"):
+        return str(cargo["destination_city"])
+    if cargo.get("recipient_address"):
+        address = str(cargo["recipient_address"]).lower()
+        for markers, city in DESTINATION_ADDRESS_CITIES:
+            if any(marker in address for marker in markers):
+                return city
+        return "Другой город"
+    if cargo.get("recipient_name") or cargo.get("recipient_full_name"):
+        recipient = str(cargo.get("recipient_full_name") or cargo.get("recipient_name", "")).lower()
+        if any(word in recipient for word in ["москва", "moscow", "российская", "russia"]):
+            return "Москва"
+        if any(word in recipient for word in ["душанбе", "dushanbe"]):
+            return "Душанбе"
+        if any(word in recipient for word in ["худжанд", "khujand"]):
+            return "Худжанд"
+        return "Таджикистан"
+    if cargo.get("route"):
+        route = str(cargo["route"]).lower()
+        if "moscow" in route or "москва" in route:
+            return "Москва"
+        if "tajikistan" in route or "таджикистан" in route:
+            return "Таджикистан"
+        return str(cargo["route"])
+    return "Не указано"
+
+def cargo_stats_contribution(collection_name: str, cargo: dict) -> Dict[str, dict]:
+    """Вклад груза в счетчики: {scope: {поле: значение}}"""
+    weight = _cargo_stats_weight(cargo)
+    value = _cargo_stats_value(cargo)
+    cargo_status = cargo.get("status", "unknown")
+    processing_status = cargo.get("processing_status", "")
+    payment_status = cargo.get("payment_status", "")
+    payment_method = cargo.get("payment_method", "")
+    combined_status = f"{cargo_status}_{processing_status}" if processing_status else cargo_status
+    status_text = str(cargo.get("status") or "").lower()
+    
+    is_awaiting_recipient = (
+        any(marker in status_text for marker in ("delivered", "доставлен", "awaiting_pickup"))
+        or "ожидает_получения" in str(processing_status or "").lower()
+    )
+    is_debtor = (payment_method == "credit" and payment_status in ["pending", "unpaid"]) or processing_status == "payment_pending"
+    is_paid = payment_status in ["paid", "completed"] or processing_status == "paid"
+    is_unpaid = not is_paid and (
+        payment_method == "credit" or payment_status in ["pending", "unpaid"] or processing_status == "payment_pending"
+    )
+    debt = _stats_float(cargo.get("declared_value", 0) or cargo.get("total_cost", 0))
+    in_stock = cargo.get("status") in WAREHOUSE_STOCK_STATUSES.get(collection_name, [])
+    
+    counters = {
+        "cargo_count": 1,
+        f"cargo_by_collection.{collection_name}": 1,
+        "total_weight": weight,
+        "total_value": value,
+        "awaiting_recipient": int(is_awaiting_recipient),
+        "debtors_count": int(is_debtor),
+        "debt_amount": debt if is_debtor else 0,
+        "paid_cargo": int(is_paid),
+        "unpaid_cargo": int(is_unpaid),
+        "unpaid_amount": debt if is_unpaid else 0,
+        f"by_status.{_stats_key(cargo_status)}": 1,
+        f"by_combined_status.{_stats_key(combined_status)}": 1,
+        f"stock_by_collection.{collection_name}": int(in_stock),
+        "stock_weight": weight if in_stock else 0
+    }
+    
+    result = {STATS_GLOBAL_SCOPE: counters}
+    if cargo.get("warehouse_id"):
+        destination = f"destinations.{_stats_key(cargo_destination_label(cargo))}"
+        result[f"warehouse:{cargo['warehouse_id']}"] = dict(counters, **{
+            f"{destination}.cargo_count": 1,
+            f"{destination}.total_weight": weight,
+            f"{destination}.total_value": value
+        })
+    if cargo.get("created_by"):
+        result[f"operator:{cargo['created_by']}"] = counters
+    return result
+
+def cargo_phone_refs(cargo: dict) -> set:
+    """Телефоны груза для подсчета уникальных клиентов: {(scope, role, phone)}"""
+    scopes = [STATS_GLOBAL_SCOPE]
+    if cargo.get("warehouse_id"):
+        scopes.append(f"warehouse:{cargo['warehouse_id']}")
+    refs = set()
+    for role in ("sender", "recipient"):
+        phone = cargo.get(f"{role}_phone")
+        if phone:
+            refs.update((scope, role, str(phone)) for scope in scopes)
+    return refs
+
+def cell_stats_contribution(cell: dict) -> Dict[str, dict]:
+    """Вклад ячейки: занятость для склада и размещение по дням для оператора"""
+    result = {}
+    if cell.get("is_occupied") is True:
+        result[STATS_GLOBAL_SCOPE] = {"occupied_cells": 1}
+        if cell.get("warehouse_id"):
+            result[f"warehouse:{cell['warehouse_id']}"] = {"occupied_cells": 1}
+    if cell.get("placed_by") and isinstance(cell.get("placed_at"), datetime):
+        result[f"operator:{cell['placed_by']}"] = {f"placements_by_day.{cell['placed_at'].strftime('%Y-%m-%d')}": 1}
+    return result
+
+def transport_stats_contribution(transport: dict) -> Dict[str, dict]:
+    """Вклад транспорта: общее количество, активные и направления"""
+    is_active = int(transport.get("status") in ACTIVE_TRANSPORT_STATUSES)
+    direction = str(transport.get("direction") or "")
+    result = {STATS_GLOBAL_SCOPE: {
+        "transports_total": 1,
+        "active_transports": is_active,
+        "transports_moscow_to_tajikistan": int(bool(re.search("moscow.*tajikistan", direction, re.IGNORECASE))),
+        "transports_tajikistan_to_moscow": int(bool(re.search("tajikistan.*moscow", direction, re.IGNORECASE)))
+    }}
+    for warehouse_id in {transport.get("source_warehouse_id"), transport.get("destination_warehouse_id")} - {None, ""}:
+        result[f"warehouse:{warehouse_id}"] = {"transports_total": 1, "active_transports": is_active}
+    return result
+
+def _flatten_stats(document: dict, prefix: str = "") -> dict:
+    flat = {}
+    for key, value in document.items():
+        if key in ("_id", "updated_at") and not prefix:
+            continue
+        path = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(_flatten_stats(value, f"{path}."))
+        else:
+            flat[path] = value
+    return flat
+
+def _unflatten_stats(flat: dict) -> dict:
+    document = {}
+    for path, value in flat.items():
+        target = document
+        *parents, leaf = path.split(".")
+        for part in parents:
+            target = target.setdefault(part, {})
+        target[leaf] = value
+    return document
+
+def _is_expired_placement_day(field: str) -> bool:
+    """Счетчик размещений за день старше STATS_PLACEMENT_DAYS_KEPT (удаляется при сверке)"""
+    if not field.startswith("placements_by_day."):
+        return False
+    oldest_day = (datetime.utcnow() - timedelta(days=STATS_PLACEMENT_DAYS_KEPT)).strftime("%Y-%m-%d")
+    return field.split(".", 1)[1] < oldest_day
+
+class DashboardStatsService:
+    """Инкрементальные счетчики дашбордов и их ночная сверка"""
+    
+    def __init__(self, database):
+        self.counters = database.stats_counters
+        self.phone_refs = database.stats_phone_refs
+        self.meta = database.schema_meta
+        self.database = database
+        self.state = BackfillState(database.schema_meta, "stats_reconcile", 1)
+    
+    # ---------- Обновление ----------
+    
+    def _apply(self, contribution, changes: list, track_phones: bool = False):
+        deltas: Dict[str, dict] = {}
+        
+        def add(parts: Dict[str, dict], sign: int):
+            for scope, counters in parts.items():
+                scope_deltas = deltas.setdefault(scope, {})
+                for field, value in counters.items():
+                    scope_deltas[field] = scope_deltas.get(field, 0) + sign * value
+        
+        phone_steps: Dict[tuple, int] = {}
+        for before, after in changes:
+            if before is not None:
+                add(contribution(before), -1)
+            if after is not None:
+                add(contribution(after), 1)
+            if track_phones:
+                old_refs = cargo_phone_refs(before) if before is not None else set()
+                new_refs = cargo_phone_refs(after) if after is not None else set()
+                for ref, step in [(ref, 1) for ref in new_refs - old_refs] + [(ref, -1) for ref in old_refs - new_refs]:
+                    phone_steps[ref] = phone_steps.get(ref, 0) + step
+        if phone_steps:
+            add(self._apply_phone_refs(phone_steps), 1)
+        
+        now = datetime.utcnow()
+        operations = []
+        for scope, scope_deltas in deltas.items():
+            increments = {field: value for field, value in scope_deltas.items() if value}
+            if increments:
+                operations.append(UpdateOne({"_id": scope}, {"$inc": increments, "$set": {"updated_at": now}}, upsert=True))
+        if operations:
+            self.counters.bulk_write(operations, ordered=False)
+    
+    def _apply_phone_refs(self, steps: Dict[tuple, int]) -> Dict[str, dict]:
+        """Счетчики ссылок на телефоны одной пачкой $inc; возвращает изменения unique_senders/unique_recipients.
+        
+        Переход через ноль определяется по значениям, перечитанным одним $in после записи:
+        одновременное изменение той же ссылки другим запросом может сдвинуть счетчик
+        уникальных клиентов, расхождение исправляет ночная сверка.
+        """
+        now = datetime.utcnow()
+        steps = {f"{scope}|{role}|{phone}": ((scope, role, phone), step) for (scope, role, phone), step in steps.items() if step}
+        if not steps:
+            return {}
+        self.phone_refs.bulk_write([
+            UpdateOne(
+                {"_id": ref_id},
+                {"$inc": {"refs": step}, "$set": {"updated_at": now}, "$setOnInsert": {"scope": scope, "role": role, "phone": phone}},
+                upsert=step > 0
+            )
+            for ref_id, ((scope, role, phone), step) in steps.items()
+        ], ordered=False)
+        current = {ref["_id"]: ref.get("refs", 0) for ref in self.phone_refs.find({"_id": {"$in": list(steps)}}, {"refs": 1})}
+        
+        deltas: Dict[str, dict] = {}
+        released = []
+        for ref_id, ((scope, role, _), step) in steps.items():
+            if ref_id not in current:
+                continue
+            refs = current[ref_id]
+            field = f"unique_{role}s"
+            if step > 0 and refs - step <= 0 < refs:
+                deltas.setdefault(scope, {})[field] = deltas.get(scope, {}).get(field, 0) + 1
+            elif step < 0 and refs <= 0 < refs - step:
+                released.append(ref_id)
+                deltas.setdefault(scope, {})[field] = deltas.get(scope, {}).get(field, 0) - 1
+        if released:
+            self.phone_refs.delete_many({"_id": {"$in": released}, "refs": {"$lte": 0}})
+        return deltas
+    
+    def on_cargo_changes(self, collection_name: str, changes: list):
+        self._apply(lambda cargo: cargo_stats_contribution(collection_name, cargo), changes, track_phones=True)
+    
+    def on_cell_changes(self, collection_name: str, changes: list):
+        self._apply(cell_stats_contribution, changes)
+    
+    def on_transport_changes(self, collection_name: str, changes: list):
+        self._apply(transport_stats_contribution, changes)
+    
+    # ---------- Чтение ----------
+    
+    def get(self, scope: str) -> dict:
+        return self.get_many([scope])[scope]
+    
+    def get_many(self, scopes: List[str]) -> Dict[str, dict]:
+        """Счетчики областей; пока они не построены или помечены для пересборки - пересчет по исходным коллекциям"""
+        if not self.is_built():
+            return self.compute(scopes)
+        found = {doc["_id"]: doc for doc in self.counters.find({"_id": {"$in": list(scopes)}})}
+        return {scope: found.get(scope, {}) for scope in scopes}
+    
+    def placements_on(self, operator_id: str, day) -> int:
+        return self.get(f"operator:{operator_id}").get("placements_by_day", {}).get(day.strftime("%Y-%m-%d"), 0)
+    
+    def unique_clients(self, scopes: List[str]) -> Dict[str, int]:
+        """Уникальные отправители/получатели по объединению нескольких областей"""
+        if not self.is_built():
+            return {role: len(self._source_phones(scopes, role)) for role in ("sender", "recipient")}
+        counts = {"sender": 0, "recipient": 0}
+        for row in self.phone_refs.aggregate([
+            {"$match": {"scope": {"$in": list(scopes)}, "refs": {"$gt": 0}}},
+            {"$group": {"_id": {"role": "$role", "phone": "$phone"}}},
+            {"$group": {"_id": "$_id.role", "count": {"$sum": 1}}}
+        ]):
+            counts[row["_id"]] = row["count"]
+        return counts
+    
+    def sample_phones(self, scope: str, role: str, limit: int = 10) -> List[str]:
+        if not self.is_built():
+            return sorted(self._source_phones([scope], role))[:limit]
+        return [ref["phone"] for ref in self.phone_refs.find({"scope": scope, "role": role, "refs": {"$gt": 0}}, {"phone": 1}).limit(limit)]
+    
+    def is_built(self) -> bool:
+        return self.state.is_built()
+    
+    # ---------- Расчет по исходным коллекциям ----------
+    
+    def _source_filters(self, scopes: Optional[Set[str]]) -> tuple:
+        """Фильтры (грузы, ячейки, транспорты) для областей; None - коллекция в областях не участвует"""
+        if scopes is None or STATS_GLOBAL_SCOPE in scopes:
+            return {}, {}, {}
+        warehouse_ids = [scope.split(":", 1)[1] for scope in scopes if scope.startswith("warehouse:")]
+        operator_ids = [scope.split(":", 1)[1] for scope in scopes if scope.startswith("operator:")]
+        cargo_parts, cell_parts, transport_parts = [], [], []
+        if warehouse_ids:
+            cargo_parts.append({"warehouse_id": {"$in": warehouse_ids}})
+            cell_parts.append({"warehouse_id": {"$in": warehouse_ids}})
+            transport_parts.extend([
+                {"source_warehouse_id": {"$in": warehouse_ids}},
+                {"destination_warehouse_id": {"$in": warehouse_ids}}
+            ])
+        if operator_ids:
+            cargo_parts.append({"created_by": {"$in": operator_ids}})
+            cell_parts.append({"placed_by": {"$in": operator_ids}})
+        return tuple({"$or": parts} if parts else None for parts in (cargo_parts, cell_parts, transport_parts))
+    
+    def _scan(self, scopes: Optional[Set[str]] = None, include_cargo: bool = True, track_phones: bool = False) -> Dict[str, dict]:
+        """Потоковый пересчет плоских счетчиков областей scopes (None - всех) по исходным коллекциям"""
+        totals: Dict[str, dict] = {}
+        phones: Dict[tuple, set] = {}
+        
+        def add(parts: Dict[str, dict]):
+            for scope, counters in parts.items():
+                if scopes is not None and scope not in scopes:
+                    continue
+                scope_totals = totals.setdefault(scope, {})
+                for field, value in counters.items():
+                    scope_totals[field] = scope_totals.get(field, 0) + value
+        
+        cargo_filter, cell_filter, transport_filter = self._source_filters(scopes)
+        if include_cargo and cargo_filter is not None:
+            cargo_projection = {field: 1 for field in STATS_CARGO_FIELDS}
+            for collection_name in CARGO_COLLECTIONS:
+                for cargo in self.database[collection_name].find(cargo_filter, cargo_projection):
+                    add(cargo_stats_contribution(collection_name, cargo))
+                    if track_phones:
+                        for scope, role, phone in cargo_phone_refs(cargo):
+                            phones.setdefault((scope, role), set()).add(phone)
+        if cell_filter is not None:
+            for cell in self.database.warehouse_cells.find(cell_filter, {field: 1 for field in STATS_CELL_FIELDS}):
+                add(cell_stats_contribution(cell))
+        if transport_filter is not None:
+            for transport in self.database.transports.find(transport_filter, {field: 1 for field in STATS_TRANSPORT_FIELDS}):
+                add(transport_stats_contribution(transport))
+        add({scope: {f"unique_{role}s": len(values)} for (scope, role), values in phones.items()})
+        
+        for scope_totals in totals.values():
+            for field in [f for f in scope_totals if _is_expired_placement_day(f)]:
+                del scope_totals[field]
+        return totals
+    
+    def _source_phones(self, scopes: List[str], role: str) -> Set[str]:
+        cargo_filter = self._source_filters(set(scopes))[0]
+        phones = set()
+        if cargo_filter is not None:
+            for collection_name in CARGO_COLLECTIONS:
+                phones.update(str(phone) for phone in self.database[collection_name].distinct(f"{role}_phone", cargo_filter) if phone)
+        return phones
+    
+    def compute(self, scopes: List[str], include_cargo: bool = True) -> Dict[str, dict]:
+        """Счетчики областей по исходным коллекциям - пока счетчики не построены или помечены для пересборки"""
+        totals = self._scan(set(scopes), include_cargo=include_cargo, track_phones=include_cargo)
+        return {scope: _unflatten_stats(totals.get(scope, {})) for scope in scopes}
+    
+    # ---------- Сверка ----------
+    
+    def _expected_phone_refs(self):
+        """Ссылки на телефоны, пересчитанные агрегацией: курсор {_id, scope, role, phone, refs} по возрастанию _id"""
+        phone_fields = {"_id": 0, "warehouse_id": 1, "sender_phone": 1, "recipient_phone": 1}
+        warehouse_scope = {"$concat": ["warehouse:", {"$toString": "$warehouse_id"}]}
+        entries = [
+            {"scope": scope, "role": role, "phone": f"${role}_phone"}
+            for scope in (STATS_GLOBAL_SCOPE, warehouse_scope)
+            for role in ("sender", "recipient")
+        ]
+        return self.database.cargo.aggregate([
+            {"$project": phone_fields},
+            {"$unionWith": {"coll": "operator_cargo", "pipeline": [{"$project": phone_fields}]}},
+            {"$project": {"entries": entries}},
+            {"$unwind": "$entries"},
+            {"$replaceRoot": {"newRoot": "$entries"}},
+            {"$match": {"scope": {"$nin": [None, "warehouse:"]}, "phone": {"$nin": [None, ""]}}},
+            {"$group": {
+                "_id": {"$concat": ["$scope", "|", "$role", "|", {"$toString": "$phone"}]},
+                "scope": {"$first": "$scope"},
+                "role": {"$first": "$role"},
+                "phone": {"$first": {"$toString": "$phone"}},
+                "refs": {"$sum": 1}
+            }},
+            {"$sort": {"_id": 1}}
+        ], allowDiskUse=True)
+    
+    def _reconcile_phone_refs(self, started_at: datetime, repair: bool) -> tuple:
+        """Сверить stats_phone_refs с пересчетом; (уникальные клиенты по областям, расхождений, пропущено).
+        
+        Исправление - условная запись: ссылка, которую живое обновление изменило после
+        started_at, пропускается до следующей сверки.
+        """
+        stored = {ref["_id"]: ref.get("refs", 0) for ref in self.phone_refs.find({}, {"refs": 1})}
+        unique: Dict[str, dict] = {}
+        operations = []
+        untouched = {"updated_at": {"$not": {"$gte": started_at}}}
+        for ref in self._expected_phone_refs():
+            field = f"unique_{ref['role']}s"
+            unique.setdefault(ref["scope"], {})[field] = unique.get(ref["scope"], {}).get(field, 0) + 1
+            if stored.pop(ref["_id"], None) != ref["refs"]:
+                operations.append(UpdateOne(
+                    dict(untouched, _id=ref["_id"]),
+                    {"$set": {"refs": ref["refs"], "scope": ref["scope"], "role": ref["role"], "phone": ref["phone"]}},
+                    upsert=True
+                ))
+        operations.extend(DeleteOne(dict(untouched, _id=ref_id)) for ref_id in stored)
+        
+        applied = 0
+        if repair and operations:
+            try:
+                result = self.phone_refs.bulk_write(operations, ordered=False)
+            except BulkWriteError as e:
+                # Дубликат _id при upsert - ссылку только что создало живое обновление
+                if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                    raise
+                result = e.details
+                applied = result.get("nMatched", 0) + result.get("nUpserted", 0) + result.get("nRemoved", 0)
+            else:
+                applied = result.matched_count + result.upserted_count + result.deleted_count
+        return unique, len(operations), len(operations) - applied if repair else 0
+    
+    def reconcile(self, repair: bool = True) -> dict:
+        """Сверить сохраненные счетчики с пересчитанными, записать отчет и исправить расхождения.
+        
+        Сохраненные значения читаются до пересчета, исправление каждого поля - условная запись
+        по прочитанному значению: поле, которое живое $inc изменило во время пересчета,
+        пропускается (skipped_count) и исправляется следующей сверкой.
+        """
+        started_at = datetime.utcnow()
+        stored = {doc["_id"]: _flatten_stats(doc) for doc in self.counters.find({})}
+        expected = self._scan()
+        unique, phone_drift, phone_skipped = self._reconcile_phone_refs(started_at, repair)
+        for scope, counters in unique.items():
+            expected.setdefault(scope, {}).update(counters)
+        
+        drift = []
+        operations = []
+        for scope in sorted(set(expected) | set(stored)):
+            expected_fields = expected.get(scope, {})
+            stored_fields = stored.get(scope, {})
+            for field in sorted(set(expected_fields) | set(stored_fields)):
+                stored_value = stored_fields.get(field)
+                condition = {"_id": scope, field: stored_value if field in stored_fields else {"$exists": False}}
+                if _is_expired_placement_day(field):
+                    operations.append(UpdateOne(condition, {"$unset": {field: ""}}))
+                    continue
+                expected_value = expected_fields.get(field, 0)
+                if isinstance(stored_value, (int, float)) and abs(expected_value - stored_value) <= STATS_DRIFT_TOLERANCE:
+                    continue
+                if stored_value is None and not expected_value:
+                    continue
+                drift.append({"scope": scope, "field": field, "stored": stored_value or 0, "expected": expected_value})
+                operations.append(UpdateOne(condition, {"$set": {field: expected_value}}, upsert=True))
+        
+        skipped = phone_skipped
+        if repair and operations:
+            try:
+                result = self.counters.bulk_write(operations, ordered=False)
+                applied = result.matched_count + result.upserted_count
+            except BulkWriteError as e:
+                # Дубликат _id при upsert - поле появилось в документе во время пересчета
+                if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                    raise
+                applied = e.details.get("nMatched", 0) + e.details.get("nUpserted", 0)
+            skipped += len(operations) - applied
+        
+        report = {
+            "started_at": started_at,
+            "finished_at": datetime.utcnow(),
+            "scopes": len(expected),
+            "repaired": repair,
+            "drift_count": len(drift) + phone_drift,
+            "skipped_count": skipped,
+            "drift": drift[:200]
+        }
+        if repair:
+            self.state.mark_built(report)
+        else:
+            self.meta.update_one({"_id": self.state.name}, {"$set": report}, upsert=True)
+        print(f"📊 Сверка счетчиков: областей {len(expected)}, расхождений {report['drift_count']}, пропущено {skipped}")
+        return report
+    
+
+dashboard_stats = DashboardStatsService(db)
+for _cargo_collection_name in CARGO_COLLECTIONS:
+    ChangeTrackedDatabase.subscribe(_cargo_collection_name, STATS_CARGO_FIELDS, dashboard_stats.on_cargo_changes, on_error=dashboard_stats.state.mark_dirty)
+ChangeTrackedDatabase.subscribe("warehouse_cells", STATS_CELL_FIELDS, dashboard_stats.on_cell_changes, on_error=dashboard_stats.state.mark_dirty)
+ChangeTrackedDatabase.subscribe("transports", STATS_TRANSPORT_FIELDS, dashboard_stats.on_transport_changes, on_error=dashboard_stats.state.mark_dirty)
+register_backfill(dashboard_stats.state, dashboard_stats.reconcile, "счетчики дашбордов")
+
+async def nightly_stats_reconcile():
+    """Ежесуточная сверка счетчиков в STATS_RECONCILE_HOUR_UTC"""
+    while True:
+        now = datetime.utcnow()
+        next_run = now.replace(hour=STATS_RECONCILE_HOUR_UTC, minute=0, second=0, microsecond=0)
+        if next_run <= now:
+            next_run += timedelta(days=1)
+        await asyncio.sleep((next_run - now).total_seconds())
+        try:
+            await run_in_threadpool(dashboard_stats.state.run, dashboard_stats.reconcile, next_run.strftime("%Y-%m-%d"))
+        except Exception as e:
+            print(f"❌ Ошибка ночной сверки счетчиков: {str(e)}")
+
+@app.on_event("startup")
+async def bootstrap_dashboard_stats():
+    """Запланировать ночную сверку счетчиков (первое построение - в заполнении производных данных)"""
+    asyncio.create_task(nightly_stats_reconcile())
+
+@app.post("/api/admin/stats/reconcile")
+def reconcile_dashboard_stats(
+    repair: bool = True,
+    current_user: User = Depends(require_role(UserRole.ADMIN))
+):
+    """Пересчитать счетчики дашбордов с нуля и вернуть отчет о расхождениях"""
+    return dashboard_stats.reconcile(repair=repair)
+
+@app.get("/api/admin/stats/reconcile")
+def get_dashboard_stats_reconcile_report(
+    current_user: User = Depends(require_role(UserRole.ADMIN))
+):
+    """Отчет последней сверки счетчиков дашбордов"""
+    return db.schema_meta.find_one({"_id": "stats_reconcile"}, {"_id": 0}) or {}
+
+# ==================== ЗАНЯТОСТЬ ЯЧЕЕК СКЛАДОВ ====================
+# Для каждого склада в памяти процесса хранится битовая карта занятости ячеек
+# (позиция = ((блок-1) * полок + (полка-1)) * ячеек + (ячейка-1)) и массив cargo_id.
+# Карта строится из warehouse_cells при старте и обновляется подпиской на записи
+# в warehouse_cells, поэтому все пути размещения, перемещения и освобождения
+# поддерживают ее без изменений. Другие процессы узнают об изменениях по версиям
+# складов в schema_meta {"_id": "cell_occupancy"}.
+
+OCCUPANCY_CELL_FIELDS = ["warehouse_id", "is_occupied", "cargo_id", "block_number", "shelf_number", "cell_number", "block", "location_code"]
+LOCATION_CODE_PATTERN = re.compile(r"^\D*(\d+)\D+(\d+)\D+(\d+)$")
+
+def cell_position(cell: dict) -> Optional[tuple]:
+    """Координаты (блок, полка, ячейка) записи warehouse_cells: из номеров или из location_code"""
+    block = cell.get("block_number", cell.get("block"))
+    shelf = cell.get("shelf_number")
+    number = cell.get("cell_number")
+    try:
+        if block is not None and shelf is not None and number is not None:
+            return int(block), int(shelf), int(number)
+    except (TypeError, ValueError):
+        pass
+    match = LOCATION_CODE_PATTERN.match(str(cell.get("location_code") or ""))
+    return tuple(int(part) for part in match.groups()) if match else None
+
+def warehouse_dimensions(warehouse: dict) -> tuple:
+    """(блоков, полок в блоке, ячеек на полке); add-block хранит число блоков в поле blocks"""
+    def number(field: str) -> int:
+        value = warehouse.get(field)
+        return int(value) if isinstance(value, (int, float)) else 0
+    return max(number("blocks_count"), number("blocks")), number("shelves_per_block"), number("cells_per_shelf")
+
+class WarehouseOccupancyMap:
+    """Битовая карта занятости одного склада и массив cargo_id по позициям"""
+    
+    def __init__(self, blocks: int, shelves: int, cells: int):
+        self.blocks, self.shelves, self.cells = blocks, shelves, cells
+        self.size = blocks * shelves * cells
+        self.bits = bytearray((self.size + 7) // 8)
+        self.refs = bytearray(self.size)  # Число занятых записей на позицию (бывают дубли записей ячейки)
+        self.cargo_ids: List[Optional[str]] = [None] * self.size
+        self.occupied_per_block = [0] * blocks
+        self.occupied = 0
+    
+    def index(self, block: int, shelf: int, cell: int) -> Optional[int]:
+        if 1 <= block <= self.blocks and 1 <= shelf <= self.shelves and 1 <= cell <= self.cells:
+            return ((block - 1) * self.shelves + (shelf - 1)) * self.cells + (cell - 1)
+        return None
+    
+    def position(self, index: int) -> tuple:
+        block, rest = divmod(index, self.shelves * self.cells)
+        shelf, cell = divmod(rest, self.cells)
+        return block + 1, shelf + 1, cell + 1
+    
+    def is_set(self, index: int) -> bool:
+        return bool(self.bits[index >> 3] & (1 << (index & 7)))
+    
+    def occupy(self, index: int, cargo_id: Optional[str]):
+        if self.refs[index] < 255:
+            self.refs[index] += 1
+        if cargo_id:
+            self.cargo_ids[index] = cargo_id
+        if not self.is_set(index):
+            self.bits[index >> 3] |= 1 << (index & 7)
+            self.occupied_per_block[index // (self.shelves * self.cells)] += 1
+            self.occupied += 1
+    
+    def release(self, index: int):
+        if self.refs[index]:
+            self.refs[index] -= 1
+        if not self.refs[index] and self.is_set(index):
+            self.bits[index >> 3] &= ~(1 << (index & 7)) & 0xFF
+            self.cargo_ids[index] = None
+            self.occupied_per_block[index // (self.shelves * self.cells)] -= 1
+            self.occupied -= 1
+    
+    def free_indexes(self, start: int, stop: int, limit: Optional[int] = None):
+        """Свободные позиции в [start, stop); полностью занятые байты пропускаются целиком"""
+        found = []
+        index = start
+        while index < stop and (limit is None or len(found) < limit):
+            if index & 7 == 0 and index + 8 <= stop and self.bits[index >> 3] == 0xFF:
+                index += 8
+                continue
+            if not self.is_set(index):
+                found.append(index)
+            index += 1
+        return found
+
+class WarehouseOccupancyIndex:
+    """Занятость ячеек всех складов в памяти процесса.
+    
+    Склад перечитывается из MongoDB при первом обращении, при изменении размеров
+    (warehouses) и когда его версия в schema_meta изменил другой процесс. Версии
+    проверяются не чаще одного раза в check_interval секунд.
+    """
+    META_ID = "cell_occupancy"
+    
+    def __init__(self, database, check_interval: float):
+        self._warehouses = database.warehouses
+        self._cells = database.warehouse_cells
+        self._meta = database.schema_meta
+        self._lock = threading.Lock()
+        self._maps: Dict[str, WarehouseOccupancyMap] = {}
+        self._versions: Dict[str, int] = {}
+        self._stale: Set[str] = set()
+        self._reloads: List[Set[str]] = []  # Склады, измененные во время идущих перечитываний
+        self._checked_at = 0.0
+        self.check_interval = check_interval
+    
+    # ---------- Загрузка ----------
+    
+    def _read_versions(self) -> Dict[str, int]:
+        stamp = self._meta.find_one({"_id": self.META_ID}, {"_id": 0, "versions": 1})
+        return (stamp or {}).get("versions", {})
+    
+    def _build(self, warehouses: list, cells) -> Dict[str, WarehouseOccupancyMap]:
+        maps = {warehouse["id"]: WarehouseOccupancyMap(*warehouse_dimensions(warehouse)) for warehouse in warehouses}
+        for cell in cells:
+            occupancy = maps.get(cell.get("warehouse_id"))
+            position = cell_position(cell)
+            index = occupancy.index(*position) if occupancy and position else None
+            if index is not None:
+                occupancy.occupy(index, cell.get("cargo_id"))
+        return maps
+    
+    def reload(self, warehouse_ids: Optional[List[str]] = None):
+        """Перечитать карты всех складов или только указанных (два запроса).
+        
+        Изменения, пришедшие между чтением из MongoDB и подменой карт, могли не попасть
+        в прочитанные данные: такие склады после подмены помечаются устаревшими.
+        """
+        touched_during_reload: Set[str] = set()
+        with self._lock:
+            self._reloads.append(touched_during_reload)
+        try:
+            self._reload(warehouse_ids, touched_during_reload)
+        finally:
+            with self._lock:
+                self._reloads.remove(touched_during_reload)
+    
+    def _reload(self, warehouse_ids: Optional[List[str]], touched_during_reload: Set[str]):
+        versions = self._read_versions()
+        warehouse_query = {"id": {"$in": list(warehouse_ids)}} if warehouse_ids is not None else {}
+        cell_query = {"is_occupied": True}
+        if warehouse_ids is not None:
+            cell_query["warehouse_id"] = {"$in": list(warehouse_ids)}
+        warehouses = list(self._warehouses.find(
+            warehouse_query,
+            {"_id": 0, "id": 1, "blocks_count": 1, "blocks": 1, "shelves_per_block": 1, "cells_per_shelf": 1}
+        ))
+        projection = {field: 1 for field in OCCUPANCY_CELL_FIELDS}
+        projection["_id"] = 0
+        maps = self._build(warehouses, self._cells.find(cell_query, projection))
+        with self._lock:
+            if warehouse_ids is None:
+                self._maps = maps
+                self._stale = set()
+                self._versions = dict(versions)
+                self._checked_at = time.monotonic()
+            else:
+                for warehouse_id in warehouse_ids:
+                    if warehouse_id in maps:
+                        self._maps[warehouse_id] = maps[warehouse_id]
+                    else:
+                        self._maps.pop(warehouse_id, None)
+                    self._stale.discard(warehouse_id)
+                    self._versions[warehouse_id] = versions.get(warehouse_id, 0)
+            self._stale.update(touched_during_reload)
+    
+    def _ensure_fresh(self):
+        if time.monotonic() - self._checked_at >= self.check_interval:
+            versions = self._read_versions()
+            with self._lock:
+                self._stale.update(
+                    warehouse_id for warehouse_id, version in versions.items()
+                    if self._versions.get(warehouse_id, 0) != version
+                )
+                self._checked_at = time.monotonic()
+    
+    def _map(self, warehouse_id: str) -> Optional[WarehouseOccupancyMap]:
+        self._ensure_fresh()
+        if warehouse_id not in self._maps or warehouse_id in self._stale:
+            self.reload([warehouse_id])
+        return self._maps.get(warehouse_id)
+    
+    # ---------- Обновление ----------
+    
+    def on_cell_changes(self, collection_name: str, changes: list):
+        touched = set()
+        with self._lock:
+            for before, after in changes:
+                for cell, occupy in ((before, False), (after, True)):
+                    if not cell or cell.get("is_occupied") is not True:
+                        continue
+                    warehouse_id = cell.get("warehouse_id")
+                    touched.add(warehouse_id)
+                    for touched_during_reload in self._reloads:
+                        touched_during_reload.add(warehouse_id)
+                    occupancy = self._maps.get(warehouse_id)
+                    position = cell_position(cell)
+                    index = occupancy.index(*position) if occupancy and position else None
+                    if index is None:
+                        # Ячейка вне известных размеров склада - перечитаем склад при обращении
+                        self._stale.add(warehouse_id)
+                    elif occupy:
+                        occupancy.occupy(index, cell.get("cargo_id"))
+                    else:
+                        occupancy.release(index)
+        touched.discard(None)
+        if touched:
+            self._bump_versions(touched)
+    
+    def on_warehouse_changes(self, collection_name: str, changes: list):
+        """Изменение размеров или удаление склада - перечитать его карту"""
+        touched = set()
+        for before, after in changes:
+            if before is None or after is None or warehouse_dimensions(before) != warehouse_dimensions(after):
+                touched.add((after or before).get("id"))
+        touched.discard(None)
+        if touched:
+            with self._lock:
+                self._stale.update(touched)
+                for touched_during_reload in self._reloads:
+                    touched_during_reload.update(touched)
+            self._bump_versions(touched)
+    
+    def invalidate_all(self):
+        """Перечитать все склады во всех процессах при следующем обращении (ошибка подписчика)"""
+        with self._lock:
+            warehouse_ids = set(self._maps)
+            self._stale.update(warehouse_ids)
+        if warehouse_ids:
+            self._bump_versions(warehouse_ids)
+    
+    def _bump_versions(self, warehouse_ids: set):
+        stamp = self._meta.find_one_and_update(
+            {"_id": self.META_ID},
+            {"$inc": {f"versions.{warehouse_id}": 1 for warehouse_id in warehouse_ids}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        versions = stamp.get("versions", {})
+        with self._lock:
+            for warehouse_id in warehouse_ids:
+                # Версия выросла больше чем на 1 - склад менял другой процесс
+                if versions.get(warehouse_id, 0) != self._versions.get(warehouse_id, 0) + 1:
+                    self._stale.add(warehouse_id)
+                self._versions[warehouse_id] = versions.get(warehouse_id, 0)
+    
+    # ---------- Чтение ----------
+    
+    def is_free(self, warehouse_id: str, block: int, shelf: int, cell: int) -> Optional[bool]:
+        """True/False - занятость ячейки; None - склад или ячейка неизвестны"""
+        occupancy = self._map(warehouse_id)
+        index = occupancy.index(block, shelf, cell) if occupancy else None
+        return None if index is None else not occupancy.is_set(index)
+    
+    def cargo_at(self, warehouse_id: str, block: int, shelf: int, cell: int) -> Optional[str]:
+        occupancy = self._map(warehouse_id)
+        index = occupancy.index(block, shelf, cell) if occupancy else None
+        return None if index is None else occupancy.cargo_ids[index]
+    
+    def next_free(self, warehouse_id: str, limit: Optional[int] = None, block: Optional[int] = None, shelf: Optional[int] = None) -> List[tuple]:
+        """Первые limit свободных ячеек (блок, полка, ячейка) склада, блока или полки по порядку"""
+        occupancy = self._map(warehouse_id)
+        if not occupancy or not occupancy.size:
+            return []
+        start, stop = 0, occupancy.size
+        if block is not None:
+            first = occupancy.index(block, shelf or 1, 1)
+            if first is None:
+                return []
+            start = first
+            stop = first + (occupancy.cells if shelf is not None else occupancy.shelves * occupancy.cells)
+        with self._lock:
+            return [occupancy.position(index) for index in occupancy.free_indexes(start, stop, limit)]
+    
+    def occupied_cells(self, warehouse_id: str) -> List[tuple]:
+        """Занятые ячейки склада: (блок, полка, ячейка, cargo_id)"""
+        occupancy = self._map(warehouse_id)
+        if not occupancy:
+            return []
+        with self._lock:
+            return [
+                (*occupancy.position(index), occupancy.cargo_ids[index])
+                for index in range(occupancy.size) if occupancy.is_set(index)
+            ]
+    
+    def summary(self, warehouse_id: str) -> dict:
+        """Всего/занято/свободно и занятость по блокам"""
+        occupancy = self._map(warehouse_id)
+        if not occupancy:
+            return {"total_cells": 0, "occupied_cells": 0, "free_cells": 0, "blocks": []}
+        per_block = occupancy.shelves * occupancy.cells
+        with self._lock:
+            return {
+                "total_cells": occupancy.size,
+                "occupied_cells": occupancy.occupied,
+                "free_cells": occupancy.size - occupancy.occupied,
+                "blocks": [
+                    {"block_number": block + 1, "total_cells": per_block, "occupied_cells": occupied, "free_cells": per_block - occupied}
+                    for block, occupied in enumerate(occupancy.occupied_per_block)
+                ]
+            }
+
+cell_occupancy = WarehouseOccupancyIndex(
+    db,
+    check_interval=float(os.environ.get('OCCUPANCY_CHECK_SECONDS', '2'))
+)
+ChangeTrackedDatabase.subscribe("warehouse_cells", OCCUPANCY_CELL_FIELDS, cell_occupancy.on_cell_changes, on_error=lambda reason: cell_occupancy.invalidate_all())
+ChangeTrackedDatabase.subscribe("warehouses", ["id", "blocks_count", "blocks", "shelves_per_block", "cells_per_shelf"], cell_occupancy.on_warehouse_changes, on_error=lambda reason: cell_occupancy.invalidate_all())
+
+@app.on_event("startup")
+def load_cell_occupancy():
+    """Построение карт занятости ячеек при старте сервера"""
+    try:
+        cell_occupancy.reload()
+    except Exception as e:
+        print(f"❌ Ошибка построения карт занятости ячеек: {str(e)}")
+
+# ==================== СПРАВОЧНИК ЯЧЕЕК ====================
+# Разбор отсканированного кода ячейки и поиск склада/ячейки выполняются по
+# справочнику в памяти процесса: склад по id, warehouse_id_number и warehouse_number,
+# ячейка по id_based_code. Справочник перечитывается после любой записи в warehouses
+# и после добавления/удаления записей ячеек (создание склада, add-block, delete-block).
+
+WAREHOUSE_NOT_FOUND_MESSAGES = {
+    "id": "Warehouse with ID number {key} not found",
+    "legacy": "Warehouse not found",
+    "compact9": "Warehouse with number {key} not found",
+    "compact8": "Warehouse with number {key} not found"
+}
+
+DIRECTORY_WAREHOUSE_FIELDS = ["id", "name", "location", "warehouse_id_number", "warehouse_number", "is_active"]
+
+def parse_cell_code(cell_code: str) -> Optional[dict]:
+    """Разобрать QR код ячейки без обращения к базе.
+    
+    Форматы: '001-01-01-001' (ID система), 'WAREHOUSE_ID-Б1-П1-Я1', '003010106' (9 цифр)
+    и '03010106' (8 цифр). Склад ищется по полю warehouse_field со значением warehouse_key.
+    Для ID системы номера блока/полки/ячейки уточняются по записи ячейки, если она есть.
+    """
+    parts = cell_code.split("-")
+    if len(parts) == 4 and all(part.isdigit() for part in parts):
+        return {
+            "format": "id",
+            "warehouse_field": "warehouse_id_number",
+            "warehouse_key": parts[0],
+            "block_id_number": parts[1],
+            "shelf_id_number": parts[2],
+            "cell_id_number": parts[3],
+            "block": int(parts[1]),
+            "shelf": int(parts[2]),
+            "cell": int(parts[3])
+        }
+    if "-Б" in cell_code and "-П" in cell_code and "-Я" in cell_code:
+        b_index = cell_code.find("-Б")
+        coord_parts = cell_code[b_index + 1:].split("-")
+        if len(coord_parts) != 3:
+            return None
+        try:
+            block, shelf, cell = (int(part[1:]) for part in coord_parts)
+        except ValueError:
+            return None
+        return {"format": "legacy", "warehouse_field": "id", "warehouse_key": cell_code[:b_index], "block": block, "shelf": shelf, "cell": cell}
+    if len(cell_code) in (8, 9) and cell_code.isdigit():
+        width = len(cell_code) - 6
+        return {
+            "format": f"compact{len(cell_code)}",
+            "warehouse_field": "warehouse_number",
+            "warehouse_key": int(cell_code[:width]),
+            "block": int(cell_code[width:width + 2]),
+            "shelf": int(cell_code[width + 2:width + 4]),
+            "cell": int(cell_code[width + 4:width + 6])
+        }
+    return None
+
+def id_based_cell_code(warehouse_id_number: str, block: int, shelf: int, cell: int) -> str:
+    """Код ячейки ID системы в формате generate_warehouse_structure: 001-01-01-001"""
+    return f"{warehouse_id_number}-{block:02d}-{shelf:02d}-{cell:03d}"
+
+class CellDirectory:
+    """Справочник складов и ячеек для разбора QR кодов ячеек без запросов к MongoDB.
+    
+    Загружается при старте, помечается устаревшим подпиской на записи в warehouses
+    и warehouse_cells и перечитывается при следующем обращении. Другие процессы узнают
+    об изменениях по штампу версии в schema_meta, который проверяется не чаще одного
+    раза в check_interval секунд.
+    """
+    META_ID = "cell_directory"
+    
+    def __init__(self, database, check_interval: float):
+        self._warehouses = database.warehouses
+        self._cells = database.warehouse_cells
+        self._meta = database.schema_meta
+        self._lock = threading.Lock()
+        self._by_id: Dict[str, dict] = {}
+        self._by_id_number: Dict[str, dict] = {}
+        self._by_number: Dict[int, dict] = {}
+        self._cell_ids: Dict[str, str] = {}
+        self._layout_cells: Dict[str, Set[tuple]] = {}
+        self._version = None
+        self._dirty = False
+        self._checked_at = 0.0
+        self.check_interval = check_interval
+    
+    def _read_version(self) -> int:
+        stamp = self._meta.find_one({"_id": self.META_ID}, {"version": 1})
+        return stamp.get("version", 0) if stamp else 0
+    
+    def reload(self):
+        """Полностью перечитать склады и ячейки из MongoDB"""
+        version = self._read_version()
+        by_id, by_id_number, by_number, layout_cells = {}, {}, {}, {}
+        projection = {field: 1 for field in DIRECTORY_WAREHOUSE_FIELDS}
+        projection.update({"_id": 0, "layout.blocks": 1})
+        for warehouse in self._warehouses.find({}, projection):
+            layout = warehouse.pop("layout", None) or {}
+            entry = {field: warehouse.get(field) for field in DIRECTORY_WAREHOUSE_FIELDS}
+            by_id[entry["id"]] = entry
+            if entry["warehouse_id_number"]:
+                by_id_number.setdefault(entry["warehouse_id_number"], entry)
+            if entry["warehouse_number"] is not None:
+                by_number.setdefault(entry["warehouse_number"], entry)
+            if layout.get("blocks"):
+                layout_cells[entry["id"]] = {
+                    (block.get("number"), shelf.get("number"), cell.get("number"))
+                    for block in layout["blocks"]
+                    for shelf in block.get("shelves", [])
+                    for cell in shelf.get("cells", [])
+                }
+        cell_ids = {
+            cell["id_based_code"]: cell["id"]
+            for cell in self._cells.find({"id_based_code": {"$exists": True}, "id": {"$exists": True}}, {"_id": 0, "id": 1, "id_based_code": 1})
+        }
+        with self._lock:
+            self._by_id, self._by_id_number, self._by_number = by_id, by_id_number, by_number
+            self._cell_ids = cell_ids
+            self._layout_cells = layout_cells
+            self._version = version
+            self._dirty = False
+            self._checked_at = time.monotonic()
+    
+    def invalidate(self):
+        """Пометить справочник устаревшим во всех процессах; перечитывается при следующем обращении"""
+        self._meta.update_one({"_id": self.META_ID}, {"$inc": {"version": 1}}, upsert=True)
+        self._dirty = True
+    
+    def _ensure_fresh(self):
+        if self._dirty or self._version is None:
+            self.reload()
+        elif time.monotonic() - self._checked_at >= self.check_interval:
+            if self._read_version() != self._version:
+                self.reload()
+            else:
+                self._checked_at = time.monotonic()
+    
+    def on_warehouse_changes(self, collection_name: str, changes: list):
+        self.invalidate()
+    
+    def on_cell_changes(self, collection_name: str, changes: list):
+        """Меняется только набор ячеек: создание или удаление записей с id_based_code"""
+        if any(
+            (before is None or after is None) and (before or after or {}).get("id_based_code")
+            for before, after in changes
+        ):
+            self.invalidate()
+    
+    # ---------- Чтение ----------
+    
+    def warehouse(self, warehouse_id: str) -> Optional[dict]:
+        self._ensure_fresh()
+        entry = self._by_id.get(warehouse_id)
+        return dict(entry) if entry else None
+    
+    def warehouse_by_id_number(self, warehouse_id_number: str) -> Optional[dict]:
+        self._ensure_fresh()
+        entry = self._by_id_number.get(warehouse_id_number)
+        return dict(entry) if entry else None
+    
+    def first_warehouse(self) -> Optional[dict]:
+        self._ensure_fresh()
+        entry = next(iter(self._by_id.values()), None)
+        return dict(entry) if entry else None
+    
+    def cell_id(self, warehouse_id: str, block: int, shelf: int, cell: int) -> Optional[str]:
+        """id записи ячейки ID системы по координатам"""
+        self._ensure_fresh()
+        entry = self._by_id.get(warehouse_id)
+        if not entry or not entry["warehouse_id_number"]:
+            return None
+        return self._cell_ids.get(id_based_cell_code(entry["warehouse_id_number"], block, shelf, cell))
+    
+    def layout_has_cell(self, warehouse_id: str, block: int, shelf: int, cell: int) -> Optional[bool]:
+        """Есть ли ячейка в layout склада; None - у склада нет layout"""
+        self._ensure_fresh()
+        cells = self._layout_cells.get(warehouse_id)
+        return None if cells is None else (block, shelf, cell) in cells
+    
+    def resolve(self, cell_code: str) -> Optional[dict]:
+        """Разобрать код ячейки и найти склад и запись ячейки. None - неверный формат.
+        
+        В результате warehouse = None, если склад не найден; cell_id = None, если у ячейки
+        нет записи ID системы.
+        """
+        parsed = parse_cell_code(cell_code)
+        if not parsed:
+            return None
+        self._ensure_fresh()
+        index = {"id": self._by_id, "warehouse_id_number": self._by_id_number, "warehouse_number": self._by_number}[parsed["warehouse_field"]]
+        entry = index.get(parsed["warehouse_key"])
+        parsed["warehouse"] = dict(entry) if entry else None
+        parsed["cell_id"] = None
+        if parsed["format"] == "id":
+            parsed["cell_id"] = self._cell_ids.get(cell_code)
+        elif entry and entry["warehouse_id_number"]:
+            parsed["cell_id"] = self._cell_ids.get(id_based_cell_code(entry["warehouse_id_number"], parsed["block"], parsed["shelf"], parsed["cell"]))
+        parsed["location_code"] = f"{parsed['block']}-{parsed['shelf']}-{parsed['cell']}"
+        return parsed
+
+cell_directory = CellDirectory(
+    db,
+    check_interval=float(os.environ.get('CELL_DIRECTORY_CHECK_SECONDS', '5'))
+)
+ChangeTrackedDatabase.subscribe("warehouses", ["id"], cell_directory.on_warehouse_changes, on_error=lambda reason: cell_directory.invalidate())
+ChangeTrackedDatabase.subscribe("warehouse_cells", ["id_based_code"], cell_directory.on_cell_changes, on_error=lambda reason: cell_directory.invalidate())
+
+@app.on_event("startup")
+def load_cell_directory():
+    """Загрузка справочника ячеек при старте сервера"""
+    try:
+        cell_directory.reload()
+    except Exception as e:
+        print(f"❌ Ошибка загрузки справочника ячеек: {str(e)}")
+
+# ==================== ЕДИНИЦЫ ГРУЗА ====================
+# Каждая единица груза (individual_items внутри cargo_items, а для позиций без
+# individual_items - единицы, получаемые из quantity) хранится отдельным документом
+# в cargo_units с _id "<коллекция>:<individual_number>". Коллекция - производная:
+# ее поддерживает подписка на записи в cargo и operator_cargo, поэтому все пути
+# размещения и отмены продолжают писать во вложенные массивы, а чтения единиц
+# выполняются одним индексированным запросом. Первичное заполнение (и пересборка
+# при смене CARGO_UNITS_VERSION) - backfill, отчет в schema_meta {"_id": "cargo_units"}.
+
+CARGO_UNITS_VERSION = 1
+CARGO_UNITS_BACKFILL_BATCH = int(os.environ.get('CARGO_UNITS_BACKFILL_BATCH', '1000'))
+
+CARGO_UNIT_SOURCE_FIELDS = [
+    "id", "cargo_number", "cargo_items", "status", "warehouse_id", "warehouse_info", "warehouse_location",
+    "block_number", "shelf_number", "cell_number", "sender_full_name", "recipient_full_name", "recipient_address",
+    "delivery_method", "payment_method", "accepting_operator", "accepting_operator_phone", "created_at"
+]
+# Статусы заявки, при которых ее единицы не показываются в списке ожидающих размещения
+CARGO_UNIT_CLOSED_STATUSES = ("placed_in_warehouse", "removed_from_placement")
+
+def cargo_awaits_placement(cargo: dict) -> bool:
+    """Условие списка размещения: заявка не закрыта и у нее нет полного адреса на складе"""
+    return (
+        cargo.get("status") not in CARGO_UNIT_CLOSED_STATUSES
+        and cargo.get("warehouse_location") in (None, "")
+        and any(cargo.get(field) is None for field in ("block_number", "shelf_number", "cell_number"))
+    )
+
+def build_cargo_units(collection_name: str, cargo: dict) -> Dict[str, dict]:
+    """Документы cargo_units для заявки: {_id: единица}"""
+    cargo_number = cargo.get("cargo_number")
+    warehouse_info = cargo.get("warehouse_info")
+    warehouse_info = warehouse_info[0] if isinstance(warehouse_info, list) and warehouse_info else {}
+    shared = {
+        "source_collection": collection_name,
+        "cargo_id": cargo.get("id"),
+        "cargo_number": cargo_number,
+        "cargo_status": cargo.get("status"),
+        "awaiting_placement": cargo_awaits_placement(cargo),
+        "sender_full_name": cargo.get("sender_full_name"),
+        "recipient_full_name": cargo.get("recipient_full_name"),
+        "recipient_address": cargo.get("recipient_address"),
+        "delivery_method": cargo.get("delivery_method"),
+        "payment_method": cargo.get("payment_method"),
+        "created_at": cargo.get("created_at"),
+        "warehouse_id": cargo.get("warehouse_id"),
+        "warehouse_name": warehouse_info.get("name") if isinstance(warehouse_info, dict) else None,
+        "accepting_operator": cargo.get("accepting_operator"),
+        "accepting_operator_phone": cargo.get("accepting_operator_phone")
+    }
+    
+    units = {}
+    for item_index, cargo_item in enumerate(cargo.get("cargo_items") or []):
+        if not isinstance(cargo_item, dict):
+            continue
+        type_number = f"{item_index + 1:02d}"
+        individual_items = cargo_item.get("individual_items") or []
+        synthetic = not individual_items
+        if synthetic:
+            try:
+                quantity = int(cargo_item.get("quantity", 1) or 0)
+            except (TypeError, ValueError):
+                quantity = 0
+            individual_items = [{"unit_index": f"{unit_index:02d}"} for unit_index in range(1, quantity + 1)]
+        
+        for position, unit in enumerate(individual_items):
+            unit_index = unit.get("unit_index", "01")
+            individual_number = unit.get("individual_number") or f"{cargo_number}/{type_number}/{unit_index}"
+            units[f"{collection_name}:{individual_number}"] = dict(
+                shared,
+                _id=f"{collection_name}:{individual_number}",
+                individual_number=individual_number,
+                item_index=item_index,
+                unit_position=position,
+                type_number=type_number,
+                unit_index=unit_index,
+                synthetic=synthetic,
+                cargo_name=cargo_item.get("cargo_name"),
+                weight=cargo_item.get("weight", 0),
+                is_placed=bool(unit.get("is_placed", False)),
+                placement_status=unit.get("placement_status", "awaiting_placement"),
+                placement_info=unit.get("placement_info"),
+                placement_timestamp=unit.get("placement_timestamp"),
+                placed_by=unit.get("placed_by"),
+                placement_session_id=unit.get("placement_session_id")
+            )
+    return units
+
+class CargoUnitsService:
+    """Поддержка коллекции cargo_units по изменениям заявок и ее первичное заполнение"""
+    
+    def __init__(self, database):
+        self.units = database.cargo_units
+        self.database = database
+        self.state = BackfillState(database.schema_meta, "cargo_units", CARGO_UNITS_VERSION)
+    
+    def on_cargo_changes(self, collection_name: str, changes: list):
+        operations = []
+        now = datetime.utcnow()
+        for before, after in changes:
+            old_units = build_cargo_units(collection_name, before) if before is not None else {}
+            new_units = build_cargo_units(collection_name, after) if after is not None else {}
+            operations.extend(DeleteOne({"_id": unit_id}) for unit_id in old_units.keys() - new_units.keys())
+            operations.extend(
+                ReplaceOne({"_id": unit_id}, dict(unit, synced_at=now), upsert=True)
+                for unit_id, unit in new_units.items() if old_units.get(unit_id) != unit
+            )
+        if operations:
+            self.units.bulk_write(operations, ordered=False)
+    
+    def is_built(self) -> bool:
+        return self.state.is_built()
+    
+    def backfill(self) -> dict:
+        """Пересобрать cargo_units из всех заявок.
+        
+        Каждая единица перезаписывается со штампом synced_at; единицы, которых не коснулись
+        ни заполнение, ни подписка после его начала, принадлежат удаленным заявкам и удаляются.
+        """
+        started_at = datetime.utcnow()
+        projection = {field: 1 for field in CARGO_UNIT_SOURCE_FIELDS}
+        written = 0
+        for collection_name in CARGO_COLLECTIONS:
+            operations = []
+            for cargo in self.database[collection_name].find({}, projection).batch_size(CARGO_UNITS_BACKFILL_BATCH):
+                now = datetime.utcnow()
+                operations.extend(
+                    ReplaceOne({"_id": unit_id}, dict(unit, synced_at=now), upsert=True)
+                    for unit_id, unit in build_cargo_units(collection_name, cargo).items()
+                )
+                if len(operations) >= CARGO_UNITS_BACKFILL_BATCH:
+                    self.units.bulk_write(operations, ordered=False)
+                    written += len(operations)
+                    operations = []
+            if operations:
+                self.units.bulk_write(operations, ordered=False)
+                written += len(operations)
+        
+        removed = self.units.delete_many({"synced_at": {"$lt": started_at}}).deleted_count
+        report = {
+            "version": CARGO_UNITS_VERSION,
+            "started_at": started_at,
+            "finished_at": datetime.utcnow(),
+            "units": written,
+            "removed": removed
+        }
+        self.state.mark_built(report)
+        print(f"🧩 Единицы груза v{CARGO_UNITS_VERSION}: записано {written}, удалено устаревших {removed}")
+        return report
+
+# Порядок списка единиц для размещения: по номеру заявки, затем в порядке позиций и единиц
+CARGO_UNIT_ORDER = {"cargo_number": 1, "source_collection": 1, "item_index": 1, "unit_position": 1}
+
+def cargo_unit_filters(cargo_type_filter: Optional[str] = None, status_filter: Optional[str] = None) -> dict:
+    """Условия фильтров списка единиц по полям документа cargo_units"""
+    query = {}
+    if cargo_type_filter:
+        query["type_number"] = cargo_type_filter
+    if status_filter == "placed":
+        query["placement_status"] = "placed"
+    elif status_filter == "awaiting":
+        query["placement_status"] = "awaiting_placement"
+    return query
+
+def _zero_pad_expression(number) -> dict:
+    """Выражение агрегации: число как строка минимум из двух цифр (1 -> "01")"""
+    return {"$let": {
+        "vars": {"text": {"$toString": number}},
+        "in": {"$cond": [{"$lt": [{"$strLenCP": "$$text"}, 2]}, {"$concat": ["0", "$$text"]}, "$$text"]}
+    }}
+
+def source_units_pipeline(unit_filters: dict) -> list:
+    """Pipeline, разворачивающий единицы ожидающих размещения заявок прямо из cargo и operator_cargo.
+    
+    Повторяет build_cargo_units внутри MongoDB ($unionWith + $unwind): используется,
+    пока cargo_units еще не заполнена. Результат - документы с полями cargo_units.
+    """
+    awaiting_query = {
+        "status": {"$nin": list(CARGO_UNIT_CLOSED_STATUSES)},
+        "$and": [
+            {"warehouse_location": {"$in": [None, ""]}},
+            {"$or": [{field: None} for field in ("block_number", "shelf_number", "cell_number")]}
+        ]
+    }
+    projection = {field: 1 for field in CARGO_UNIT_SOURCE_FIELDS}
+    projection["_id"] = 0
+    individual_items = "$cargo_items.individual_items"
+    
+    pipeline = _cargo_union_pipeline(awaiting_query, projection)
+    pipeline.extend([
+        {"$unwind": {"path": "$cargo_items", "includeArrayIndex": "item_index"}},
+        {"$match": {"cargo_items": {"$type": "object"}}},
+        {"$addFields": {
+            "type_number": _zero_pad_expression({"$add": ["$item_index", 1]}),
+            "synthetic": {"$eq": [{"$size": {"$cond": [{"$isArray": individual_items}, individual_items, []]}}, 0]}
+        }},
+        {"$addFields": {"units": {"$cond": [
+            "$synthetic",
+            {"$map": {
+                "input": {"$range": [1, {"$add": [
+                    {"$convert": {"input": "$cargo_items.quantity", "to": "int", "onError": 0, "onNull": 1}}, 1
+                ]}]},
+                "as": "index",
+                "in": {"unit_index": _zero_pad_expression("$$index")}
+            }},
+            individual_items
+        ]}}},
+        {"$unwind": {"path": "$units", "includeArrayIndex": "unit_position"}},
+        {"$project": {
+            "source_collection": f"${CARGO_SOURCE_FIELD}",
+            "cargo_id": "$id",
+            "cargo_number": 1,
+            "cargo_status": "$status",
+            "sender_full_name": 1,
+            "recipient_full_name": 1,
+            "recipient_address": 1,
+            "delivery_method": 1,
+            "payment_method": 1,
+            "created_at": 1,
+            "warehouse_id": 1,
+            "warehouse_name": {"$arrayElemAt": ["$warehouse_info.name", 0]},
+            "accepting_operator": 1,
+            "accepting_operator_phone": 1,
+            "item_index": 1,
+            "unit_position": 1,
+            "type_number": 1,
+            "synthetic": 1,
+            "unit_index": {"$ifNull": ["$units.unit_index", "01"]},
+            "individual_number": {"$ifNull": ["$units.individual_number", {"$concat": [
+                {"$toString": "$cargo_number"}, "/", "$type_number", "/", {"$ifNull": ["$units.unit_index", "01"]}
+            ]}]},
+            "cargo_name": "$cargo_items.cargo_name",
+            "weight": {"$ifNull": ["$cargo_items.weight", 0]},
+            "is_placed": {"$eq": ["$units.is_placed", True]},
+            "placement_status": {"$ifNull": ["$units.placement_status", "awaiting_placement"]},
+            "placement_info": "$units.placement_info"
+        }}
+    ])
+    if unit_filters:
+        pipeline.append({"$match": unit_filters})
+    return pipeline
+
+def cargo_unit_card(unit: dict) -> dict:
+    """Карточка единицы груза в формате списка individual units для размещения"""
+    return {
+        "individual_number": unit["individual_number"],
+        "cargo_request_number": unit.get("cargo_number"),
+        "cargo_id": unit.get("cargo_id"),
+        "cargo_name": unit.get("cargo_name") or "Неизвестный груз",
+        "type_number": unit.get("type_number"),
+        "unit_index": unit.get("unit_index", "01"),
+        "placement_status": unit.get("placement_status", "awaiting_placement"),
+        "weight": unit.get("weight", 0),
+        "is_placed": unit.get("is_placed", False),
+        "placement_info": unit.get("placement_info"),
+        
+        # Информация о заявке
+        "sender_full_name": unit.get("sender_full_name") or "Неизвестно",
+        "recipient_full_name": unit.get("recipient_full_name") or "Неизвестно",
+        "recipient_address": unit.get("recipient_address") or "Неизвестно",
+        "delivery_method": unit.get("delivery_method") or "pickup",
+        "payment_method": unit.get("payment_method") or "cash",
+        "created_at": unit.get("created_at"),
+        
+        # Информация о складе и операторе
+        "warehouse_name": unit.get("warehouse_name") or "Неизвестен",
+        "warehouse_id": unit.get("warehouse_id"),
+        "accepting_operator": {
+            "operator_name": unit.get("accepting_operator") or "Неизвестно",
+            "operator_phone": unit.get("accepting_operator_phone") or "Не указан"
+        }
+    }
+
+cargo_units = CargoUnitsService(db)
+for _cargo_collection_name in CARGO_COLLECTIONS:
+    ChangeTrackedDatabase.subscribe(_cargo_collection_name, CARGO_UNIT_SOURCE_FIELDS, cargo_units.on_cargo_changes, on_error=cargo_units.state.mark_dirty)
+register_backfill(cargo_units.state, cargo_units.backfill, "единицы груза")
+
+def find_cargo_units(
+    collection_name: str,
+    individual_numbers: Optional[List[str]] = None,
+    cargo_id: Optional[str] = None,
+    **conditions
+) -> List[dict]:
+    """Единицы заявок коллекции по номерам и/или по заявке с условиями равенства полей.
+    
+    Пока cargo_units не заполнена, единицы строятся из самих заявок (build_cargo_units).
+    """
+    query = {"source_collection": collection_name, **conditions}
+    source_query = {}
+    if individual_numbers is not None:
+        query["individual_number"] = {"$in": list(individual_numbers)}
+        # Синтетические единицы (позиции только с quantity) ищутся по номеру заявки из NUMBER/TT/UU
+        cargo_numbers = {number.rsplit("/", 2)[0] for number in individual_numbers if number.count("/") >= 2}
+        source_query["$or"] = [
+            {"cargo_items.individual_items.individual_number": {"$in": list(individual_numbers)}},
+            {"cargo_number": {"$in": list(cargo_numbers)}}
+        ]
+    if cargo_id is not None:
+        query["cargo_id"] = cargo_id
+        source_query["id"] = cargo_id
+    if cargo_units.is_built():
+        return list(db.cargo_units.find(query))
+    
+    wanted = set(individual_numbers) if individual_numbers is not None else None
+    units = []
+    for cargo in db[collection_name].find(source_query, {field: 1 for field in CARGO_UNIT_SOURCE_FIELDS}):
+        units.extend(
+            unit for unit in build_cargo_units(collection_name, cargo).values()
+            if (wanted is None or unit["individual_number"] in wanted)
+            and all(unit.get(field) == value for field, value in conditions.items())
+        )
+    return units
+
+@app.post("/api/admin/cargo-units/backfill")
+def backfill_cargo_units(
+    current_user: User = Depends(require_role(UserRole.ADMIN))
+):
+    """Пересобрать коллекцию cargo_units из заявок и вернуть отчет"""
+    return cargo_units.backfill()
+
+# ==================== МАССОВЫЕ ИЗМЕНЕНИЯ ====================
+# Массовые endpoint'ы находят все идентификаторы одним $in на коллекцию, применяют
+# изменения через bulk_write и в том же проходе убирают ссылки на удаленные сущности:
+# ячейки складов, фото, историю размещения и cargo_list транспортов. Ответ каждого
+# массового endpoint'а содержит results - исход по каждому запрошенному id.
+
+def bulk_outcome(entity_id: str, success: bool, error: Optional[str] = None, **details) -> dict:
+    """Исход массовой операции для одного идентификатора"""
+    outcome = {"id": entity_id, "success": success, **details}
+    if error:
+        outcome["error"] = error
+    return outcome
+
+def bulk_write_failures(collection, operations: list) -> Dict[int, str]:
+    """Неупорядоченный bulk_write; {индекс операции: ошибка} для неудавшихся операций"""
+    if not operations:
+        return {}
+    try:
+        collection.bulk_write(operations, ordered=False)
+    except BulkWriteError as e:
+        return {item["index"]: item.get("errmsg", "write error") for item in e.details.get("writeErrors", [])}
+    return {}
+
+def resolve_cargo_ids(cargo_ids: list, projection: Optional[dict] = None, include_requests: bool = False) -> Dict[str, dict]:
+    """Найти грузы по списку id: {id: {"collection", "cargo", "request_id"}}.
+    
+    operator_cargo (в приоритете) и cargo просматриваются одним aggregate, позиции
+    заявок на забор (include_requests) - одним find по items.id для ненайденных id.
+    """
+    resolved = {
+        cargo_id: {"collection": collection_name, "cargo": cargo, "request_id": None}
+        for cargo_id, (cargo, collection_name) in locate_cargo_many(
+            "id", cargo_ids, projection, collections=("operator_cargo", "cargo")
+        ).items()
+    }
+    missing = [cargo_id for cargo_id in cargo_ids if cargo_id not in resolved]
+    if include_requests and missing:
+        wanted = set(missing)
+        for cargo_request in db.cargo_requests.find({"items.id": {"$in": missing}}, {"_id": 0, "id": 1, "items": 1}):
+            for item in cargo_request.get("items") or []:
+                if item.get("id") in wanted and item["id"] not in resolved:
+                    resolved[item["id"]] = {"collection": "cargo_requests", "cargo": item, "request_id": cargo_request["id"]}
+    return resolved
+
+def bulk_update_cargo(resolved: Dict[str, dict], fields: dict) -> Dict[str, str]:
+    """Установить поля найденным грузам одним bulk_write на коллекцию; {id: ошибка} для неудачных.
+    
+    Для позиций заявок на забор поля пишутся в элемент массива items, updated_at - в заявку.
+    """
+    now = datetime.utcnow()
+    operations: Dict[str, list] = {}
+    for cargo_id, entry in resolved.items():
+        if entry["collection"] == "cargo_requests":
+            update = {f"items.$.{field}": value for field, value in fields.items()}
+            operation = TrackedUpdateOne({"id": entry["request_id"], "items.id": cargo_id}, {"$set": dict(update, updated_at=now)})
+        else:
+            operation = TrackedUpdateOne({"id": cargo_id}, {"$set": dict(fields, updated_at=now)})
+        operations.setdefault(entry["collection"], []).append((cargo_id, operation))
+    
+    errors = {}
+    for collection_name, entries in operations.items():
+        failures = bulk_write_failures(db[collection_name], [operation for _, operation in entries])
+        errors.update({entries[index][0]: error for index, error in failures.items()})
+    return errors
+
+def cascade_deleted_cargo(cargo_docs: List[dict]) -> dict:
+    """Убрать ссылки на удаленные грузы: освободить ячейки, удалить фото, историю размещения
+    и записи размещения единиц, исключить грузы из cargo_list транспортов с уменьшением загрузки"""
+    weights = {cargo["id"]: _stats_float(cargo.get("weight")) for cargo in cargo_docs if cargo.get("id")}
+    report = {"cells_released": 0, "photos_deleted": 0, "placement_history_deleted": 0, "placement_records_deleted": 0, "transports_updated": 0}
+    if not weights:
+        return report
+    cargo_ids = list(weights)
+    now = datetime.utcnow()
+    
+    report["cells_released"] = db.warehouse_cells.update_many(
+        {"cargo_id": {"$in": cargo_ids}},
+        {"$set": {"is_occupied": False, "cargo_id": None, "updated_at": now}}
+    ).modified_count
+    report["photos_deleted"] = db.cargo_photos.delete_many({"cargo_id": {"$in": cargo_ids}}).deleted_count
+    report["placement_history_deleted"] = db.placement_history.delete_many({"cargo_id": {"$in": cargo_ids}}).deleted_count
+    report["placement_records_deleted"] = db.placement_records.delete_many({"cargo_id": {"$in": cargo_ids}}).deleted_count
+    
+    transport_operations = []
+    for transport in db.transports.find({"cargo_list": {"$in": cargo_ids}}, {"_id": 0, "id": 1, "cargo_list": 1, "current_load_kg": 1}):
+        cargo_list = transport.get("cargo_list") or []
+        removed_weight = sum(weights[cargo_id] for cargo_id in set(cargo_list) if cargo_id in weights)
+        transport_operations.append(TrackedUpdateOne({"id": transport["id"]}, {"$set": {
+            "cargo_list": [cargo_id for cargo_id in cargo_list if cargo_id not in weights],
+            "current_load_kg": max(0, _stats_float(transport.get("current_load_kg")) - removed_weight),
+            "updated_at": now
+        }}))
+    bulk_write_failures(db.transports, transport_operations)
+    report["transports_updated"] = len(transport_operations)
+    return report
+
+def cascade_deleted_warehouses(warehouse_ids: list) -> dict:
+    """Удалить привязки операторов и структуру (блоки, полки, ячейки) удаленных складов"""
+    if not warehouse_ids:
+        return {"bindings_deleted": 0, "cells_deleted": 0, "blocks_deleted": 0, "shelves_deleted": 0}
+    query = {"warehouse_id": {"$in": list(warehouse_ids)}}
+    report = {
+        "bindings_deleted": db.operator_warehouse_bindings.delete_many(query).deleted_count,
+        "cells_deleted": db.warehouse_cells.delete_many(query).deleted_count,
+        "blocks_deleted": db.warehouse_blocks.delete_many(query).deleted_count,
+        "shelves_deleted": db.warehouse_shelves.delete_many(query).deleted_count
+    }
+    operator_bindings.invalidate()
+    return report
+
+# ==================== ПОИСКОВЫЙ ИНДЕКС ====================
+# Для каждого груза, пользователя и склада в search_index хранится документ
+# с нормализованными значениями полей поиска, триграммами ("<группа>:<триграмма>")
+# и словами ("<группа>:<слово>"). Документы поддерживаются подпиской на записи
+# в исходные коллекции. Поиск подстроки от 3 символов - индексированный $all
+# по триграммам запроса, короче - префиксный поиск по словам; кандидаты проверяются
+# на вхождение подстроки и ранжируются search_relevance. Точные совпадения выбираются
+# отдельным запросом, чтобы их не отсек лимит кандидатов. Первичное заполнение -
+# backfill при смене SEARCH_INDEX_VERSION, отчет в schema_meta {"_id": "search_index"};
+# пока индекс не построен, кандидаты ищутся регулярным выражением по исходным коллекциям.
+
+SEARCH_INDEX_VERSION = 1
+SEARCH_GRAM_SIZE = 3
+SEARCH_CANDIDATE_LIMIT = int(os.environ.get('SEARCH_CANDIDATE_LIMIT', '500'))
+SEARCH_BACKFILL_BATCH = int(os.environ.get('SEARCH_BACKFILL_BATCH', '1000'))
+SEARCH_PHONE_QUERY_PATTERN = re.compile(r"^[\d\s()+\-]+$")
+SEARCH_WORD_PATTERN = re.compile(r"\w+")
+
+# Группы полей по типам сущностей: группа -> (поля, вес в релевантности, телефонная группа)
+SEARCH_ENTITY_GROUPS = {
+    "cargo": {
+        "number": (["cargo_number"], 50.0, False),
+        "sender_name": (["sender_full_name"], 20.0, False),
+        "recipient_name": (["recipient_full_name", "recipient_name"], 20.0, False),
+        "phone": (["sender_phone", "recipient_phone"], 25.0, True),
+        "cargo_name": (["cargo_name", "description"], 30.0, False),
+    },
+    "user": {
+        "number": (["user_number"], 70.0, False),
+        "name": (["full_name"], 50.0, False),
+        "phone": (["phone"], 60.0, True),
+        "email": (["email"], 40.0, False),
+    },
+    "warehouse": {
+        "name": (["name"], 70.0, False),
+        "location": (["location"], 50.0, False),
+        "description": (["description"], 30.0, False),
+    },
+}
+SEARCH_ENTITY_SOURCES = {"cargo": CARGO_COLLECTIONS, "user": ("users",), "warehouse": ("warehouses",)}
+SEARCH_SOURCE_ENTITIES = {source: entity for entity, sources in SEARCH_ENTITY_SOURCES.items() for source in sources}
+
+def search_source_fields(entity: str) -> List[str]:
+    """Поля исходной коллекции, от которых зависит документ индекса"""
+    fields = {"id"}
+    for group_fields, _, _ in SEARCH_ENTITY_GROUPS[entity].values():
+        fields.update(group_fields)
+    return sorted(fields)
+
+def normalize_search_text(value, phone: bool = False) -> str:
+    """Нормализованный текст для поиска: нижний регистр и ё -> е, для телефонов только цифры"""
+    if value is None:
+        return ""
+    text = str(value)
+    if phone:
+        return "".join(char for char in text if char.isdigit())
+    return " ".join(text.lower().replace("ё", "е").split())
+
+def search_grams(text: str) -> Set[str]:
+    """Триграммы текста (короче трех символов - пусто)"""
+    return {text[i:i + SEARCH_GRAM_SIZE] for i in range(len(text) - SEARCH_GRAM_SIZE + 1)}
+
+def search_needle(query: str, phone: bool) -> str:
+    """Искомая подстрока для группы; пусто, если запрос к группе неприменим"""
+    if phone and not SEARCH_PHONE_QUERY_PATTERN.match(query or ""):
+        return ""
+    return normalize_search_text(query, phone)
+
+def build_search_entry(entity: str, source: str, document: dict) -> Optional[dict]:
+    """Документ search_index для сущности (None, если у нее нет id)"""
+    if not document.get("id"):
+        return None
+    values, grams, words = {}, set(), set()
+    for group, (fields, _, phone) in SEARCH_ENTITY_GROUPS[entity].items():
+        group_values = []
+        for field in fields:
+            text = normalize_search_text(document.get(field), phone)
+            if text and text not in group_values:
+                group_values.append(text)
+                grams.update(f"{group}:{gram}" for gram in search_grams(text))
+                words.update(f"{group}:{word}" for word in SEARCH_WORD_PATTERN.findall(text))
+        if group_values:
+            values[group] = group_values
+    return {
+        "_id": f"{source}:{document['id']}",
+        "entity": entity,
+        "source": source,
+        "ref": document["id"],
+        "values": values,
+        "grams": sorted(grams),
+        "words": sorted(words)
+    }
+
+def search_relevance(entity: str, values: dict, query: Optional[str], groups=None) -> float:
+    """Релевантность по группам: точное совпадение - двойной вес группы, начало значения
+    или слова - полуторный, вхождение подстроки - одинарный (не больше 100)"""
+    if not query:
+        return 1.0
+    score = 0.0
+    for group, (_, weight, phone) in SEARCH_ENTITY_GROUPS[entity].items():
+        if groups and group not in groups:
+            continue
+        needle = search_needle(query, phone)
+        if not needle:
+            continue
+        best = 0.0
+        for value in values.get(group, []):
+            if value == needle:
+                best = 2.0
+            elif value.startswith(needle) or f" {needle}" in value:
+                best = max(best, 1.5)
+            elif needle in value:
+                best = max(best, 1.0)
+        score += weight * best
+    return min(score, 100.0)
+
+class SearchIndexService:
+    """Поддержка search_index по изменениям исходных коллекций, поиск и первичное заполнение"""
+    
+    def __init__(self, database):
+        self.index = database.search_index
+        self.database = database
+        self.state = BackfillState(database.schema_meta, "search_index", SEARCH_INDEX_VERSION)
+    
+    def on_changes(self, collection_name: str, changes: list):
+        entity = SEARCH_SOURCE_ENTITIES[collection_name]
+        operations = []
+        for before, after in changes:
+            old_entry = build_search_entry(entity, collection_name, before) if before is not None else None
+            new_entry = build_search_entry(entity, collection_name, after) if after is not None else None
+            if old_entry and (not new_entry or new_entry["_id"] != old_entry["_id"]):
+                operations.append(DeleteOne({"_id": old_entry["_id"]}))
+            if new_entry and new_entry != old_entry:
+                operations.append(ReplaceOne({"_id": new_entry["_id"]}, dict(new_entry, synced_at=datetime.utcnow()), upsert=True))
+        if operations:
+            self.index.bulk_write(operations, ordered=False)
+    
+    def match(self, entity: str, query: str, groups=None, sources=None, limit: int = SEARCH_CANDIDATE_LIMIT) -> List[dict]:
+        """Найти сущности, у которых значение хотя бы одной группы содержит запрос.
+        
+        Возвращает не больше limit (0 - без ограничения) записей [{"source", "ref", "score"}]
+        по убыванию релевантности. Точные совпадения выбираются первыми, остальные
+        кандидаты - не больше limit из индекса.
+        """
+        entity_groups = SEARCH_ENTITY_GROUPS[entity]
+        groups = [group for group in (groups or entity_groups) if group in entity_groups]
+        needles = {}
+        clauses = {}
+        for group in groups:
+            needle = search_needle(query, entity_groups[group][2])
+            if not needle:
+                continue
+            if len(needle) >= SEARCH_GRAM_SIZE:
+                clauses[group] = {"grams": {"$all": sorted(f"{group}:{gram}" for gram in search_grams(needle))}}
+            elif SEARCH_WORD_PATTERN.fullmatch(needle):
+                clauses[group] = {"words": {"$regex": f"^{re.escape(group)}:{re.escape(needle)}"}}
+            else:
+                continue
+            needles[group] = needle
+        if not needles:
+            return []
+        
+        if self.is_built():
+            candidates = self._index_candidates(entity, needles, clauses, sources, limit)
+        else:
+            candidates = self._source_candidates(entity, query, needles, sources, limit)
+        hits = []
+        for entry in candidates:
+            values = entry.get("values", {})
+            if any(needle in value for group, needle in needles.items() for value in values.get(group, [])):
+                hits.append({
+                    "source": entry["source"],
+                    "ref": entry["ref"],
+                    "score": search_relevance(entity, values, query, groups)
+                })
+        hits.sort(key=lambda hit: hit["score"], reverse=True)
+        return hits[:limit] if limit else hits
+    
+    def _index_candidates(self, entity: str, needles: dict, clauses: dict, sources, limit: int) -> list:
+        """Кандидаты из search_index: сначала точные совпадения значения группы, затем остальные"""
+        base_query = {"entity": entity}
+        if sources:
+            base_query["source"] = {"$in": list(sources)}
+        exact_clauses = [dict(clauses[group], **{f"values.{group}": needle}) for group, needle in needles.items()]
+        candidates = {}
+        for clause_list in (exact_clauses, list(clauses.values())):
+            cursor = self.index.find(dict(base_query, **{"$or": clause_list}), {"source": 1, "ref": 1, "values": 1})
+            for entry in cursor.limit(limit):
+                candidates.setdefault(entry["_id"], entry)
+        return list(candidates.values())
+    
+    def _source_candidates(self, entity: str, query: str, needles: dict, sources, limit: int) -> list:
+        """Кандидаты регулярным выражением по исходным коллекциям (индекс еще не построен)"""
+        pattern = {"$regex": re.escape(query.strip()), "$options": "i"}
+        conditions = [{field: pattern} for group in needles for field in SEARCH_ENTITY_GROUPS[entity][group][0]]
+        projection = {field: 1 for field in search_source_fields(entity)}
+        candidates = []
+        for source in sources or SEARCH_ENTITY_SOURCES[entity]:
+            for document in self.database[source].find({"$or": conditions}, projection).limit(limit):
+                entry = build_search_entry(entity, source, document)
+                if entry:
+                    candidates.append(entry)
+        return candidates
+    
+    def is_built(self) -> bool:
+        return self.state.is_built()
+    
+    def backfill(self) -> dict:
+        """Пересобрать search_index из всех исходных коллекций (устаревшие документы удаляются)"""
+        started_at = datetime.utcnow()
+        written = {}
+        for source, entity in SEARCH_SOURCE_ENTITIES.items():
+            projection = {field: 1 for field in search_source_fields(entity)}
+            operations = []
+            written[source] = 0
+            for document in self.database[source].find({}, projection).batch_size(SEARCH_BACKFILL_BATCH):
+                entry = build_search_entry(entity, source, document)
+                if entry:
+                    operations.append(ReplaceOne({"_id": entry["_id"]}, dict(entry, synced_at=datetime.utcnow()), upsert=True))
+                if len(operations) >= SEARCH_BACKFILL_BATCH:
+                    self.index.bulk_write(operations, ordered=False)
+                    written[source] += len(operations)
+                    operations = []
+            if operations:
+                self.index.bulk_write(operations, ordered=False)
+                written[source] += len(operations)
+        
+        removed = self.index.delete_many({"synced_at": {"$lt": started_at}}).deleted_count
+        report = {
+            "version": SEARCH_INDEX_VERSION,
+            "started_at": started_at,
+            "finished_at": datetime.utcnow(),
+            "documents": written,
+            "removed": removed
+        }
+        self.state.mark_built(report)
+        print(f"🔎 Поисковый индекс v{SEARCH_INDEX_VERSION}: записано {sum(written.values())}, удалено устаревших {removed}")
+        return report
+
+search_index = SearchIndexService(db)
+for _search_source, _search_entity in SEARCH_SOURCE_ENTITIES.items():
+    ChangeTrackedDatabase.subscribe(_search_source, search_source_fields(_search_entity), search_index.on_changes, on_error=search_index.state.mark_dirty)
+register_backfill(search_index.state, search_index.backfill, "поисковый индекс")
+
+def search_entities(entity: str, query: str, groups=None, limit: int = SEARCH_CANDIDATE_LIMIT) -> List[tuple]:
+    """Найти сущности по индексу и загрузить их документы: [(документ, коллекция, релевантность)].
+    
+    Документы каждой коллекции загружаются одним $in; порядок - по убыванию релевантности.
+    """
+    hits = search_index.match(entity, query, groups, limit=limit)
+    refs: Dict[str, list] = {}
+    for hit in hits:
+        refs.setdefault(hit["source"], []).append(hit["ref"])
+    documents = {}
+    for source, ids in refs.items():
+        for document in db[source].find({"id": {"$in": ids}}, {"_id": 0, "password": 0}):
+            documents.setdefault((source, document["id"]), document)
+    return [
+        (documents[(hit["source"], hit["ref"])], hit["source"], hit["score"])
+        for hit in hits if (hit["source"], hit["ref"]) in documents
+    ]
+
+@app.post("/api/admin/search-index/backfill")
+def backfill_search_index(
+    current_user: User = Depends(require_role(UserRole.ADMIN))
+):
+    """Пересобрать поисковый индекс и вернуть отчет"""
+    return search_index.backfill()
+
+# ==================== КЛЮЧИ ТЕЛЕФОНОВ ====================
+# Телефоны хранятся в разных форматах ("+992 900 00 00 00", "8 9...", со скобками),
+# поэтому рядом с каждым полем телефона хранится канонический ключ "<поле>_key"
+# (только цифры, российская "8" в начале заменяется на "7") и перевернутый ключ
+# "<поле>_rkey" для поиска по последним цифрам анкерным префиксом по индексу.
+# Ключи проставляются при записи через подписку на изменения полей телефонов;
+# для существующих документов - backfill при смене PHONE_KEYS_VERSION,
+# отчет в schema_meta {"_id": "phone_keys"}.
+
+PHONE_KEYS_VERSION = 1
+PHONE_KEYS_BACKFILL_BATCH = int(os.environ.get('PHONE_KEYS_BACKFILL_BATCH', '1000'))
+PHONE_SUFFIX_MIN_DIGITS = 4
+PHONE_KEY_FIELDS = {
+    "users": ["phone"],
+    "cargo": ["sender_phone", "recipient_phone"],
+    "operator_cargo": ["sender_phone", "recipient_phone"],
+    "couriers": ["phone"],
+    "debts": ["debtor_phone"],
+}
+
+def phone_key(phone) -> str:
+    """Канонический ключ телефона: только цифры, "8XXXXXXXXXX" -> "7XXXXXXXXXX" """
+    digits = "".join(char for char in str(phone or "") if char.isdigit())
+    if len(digits) == 11 and digits.startswith("8"):
+        digits = "7" + digits[1:]
+    return digits
+
+def phone_key_fields(collection_name: str, document: dict) -> dict:
+    """Значения полей ключей телефонов для документа"""
+    keys = {}
+    for field in PHONE_KEY_FIELDS[collection_name]:
+        key = phone_key(document.get(field))
+        keys[f"{field}_key"] = key or None
+        keys[f"{field}_rkey"] = key[::-1] or None
+    return keys
+
+def phone_exact_filter(field: str, phone: str) -> dict:
+    """Фильтр точного совпадения телефона по ключу (до заполнения ключей - и по исходной строке)"""
+    key = phone_key(phone)
+    if not key:
+        return {field: phone}
+    return {"$or": [{f"{field}_key": key}, {field: phone}]}
+
+def phone_suffix_filter(field: str, digits: str) -> dict:
+    """Фильтр "телефон заканчивается на эти цифры" по индексу перевернутого ключа"""
+    key = phone_key(digits)
+    if len(key) < PHONE_SUFFIX_MIN_DIGITS:
+        raise HTTPException(status_code=400, detail=f"Phone search requires at least {PHONE_SUFFIX_MIN_DIGITS} digits")
+    return {f"{field}_rkey": {"$regex": f"^{re.escape(key[::-1])}"}}
+
+def find_user_by_phone(phone: str, extra_query: Optional[dict] = None, projection: Optional[dict] = None) -> Optional[dict]:
+    """Пользователь по телефону в любом формате записи.
+    
+    Если номер (в разных форматах) записан у нескольких пользователей, выбрать
+    одного нельзя - 409 вместо произвольного совпадения.
+    """
+    users = list(db.users.find({**phone_exact_filter("phone", phone), **(extra_query or {})}, projection).limit(2))
+    if len(users) > 1:
+        raise HTTPException(
+            status_code=409,
+            detail="Номер телефона записан у нескольких пользователей, обратитесь к администратору"
+        )
+    return users[0] if users else None
+
+class PhoneKeysService:
+    """Простановка ключей телефонов при записи и первичное заполнение"""
+    
+    def __init__(self, database):
+        self.database = database
+        self.state = BackfillState(database.schema_meta, "phone_keys", PHONE_KEYS_VERSION)
+    
+    def on_changes(self, collection_name: str, changes: list):
+        operations = []
+        for _, after in changes:
+            if after is None:
+                continue
+            keys = phone_key_fields(collection_name, after)
+            if any(after.get(field) != value for field, value in keys.items()):
+                # Ключи пишутся, только если телефоны не поменялись после этой записи
+                phone_filter = {field: after.get(field) for field in PHONE_KEY_FIELDS[collection_name]}
+                operations.append(UpdateOne(dict(phone_filter, _id=after["_id"]), {"$set": keys}))
+        if operations:
+            # Запись идет мимо подписок: меняются только поля ключей, повторно вызывать слушателей незачем
+            Collection(self.database, collection_name).bulk_write(operations, ordered=False)
+    
+    def backfill(self) -> dict:
+        """Проставить ключи всем документам, у которых они отсутствуют или устарели"""
+        started_at = datetime.utcnow()
+        updated = {}
+        for collection_name, fields in PHONE_KEY_FIELDS.items():
+            # Запись идет мимо подписок: меняются только поля ключей
+            collection = Collection(self.database, collection_name)
+            projection = {field: 1 for field in fields}
+            projection.update({f"{field}_key": 1 for field in fields})
+            projection.update({f"{field}_rkey": 1 for field in fields})
+            operations = []
+            updated[collection_name] = 0
+            for document in collection.find({}, projection).batch_size(PHONE_KEYS_BACKFILL_BATCH):
+                keys = phone_key_fields(collection_name, document)
+                if any(document.get(field) != value for field, value in keys.items()):
+                    operations.append(UpdateOne({"_id": document["_id"]}, {"$set": keys}))
+                if len(operations) >= PHONE_KEYS_BACKFILL_BATCH:
+                    collection.bulk_write(operations, ordered=False)
+                    updated[collection_name] += len(operations)
+                    operations = []
+            if operations:
+                collection.bulk_write(operations, ordered=False)
+                updated[collection_name] += len(operations)
+        
+        report = {
+            "version": PHONE_KEYS_VERSION,
+            "started_at": started_at,
+            "finished_at": datetime.utcnow(),
+            "updated": updated
+        }
+        self.state.mark_built(report)
+        print(f"📞 Ключи телефонов v{PHONE_KEYS_VERSION}: обновлено {sum(updated.values())} документов")
+        return report
+
+phone_keys = PhoneKeysService(db)
+for _phone_collection, _phone_fields in PHONE_KEY_FIELDS.items():
+    ChangeTrackedDatabase.subscribe(
+        _phone_collection,
+        _phone_fields + [f"{field}_key" for field in _phone_fields] + [f"{field}_rkey" for field in _phone_fields],
+        phone_keys.on_changes,
+        on_error=phone_keys.state.mark_dirty
+    )
+register_backfill(phone_keys.state, phone_keys.backfill, "ключи телефонов")
+
+@app.post("/api/admin/phone-keys/backfill")
+def backfill_phone_keys(
+    current_user: User = Depends(require_role(UserRole.ADMIN))
+):
+    """Проставить ключи телефонов всем документам и вернуть отчет"""
+    return phone_keys.backfill()
+
+# ==================== ПОДСКАЗКИ ПОИСКА ====================
+# Автодополнение /api/search/suggest обслуживается индексом в памяти процесса:
+# отсортированный массив ключей (нормализованный текст, тип, значение) с поиском
+# префикса бинарным поиском. Имена индексируются с начала каждого слова, поэтому
+# "алиш" находит "Рахимов Алишер". Индекс строится при старте и ограничен
+# SUGGEST_MAX_TERMS ключами (при заполнении новые ключи отбрасываются до перестройки).
+# Записи этого процесса применяются подпиской сразу и публикуются в
+# search_suggestion_deltas (изменения ключей по документам); другие процессы
+# забирают их каждые SUGGEST_SYNC_SECONDS. Полная перестройка - только при старте,
+# после ошибки подписчика или если процесс отстал больше, чем хранятся изменения.
+
+SUGGEST_MAX_TERMS = int(os.environ.get('SUGGEST_MAX_TERMS', '200000'))
+SUGGEST_SYNC_SECONDS = float(os.environ.get('SUGGEST_SYNC_SECONDS', '5'))
+SUGGEST_DELTAS_COLLECTION = "search_suggestion_deltas"
+SUGGEST_DELTA_TTL_SECONDS = 86400  # Совпадает с TTL-индексом search_suggestion_deltas
+SUGGEST_SYNC_LOOKBACK = timedelta(seconds=60)  # Изменения других процессов, записанные не по порядку
+SUGGEST_BUILD_BATCH = 1000
+SUGGEST_MERGE_THRESHOLD = 1024
+SUGGEST_SCAN_LIMIT = 500
+SUGGEST_PROCESS_ID = str(uuid.uuid4())
+SUGGEST_CARGO_FIELDS = ["cargo_number", "sender_full_name", "recipient_full_name", "recipient_name"]
+SUGGEST_USER_FIELDS = ["user_number"]
+# Типы подсказок, доступные только персоналу
+SUGGEST_STAFF_KINDS = {"sender_name", "recipient_name", "user_number"}
+
+def suggestion_terms(collection_name: str, document: Optional[dict]) -> Set[tuple]:
+    """Ключи индекса подсказок для документа: (нормализованный текст, тип, значение)"""
+    if not document:
+        return set()
+    if collection_name == "users":
+        values = [("user_number", document.get("user_number"))]
+    else:
+        values = [
+            ("cargo_number", document.get("cargo_number")),
+            ("sender_name", document.get("sender_full_name")),
+            ("recipient_name", document.get("recipient_full_name") or document.get("recipient_name"))
+        ]
+    terms = set()
+    for kind, value in values:
+        if not value:
+            continue
+        display = " ".join(str(value).split())
+        words = normalize_search_text(display).split(" ")
+        for index in range(len(words)):
+            terms.add((" ".join(words[index:]), kind, display))
+    return terms
+
+class SuggestionIndex:
+    """Префиксный индекс подсказок в памяти процесса.
+    
+    Живые ключи и число ссылок на них - в _refs. Новые ключи вставляются в небольшой
+    отсортированный буфер _recent, удаленные остаются в массивах до слияния: буфер
+    сливается с основным массивом, когда в нем или среди удаленных набирается
+    SUGGEST_MERGE_THRESHOLD ключей.
+    """
+    
+    def __init__(self, database, max_terms: int):
+        self._database = database
+        self._deltas = database[SUGGEST_DELTAS_COLLECTION]
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._keys: List[tuple] = []
+        self._recent: List[tuple] = []
+        self._refs: Dict[tuple, int] = {}
+        self._scan: Optional[dict] = None
+        self._rebuild_requested = False
+        self._synced_until: Optional[datetime] = None
+        self._seen_deltas: Dict[Any, datetime] = {}
+        self.max_terms = max_terms
+        self.dropped = 0
+        self.built_at = None
+    
+    # ---------- Ключи ----------
+    
+    @staticmethod
+    def _contains(keys: List[tuple], term: tuple) -> bool:
+        index = bisect.bisect_left(keys, term)
+        return index < len(keys) and keys[index] == term
+    
+    def _add(self, term: tuple):
+        if term in self._refs:
+            self._refs[term] += 1
+        elif len(self._refs) >= self.max_terms:
+            self.dropped += 1
+        else:
+            self._refs[term] = 1
+            if not self._contains(self._keys, term) and not self._contains(self._recent, term):
+                bisect.insort(self._recent, term)
+            self._merge_if_needed()
+    
+    def _remove(self, term: tuple):
+        refs = self._refs.get(term)
+        if refs is None:
+            return
+        if refs > 1:
+            self._refs[term] = refs - 1
+            return
+        del self._refs[term]
+        self._merge_if_needed()
+    
+    def _merge_if_needed(self):
+        removed = len(self._keys) + len(self._recent) - len(self._refs)
+        if len(self._recent) > SUGGEST_MERGE_THRESHOLD or removed > max(SUGGEST_MERGE_THRESHOLD, len(self._keys) // 8):
+            self._keys = [term for term in heapq.merge(self._keys, self._recent) if term in self._refs]
+            self._recent = []
+    
+    def _apply_terms(self, old_terms: frozenset, new_terms: frozenset):
+        for term in old_terms - new_terms:
+            self._remove(term)
+        for term in new_terms - old_terms:
+            self._add(term)
+    
+    # ---------- Изменения ----------
+    
+    @staticmethod
+    def _entries(collection_name: str, changes: list) -> List[tuple]:
+        """Изменения документов: (коллекция, _id, ключи до, ключи после)"""
+        entries = []
+        for before, after in changes:
+            old_terms = frozenset(suggestion_terms(collection_name, before))
+            new_terms = frozenset(suggestion_terms(collection_name, after))
+            if old_terms != new_terms:
+                entries.append((collection_name, (after or before).get("_id"), old_terms, new_terms))
+        return entries
+    
+    def on_changes(self, collection_name: str, changes: list):
+        """Записи этого процесса - сразу в индекс"""
+        entries = self._entries(collection_name, changes)
+        if entries:
+            with self._lock:
+                for entry in entries:
+                    self._receive(entry)
+    
+    def publish(self, collection_name: str, changes: list):
+        """Записи этого процесса - в search_suggestion_deltas для других процессов"""
+        now = datetime.utcnow()
+        deltas = [
+            {
+                "origin": SUGGEST_PROCESS_ID,
+                "collection": entry_collection,
+                "doc_id": doc_id,
+                "before": [list(term) for term in sorted(old_terms)],
+                "after": [list(term) for term in sorted(new_terms)],
+                "created_at": now
+            }
+            for entry_collection, doc_id, old_terms, new_terms in self._entries(collection_name, changes)
+        ]
+        if deltas:
+            self._deltas.insert_many(deltas, ordered=False)
+    
+    def on_publish_error(self, reason: str):
+        """Изменения не опубликованы: другие процессы перестроят индекс"""
+        self._deltas.insert_one({"origin": SUGGEST_PROCESS_ID, "rebuild": True, "reason": reason, "created_at": datetime.utcnow()})
+    
+    def sync(self) -> int:
+        """Применить изменения, опубликованные другими процессами; возвращает их число"""
+        with self._sync_lock:
+            if self._synced_until is None:
+                return 0
+            started = datetime.utcnow()
+            if started - self._synced_until > timedelta(seconds=SUGGEST_DELTA_TTL_SECONDS / 2):
+                # Часть изменений могла истечь по TTL - только перестройка
+                self.schedule_build()
+                return 0
+            entries = []
+            rebuild = False
+            for delta in self._deltas.find({
+                "created_at": {"$gte": self._synced_until - SUGGEST_SYNC_LOOKBACK},
+                "origin": {"$ne": SUGGEST_PROCESS_ID}
+            }).sort("created_at", 1):
+                if delta["_id"] in self._seen_deltas:
+                    continue
+                self._seen_deltas[delta["_id"]] = delta["created_at"]
+                if delta.get("rebuild"):
+                    rebuild = True
+                    continue
+                entries.append((
+                    delta["collection"],
+                    delta["doc_id"],
+                    frozenset(tuple(term) for term in delta["before"]),
+                    frozenset(tuple(term) for term in delta["after"])
+                ))
+            if entries:
+                with self._lock:
+                    for entry in entries:
+                        self._receive(entry)
+            self._synced_until = started
+            self._seen_deltas = {
+                delta_id: created_at for delta_id, created_at in self._seen_deltas.items()
+                if created_at >= started - SUGGEST_SYNC_LOOKBACK
+            }
+        if rebuild:
+            self.schedule_build()
+        return len(entries)
+    
+    def _receive(self, entry: tuple):
+        """Применить изменение к индексу; во время перестройки - решить, нужно ли оно новому снимку"""
+        self._apply_terms(entry[2], entry[3])
+        if self._scan is None:
+            return
+        state = self._scan["collections"].get(entry[0])
+        if state is None:
+            return
+        if state["done"] or self._was_read(state["boundary"], entry[1]):
+            self._scan["pending"].append(entry)
+        elif state["inflight"]:
+            self._scan["ambiguous"].append(entry)
+        # Иначе документ еще не прочитан: снимок увидит его уже измененным
+    
+    @staticmethod
+    def _was_read(boundary, doc_id) -> bool:
+        """Прочитан ли документ перестройкой (коллекции читаются по убыванию _id)"""
+        if boundary is None:
+            return False
+        try:
+            return doc_id >= boundary
+        except TypeError:
+            return True
+    
+    # ---------- Перестройка ----------
+    
+    def _resolve_ambiguous(self, state: dict, page_terms: dict):
+        """Изменения, пришедшие во время чтения страницы: снимок видел состояние документа
+        после какого-то их префикса, новому снимку нужны только остальные"""
+        by_document: Dict[Any, list] = {}
+        for entry in self._scan["ambiguous"]:
+            by_document.setdefault(entry[1], []).append(entry)
+        self._scan["ambiguous"] = []
+        for doc_id, entries in by_document.items():
+            if not (state["done"] or self._was_read(state["boundary"], doc_id)):
+                continue
+            states = [entries[0][2]] + [entry[3] for entry in entries]
+            seen = page_terms.get(doc_id, frozenset())
+            self._scan["pending"].extend(entries[states.index(seen) if seen in states else 0:])
+    
+    def build(self) -> dict:
+        """Перестроить индекс из MongoDB постранично по убыванию _id (новые документы имеют
+        приоритет при заполнении); изменения во время чтения применяются поверх снимка,
+        только если снимок их не видел"""
+        sources = [(name, SUGGEST_CARGO_FIELDS) for name in CARGO_COLLECTIONS] + [("users", SUGGEST_USER_FIELDS)]
+        with self._lock:
+            if self._scan is not None:
+                self._rebuild_requested = True
+                return self.stats()
+            self._scan = {
+                "collections": {name: {"boundary": None, "done": False, "inflight": False} for name, _ in sources},
+                "pending": [],
+                "ambiguous": []
+            }
+        with self._sync_lock:
+            self._synced_until = datetime.utcnow()
+        refs: Dict[tuple, int] = {}
+        dropped = 0
+        try:
+            for collection_name, fields in sources:
+                state = self._scan["collections"][collection_name]
+                projection = {field: 1 for field in fields}
+                while not state["done"]:
+                    # Изменения других процессов - до чтения страницы, чтобы снимок их не задвоил
+                    self.sync()
+                    with self._lock:
+                        state["inflight"] = True
+                    query = {"_id": {"$lt": state["boundary"]}} if state["boundary"] is not None else {}
+                    page = list(self._database[collection_name].find(query, projection).sort("_id", -1).limit(SUGGEST_BUILD_BATCH))
+                    page_terms = {}
+                    for document in page:
+                        terms = suggestion_terms(collection_name, document)
+                        page_terms[document["_id"]] = frozenset(terms)
+                        for term in terms:
+                            if term in refs:
+                                refs[term] += 1
+                            elif len(refs) >= self.max_terms:
+                                dropped += 1
+                            else:
+                                refs[term] = 1
+                    with self._lock:
+                        if page:
+                            state["boundary"] = page[-1]["_id"]
+                        state["done"] = len(page) < SUGGEST_BUILD_BATCH
+                        state["inflight"] = False
+                        self._resolve_ambiguous(state, page_terms)
+        except Exception:
+            with self._lock:
+                self._scan = None
+            raise
+        
+        keys = sorted(refs)
+        with self._lock:
+            pending = self._scan["pending"]
+            self._scan = None
+            self._keys, self._recent, self._refs, self.dropped = keys, [], refs, dropped
+            for _, _, old_terms, new_terms in pending:
+                self._apply_terms(old_terms, new_terms)
+            self.built_at = datetime.utcnow()
+            rebuild, self._rebuild_requested = self._rebuild_requested, False
+        print(f"💡 Индекс подсказок: {len(keys)} ключей, отброшено {dropped}, изменений во время чтения {len(pending)}")
+        if rebuild:
+            self.schedule_build()
+        return self.stats()
+    
+    def schedule_build(self):
+        """Перестроить индекс в фоновом потоке"""
+        def run():
+            try:
+                self.build()
+            except Exception as e:
+                print(f"❌ Ошибка перестройки индекса подсказок: {str(e)}")
+        threading.Thread(target=run, name="suggestions-build", daemon=True).start()
+    
+    # ---------- Чтение ----------
+    
+    def suggest(self, query: str, kinds: Set[str], limit: int) -> List[dict]:
+        """Значения, у которых название или слово названия начинается с query"""
+        prefix = normalize_search_text(query)
+        if not prefix:
+            return []
+        suggestions = []
+        seen = set()
+        with self._lock:
+            candidates = heapq.merge(
+                itertools.islice(self._keys, bisect.bisect_left(self._keys, (prefix,)), None),
+                itertools.islice(self._recent, bisect.bisect_left(self._recent, (prefix,)), None)
+            )
+            for term in itertools.islice(candidates, SUGGEST_SCAN_LIMIT):
+                text, kind, display = term
+                if not text.startswith(prefix) or len(suggestions) >= limit:
+                    break
+                if term in self._refs and kind in kinds and (kind, display) not in seen:
+                    seen.add((kind, display))
+                    suggestions.append({"value": display, "type": kind})
+        return suggestions
+    
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "terms": len(self._refs),
+                "max_terms": self.max_terms,
+                "dropped": self.dropped,
+                "built_at": self.built_at
+            }
+
+search_suggestions = SuggestionIndex(db, SUGGEST_MAX_TERMS)
+for _suggest_collection, _suggest_fields in [(name, SUGGEST_CARGO_FIELDS) for name in CARGO_COLLECTIONS] + [("users", SUGGEST_USER_FIELDS)]:
+    ChangeTrackedDatabase.subscribe(_suggest_collection, _suggest_fields, search_suggestions.on_changes, on_error=lambda reason: search_suggestions.schedule_build())
+    ChangeTrackedDatabase.subscribe(_suggest_collection, _suggest_fields, search_suggestions.publish, on_error=search_suggestions.on_publish_error, deferred=True)
+
+async def periodic_suggestions_sync():
+    """Изменения подсказок из других процессов каждые SUGGEST_SYNC_SECONDS"""
+    while True:
+        await asyncio.sleep(SUGGEST_SYNC_SECONDS)
+        try:
+            await run_in_threadpool(search_suggestions.sync)
+        except Exception as e:
+            print(f"❌ Ошибка синхронизации индекса подсказок: {str(e)}")
+
+@app.on_event("startup")
+async def bootstrap_search_suggestions():
+    """Построить индекс подсказок и запланировать синхронизацию с другими процессами"""
+    try:
+        await run_in_threadpool(search_suggestions.build)
+    except Exception as e:
+        print(f"❌ Ошибка построения индекса подсказок: {str(e)}")
+    asyncio.create_task(periodic_suggestions_sync())
+
+@app.get("/api/search/suggest")
+def suggest_search(
+    q: str,
+    limit: int = 5,
+    current_user: User = Depends(get_current_user)
+):
+    """Подсказки автодополнения: номера грузов, для персонала - имена и номера пользователей"""
+    if len(q.strip()) < 2:
+        return {"query": q, "suggestions": []}
+    kinds = {"cargo_number"}
+    if current_user.role in [UserRole.ADMIN, UserRole.WAREHOUSE_OPERATOR]:
+        kinds |= SUGGEST_STAFF_KINDS
+    return {"query": q, "suggestions": search_suggestions.suggest(q, kinds, min(max(1, limit), 20))}
+
+@app.get("/api/admin/search/suggest/stats")
+def get_search_suggestions_stats(
+    current_user: User = Depends(require_role(UserRole.ADMIN))
+):
+    """Размер и заполненность индекса подсказок текущего процесса"""
+    return search_suggestions.stats()
+
+# ==================== ПРИЕМ GPS ====================
+# GPS точки курьеров не пишутся в базу на каждый запрос: обработчик кладет точку
+# в буфер процесса и сразу отвечает. Фоновая задача сбрасывает буфер, как только
+# накопилось GPS_FLUSH_BATCH точек или прошло GPS_FLUSH_INTERVAL_SECONDS:
+# история - одним insert_many в time-series коллекцию courier_location_history
+# (metaField courier_id), последняя позиция и статус курьера - пачкой условных update,
+# причем на курьера пишется только самая свежая точка из буфера и только если
+# в базе нет более свежей (пакеты /api/courier/location/batch приходят с опозданием).
+# Профиль курьера и его текущая заявка кэшируются на GPS_CONTEXT_TTL_SECONDS.
+# Точки пакета перед записью занимаются в gps_point_claims (_id "<courier_id>|<время>",
+# уникальный): time-series коллекция не поддерживает уникальные индексы, а повторная
+# отправка того же пакета может прийти параллельно с первой.
+
+GPS_HISTORY_COLLECTION = "courier_location_history"
+GPS_HISTORY_LEGACY_COLLECTION = "courier_location_history_legacy"
+GPS_FLUSH_BATCH = int(os.environ.get('GPS_FLUSH_BATCH', '500'))
+GPS_FLUSH_INTERVAL_SECONDS = float(os.environ.get('GPS_FLUSH_INTERVAL_SECONDS', '2'))
+GPS_BUFFER_MAX_POINTS = int(os.environ.get('GPS_BUFFER_MAX_POINTS', '50000'))
+GPS_CONTEXT_TTL_SECONDS = float(os.environ.get('GPS_CONTEXT_TTL_SECONDS', '30'))
+GPS_MIGRATION_BATCH = 5000
+GPS_MIGRATION_PROGRESS_ID = "gps_history_migration_progress"
+GPS_CLOCK_SKEW = timedelta(minutes=5)  # Допустимое опережение часов устройства
+GPS_POINT_CLAIMS_COLLECTION = "gps_point_claims"  # Записи удаляет TTL-индекс через 7 дней
+GPS_COURIER_FIELDS = ["id", "user_id", "full_name", "phone", "transport_type", "transport_capacity", "assigned_warehouse_id", "is_active"]
+
+def ensure_gps_history_collection() -> str:
+    """Создать courier_location_history как time-series коллекцию.
+    
+    Обычная коллекция от прежних версий переименовывается в courier_location_history_legacy,
+    ее точки переносит migrate_legacy_gps_history. Возвращает тип коллекции истории.
+    """
+    info = next(iter(db.list_collections(filter={"name": GPS_HISTORY_COLLECTION})), None)
+    if info and info.get("type") == "timeseries":
+        return "timeseries"
+    if info:
+        if db.list_collection_names(filter={"name": GPS_HISTORY_LEGACY_COLLECTION}):
+            return "regular"
+        db[GPS_HISTORY_COLLECTION].rename(GPS_HISTORY_LEGACY_COLLECTION)
+    try:
+        db.create_collection(GPS_HISTORY_COLLECTION, timeseries={
+            "timeField": "timestamp",
+            "metaField": "courier_id",
+            "granularity": "seconds"
+        })
+    except CollectionInvalid:
+        pass  # Создана другим процессом
+    except OperationFailure as e:
+        # MongoDB без поддержки time-series: история остается обычной коллекцией
+        print(f"⚠️ Time-series коллекция недоступна: {str(e)}")
+        if info:
+            db[GPS_HISTORY_LEGACY_COLLECTION].rename(GPS_HISTORY_COLLECTION)
+        return "regular"
+    return "timeseries"
+
+gps_history_migration = BackfillState(db.schema_meta, "gps_history_migration", 1)
+
+def migrate_legacy_gps_history() -> dict:
+    """Перенести точки из courier_location_history_legacy в time-series коллекцию.
+    
+    Точки переносятся пачками по возрастанию _id вместе со своим _id; после каждой пачки
+    последний перенесенный _id сохраняется в schema_meta, и прерванный перенос продолжается
+    с него. Точки пачки, записанные до прерывания, повторно не вставляются.
+    """
+    legacy = db[GPS_HISTORY_LEGACY_COLLECTION]
+    history = db[GPS_HISTORY_COLLECTION]
+    progress = db.schema_meta.find_one({"_id": GPS_MIGRATION_PROGRESS_ID}) or {}
+    last_id = progress.get("last_id")
+    moved = progress.get("moved", 0)
+    while True:
+        query = {"_id": {"$gt": last_id}} if last_id is not None else {}
+        batch = list(legacy.find(query).sort("_id", 1).limit(GPS_MIGRATION_BATCH))
+        if not batch:
+            break
+        points = [point for point in batch if point.get("timestamp")]
+        if points:
+            written = {point["_id"] for point in history.find({"_id": {"$in": [point["_id"] for point in points]}}, {"_id": 1})}
+            missing = [point for point in points if point["_id"] not in written]
+            if missing:
+                history.insert_many(missing, ordered=False)
+            moved += len(missing)
+        last_id = batch[-1]["_id"]
+        db.schema_meta.update_one(
+            {"_id": GPS_MIGRATION_PROGRESS_ID},
+            {"$set": {"last_id": last_id, "moved": moved, "updated_at": datetime.utcnow()}},
+            upsert=True
+        )
+    legacy.drop()
+    db.schema_meta.delete_one({"_id": GPS_MIGRATION_PROGRESS_ID})
+    report = {"moved": moved, "finished_at": datetime.utcnow()}
+    gps_history_migration.mark_built(report)
+    if moved:
+        print(f"🛰️ История GPS перенесена в time-series коллекцию: {moved} точек")
+    return report
+
+def gps_point_claim_id(courier_id: str, timestamp: datetime) -> str:
+    return f"{courier_id}|{timestamp.isoformat()}"
+
+def claim_gps_points(courier_id: str, timestamps: List[datetime]) -> Set[datetime]:
+    """Занять точки курьера для записи в историю; возвращает время точек, занятых этим вызовом"""
+    if not timestamps:
+        return set()
+    now = datetime.utcnow()
+    try:
+        db[GPS_POINT_CLAIMS_COLLECTION].insert_many([
+            {"_id": gps_point_claim_id(courier_id, timestamp), "claimed_at": now} for timestamp in timestamps
+        ], ordered=False)
+    except BulkWriteError as e:
+        # Дубликат _id - точку записывает или уже записал другой запрос
+        if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+            raise
+        taken = {error["index"] for error in e.details.get("writeErrors", [])}
+        return {timestamp for index, timestamp in enumerate(timestamps) if index not in taken}
+    return set(timestamps)
+
+def release_gps_points(courier_id: str, timestamps: List[datetime]):
+    """Освободить точки, которые не удалось записать, чтобы повторная отправка их сохранила"""
+    if timestamps:
+        db[GPS_POINT_CLAIMS_COLLECTION].delete_many({"_id": {"$in": [gps_point_claim_id(courier_id, timestamp) for timestamp in timestamps]}})
+
+def ensure_courier_profile(user: User) -> dict:
+    """Профиль курьера пользователя; создается автоматически при первом GPS update"""
+    courier = db.couriers.find_one({"user_id": user.id}, {"_id": 0})
+    if courier:
+        return courier
+    current_time = datetime.utcnow()
+    courier = {
+        "id": str(uuid.uuid4()),
+        "user_id": user.id,
+        "full_name": user.full_name,
+        "phone": user.phone,
+        "address": "Не указан",
+        "transport_type": "car",  # По умолчанию
+        "transport_number": "Не указан",
+        "transport_capacity": 50.0,  # По умолчанию
+        "assigned_warehouse_id": None,  # Будет назначен админом позже
+        "assigned_warehouse_name": None,
+        "is_active": True,
+        "created_at": current_time,
+        "updated_at": current_time,
+        "status": "offline",
+        "notes": "Профиль создан автоматически при первом GPS update"
+    }
+    db.couriers.insert_one(dict(courier))
+    print(f"✅ Auto-created courier profile for user {user.id}")
+    return courier
+
+class CourierContextCache:
+    """Профиль курьера и его текущая заявка по user_id с TTL.
+    
+    Изменение профиля курьера сбрасывает запись подпиской на couriers;
+    смена текущей заявки видна через TTL.
+    """
+    def __init__(self, ttl_seconds: float):
+        self.ttl_seconds = ttl_seconds
+        self._entries: Dict[str, tuple] = {}  # user_id -> (expires_at, context)
+        self._lock = threading.Lock()
+    
+    def get(self, user: User) -> dict:
+        with self._lock:
+            entry = self._entries.get(user.id)
+            if entry and entry[0] > time.monotonic():
+                return entry[1]
+        courier = ensure_courier_profile(user)
+        current_request = db.courier_requests.find_one({
+            "assigned_courier_id": courier["id"],
+            "request_status": {"$in": ["accepted", "picked_up"]}
+        }, {"_id": 0, "id": 1, "pickup_address": 1})
+        context = {
+            "courier": {field: courier.get(field) for field in GPS_COURIER_FIELDS},
+            "current_request_id": current_request["id"] if current_request else None,
+            "current_request_address": current_request.get("pickup_address") if current_request else None
+        }
+        with self._lock:
+            self._entries[user.id] = (time.monotonic() + self.ttl_seconds, context)
+        return context
+    
+    def on_courier_changes(self, collection_name: str, changes: list):
+        with self._lock:
+            for before, after in changes:
+                for image in (before, after):
+                    if image and image.get("user_id"):
+                        self._entries.pop(image["user_id"], None)
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+class GpsIngestBuffer:
+    """Буфер GPS точек процесса со сбросом по размеру или по времени"""
+    
+    def __init__(self, database, flush_batch: int, max_points: int):
+        self._database = database
+        self._lock = threading.Lock()
+        self._history: List[dict] = []
+        self._latest: Dict[str, dict] = {}
+        self._wake = None
+        self._loop = None
+        self.flush_batch = flush_batch
+        self.max_points = max_points
+        self.dropped = 0
+        self.flushed = 0
+        self.flush_errors = 0
+    
+    def add(self, history_record: Optional[dict], location_record: Optional[dict] = None):
+        """Добавить точку истории и/или последнюю позицию курьера"""
+        with self._lock:
+            if history_record:
+                self._history.append(history_record)
+                overflow = len(self._history) - self.max_points
+                if overflow > 0:
+                    del self._history[:overflow]
+                    self.dropped += overflow
+            if location_record:
+                current = self._latest.get(location_record["courier_id"])
+                if current is None or current["last_updated"] <= location_record["last_updated"]:
+                    self._latest[location_record["courier_id"]] = location_record
+            pending = len(self._history)
+        if pending >= self.flush_batch:
+            self.request_flush()
+    
+    def buffered_at(self, courier_id: str) -> Optional[datetime]:
+        """Время последней позиции курьера, ожидающей записи"""
+        with self._lock:
+            current = self._latest.get(courier_id)
+            return current["last_updated"] if current else None
+    
+    def request_flush(self):
+        if self._wake is None or self._loop is None:
+            return
+        try:
+            if asyncio.get_running_loop() is self._loop:
+                self._wake.set()
+                return
+        except RuntimeError:
+            pass
+        self._loop.call_soon_threadsafe(self._wake.set)
+    
+    def _requeue(self, history: List[dict], latest: Dict[str, dict]):
+        """Вернуть несохраненные точки в начало буфера (с учетом лимита)"""
+        with self._lock:
+            self._history = history + self._history
+            overflow = len(self._history) - self.max_points
+            if overflow > 0:
+                del self._history[:overflow]
+                self.dropped += overflow
+            for courier_id, record in latest.items():
+                current = self._latest.get(courier_id)
+                if current is None or current["last_updated"] < record["last_updated"]:
+                    self._latest[courier_id] = record
+    
+    def _insert_history(self, history: List[dict]) -> List[dict]:
+        """insert_many точек истории; возвращает отклоненные точки для повтора"""
+        try:
+            self._database[GPS_HISTORY_COLLECTION].insert_many(history, ordered=False)
+        except BulkWriteError as e:
+            # Остальные точки пачки уже записаны: повторяются только отклоненные
+            # (дубликат ключа означает, что точка уже в базе)
+            return [
+                history[error["index"]]
+                for error in e.details.get("writeErrors", [])
+                if error.get("code") != 11000
+            ]
+        return []
+    
+    def _update_latest(self, latest: Dict[str, dict]):
+        """Обновить существующие позиции, если в базе нет более свежей точки"""
+        if latest:
+            self._database.courier_locations.bulk_write([
+                UpdateOne({"courier_id": courier_id, "last_updated": {"$lte": record["last_updated"]}}, {"$set": record})
+                for courier_id, record in latest.items()
+            ], ordered=False)
+    
+    def _insert_latest(self, latest: Dict[str, dict]) -> Dict[str, dict]:
+        """Вставить позиции курьеров, у которых их еще нет; возвращает позиции,
+        которые успел вставить другой процесс"""
+        courier_ids = list(latest)
+        # Поля подбора - из профиля, а не из кэша контекста GPS
+        profiles = {
+            courier["id"]: courier_profile_dispatch_fields(courier)
+            for courier in self._database.couriers.find({"id": {"$in": courier_ids}}, {"_id": 0, **{field: 1 for field in COURIER_DISPATCH_PROFILE_FIELDS}})
+        }
+        operations = [
+            UpdateOne({"courier_id": courier_id}, {"$setOnInsert": {
+                **{field: value for field, value in latest[courier_id].items() if field != "courier_id"},
+                **profiles.get(courier_id, {})
+            }}, upsert=True)
+            for courier_id in courier_ids
+        ]
+        try:
+            upserted = self._database.courier_locations.bulk_write(operations, ordered=False).upserted_ids
+        except BulkWriteError as e:
+            # Дубликат ключа courier_id - позицию вставил другой процесс
+            if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                raise
+            upserted = {item["index"]: item["_id"] for item in e.details.get("upserted", [])}
+        return {courier_id: latest[courier_id] for index, courier_id in enumerate(courier_ids) if index not in upserted}
+    
+    def _write_latest(self, latest: Dict[str, dict]):
+        """Последние позиции и статусы курьеров; более старая точка не перезаписывает более новую.
+        
+        Позиция обновляется условным update без upsert (upsert с условием на last_updated
+        при более свежей позиции в базе упирался бы в уникальный индекс courier_id),
+        первая позиция курьера вставляется отдельно только при отсутствии документа.
+        """
+        self._update_latest(latest)
+        existing = {
+            location["courier_id"]
+            for location in self._database.courier_locations.find({"courier_id": {"$in": list(latest)}}, {"_id": 0, "courier_id": 1})
+        }
+        missing = {courier_id: record for courier_id, record in latest.items() if courier_id not in existing}
+        if missing:
+            self._update_latest(self._insert_latest(missing))
+        self._database.couriers.bulk_write([
+            TrackedUpdateOne(
+                {"id": courier_id, "last_location_at": {"$not": {"$gt": record["last_updated"]}}},
+                {"$set": {"status": record["status"], "updated_at": datetime.utcnow(), "last_location_at": record["last_updated"]}}
+            )
+            for courier_id, record in latest.items()
+        ], ordered=False)
+    
+    def flush(self) -> dict:
+        """Записать накопленные точки: insert_many истории и пачка upsert последних позиций"""
+        with self._lock:
+            history, self._history = self._history, []
+            latest, self._latest = self._latest, {}
+        if not history and not latest:
+            return {"history": 0, "locations": 0}
+        
+        rejected = []
+        try:
+            if history:
+                rejected = self._insert_history(history)
+            history_written = len(history) - len(rejected)
+            history = rejected
+            if latest:
+                self._write_latest(latest)
+        except Exception as e:
+            self.flush_errors += 1
+            self._requeue(history, latest)
+            print(f"❌ Ошибка сброса GPS буфера: {str(e)}")
+            raise
+        
+        self.flushed += history_written
+        if rejected:
+            self.flush_errors += 1
+            self._requeue(rejected, {})
+            print(f"❌ Ошибка сброса GPS буфера: отклонено {len(rejected)} из {history_written + len(rejected)} точек")
+        return {"history": history_written, "locations": len(latest)}
+    
+    async def run(self, interval: float):
+        """Фоновый сброс: по таймеру или по сигналу переполнения"""
+        self._loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await run_in_threadpool(self.flush)
+            except Exception:
+                await asyncio.sleep(interval)
+    
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "buffered_points": len(self._history),
+                "buffered_couriers": len(self._latest),
+                "flushed_points": self.flushed,
+                "dropped_points": self.dropped,
+                "flush_errors": self.flush_errors
+            }
+
+courier_context = CourierContextCache(GPS_CONTEXT_TTL_SECONDS)
+ChangeTrackedDatabase.subscribe("couriers", GPS_COURIER_FIELDS, courier_context.on_courier_changes, on_error=lambda reason: courier_context.clear())
+gps_ingest = GpsIngestBuffer(db, GPS_FLUSH_BATCH, GPS_BUFFER_MAX_POINTS)
+
+register_backfill(gps_history_migration, migrate_legacy_gps_history, "перенос истории GPS")
+
+@app.on_event("startup")
+async def start_gps_ingest():
+    """Запустить фоновый сброс GPS буфера"""
+    asyncio.create_task(gps_ingest.run(GPS_FLUSH_INTERVAL_SECONDS))
+
+@app.on_event("shutdown")
+def flush_gps_ingest():
+    """Сбросить накопленные GPS точки при остановке процесса"""
+    try:
+        gps_ingest.flush()
+    except Exception as e:
+        print(f"❌ Ошибка сброса GPS буфера при остановке: {str(e)}")
+
+@app.get("/api/admin/gps/ingest/stats")
+def get_gps_ingest_stats(
+    current_user: User = Depends(require_role(UserRole.ADMIN))
+):
+    """Состояние GPS буфера текущего процесса"""
+    return gps_ingest.stats()
+
+# ==================== АНАЛИТИКА ТРЕКОВ ====================
+# Расстояние, активное время, скорости и статусы по GPS трекам считаются векторно
+# в NumPy: точки читаются одним запросом, отсортированные по курьеру и времени,
+# и раскладываются в массивы столбцов. Отрезок между соседними точками учитывается,
+# если у них один курьер и один день (UTC); в активное время идут только отрезки
+# не длиннее TRACK_ACTIVE_GAP_SECONDS (более длинный разрыв - курьер не на связи).
+
+TRACK_ACTIVE_GAP_SECONDS = float(os.environ.get('TRACK_ACTIVE_GAP_SECONDS', '600'))
+EARTH_RADIUS_KM = 6371.0
+TRACK_POINT_PROJECTION = {"_id": 0, "courier_id": 1, "timestamp": 1, "latitude": 1, "longitude": 1, "speed": 1, "status": 1}
+
+def as_utc_datetime(value) -> Optional[datetime]:
+    """datetime из сохраненного значения (datetime или ISO строка) в наивном UTC"""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if isinstance(value, datetime) and value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value if isinstance(value, datetime) else None
+
+def track_period_filter(date_from: Optional[str], date_to: Optional[str], default_days: int) -> tuple:
+    """Фильтр по timestamp за дни [date_from, date_to] (YYYY-MM-DD) и границы периода"""
+    today = datetime.utcnow().date()
+    date_from = date_from or (today - timedelta(days=default_days)).isoformat()
+    date_to = date_to or today.isoformat()
+    start = datetime.fromisoformat(date_from)
+    end = datetime.fromisoformat(date_to) + timedelta(days=1)
+    return {"timestamp": {"$gte": start, "$lt": end}}, date_from, date_to
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Расстояние по формуле Haversine в километрах (скаляры или массивы координат)"""
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(value, dtype=float)) for value in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+def track_columns(points) -> dict:
+    """Массивы столбцов трека из точек, отсортированных по courier_id и timestamp"""
+    couriers, timestamps, latitudes, longitudes, speeds, statuses = [], [], [], [], [], []
+    for point in points:
+        timestamp = as_utc_datetime(point.get("timestamp"))
+        if timestamp is None or point.get("latitude") is None or point.get("longitude") is None:
+            continue
+        couriers.append(point.get("courier_id"))
+        timestamps.append(timestamp)
+        latitudes.append(point["latitude"])
+        longitudes.append(point["longitude"])
+        speeds.append(point["speed"] if point.get("speed") is not None else np.nan)
+        statuses.append(point.get("status") or "unknown")
+    return {
+        "courier_id": np.array(couriers, dtype=object),
+        "timestamp": np.array(timestamps, dtype="datetime64[ms]"),
+        "latitude": np.array(latitudes, dtype=float),
+        "longitude": np.array(longitudes, dtype=float),
+        "speed": np.array(speeds, dtype=float),
+        "status": np.array(statuses, dtype=object)
+    }
+
+def _track_group_metrics(boundary, distance, active_seconds, speed, status_codes, status_values) -> List[dict]:
+    """Метрики групп подряд идущих точек; boundary отмечает первую точку каждой группы"""
+    starts = np.flatnonzero(boundary)
+    group = np.cumsum(boundary) - 1
+    groups = len(starts)
+    
+    points_count = np.bincount(group, minlength=groups)
+    distance_km = np.bincount(group, weights=distance, minlength=groups)
+    active_hours = np.bincount(group, weights=active_seconds, minlength=groups) / 3600
+    reported = ~np.isnan(speed)
+    speed_count = np.bincount(group, weights=reported, minlength=groups)
+    speed_sum = np.bincount(group, weights=np.where(reported, speed, 0.0), minlength=groups)
+    max_speed = np.maximum.reduceat(np.where(reported, speed, -np.inf), starts)
+    status_counts = np.zeros((groups, len(status_values)), dtype=np.int64)
+    np.add.at(status_counts, (group, status_codes), 1)
+    
+    metrics = []
+    for index in range(groups):
+        metrics.append({
+            "start": int(starts[index]),
+            "points_count": int(points_count[index]),
+            "distance_km": round(float(distance_km[index]), 2),
+            "active_hours": round(float(active_hours[index]), 2),
+            "avg_speed": round(float(speed_sum[index] / speed_count[index]), 2) if speed_count[index] else 0,
+            "max_speed": round(float(max_speed[index]), 2) if np.isfinite(max_speed[index]) else 0,
+            "moving_speed_kmh": round(float(distance_km[index] / active_hours[index]), 2) if active_hours[index] > 0 else 0,
+            "status_breakdown": {
+                str(status_values[code]): int(count)
+                for code, count in enumerate(status_counts[index]) if count
+            }
+        })
+    return metrics
+
+def summarize_tracks(columns: dict, with_ranges: bool = False) -> Dict[str, dict]:
+    """Итоги по курьерам и дням за один проход: {courier_id: {"total": {...}, "days": [...]}}.
+    
+    with_ranges добавляет в итоги дня "range" - срез точек дня в столбцах (начало, конец).
+    """
+    count = len(columns["timestamp"])
+    if not count:
+        return {}
+    couriers = columns["courier_id"]
+    timestamps = columns["timestamp"]
+    latitudes, longitudes = columns["latitude"], columns["longitude"]
+    days = timestamps.astype("datetime64[D]")
+    
+    courier_boundary = np.ones(count, dtype=bool)
+    courier_boundary[1:] = couriers[1:] != couriers[:-1]
+    day_boundary = courier_boundary.copy()
+    day_boundary[1:] |= days[1:] != days[:-1]
+    
+    # Отрезки от предыдущей точки; через границу курьера или дня отрезок не считается
+    distance = np.zeros(count)
+    distance[1:] = haversine_km(latitudes[:-1], longitudes[:-1], latitudes[1:], longitudes[1:])
+    gap_seconds = np.zeros(count)
+    gap_seconds[1:] = (timestamps[1:] - timestamps[:-1]) / np.timedelta64(1, "s")
+    distance[day_boundary] = 0.0
+    gap_seconds[day_boundary] = 0.0
+    active_seconds = np.where(gap_seconds <= TRACK_ACTIVE_GAP_SECONDS, gap_seconds, 0.0)
+    
+    status_values, status_codes = np.unique(columns["status"].astype(str), return_inverse=True)
+    args = (distance, active_seconds, columns["speed"], status_codes, status_values)
+    
+    summaries = {}
+    for total in _track_group_metrics(courier_boundary, *args):
+        summaries[couriers[total.pop("start")]] = {"total": total, "days": []}
+    for day in _track_group_metrics(day_boundary, *args):
+        start = day.pop("start")
+        if with_ranges:
+            day["range"] = (start, start + day["points_count"])
+        summaries[couriers[start]]["days"].append(dict(day, date=str(days[start])))
+    return summaries
+
+# ==================== СВОДКИ ТРЕКОВ ====================
+# courier_daily_rollups хранит на курьера и день (_id "<courier_id>:<YYYY-MM-DD>")
+# метрики summarize_tracks и трек, упрощенный алгоритмом Дугласа-Пекера с допуском
+# TRACK_SIMPLIFY_TOLERANCE_METERS. Фоновая задача раз в TRACK_ROLLUP_INTERVAL_SECONDS
+# пересчитывает вчера и сегодня (один воркер на интервал), при первом запуске -
+# последние TRACK_ROLLUP_BACKFILL_DAYS дней. Эндпоинты истории читают сводки:
+# прошедший день без сводки считается из сырых точек и сохраняется, сегодняшний
+# считается всегда. Пакетная загрузка точек за прошедшие дни помечает их сводки
+# устаревшими (stale_at), и они пересчитываются при следующем чтении; дни без точек
+# не сохраняются. Сырые точки отдаются только по запросу (include_points).
+
+TRACK_ROLLUP_VERSION = 1
+TRACK_ROLLUP_INTERVAL_SECONDS = int(os.environ.get('TRACK_ROLLUP_INTERVAL_SECONDS', '900'))
+TRACK_ROLLUP_BACKFILL_DAYS = int(os.environ.get('TRACK_ROLLUP_BACKFILL_DAYS', '30'))
+TRACK_SIMPLIFY_TOLERANCE_METERS = float(os.environ.get('TRACK_SIMPLIFY_TOLERANCE_METERS', '15'))
+TRACK_RECENT_POINTS = 20
+
+def simplify_track(latitudes: np.ndarray, longitudes: np.ndarray, tolerance_meters: float) -> np.ndarray:
+    """Индексы точек, оставляемых алгоритмом Дугласа-Пекера (расстояния - в локальной проекции, м)"""
+    count = len(latitudes)
+    if count <= 2:
+        return np.arange(count)
+    meters_per_radian = EARTH_RADIUS_KM * 1000
+    x = np.radians(longitudes) * meters_per_radian * np.cos(np.radians(np.mean(latitudes)))
+    y = np.radians(latitudes) * meters_per_radian
+    keep = np.zeros(count, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, count - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        dx, dy = x[end] - x[start], y[end] - y[start]
+        px, py = x[start + 1:end] - x[start], y[start + 1:end] - y[start]
+        length = math.hypot(dx, dy)
+        distances = np.abs(dx * py - dy * px) / length if length else np.hypot(px, py)
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance_meters:
+            middle = start + 1 + farthest
+            keep[middle] = True
+            stack.append((start, middle))
+            stack.append((middle, end))
+    return np.flatnonzero(keep)
+
+class CourierRollupService:
+    """Дневные сводки треков курьеров: расчет, хранение и чтение с дозаполнением"""
+    
+    def __init__(self, database):
+        self.database = database
+        self.rollups = database.courier_daily_rollups
+        self.state = BackfillState(database.schema_meta, "courier_rollups", TRACK_ROLLUP_VERSION)
+    
+    def compute(self, start: datetime, end: datetime, courier_ids=None) -> List[dict]:
+        """Сводки за дни [start, end) одним запросом по всем или указанным курьерам"""
+        match = {"timestamp": {"$gte": start, "$lt": end}}
+        if courier_ids is not None:
+            match["courier_id"] = {"$in": list(courier_ids)}
+        computed_at = datetime.utcnow()  # До чтения точек: store сравнивает с пометкой stale_at
+        columns = track_columns(self.database[GPS_HISTORY_COLLECTION].aggregate([
+            {"$match": match},
+            {"$sort": {"courier_id": 1, "timestamp": 1}},
+            {"$project": TRACK_POINT_PROJECTION}
+        ], allowDiskUse=True))
+        
+        today = datetime.utcnow().date().isoformat()
+        rollups = []
+        for courier_id, summary in summarize_tracks(columns, with_ranges=True).items():
+            for day in summary["days"]:
+                first, last = day.pop("range")
+                date = day.pop("date")
+                latitudes = columns["latitude"][first:last]
+                longitudes = columns["longitude"][first:last]
+                kept = simplify_track(latitudes, longitudes, TRACK_SIMPLIFY_TOLERANCE_METERS)
+                timestamps = columns["timestamp"][first:last][kept].tolist()
+                rollups.append({
+                    "_id": f"{courier_id}:{date}",
+                    "courier_id": courier_id,
+                    "date": date,
+                    "version": TRACK_ROLLUP_VERSION,
+                    "metrics": day,
+                    "track": [
+                        [float(latitudes[index]), float(longitudes[index]), timestamp]
+                        for index, timestamp in zip(kept, timestamps)
+                    ],
+                    "day_complete": date < today,
+                    "computed_at": computed_at
+                })
+        return rollups
+    
+    def store(self, rollups: List[dict]):
+        """Сохранить сводки; сводка, помеченная устаревшей после начала ее расчета, не перезаписывается"""
+        if not rollups:
+            return
+        try:
+            self.rollups.bulk_write([
+                ReplaceOne({"_id": rollup["_id"], "stale_at": {"$not": {"$gte": rollup["computed_at"]}}}, rollup, upsert=True)
+                for rollup in rollups
+            ], ordered=False)
+        except BulkWriteError as e:
+            # Дубликат _id - сводка помечена устаревшей во время расчета и будет пересчитана при чтении
+            if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                raise
+    
+    def mark_stale(self, courier_id: str, dates):
+        """Пометить сводки прошедших дней устаревшими: точки за эти дни пришли после расчета"""
+        today = datetime.utcnow().date().isoformat()
+        now = datetime.utcnow()
+        operations = [
+            UpdateOne({"_id": f"{courier_id}:{date}"}, {"$set": {"courier_id": courier_id, "date": date, "stale_at": now}}, upsert=True)
+            for date in sorted(set(dates)) if date < today
+        ]
+        if operations:
+            self.rollups.bulk_write(operations, ordered=False)
+    
+    def refresh(self, days: int) -> dict:
+        """Пересчитать сводки всех курьеров за последние days дней и сегодня"""
+        started_at = datetime.utcnow()
+        start = datetime.combine(started_at.date() - timedelta(days=days), datetime.min.time())
+        rollups = self.compute(start, datetime.combine(started_at.date() + timedelta(days=1), datetime.min.time()))
+        self.store(rollups)
+        return {"from": start.date().isoformat(), "rollups": len(rollups), "seconds": round((datetime.utcnow() - started_at).total_seconds(), 2)}
+    
+    def read(self, courier_id: str, date_from: str, date_to: str) -> List[dict]:
+        """Сводки курьера по дням периода; недостающие и устаревшие прошедшие дни считаются и сохраняются"""
+        first_day = datetime.fromisoformat(date_from).date()
+        last_day = datetime.fromisoformat(date_to).date()
+        today = datetime.utcnow().date()
+        stored = {
+            rollup["date"]: rollup for rollup in self.rollups.find(
+                {
+                    "courier_id": courier_id,
+                    "date": {"$gte": date_from, "$lte": date_to},
+                    "version": TRACK_ROLLUP_VERSION,
+                    "stale_at": {"$exists": False},
+                    "metrics.points_count": {"$gt": 0}
+                }
+            )
+        }
+        missing = [
+            first_day + timedelta(days=offset) for offset in range((last_day - first_day).days + 1)
+            if (first_day + timedelta(days=offset)).isoformat() not in stored or first_day + timedelta(days=offset) >= today
+        ]
+        if missing:
+            computed = {
+                rollup["date"]: rollup for rollup in self.compute(
+                    datetime.combine(min(missing), datetime.min.time()),
+                    datetime.combine(max(missing) + timedelta(days=1), datetime.min.time()),
+                    [courier_id]
+                )
+            }
+            # Дни без точек не сохраняются: точки за них могут прийти пакетом позже
+            fresh = [computed[day.isoformat()] for day in missing if day.isoformat() in computed]
+            for rollup in fresh:
+                stored[rollup["date"]] = rollup
+            self.store([rollup for rollup in fresh if rollup["day_complete"]])
+        return [stored[date] for date in sorted(stored)]
+    
+    def backfill(self) -> dict:
+        report = self.refresh(TRACK_ROLLUP_BACKFILL_DAYS)
+        self.state.mark_built(dict(report, built_at=datetime.utcnow()))
+        print(f"🗺️ Сводки треков v{TRACK_ROLLUP_VERSION}: {report['rollups']} дней курьеров с {report['from']}")
+        return report
+
+courier_rollups = CourierRollupService(db)
+register_backfill(courier_rollups.state, courier_rollups.backfill, "сводки треков")
+
+def courier_history_response(courier_id: str, date_from: Optional[str], date_to: Optional[str], default_days: int, include_points: bool) -> dict:
+    """Ответ эндпоинтов истории: сводки по дням, упрощенные треки и последние точки"""
+    period_filter, date_from, date_to = track_period_filter(date_from, date_to, default_days)
+    rollups = courier_rollups.read(courier_id, date_from, date_to)
+    
+    recent_points = list(db[GPS_HISTORY_COLLECTION].find(
+        {"courier_id": courier_id, **period_filter}, {"_id": 0}
+    ).sort("timestamp", -1).limit(TRACK_RECENT_POINTS))
+    recent_points.reverse()
+    
+    response = {
+        "courier_id": courier_id,
+        "date_from": date_from,
+        "date_to": date_to,
+        "total_points": sum(rollup["metrics"]["points_count"] for rollup in rollups),
+        "total_distance_km": round(sum(rollup["metrics"]["distance_km"] for rollup in rollups), 2),
+        "total_active_hours": round(sum(rollup["metrics"]["active_hours"] for rollup in rollups), 2),
+        "daily_stats": [
+            dict(rollup["metrics"], date=rollup["date"], statuses=list(rollup["metrics"]["status_breakdown"]))
+            for rollup in rollups
+        ],
+        "tracks": [{"date": rollup["date"], "points": rollup["track"]} for rollup in rollups],
+        "recent_points": recent_points
+    }
+    if include_points:
+        response["history"] = list(db[GPS_HISTORY_COLLECTION].find(
+            {"courier_id": courier_id, **period_filter}, {"_id": 0}
+        ).sort("timestamp", 1))
+    return response
+
+async def periodic_courier_rollups():
+    """Пересчет сводок за вчера и сегодня каждые TRACK_ROLLUP_INTERVAL_SECONDS"""
+    while True:
+        await asyncio.sleep(TRACK_ROLLUP_INTERVAL_SECONDS)
+        try:
+            run_key = str(int(time.time() // TRACK_ROLLUP_INTERVAL_SECONDS))
+            await run_in_threadpool(courier_rollups.state.run, lambda: courier_rollups.refresh(1), run_key)
+        except Exception as e:
+            print(f"❌ Ошибка пересчета сводок треков: {str(e)}")
+
+@app.on_event("startup")
+async def bootstrap_courier_rollups():
+    """Запланировать пересчет сводок треков (первичное заполнение - в ensure_backfills)"""
+    asyncio.create_task(periodic_courier_rollups())
+
+@app.post("/api/admin/couriers/rollups/rebuild")
+def rebuild_courier_rollups(
+    days: int = TRACK_ROLLUP_BACKFILL_DAYS,
+    current_user: User = Depends(require_role(UserRole.ADMIN))
+):
+    """Пересчитать сводки треков всех курьеров за последние days дней"""
+    return courier_rollups.refresh(max(0, days))
+
+# ==================== БЛИЖАЙШИЕ КУРЬЕРЫ ====================
+# В courier_locations рядом с latitude/longitude хранится GeoJSON точка "location"
+# (индекс 2dsphere) и поля курьера для фильтров подбора: склад, вместимость
+# транспорта и активность. Точка пишется вместе с последней позицией, поля профиля
+# читаются из couriers при первой позиции курьера, а затем обновляются только
+# подпиской на couriers (кэш контекста GPS может быть устаревшим). /api/couriers/nearest выполняет $geoNear с фильтрами
+# в самом запросе. Записи прежних версий дополняются backfill при смене
+# COURIER_DISPATCH_VERSION.
+
+COURIER_DISPATCH_VERSION = 1
+COURIER_DISPATCH_PROFILE_FIELDS = ["id", "assigned_warehouse_id", "transport_capacity", "is_active"]
+NEAREST_COURIERS_MAX_LIMIT = 50
+NEAREST_MAX_LOCATION_AGE_MINUTES = int(os.environ.get('NEAREST_MAX_LOCATION_AGE_MINUTES', '30'))
+
+def geojson_point(latitude: float, longitude: float) -> dict:
+    """GeoJSON точка (в GeoJSON порядок координат - долгота, широта)"""
+    return {"type": "Point", "coordinates": [float(longitude), float(latitude)]}
+
+def courier_profile_dispatch_fields(courier: dict) -> dict:
+    """Поля профиля курьера, по которым фильтруется подбор ближайших"""
+    return {
+        "assigned_warehouse_id": courier.get("assigned_warehouse_id"),
+        "transport_capacity": courier.get("transport_capacity"),
+        "courier_active": courier.get("is_active", True)
+    }
+
+def find_nearest_couriers(
+    latitude: float,
+    longitude: float,
+    limit: int,
+    warehouse_ids: Optional[List[str]] = None,
+    min_capacity: Optional[float] = None,
+    max_distance_km: Optional[float] = None
+) -> List[dict]:
+    """K ближайших активных курьеров не в статусе offline со свежей позицией, по возрастанию расстояния"""
+    query = {
+        "status": {"$ne": "offline"},
+        "courier_active": {"$ne": False},
+        "last_updated": {"$gte": datetime.utcnow() - timedelta(minutes=NEAREST_MAX_LOCATION_AGE_MINUTES)}
+    }
+    if warehouse_ids is not None:
+        query["assigned_warehouse_id"] = {"$in": list(warehouse_ids)}
+    if min_capacity is not None:
+        query["transport_capacity"] = {"$gte": min_capacity}
+    geo_near = {
+        "near": geojson_point(latitude, longitude),
+        "distanceField": "distance_m",
+        "spherical": True,
+        "query": query
+    }
+    if max_distance_km is not None:
+        geo_near["maxDistance"] = max_distance_km * 1000
+    return list(db.courier_locations.aggregate([
+        {"$geoNear": geo_near},
+        {"$limit": limit},
+        {"$project": {"_id": 0, "location": 0}}
+    ]))
+
+class CourierDispatchService:
+    """Поддержка полей подбора в courier_locations и их первичное заполнение"""
+    
+    def __init__(self, database):
+        self.locations = database.courier_locations
+        self.couriers = database.couriers
+        self.state = BackfillState(database.schema_meta, "courier_dispatch", COURIER_DISPATCH_VERSION)
+    
+    def on_courier_changes(self, collection_name: str, changes: list):
+        operations = []
+        for before, after in changes:
+            if after is None or not after.get("id"):
+                continue
+            fields = courier_profile_dispatch_fields(after)
+            if before is None or courier_profile_dispatch_fields(before) != fields:
+                operations.append(UpdateOne({"courier_id": after["id"]}, {"$set": fields}))
+        if operations:
+            self.locations.bulk_write(operations, ordered=False)
+    
+    def backfill(self) -> dict:
+        """GeoJSON точки из latitude/longitude и поля профиля курьеров для всех позиций"""
+        located = self.locations.update_many(
+            {"location": {"$exists": False}, "latitude": {"$type": "number"}, "longitude": {"$type": "number"}},
+            [{"$set": {"location": {"type": "Point", "coordinates": ["$longitude", "$latitude"]}}}]
+        ).modified_count
+        operations = [
+            UpdateOne({"courier_id": courier["id"]}, {"$set": courier_profile_dispatch_fields(courier)})
+            for courier in self.couriers.find({}, {"_id": 0, **{field: 1 for field in COURIER_DISPATCH_PROFILE_FIELDS}})
+            if courier.get("id")
+        ]
+        profiled = self.locations.bulk_write(operations, ordered=False).modified_count if operations else 0
+        report = {"located": located, "profiled": profiled, "built_at": datetime.utcnow()}
+        self.state.mark_built(report)
+        print(f"📍 Позиции курьеров v{COURIER_DISPATCH_VERSION}: точек {located}, профилей {profiled}")
+        return report
+
+courier_dispatch = CourierDispatchService(db)
+ChangeTrackedDatabase.subscribe("couriers", COURIER_DISPATCH_PROFILE_FIELDS, courier_dispatch.on_courier_changes, on_error=courier_dispatch.state.mark_dirty)
+register_backfill(courier_dispatch.state, courier_dispatch.backfill, "позиции курьеров")
+
+@app.get("/api/couriers/nearest")
+def get_nearest_couriers(
+    latitude: float,
+    longitude: float,
+    limit: int = 5,
+    warehouse_id: Optional[str] = None,
+    min_capacity: Optional[float] = None,
+    max_distance_km: Optional[float] = None,
+    current_user: User = Depends(get_current_user)
+):
+    """Ближайшие к точке забора курьеры не в статусе offline с расстоянием (для назначения заявок)"""
+    if current_user.role not in [UserRole.ADMIN, UserRole.WAREHOUSE_OPERATOR]:
+        raise HTTPException(status_code=403, detail="Insufficient permissions")
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise HTTPException(status_code=400, detail="Invalid coordinates")
+    
+    # Оператор подбирает курьеров только своих складов
+    warehouse_ids = [warehouse_id] if warehouse_id else None
+    if current_user.role == UserRole.WAREHOUSE_OPERATOR:
+        operator_warehouse_ids = operator_bindings.warehouse_ids_for_operator(current_user.id)
+        if warehouse_id and warehouse_id not in operator_warehouse_ids:
+            raise HTTPException(status_code=403, detail="No access to this warehouse")
+        warehouse_ids = warehouse_ids or list(operator_warehouse_ids)
+    
+    couriers = find_nearest_couriers(
+        latitude, longitude, min(max(1, limit), NEAREST_COURIERS_MAX_LIMIT),
+        warehouse_ids, min_capacity, max_distance_km
+    )
+    for courier in couriers:
+        courier["distance_km"] = round(courier.pop("distance_m") / 1000, 3)
+    
+    return {
+        "origin": {"latitude": latitude, "longitude": longitude},
+        "couriers": couriers,
+        "count": len(couriers)
+    }
+
+# API Routes
+
+@app.get("/api/health")
+def health_check():
+    return {"status": "ok"}
+
+# Аутентификация
+@app.post("/api/auth/register")
+def register(user_data: UserCreate):
+    # Проверка существования пользователя
+    if find_user_by_phone(user_data.phone, projection={"_id": 1}):
+        raise HTTPException(status_code=400, detail="User with this phone already exists")
+    
+    # Создание пользователя с ролью по умолчанию USER (функция 3)
+    user_role = UserRole.USER  # Всегда USER для обычной регистрации
+    
+    user_id = str(uuid.uuid4())
+    user_number = generate_user_number()  # Генерируем индивидуальный номер
+    token_version = 1  # Начальная версия токена
+    user = {
+        "id": user_id,
+        "user_number": user_number,  # Добавляем индивидуальный номер
+        "full_name": user_data.full_name,
+        "phone": user_data.phone,
+        "password": hash_password(user_data.password),
+        "role": user_role.value,  # Роль всегда USER
+        "is_active": True,
+        "token_version": token_version,  # Добавляем версию токена
+        "created_at": datetime.utcnow()
+    }
+    
+    db.users.insert_one(user)
+    
+    # Создание токена
+    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    access_token = create_user_token(
+        user_id=user_id,
+        phone=user_data.phone,
+        token_version=1,  # Новые пользователи начинают с версии 1
         expires_delta=access_token_expires
     )
     
@@ -1902,9 +6344,9 @@ async def register(user_data: UserCreate):
     }
 
 @app.post("/api/auth/login")
-async def login(user_data: UserLogin):
+def login(user_data: UserLogin):
     # Сначала проверяем существование пользователя
-    user = db.users.find_one({"phone": user_data.phone})
+    user = find_user_by_phone(user_data.phone)
     
     # Детальная проверка ошибок авторизации
     if not user:
@@ -1996,7 +6438,7 @@ async def login(user_data: UserLogin):
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_user_token(
         user_id=user["id"],
-        phone=user_data.phone,
+        phone=user["phone"],  # Токен хранит телефон в формате записи, а не ввода
         token_version=user.get("token_version", 1),
         expires_delta=access_token_expires
     )
@@ -2019,10 +6461,15 @@ async def login(user_data: UserLogin):
     }
 
 @app.get("/api/auth/me")
-async def get_current_user_info(current_user: User = Depends(get_current_user)):
+def get_current_user_info(current_user: User = Depends(get_current_user)):
     """Get current user information"""
     return current_user
 
+@app.get("/api/admin/auth/cache-stats")
+def get_principal_cache_stats(current_user: User = Depends(require_role(UserRole.ADMIN))):
+    """Статистика кэша аутентифицированных пользователей (попадания/промахи) текущего процесса"""
+    return principal_cache.stats()
+
 # Модель для обновления профиля пользователя
 class UserProfileUpdate(BaseModel):
     full_name: Optional[str] = None
@@ -2031,7 +6478,7 @@ class UserProfileUpdate(BaseModel):
     address: Optional[str] = None
 
 @app.put("/api/user/profile")
-async def update_user_profile(
+def update_user_profile(
     profile_update: UserProfileUpdate,
     current_user: User = Depends(get_current_user)
 ):
@@ -2043,7 +6490,7 @@ async def update_user_profile(
         update_data["full_name"] = profile_update.full_name
     if profile_update.phone:
         # Проверяем, не занят ли номер телефона другим пользователем
-        existing_user = db.users.find_one({"phone": profile_update.phone, "id": {"$ne": current_user.id}})
+        existing_user = find_user_by_phone(profile_update.phone, {"id": {"$ne": current_user.id}})
         if existing_user:
             raise HTTPException(status_code=400, detail="Этот номер телефона уже используется")
         update_data["phone"] = profile_update.phone
@@ -2094,14 +6541,12 @@ async def update_user_profile(
 
 # QR Code APIs
 @app.get("/api/cargo/{cargo_id}/qr-code")
-async def get_cargo_qr_code(
+def get_cargo_qr_code(
     cargo_id: str,
     current_user: User = Depends(get_current_user)
 ):
     """Получить QR код для конкретного груза"""
-    cargo = db.cargo.find_one({"id": cargo_id}, {"_id": 0})
-    if not cargo:
-        cargo = db.operator_cargo.find_one({"id": cargo_id}, {"_id": 0})
+    cargo = find_cargo({"id": cargo_id}, {"_id": 0})
     
     if not cargo:
         raise HTTPException(status_code=404, detail="Cargo not found")
@@ -2119,7 +6564,7 @@ async def get_cargo_qr_code(
     }
 
 @app.post("/api/cargo/scan-qr")
-async def scan_cargo_qr_code(
+def scan_cargo_qr_code(
     qr_data: dict,
     current_user: User = Depends(get_current_user)
 ):
@@ -2138,9 +6583,7 @@ async def scan_cargo_qr_code(
             raise HTTPException(status_code=400, detail="Invalid cargo QR code format")
         
         # Ищем груз в обеих коллекциях
-        cargo = db.cargo.find_one({"cargo_number": cargo_number}, {"_id": 0})
-        if not cargo:
-            cargo = db.operator_cargo.find_one({"cargo_number": cargo_number}, {"_id": 0})
+        cargo = find_cargo({"cargo_number": cargo_number}, {"_id": 0})
         
         if not cargo:
             raise HTTPException(status_code=404, detail=f"Cargo with number {cargo_number} not found")
@@ -2268,7 +6711,7 @@ def get_available_operations(cargo: dict, current_user: User) -> list:
     return operations
 
 @app.post("/api/backend/generate-simple-qr")
-async def generate_simple_qr(
+def generate_simple_qr(
     request_data: dict,
     current_user: User = Depends(get_current_user)
 ):
@@ -2280,26 +6723,8 @@ async def generate_simple_qr(
         if not qr_text:
             raise HTTPException(status_code=400, detail="QR text is required")
         
-        # Используем ту же логику что и в generate_cargo_qr_code
-        # Генерируем QR код (копируем рабочий код)
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_L,
-            box_size=10,
-            border=4,
-        )
-        qr.add_data(qr_text)
-        qr.make(fit=True)
-        
-        # Создаем изображение
-        img = qr.make_image(fill_color="black", back_color="white")
-        
-        # Конвертируем в base64
-        buffer = BytesIO()
-        img.save(buffer, format="PNG")
-        img_data = base64.b64encode(buffer.getvalue()).decode()
-        
-        qr_code_data = f"data:image/png;base64,{img_data}"
+        # Используем те же параметры что и в generate_cargo_qr_code
+        qr_code_data = render_qr_data_url(qr_text, box_size=10, border=4)
         
         return {
             "success": True,
@@ -2313,7 +6738,7 @@ async def generate_simple_qr(
         raise HTTPException(status_code=500, detail=f"Error generating QR code: {str(e)}")
 
 @app.post("/api/cargo/generate-qr-by-number")
-async def generate_qr_by_cargo_number(
+def generate_qr_by_cargo_number(
     request_data: dict,
     current_user: User = Depends(get_current_user)
 ):
@@ -2325,9 +6750,7 @@ async def generate_qr_by_cargo_number(
             raise HTTPException(status_code=400, detail="Cargo number is required")
         
         # Проверяем существование груза
-        cargo = db.cargo.find_one({"cargo_number": cargo_number})
-        if not cargo:
-            cargo = db.operator_cargo.find_one({"cargo_number": cargo_number})
+        cargo = find_cargo({"cargo_number": cargo_number})
         
         if not cargo:
             raise HTTPException(status_code=404, detail=f"Cargo with number {cargo_number} not found")
@@ -2355,7 +6778,7 @@ async def generate_qr_by_cargo_number(
         raise HTTPException(status_code=500, detail=f"Error generating QR code: {str(e)}")
 
 @app.post("/api/warehouse/cell/status")
-async def check_warehouse_cell_status(
+def check_warehouse_cell_status(
     cell_data: dict,
     current_user: User = Depends(get_current_user)
 ):
@@ -2403,6 +6826,36 @@ async def check_warehouse_cell_status(
         else:
             raise HTTPException(status_code=400, detail="Missing required cell identification data")
         
+        # Свободная ячейка ID системы - ответ из справочника ячеек и карты занятости без запросов к базе
+        if "warehouse_id_number" in query:
+            resolved = cell_directory.resolve(f"{warehouse_id_number}-{block_id_number}-{shelf_id_number}-{cell_id_number}")
+            known_warehouse = resolved["warehouse"] if resolved else None
+        elif all(isinstance(value, int) for value in (block_number, shelf_number, cell_number)):
+            resolved = {"block": block_number, "shelf": shelf_number, "cell": cell_number}
+            known_warehouse = cell_directory.warehouse(warehouse_id)
+            if known_warehouse:
+                resolved["cell_id"] = cell_directory.cell_id(warehouse_id, block_number, shelf_number, cell_number)
+        else:
+            resolved, known_warehouse = None, None
+        if known_warehouse and resolved.get("cell_id"):
+            block, shelf, cell_number_value = resolved["block"], resolved["shelf"], resolved["cell"]
+            if cell_occupancy.is_free(known_warehouse["id"], block, shelf, cell_number_value):
+                return {
+                    "success": True,
+                    "is_occupied": False,
+                    "occupied_by": None,
+                    "cargo_number": None,
+                    "cell_exists": True,
+                    "cell_info": {
+                        "id": resolved["cell_id"],
+                        "warehouse_id": known_warehouse["id"],
+                        "warehouse_id_number": known_warehouse["warehouse_id_number"],
+                        "location_code": f"B{block}-S{shelf}-C{cell_number_value}",
+                        "id_based_code": id_based_cell_code(known_warehouse["warehouse_id_number"], block, shelf, cell_number_value),
+                        "readable_name": f"Б{block}-П{shelf}-Я{cell_number_value}"
+                    }
+                }
+        
         # Ищем ячейку
         cell = db.warehouse_cells.find_one(query)
         
@@ -2439,148 +6892,50 @@ async def check_warehouse_cell_status(
         raise HTTPException(status_code=500, detail=f"Error checking cell status: {str(e)}")
 
 @app.post("/api/cargo/place-in-cell")
-async def place_cargo_in_cell(
+def place_cargo_in_cell(
     placement_data: dict,
     current_user: User = Depends(get_current_user)
 ):
     """Разместить груз в ячейку склада по QR кодам с поддержкой ID системы"""
     if current_user.role not in [UserRole.ADMIN, UserRole.WAREHOUSE_OPERATOR]:
         raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Нет прав для размещения груза"
-        )
-    
-    try:
-        cargo_number = placement_data.get("cargo_number", "").strip()
-        cell_code = placement_data.get("cell_code", "").strip()
-        
-        if not cargo_number or not cell_code:
-            raise HTTPException(status_code=400, detail="Cargo number and cell code are required")
-        
-        # Определяем формат cell_code
-        is_id_format = False
-        warehouse_id = None
-        warehouse_id_number = None
-        block = None
-        shelf = None
-        cell = None
-        
-        # Проверяем новый формат ID: 001-01-01-001
-        if len(cell_code.split("-")) == 4 and all(part.isdigit() for part in cell_code.split("-")):
-            is_id_format = True
-            parts = cell_code.split("-")
-            warehouse_id_number = parts[0]
-            block_id = parts[1]
-            shelf_id = parts[2]
-            cell_id = parts[3]
-            
-            # Найдём склад по ID номеру
-            warehouse = db.warehouses.find_one({"warehouse_id_number": warehouse_id_number})
-            if not warehouse:
-                raise HTTPException(status_code=404, detail=f"Warehouse with ID number {warehouse_id_number} not found")
-            
-            warehouse_id = warehouse["id"]
-            
-            # Найдём ячейку по ID номерам
-            cell_query = {
-                "warehouse_id_number": warehouse_id_number,
-                "block_id_number": block_id,
-                "shelf_id_number": shelf_id,
-                "cell_id_number": cell_id
-            }
-            cell_record = db.warehouse_cells.find_one(cell_query)
-            
-            if cell_record:
-                block = cell_record.get("block_number")
-                shelf = cell_record.get("shelf_number")
-                cell = cell_record.get("cell_number")
-            else:
-                # Если ячейка не найдена, извлекаем номера из ID
-                block = int(block_id)
-                shelf = int(shelf_id)
-                cell = int(cell_id)
-                
-        # Проверяем старый формат: СКЛАД_ID-Б_номер-П_номер-Я_номер
-        elif "-Б" in cell_code and "-П" in cell_code and "-Я" in cell_code:
-            is_id_format = False
-            
-            # ИСПРАВЛЕНИЕ: Правильно извлекаем warehouse_id, учитывая что он может содержать дефисы (UUID)
-            # Ищем первое вхождение "-Б" чтобы отделить warehouse_id от координат ячейки
-            b_index = cell_code.find("-Б")
-            if b_index == -1:
-                raise HTTPException(status_code=400, detail="Invalid cell code format")
-            
-            warehouse_id = cell_code[:b_index]  # Всё до "-Б" это warehouse_id
-            coordinates_part = cell_code[b_index+1:]  # Всё после "-Б" это координаты (Б_номер-П_номер-Я_номер)
-            
-            # Парсим координаты: Б_номер-П_номер-Я_номер
-            coord_parts = coordinates_part.split("-")
-            if len(coord_parts) != 3:
-                raise HTTPException(status_code=400, detail="Invalid cell code format")
-            
-            try:
-                block = int(coord_parts[0][1:])  # Убираем "Б" и парсим номер
-                shelf = int(coord_parts[1][1:])  # Убираем "П" и парсим номер 
-                cell = int(coord_parts[2][1:])   # Убираем "Я" и парсим номер
-            except (ValueError, IndexError) as e:
-                raise HTTPException(status_code=400, detail=f"Invalid cell coordinates format: {str(e)}")
-            
-            # Проверяем существование склада
-            warehouse = db.warehouses.find_one({"id": warehouse_id})
-            if not warehouse:
-                raise HTTPException(status_code=404, detail="Warehouse not found")
-                
-        # НОВОЕ: Проверяем компактный формат 9 цифр: 003010106 (склад блок полка ячейка)
-        elif len(cell_code) == 9 and cell_code.isdigit():
-            is_id_format = False
-            
-            # Парсим НОВЫЙ компактный формат: WWWBBSSCC
-            warehouse_number = int(cell_code[:3])  # Первые 3 цифры - номер склада
-            block_number = int(cell_code[3:5])     # Следующие 2 цифры - номер блока  
-            shelf_number = int(cell_code[5:7])     # Следующие 2 цифры - номер полки
-            cell_number = int(cell_code[7:9])      # Последние 2 цифры - номер ячейки
-            
-            # Найдем склад по warehouse_number
-            warehouse = db.warehouses.find_one({"warehouse_number": warehouse_number})
-            if not warehouse:
-                raise HTTPException(status_code=404, detail=f"Warehouse with number {warehouse_number} not found")
-            
-            warehouse_id = warehouse["id"]
-            block = block_number
-            shelf = shelf_number
-            cell = cell_number
-            
-            print(f"🔍 НОВЫЙ компактный формат QR (9 цифр): {cell_code} -> Склад#{warehouse_number} Б{block} П{shelf} Я{cell}")
-                
-        # СТАРЫЙ: Проверяем компактный формат 8 цифр: 03010106 (для обратной совместимости)
-        elif len(cell_code) == 8 and cell_code.isdigit():
-            is_id_format = False
-            
-            # Парсим СТАРЫЙ компактный формат: WWBBSSCC
-            warehouse_number = int(cell_code[:2])  # Первые 2 цифры - номер склада
-            block_number = int(cell_code[2:4])     # Следующие 2 цифры - номер блока  
-            shelf_number = int(cell_code[4:6])     # Следующие 2 цифры - номер полки
-            cell_number = int(cell_code[6:8])      # Последние 2 цифры - номер ячейки
-            
-            # Найдем склад по warehouse_number
-            warehouse = db.warehouses.find_one({"warehouse_number": warehouse_number})
-            if not warehouse:
-                raise HTTPException(status_code=404, detail=f"Warehouse with number {warehouse_number} not found")
-            
-            warehouse_id = warehouse["id"]
-            block = block_number
-            shelf = shelf_number
-            cell = cell_number
-            
-            print(f"🔍 СТАРЫЙ компактный формат QR (8 цифр): {cell_code} -> Склад#{warehouse_number} Б{block} П{shelf} Я{cell}")
-                
-        else:
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Нет прав для размещения груза"
+        )
+    
+    try:
+        cargo_number = placement_data.get("cargo_number", "").strip()
+        cell_code = placement_data.get("cell_code", "").strip()
+        
+        if not cargo_number or not cell_code:
+            raise HTTPException(status_code=400, detail="Cargo number and cell code are required")
+        
+        # Разбор кода ячейки и поиск склада - по справочнику ячеек, без запросов к базе
+        resolved = cell_directory.resolve(cell_code)
+        if not resolved:
             raise HTTPException(status_code=400, detail="Invalid cell code format. Expected: '003010106' (9 digits), '03010106' (8 digits), '001-01-01-001' or 'WAREHOUSE_ID-Б1-П1-Я1'")
         
+        warehouse = resolved["warehouse"]
+        if not warehouse:
+            raise HTTPException(
+                status_code=404,
+                detail=WAREHOUSE_NOT_FOUND_MESSAGES[resolved["format"]].format(key=resolved["warehouse_key"])
+            )
+        
+        is_id_format = resolved["format"] == "id"
+        warehouse_id = warehouse["id"]
+        warehouse_id_number = resolved["warehouse_key"] if is_id_format else None
+        block_id = resolved.get("block_id_number")
+        shelf_id = resolved.get("shelf_id_number")
+        cell_id = resolved.get("cell_id_number")
+        block = resolved["block"]
+        shelf = resolved["shelf"]
+        cell = resolved["cell"]
+        
+        print(f"🔍 Код ячейки ({resolved['format']}): {cell_code} -> Склад {warehouse.get('name')} Б{block} П{shelf} Я{cell}")
+        
         # Ищем груз
-        cargo = db.cargo.find_one({"cargo_number": cargo_number})
-        if not cargo:
-            cargo = db.operator_cargo.find_one({"cargo_number": cargo_number})
+        cargo, cargo_collection = locate_cargo({"cargo_number": cargo_number})
         
         if not cargo:
             raise HTTPException(status_code=404, detail=f"Cargo {cargo_number} not found")
@@ -2697,18 +7052,12 @@ async def place_cargo_in_cell(
                 "readable_location": f"Б{block}-П{shelf}-Я{cell}"
             })
         
-        # Обновляем груз в соответствующей коллекции
-        cargo_updated = db.cargo.update_one(
+        # Обновляем груз в коллекции, где он был найден
+        db[cargo_collection].update_one(
             {"cargo_number": cargo_number},
             {"$set": update_data}
         )
         
-        if cargo_updated.matched_count == 0:
-            db.operator_cargo.update_one(
-                {"cargo_number": cargo_number},
-                {"$set": update_data}
-            )
-        
         return {
             "success": True,
             "message": f"Cargo {cargo_number} successfully placed in cell",
@@ -2728,7 +7077,7 @@ async def place_cargo_in_cell(
         raise HTTPException(status_code=500, detail=f"Error placing cargo in cell: {str(e)}")
 
 @app.get("/api/operator/placement-statistics")
-async def get_placement_statistics(
+def get_placement_statistics(
     current_user: User = Depends(get_current_user)
 ):
     """Получить статистику размещения грузов для оператора"""
@@ -2741,14 +7090,9 @@ async def get_placement_statistics(
     try:
         from datetime import datetime, timedelta
         today = datetime.utcnow().date()
-        today_start = datetime.combine(today, datetime.min.time())
-        today_end = datetime.combine(today, datetime.max.time())
         
-        # Статистика за сегодня для текущего оператора
-        today_placements = db.warehouse_cells.count_documents({
-            "placed_by": current_user.id,
-            "placed_at": {"$gte": today_start, "$lte": today_end}
-        })
+        # Статистика за сегодня для текущего оператора (счетчик размещений по дням)
+        today_placements = dashboard_stats.placements_on(current_user.id, today)
         
         # Общая статистика за текущую сессию работы (последние 8 часов)
         session_start = datetime.utcnow() - timedelta(hours=8)
@@ -2787,7 +7131,7 @@ async def get_placement_statistics(
         raise HTTPException(status_code=500, detail=f"Error retrieving placement statistics: {str(e)}")
 
 @app.get("/api/warehouses/{warehouse_id}/structure")
-async def get_warehouse_structure(
+def get_warehouse_structure(
     warehouse_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -2829,7 +7173,7 @@ async def get_warehouse_structure(
         raise HTTPException(status_code=500, detail=f"Error retrieving warehouse structure: {str(e)}")
 
 @app.post("/api/warehouse/cell/generate-qr")
-async def generate_warehouse_cell_qr(
+def generate_warehouse_cell_qr(
     cell_data: dict,
     current_user: User = Depends(get_current_user)
 ):
@@ -2894,7 +7238,7 @@ async def generate_warehouse_cell_qr(
 
 # НОВЫЙ ENDPOINT: Обновление номеров складов для уникальности QR кодов
 @app.post("/api/admin/warehouses/update-id-numbers")
-async def update_warehouse_id_numbers(
+def update_warehouse_id_numbers(
     current_user: User = Depends(get_current_user)
 ):
     """Обновить номера складов для обеспечения уникальности QR кодов ячеек"""
@@ -2963,7 +7307,7 @@ async def update_warehouse_id_numbers(
         raise HTTPException(status_code=500, detail=f"Error updating warehouse ID numbers: {str(e)}")
 
 @app.post("/api/warehouses/{warehouse_id}/add-block")
-async def add_warehouse_block(
+def add_warehouse_block(
     warehouse_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -3005,7 +7349,7 @@ async def add_warehouse_block(
         raise HTTPException(status_code=500, detail=f"Error adding block: {str(e)}")
 
 @app.post("/api/warehouses/{warehouse_id}/delete-block")
-async def delete_warehouse_block(
+def delete_warehouse_block(
     warehouse_id: str,
     block_data: dict,
     current_user: User = Depends(get_current_user)
@@ -3075,16 +7419,14 @@ async def delete_warehouse_block(
         raise HTTPException(status_code=500, detail=f"Error deleting block: {str(e)}")
 
 @app.post("/api/cargo/generate-application-qr/{cargo_number}")
-async def generate_application_qr_code(
+def generate_application_qr_code(
     cargo_number: str,
     current_user: User = Depends(get_current_user)
 ):
     """Генерировать QR код для номера заявки/груза"""
     try:
         # Поиск груза в обеих коллекциях
-        cargo = db.cargo.find_one({"cargo_number": cargo_number}, {"_id": 0})
-        if not cargo:
-            cargo = db.operator_cargo.find_one({"cargo_number": cargo_number}, {"_id": 0})
+        cargo = find_cargo({"cargo_number": cargo_number}, {"_id": 0})
         
         if not cargo:
             raise HTTPException(status_code=404, detail="Cargo not found")
@@ -3093,32 +7435,10 @@ async def generate_application_qr_code(
         if current_user.role == UserRole.USER and cargo.get("sender_id") != current_user.id:
             raise HTTPException(status_code=403, detail="Access denied")
         
-        # Создаем простой QR код с номером заявки
-        import qrcode
-        from io import BytesIO
-        import base64
-        
         # Данные для QR кода заявки
         qr_data = f"ЗАЯВКА TAJLINE.TJ\nНомер: {cargo_number}\nДата: {cargo.get('created_at', 'Не указана')}\nОтправитель: {cargo.get('sender_full_name', 'Не указан')}"
         
-        # Генерируем QR код
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_L,
-            box_size=10,
-            border=4,
-        )
-        qr.add_data(qr_data)
-        qr.make(fit=True)
-        
-        # Создаем изображение
-        img = qr.make_image(fill_color="black", back_color="white")
-        
-        # Конвертируем в base64
-        buffer = BytesIO()
-        img.save(buffer, format='PNG')
-        img_str = base64.b64encode(buffer.getvalue()).decode()
-        qr_code_data = f"data:image/png;base64,{img_str}"
+        qr_code_data = render_qr_data_url(qr_data, box_size=10, border=4)
         
         return {
             "cargo_number": cargo_number,
@@ -3137,7 +7457,7 @@ async def generate_application_qr_code(
         raise HTTPException(status_code=500, detail=f"Error generating application QR code: {str(e)}")
 
 @app.get("/api/cargo/batch/{cargo_numbers}/qr-codes")
-async def get_batch_cargo_qr_codes(
+def get_batch_cargo_qr_codes(
     cargo_numbers: str,  # comma-separated cargo numbers
     current_user: User = Depends(get_current_user)
 ):
@@ -3150,11 +7470,11 @@ async def get_batch_cargo_qr_codes(
         
         cargo_qr_codes = []
         
+        # Поиск всех грузов в обеих коллекциях одним запросом
+        found_cargo = find_cargo_many("cargo_number", cargo_numbers_list, {"_id": 0})
+        
         for cargo_number in cargo_numbers_list:
-            # Поиск груза в обеих коллекциях
-            cargo = db.cargo.find_one({"cargo_number": cargo_number}, {"_id": 0})
-            if not cargo:
-                cargo = db.operator_cargo.find_one({"cargo_number": cargo_number}, {"_id": 0})
+            cargo = found_cargo.get(cargo_number)
             
             if cargo:
                 # Проверка доступа
@@ -3182,7 +7502,7 @@ async def get_batch_cargo_qr_codes(
         raise HTTPException(status_code=500, detail=f"Error generating batch QR codes: {str(e)}")
 
 @app.get("/api/cargo/batch/{cargo_numbers}/qr-codes-old")
-async def get_batch_cargo_qr_codes_old(
+def get_batch_cargo_qr_codes_old(
     cargo_numbers: str,  # comma-separated cargo numbers
     current_user: User = Depends(get_current_user)
 ):
@@ -3195,11 +7515,11 @@ async def get_batch_cargo_qr_codes_old(
         
         cargo_qr_codes = []
         
+        # Поиск всех грузов в обеих коллекциях одним запросом
+        found_cargo = find_cargo_many("cargo_number", cargo_numbers_list, {"_id": 0})
+        
         for cargo_number in cargo_numbers_list:
-            # Поиск груза в обеих коллекциях
-            cargo = db.cargo.find_one({"cargo_number": cargo_number}, {"_id": 0})
-            if not cargo:
-                cargo = db.operator_cargo.find_one({"cargo_number": cargo_number}, {"_id": 0})
+            cargo = found_cargo.get(cargo_number)
             
             if cargo:
                 # Проверка доступа
@@ -3227,7 +7547,7 @@ async def get_batch_cargo_qr_codes_old(
         raise HTTPException(status_code=500, detail=f"Error generating batch QR codes: {str(e)}")
 
 @app.get("/api/cargo/invoice/{cargo_numbers}")
-async def generate_cargo_invoice(
+def generate_cargo_invoice(
     cargo_numbers: str,  # comma-separated cargo numbers
     current_user: User = Depends(get_current_user)
 ):
@@ -3244,11 +7564,11 @@ async def generate_cargo_invoice(
         sender_info = None
         recipient_info = None
         
+        # Поиск всех грузов в обеих коллекциях одним запросом
+        found_cargo = find_cargo_many("cargo_number", cargo_numbers_list, {"_id": 0})
+        
         for cargo_number in cargo_numbers_list:
-            # Поиск груза в обеих коллекциях
-            cargo = db.cargo.find_one({"cargo_number": cargo_number}, {"_id": 0})
-            if not cargo:
-                cargo = db.operator_cargo.find_one({"cargo_number": cargo_number}, {"_id": 0})
+            cargo = found_cargo.get(cargo_number)
             
             if cargo:
                 # Проверка доступа
@@ -3327,14 +7647,14 @@ async def generate_cargo_invoice(
         raise HTTPException(status_code=500, detail=f"Error generating invoice: {str(e)}")
 
 @app.get("/api/cargo/{cargo_id}/qr-code-old")
-async def get_cargo_qr_code_old(
+def get_cargo_qr_code_old(
     cargo_id: str,
     current_user: User = Depends(get_current_user)
 ):
     """Получить QR код для конкретного груза (старая версия для совместимости)"""
 
 @app.get("/api/warehouse/{warehouse_id}/cell-qr/{block}/{shelf}/{cell}")
-async def get_warehouse_cell_qr_code(
+def get_warehouse_cell_qr_code(
     warehouse_id: str,
     block: int,
     shelf: int,
@@ -3365,7 +7685,7 @@ async def get_warehouse_cell_qr_code(
     }
 
 @app.get("/api/warehouse/{warehouse_id}/all-cells-qr")
-async def get_all_warehouse_cells_qr_codes(
+def get_all_warehouse_cells_qr_codes(
     warehouse_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -3403,9 +7723,70 @@ async def get_all_warehouse_cells_qr_codes(
         "qr_codes": qr_codes
     }
 
+def _qr_png_response(request: Request, key: str, png: bytes) -> Response:
+    """PNG QR кода с ETag; содержимое по ключу неизменно, поэтому кэшируется клиентом навсегда"""
+    etag = f'"{key}"'
+    headers = {"ETag": etag, "Cache-Control": "private, max-age=31536000, immutable"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=png, media_type="image/png", headers=headers)
+
+@app.get("/api/qr/render.png")
+def render_qr_png(
+    request: Request,
+    data: str,
+    box_size: int = 10,
+    border: int = 4,
+    error_correction: str = "L",
+    current_user: User = Depends(get_current_user)
+):
+    """Изображение QR кода для произвольного текста (PNG, через кэш)"""
+    error_correction = error_correction.upper()
+    if error_correction not in QR_ERROR_CORRECTION_LEVELS:
+        raise HTTPException(status_code=400, detail="error_correction must be one of L, M, Q, H")
+    if not data or not (1 <= box_size <= 40) or not (0 <= border <= 20):
+        raise HTTPException(status_code=400, detail="Invalid QR parameters")
+    if len(data) > QR_MAX_DATA_LENGTH:
+        raise HTTPException(status_code=400, detail=f"QR data must not exceed {QR_MAX_DATA_LENGTH} characters")
+    
+    try:
+        key, png = qr_image_cache.png(data, box_size, border, error_correction, store=qr_payload_is_cacheable(data))
+    except DataOverflowError:
+        raise HTTPException(status_code=400, detail="QR data is too long for the selected error correction level")
+    return _qr_png_response(request, key, png)
+
+@app.get("/api/qr/{qr_key}.png")
+def get_cached_qr_png(
+    qr_key: str,
+    request: Request,
+    expires: int = 0,
+    signature: str = "",
+    data: Optional[str] = None,
+    box_size: int = 10,
+    border: int = 4,
+    ec: str = "L"
+):
+    """Изображение QR кода по подписанной ссылке из qr_image_url (для <img> без заголовка авторизации)"""
+    if not QR_KEY_PATTERN.match(qr_key):
+        raise HTTPException(status_code=404, detail="QR image not found")
+    if expires < time.time() or not hmac.compare_digest(signature, qr_url_signature(qr_key, expires)):
+        raise HTTPException(status_code=403, detail="QR image link is invalid or expired")
+    png = qr_image_cache.lookup(qr_key)
+    if png is None:
+        # Файл вытеснен или сохранен на другом хосте: подпись ключа подтверждает параметры из ссылки
+        if data is None or ec not in QR_ERROR_CORRECTION_LEVELS or QRImageCache.key(data, box_size, border, ec) != qr_key:
+            raise HTTPException(status_code=404, detail="QR image not found")
+        _, png = qr_image_cache.png(data, box_size, border, ec)
+    return _qr_png_response(request, qr_key, png)
+
+@app.get("/api/admin/qr-cache/stats")
+def get_qr_cache_stats(current_user: User = Depends(require_role(UserRole.ADMIN))):
+    """Статистика кэша QR-изображений"""
+    return qr_image_cache.stats()
+
 # QR Code Scanning API
 @app.post("/api/qr/scan")
-async def scan_qr_code(
+def scan_qr_code(
     qr_data: dict,
     current_user: User = Depends(get_current_user)
 ):
@@ -3419,21 +7800,20 @@ async def scan_qr_code(
     if "-Б" in qr_text and "-П" in qr_text and "-Я" in qr_text:
         # QR код ячейки склада: СКЛАД_ID-Б_номер-П_номер-Я_номер
         try:
-            # Разбираем код ячейки
-            parts = qr_text.split("-")
-            if len(parts) < 4:
+            # Разбираем код ячейки и ищем склад по справочнику ячеек
+            resolved = cell_directory.resolve(qr_text)
+            if not resolved:
                 raise HTTPException(status_code=400, detail="Invalid cell QR code format")
             
-            warehouse_id = parts[0]
-            block = int(parts[1][1:])  # Убираем "Б"
-            shelf = int(parts[2][1:])  # Убираем "П" 
-            cell = int(parts[3][1:])   # Убираем "Я"
-            
-            # Найти склад
-            warehouse = db.warehouses.find_one({"id": warehouse_id})
+            warehouse = resolved["warehouse"]
             if not warehouse:
                 raise HTTPException(status_code=404, detail="Warehouse not found")
             
+            warehouse_id = warehouse["id"]
+            block = resolved["block"]
+            shelf = resolved["shelf"]
+            cell = resolved["cell"]
+            
             # Проверка доступа
             if current_user.role not in [UserRole.ADMIN, UserRole.WAREHOUSE_OPERATOR]:
                 raise HTTPException(status_code=403, detail="Access denied")
@@ -3469,9 +7849,7 @@ async def scan_qr_code(
             cargo_number = qr_text.strip()
             
             # Ищем груз
-            cargo = db.cargo.find_one({"cargo_number": cargo_number})
-            if not cargo:
-                cargo = db.operator_cargo.find_one({"cargo_number": cargo_number})
+            cargo = find_cargo({"cargo_number": cargo_number})
             
             if not cargo:
                 raise HTTPException(status_code=404, detail=f"Cargo {cargo_number} not found")
@@ -3496,10 +7874,11 @@ async def scan_qr_code(
             raise HTTPException(status_code=400, detail="Invalid cargo QR code format")
 
 @app.get("/api/operator/cargo/list")
-async def get_operator_cargo_list(
+def get_operator_cargo_list(
     page: int = 1,
     per_page: int = 25,
     filter_status: Optional[str] = None,  # payment_pending, awaiting_placement, new_request
+    cursor: Optional[str] = None,  # next_cursor предыдущей страницы
     current_user: User = Depends(get_current_user)
 ):
     """Получить список грузов оператора с пагинацией и возможностью фильтрации"""
@@ -3532,37 +7911,12 @@ async def get_operator_cargo_list(
             base_query["processing_status"] = "payment_pending"
             base_query["status"] = CargoStatus.ACCEPTED
     
-    # Ищем в коллекции operator_cargo (принятые заявки)
-    operator_cargo_cursor = db.operator_cargo.find(base_query).sort("created_at", -1)
-    
-    # Также ищем в коллекции cargo (если админ)
-    user_cargo_list = []
-    if current_user.role == UserRole.ADMIN:
-        user_cargo_cursor = db.cargo.find(base_query).sort("created_at", -1)
-        user_cargo_list = list(user_cargo_cursor)
-    
-    # Получаем общий count для правильной пагинации
-    operator_cargo_count = db.operator_cargo.count_documents(base_query)
-    user_cargo_count = len(user_cargo_list)
-    total_count = operator_cargo_count + user_cargo_count
-    
-    # Применяем пагинацию
-    skip = (pagination.page - 1) * pagination.per_page
-    
-    # Получаем элементы с учетом пагинации
-    all_cargo = []
-    
-    # Получаем operator cargo
-    operator_cargo_list = list(operator_cargo_cursor.skip(skip).limit(pagination.per_page))
-    
-    # Если нужно больше элементов, добавляем из user cargo
-    remaining = pagination.per_page - len(operator_cargo_list)
-    if remaining > 0 and user_cargo_list:
-        user_skip = max(0, skip - operator_cargo_count)
-        user_cargo_subset = user_cargo_list[user_skip:user_skip + remaining]
-        all_cargo.extend(user_cargo_subset)
-    
-    all_cargo.extend(operator_cargo_list)
+    # Оператор видит принятые заявки (operator_cargo), админ - также грузы клиентов (cargo).
+    # Обе коллекции сливаются и сортируются по created_at в одном запросе
+    collections = ("operator_cargo", "cargo") if current_user.role == UserRole.ADMIN else ("operator_cargo",)
+    page_data = paginate_cargo(base_query, pagination.page, pagination.per_page, cursor, collections)
+    all_cargo = page_data["items"]
+    total_count = page_data["total_count"]
     
     # Нормализуем данные
     normalized_cargo = []
@@ -3584,15 +7938,17 @@ async def get_operator_cargo_list(
         normalized_cargo.append(normalized)
     
     # Создаем ответ с пагинацией
-    return create_pagination_response(
+    response = create_pagination_response(
         normalized_cargo, 
         total_count, 
         pagination.page, 
         pagination.per_page
     )
+    response["pagination"]["next_cursor"] = page_data["next_cursor"]
+    return response
 
 @app.post("/api/admin/cleanup-test-data")
-async def cleanup_test_data(
+def cleanup_test_data(
     current_user: User = Depends(get_current_user)
 ):
     """Очистить все тестовые данные из системы"""
@@ -3723,7 +8079,7 @@ async def cleanup_test_data(
 
 # Управление грузами
 @app.post("/api/cargo/create")
-async def create_cargo(cargo_data: CargoCreate, current_user: User = Depends(get_current_user)):
+def create_cargo(cargo_data: CargoCreate, current_user: User = Depends(get_current_user)):
     cargo_id = str(uuid.uuid4())
     cargo_number = generate_cargo_number()
     
@@ -3763,8 +8119,9 @@ async def create_cargo(cargo_data: CargoCreate, current_user: User = Depends(get
     return Cargo(**cargo)
 
 @app.get("/api/operator/my-warehouses")
-async def get_operator_warehouses_detailed(
-    current_user: User = Depends(get_current_user)
+def get_operator_warehouses_detailed(
+    current_user: User = Depends(get_current_user),
+    loaders: RequestLoaders = Depends(get_request_loaders)
 ):
     """Расширенный личный кабинет оператора - показать все склады и функции (Функция 2)"""
     if current_user.role not in [UserRole.ADMIN, UserRole.WAREHOUSE_OPERATOR]:
@@ -3789,17 +8146,18 @@ async def get_operator_warehouses_detailed(
     
     # Получаем расширенную статистику и функции по каждому складу
     warehouse_list = []
+    warehouse_stats = dashboard_stats.get_many([f"warehouse:{warehouse['id']}" for warehouse in warehouses])
+    if is_admin:
+        for warehouse in warehouses:
+            loaders.users.prime(*[binding["operator_id"] for binding in operator_bindings.bindings_for_warehouse(warehouse["id"])])
     for warehouse in warehouses:
-        # Подсчитываем грузы на складе
-        cargo_count_user = db.cargo.count_documents({"warehouse_id": warehouse["id"]})
-        cargo_count_operator = db.operator_cargo.count_documents({"warehouse_id": warehouse["id"]})
-        total_cargo = cargo_count_user + cargo_count_operator
+        stats = warehouse_stats[f"warehouse:{warehouse['id']}"]
         
-        # Подсчитываем занятые ячейки
-        occupied_cells = db.warehouse_cells.count_documents({
-            "warehouse_id": warehouse["id"], 
-            "is_occupied": True
-        })
+        # Грузы и занятые ячейки склада из счетчиков
+        cargo_count_user = stats.get("cargo_by_collection", {}).get("cargo", 0)
+        cargo_count_operator = stats.get("cargo_by_collection", {}).get("operator_cargo", 0)
+        total_cargo = cargo_count_user + cargo_count_operator
+        occupied_cells = stats.get("occupied_cells", 0)
         
         total_cells = warehouse["blocks_count"] * warehouse["shelves_per_block"] * warehouse["cells_per_shelf"]
         
@@ -3813,18 +8171,17 @@ async def get_operator_warehouses_detailed(
         })
         
         # Подсчитываем грузы в разных статусах
-        cargo_statuses = {}
-        for status in ['accepted', 'placed_in_warehouse', 'on_transport', 'in_transit', 'arrived_destination', 'delivered']:
-            count_user = db.cargo.count_documents({"warehouse_id": warehouse["id"], "status": status})
-            count_operator = db.operator_cargo.count_documents({"warehouse_id": warehouse["id"], "status": status})
-            cargo_statuses[status] = count_user + count_operator
+        cargo_statuses = {
+            status: stats.get("by_status", {}).get(status, 0)
+            for status in ['accepted', 'placed_in_warehouse', 'on_transport', 'in_transit', 'arrived_destination', 'delivered']
+        }
         
         # Получаем список других операторов этого склада (для админов)
         bound_operators = []
         if is_admin:
-            bindings = list(db.operator_warehouse_bindings.find({"warehouse_id": warehouse["id"]}))
+            bindings = operator_bindings.bindings_for_warehouse(warehouse["id"])
             for binding in bindings:
-                operator = db.users.find_one({"id": binding["operator_id"]}, {"password": 0})
+                operator = loaders.users.get(binding["operator_id"])
                 if operator:
                     bound_operators.append({
                         "id": operator["id"],
@@ -3901,7 +8258,7 @@ async def get_operator_warehouses_detailed(
     }
 
 @app.get("/api/cargo/my")
-async def get_my_cargo(current_user: User = Depends(get_current_user)):
+def get_my_cargo(current_user: User = Depends(get_current_user)):
     # Search in both collections for user's cargo
     user_cargo_list = list(db.cargo.find({"sender_id": current_user.id}))
     
@@ -3923,7 +8280,7 @@ async def get_my_cargo(current_user: User = Depends(get_current_user)):
     return normalized_cargo
 
 @app.get("/api/cargo/track/{cargo_number}")
-async def track_cargo(cargo_number: str):
+def track_cargo(cargo_number: str):
     # ИСПРАВЛЕНИЕ: Улучшенный поиск грузов с поддержкой различных форматов номеров
     
     # Создаем список возможных вариантов поиска
@@ -3987,7 +8344,7 @@ async def track_cargo(cargo_number: str):
     return normalized
 
 @app.get("/api/cargo/all")
-async def get_all_cargo(current_user: User = Depends(require_role(UserRole.ADMIN))):
+def get_all_cargo(current_user: User = Depends(require_role(UserRole.ADMIN))):
     # Get cargo from both collections
     user_cargo_list = list(db.cargo.find({}))
     operator_cargo_list = list(db.operator_cargo.find({}))
@@ -4027,7 +8384,7 @@ async def get_all_cargo(current_user: User = Depends(require_role(UserRole.ADMIN
 
 
 @app.put("/api/cargo/{cargo_id}/processing-status")
-async def update_cargo_processing_status(
+def update_cargo_processing_status(
     cargo_id: str, 
     status_update: dict,
     current_user: User = Depends(get_current_user)
@@ -4085,7 +8442,7 @@ async def update_cargo_processing_status(
         )
 
 @app.put("/api/cargo/{cargo_id}/status")
-async def update_cargo_status(
+def update_cargo_status(
     cargo_id: str, 
     status: CargoStatus,
     warehouse_location: Optional[str] = None,
@@ -4123,7 +8480,7 @@ async def update_cargo_status(
 
 # Склад
 @app.get("/api/warehouse/cargo")
-async def get_warehouse_cargo(current_user: User = Depends(require_role(UserRole.WAREHOUSE_OPERATOR))):
+def get_warehouse_cargo(current_user: User = Depends(require_role(UserRole.WAREHOUSE_OPERATOR))):
     # Search both user cargo and operator cargo collections
     user_cargo_list = list(db.cargo.find({
         "status": {"$in": [CargoStatus.CREATED, CargoStatus.ACCEPTED, CargoStatus.IN_TRANSIT]}
@@ -4167,25 +8524,14 @@ async def get_warehouse_cargo(current_user: User = Depends(require_role(UserRole
     return normalized_cargo
 
 @app.get("/api/warehouse/search")
-async def search_cargo(
+def search_cargo(
     query: str,
     current_user: User = Depends(require_role(UserRole.WAREHOUSE_OPERATOR))
 ):
-    # Search in both collections
-    user_cargo_list = list(db.cargo.find({
-        "$or": [
-            {"cargo_number": {"$regex": query, "$options": "i"}},
-            {"recipient_name": {"$regex": query, "$options": "i"}}
-        ]
-    }))
-    
-    operator_cargo_list = list(db.operator_cargo.find({
-        "$or": [
-            {"cargo_number": {"$regex": query, "$options": "i"}},
-            {"recipient_name": {"$regex": query, "$options": "i"}},
-            {"recipient_full_name": {"$regex": query, "$options": "i"}}
-        ]
-    }))
+    # Поиск по номеру и получателю в обеих коллекциях через поисковый индекс
+    found = search_entities("cargo", query, ["number", "recipient_name"])
+    user_cargo_list = [cargo for cargo, source, _ in found if source == "cargo"]
+    operator_cargo_list = [cargo for cargo, source, _ in found if source == "operator_cargo"]
     
     # Normalize all cargo data
     normalized_cargo = []
@@ -4220,12 +8566,13 @@ async def search_cargo(
 
 # Администрирование
 @app.get("/api/admin/users")
-async def get_all_users(
+def get_all_users(
     page: int = 1,
     per_page: int = 25,
     role: Optional[str] = None,
     search: Optional[str] = None,
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(get_current_user),
+    loaders: RequestLoaders = Depends(get_request_loaders)
 ):
     """Получить список всех пользователей с пагинацией и фильтрацией"""
     if current_user.role != UserRole.ADMIN:
@@ -4243,13 +8590,8 @@ async def get_all_users(
     
     # Поиск по имени, телефону или email
     if search:
-        escaped_search = escape_regex_special_chars(search)
-        search_pattern = {"$regex": escaped_search, "$options": "i"}
-        query["$or"] = [
-            {"full_name": search_pattern},
-            {"phone": search_pattern},
-            {"email": search_pattern}
-        ]
+        matched = search_index.match("user", search, ["name", "phone", "email"], limit=0)
+        query["id"] = {"$in": [hit["ref"] for hit in matched]}
     
     # Получаем пользователей с пагинацией
     users_cursor = db.users.find(query).sort("created_at", -1)
@@ -4259,6 +8601,15 @@ async def get_all_users(
     skip = (pagination.page - 1) * pagination.per_page
     users_list = list(users_cursor.skip(skip).limit(pagination.per_page))
     
+    # Склады всех операторов страницы загружаются одним запросом
+    operator_warehouse_ids = {
+        user["id"]: operator_bindings.warehouse_ids_for_operator(user["id"])
+        for user in users_list
+        if user.get('role') == UserRole.WAREHOUSE_OPERATOR.value
+    }
+    for warehouse_ids in operator_warehouse_ids.values():
+        loaders.warehouses.prime(*warehouse_ids)
+    
     # Нормализуем данные (убираем пароли)
     normalized_users = []
     for user in users_list:
@@ -4270,9 +8621,7 @@ async def get_all_users(
         # Добавляем дополнительную информацию
         if user.get('role') == UserRole.WAREHOUSE_OPERATOR.value:
             # Получаем привязанные склады для операторов
-            warehouses_binding = list(db.operator_warehouse_bindings.find({"operator_id": user["id"]}))
-            warehouse_ids = [binding["warehouse_id"] for binding in warehouses_binding]
-            warehouses = list(db.warehouses.find({"id": {"$in": warehouse_ids}}))
+            warehouses = list(loaders.warehouses.get_many(operator_warehouse_ids[user["id"]]).values())
             normalized["warehouses"] = [serialize_mongo_document(warehouse) for warehouse in warehouses]
             normalized["warehouses_count"] = len(warehouses)
         else:
@@ -4289,7 +8638,7 @@ async def get_all_users(
     )
 
 @app.put("/api/admin/users/{user_id}/status")
-async def toggle_user_status(
+def toggle_user_status(
     user_id: str,
     is_active: bool,
     current_user: User = Depends(require_role(UserRole.ADMIN))
@@ -4305,7 +8654,7 @@ async def toggle_user_status(
     return {"message": "User status updated successfully"}
 
 @app.delete("/api/admin/users/{user_id}")
-async def delete_user(
+def delete_user(
     user_id: str,
     current_user: User = Depends(require_role(UserRole.ADMIN))
 ):
@@ -4320,7 +8669,7 @@ async def delete_user(
     return {"message": "User deleted successfully"}
 
 @app.put("/api/admin/users/{user_id}/role")
-async def update_user_role(
+def update_user_role(
     user_id: str,
     role_data: UserRoleUpdate,
     current_user: User = Depends(require_role(UserRole.ADMIN))
@@ -4378,7 +8727,7 @@ class AdminUserUpdate(BaseModel):
     is_active: Optional[bool] = None
 
 @app.put("/api/admin/users/{user_id}/update")
-async def admin_update_user(
+def admin_update_user(
     user_id: str,
     user_update: AdminUserUpdate,
     current_user: User = Depends(require_role(UserRole.ADMIN))
@@ -4397,7 +8746,7 @@ async def admin_update_user(
         
     if user_update.phone is not None:
         # Проверяем, не занят ли номер телефона другим пользователем
-        existing_phone_user = db.users.find_one({"phone": user_update.phone, "id": {"$ne": user_id}})
+        existing_phone_user = find_user_by_phone(user_update.phone, {"id": {"$ne": user_id}})
         if existing_phone_user:
             raise HTTPException(status_code=400, detail="Этот номер телефона уже используется другим пользователем")
         update_data["phone"] = user_update.phone
@@ -4459,9 +8808,10 @@ async def admin_update_user(
     }
 
 @app.get("/api/admin/operators/profile/{operator_id}")
-async def get_operator_profile(
+def get_operator_profile(
     operator_id: str,
-    current_user: User = Depends(require_role(UserRole.ADMIN))
+    current_user: User = Depends(require_role(UserRole.ADMIN)),
+    loaders: RequestLoaders = Depends(get_request_loaders)
 ):
     """Получить детальный профиль оператора склада"""
     try:
@@ -4515,14 +8865,12 @@ async def get_operator_profile(
         ).sort("created_at", -1).limit(20))
         
         # Связанные склады
-        warehouse_bindings = list(db.operator_warehouse_bindings.find(
-            {"operator_id": operator_id},
-            {"_id": 0}
-        ))
+        warehouse_bindings = operator_bindings.bindings_for_operator(operator_id)
         
+        loaders.warehouses.prime(*[binding["warehouse_id"] for binding in warehouse_bindings])
         associated_warehouses = []
         for binding in warehouse_bindings:
-            warehouse = db.warehouses.find_one({"id": binding["warehouse_id"]})
+            warehouse = loaders.warehouses.get(binding["warehouse_id"])
             if warehouse:
                 cargo_count = db.operator_cargo.count_documents({
                     "created_by": operator_id,
@@ -4561,7 +8909,7 @@ async def get_operator_profile(
         raise HTTPException(status_code=500, detail=f"Error retrieving operator profile: {str(e)}")
 
 @app.get("/api/admin/users/profile/{user_id}")
-async def get_user_profile(
+def get_user_profile(
     user_id: str,
     current_user: User = Depends(require_role(UserRole.ADMIN))
 ):
@@ -4586,12 +8934,12 @@ async def get_user_profile(
         # Статистика отправлений
         total_cargo_requests = db.cargo_requests.count_documents({"created_by": user_id})
         total_sent_cargo = (
-            db.cargo.count_documents({"sender_phone": user["phone"]}) +
-            db.operator_cargo.count_documents({"sender_phone": user["phone"]})
+            db.cargo.count_documents(phone_exact_filter("sender_phone", user["phone"])) +
+            db.operator_cargo.count_documents(phone_exact_filter("sender_phone", user["phone"]))
         )
         total_received_cargo = (
-            db.cargo.count_documents({"recipient_phone": user["phone"]}) +
-            db.operator_cargo.count_documents({"recipient_phone": user["phone"]})
+            db.cargo.count_documents(phone_exact_filter("recipient_phone", user["phone"])) +
+            db.operator_cargo.count_documents(phone_exact_filter("recipient_phone", user["phone"]))
         )
         
         # Статистика по статусам
@@ -4710,7 +9058,7 @@ async def get_user_profile(
         raise HTTPException(status_code=500, detail=f"Error retrieving user profile: {str(e)}")
 
 @app.post("/api/admin/users/{user_id}/quick-cargo")
-async def create_quick_cargo_for_user(
+def create_quick_cargo_for_user(
     user_id: str,
     cargo_request: QuickCargoRequest,
     current_user: User = Depends(require_role(UserRole.WAREHOUSE_OPERATOR))
@@ -4727,11 +9075,11 @@ async def create_quick_cargo_for_user(
             raise HTTPException(status_code=403, detail="Only operators can create cargo")
         
         # Находим целевой склад для оператора
-        warehouse_binding = db.operator_warehouse_bindings.find_one({"operator_id": current_user.id})
-        if not warehouse_binding:
+        operator_warehouse_ids = operator_bindings.warehouse_ids_for_operator(current_user.id)
+        if not operator_warehouse_ids:
             raise HTTPException(status_code=400, detail="Operator not assigned to any warehouse")
         
-        target_warehouse_id = warehouse_binding["warehouse_id"]
+        target_warehouse_id = operator_warehouse_ids[0]
         warehouse = db.warehouses.find_one({"id": target_warehouse_id})
         
         # Вычисляем общий вес и стоимость
@@ -4814,12 +9162,12 @@ async def create_quick_cargo_for_user(
 
 # Уведомления
 @app.get("/api/notifications")
-async def get_notifications(current_user: User = Depends(get_current_user)):
+def get_notifications(current_user: User = Depends(get_current_user)):
     notifications = list(db.notifications.find({"user_id": current_user.id}).sort("created_at", -1))
     return [Notification(**notification) for notification in notifications]
 
 @app.put("/api/notifications/{notification_id}/read")
-async def mark_notification_read(
+def mark_notification_read(
     notification_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -4835,7 +9183,7 @@ async def mark_notification_read(
 
 # Управление складами
 @app.post("/api/warehouses/create")
-async def create_warehouse(
+def create_warehouse(
     warehouse_data: WarehouseCreate,
     current_user: User = Depends(get_current_user)
 ):
@@ -4903,7 +9251,10 @@ async def create_warehouse(
     )
 
 @app.get("/api/warehouses")
-async def get_warehouses(current_user: User = Depends(get_current_user)):
+def get_warehouses(
+    current_user: User = Depends(get_current_user),
+    loaders: RequestLoaders = Depends(get_request_loaders)
+):
     # Проверяем права доступа
     if current_user.role not in [UserRole.ADMIN, UserRole.WAREHOUSE_OPERATOR]:
         raise HTTPException(status_code=403, detail="Insufficient permissions")
@@ -4923,16 +9274,21 @@ async def get_warehouses(current_user: User = Depends(get_current_user)):
             "is_active": True
         }))
     
+    # Привязки всех складов и данные операторов одним запросом
+    warehouse_bindings = {warehouse["id"]: operator_bindings.bindings_for_warehouse(warehouse["id"]) for warehouse in warehouses}
+    for bindings in warehouse_bindings.values():
+        loaders.users.prime(*[binding["operator_id"] for binding in bindings])
+    
     # Добавляем информацию о привязанных операторах к каждому складу
     warehouses_with_operators = []
     for warehouse in warehouses:
         # Получаем операторов, привязанных к этому складу
-        bindings = list(db.operator_warehouse_bindings.find({"warehouse_id": warehouse["id"]}))
+        bindings = warehouse_bindings[warehouse["id"]]
         
         # Получаем информацию об операторах
         bound_operators = []
         for binding in bindings:
-            operator = db.users.find_one({"id": binding["operator_id"]}, {"password": 0, "_id": 0})
+            operator = loaders.users.get(binding["operator_id"])
             if operator:
                 bound_operators.append({
                     "id": operator["id"],
@@ -4953,7 +9309,7 @@ async def get_warehouses(current_user: User = Depends(get_current_user)):
     return serialize_mongo_document(warehouses_with_operators)
 
 @app.get("/api/warehouses/{warehouse_id}/structure")
-async def get_warehouse_structure(
+def get_warehouse_structure(
     warehouse_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -4997,7 +9353,7 @@ async def get_warehouse_structure(
     }
 
 @app.put("/api/warehouses/{warehouse_id}/assign-cargo")
-async def assign_cargo_to_cell(
+def assign_cargo_to_cell(
     warehouse_id: str,
     cargo_id: str,
     cell_location_code: str,
@@ -5049,7 +9405,7 @@ async def assign_cargo_to_cell(
     return {"message": "Cargo assigned to cell successfully", "location": cell_location_code}
 
 @app.delete("/api/warehouses/{warehouse_id}")
-async def delete_warehouse(
+def delete_warehouse(
     warehouse_id: str,
     current_user: User = Depends(require_role(UserRole.ADMIN))
 ):
@@ -5071,7 +9427,7 @@ async def delete_warehouse(
 
 # Управление грузами для операторов
 @app.post("/api/operator/cargo/accept")
-async def accept_new_cargo(
+def accept_new_cargo(
     cargo_data: OperatorCargoCreate,
     current_user: User = Depends(get_current_user)
 ):
@@ -5346,7 +9702,7 @@ async def accept_new_cargo(
     return response_data
 
 @app.post("/api/operator/cargo/create-for-courier")
-async def create_cargo_for_courier_pickup(
+def create_cargo_for_courier_pickup(
     cargo_data: OperatorCargoCreate,
     current_user: User = Depends(get_current_user)
 ):
@@ -5465,7 +9821,7 @@ async def create_cargo_for_courier_pickup(
         raise HTTPException(status_code=500, detail=f"Error creating cargo for courier: {str(e)}")
 
 @app.post("/api/operator/cargo/place")
-async def place_cargo_in_warehouse(
+def place_cargo_in_warehouse(
     placement_data: CargoPlacement,
     current_user: User = Depends(get_current_user)
 ):
@@ -5544,7 +9900,7 @@ async def place_cargo_in_warehouse(
     }
 
 @app.post("/api/operator/cargo/place-auto")
-async def place_cargo_in_warehouse_auto(
+def place_cargo_in_warehouse_auto(
     placement_data: CargoPlacementAuto,
     current_user: User = Depends(get_current_user)
 ):
@@ -5555,7 +9911,7 @@ async def place_cargo_in_warehouse_auto(
     
     # Если оператор склада, получаем его привязанные склады
     if current_user.role == UserRole.WAREHOUSE_OPERATOR:
-        operator_warehouses = get_operator_warehouses(current_user.id)
+        operator_warehouses = get_operator_warehouse_ids(current_user.id)
         if not operator_warehouses:
             raise HTTPException(status_code=403, detail="No warehouses assigned to this operator")
         
@@ -5633,7 +9989,7 @@ async def place_cargo_in_warehouse_auto(
     return {"message": "Cargo placed successfully in assigned warehouse", "warehouse_name": warehouse["name"]}
 
 @app.get("/api/warehouses/{warehouse_id}/statistics")
-async def get_warehouse_statistics(
+def get_warehouse_statistics(
     warehouse_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -5647,56 +10003,18 @@ async def get_warehouse_statistics(
         if not warehouse:
             raise HTTPException(status_code=404, detail="Warehouse not found")
         
-        # Подсчитываем грузы на складе (из разных коллекций)
-        cargo_count_operator = db.operator_cargo.count_documents({
-            "warehouse_id": warehouse_id,
-            "status": {"$in": ["IN_TRANSIT", "READY_FOR_DELIVERY"]}
-        })
-        
-        cargo_count_general = db.cargo.count_documents({
-            "warehouse_id": warehouse_id,
-            "status": {"$in": ["awaiting_placement", "in_transit", "ready_for_delivery"]}
-        })
-        
+        # Грузы, вес и занятые ячейки склада из счетчиков
+        stats = dashboard_stats.get(f"warehouse:{warehouse_id}")
+        cargo_count_operator = stats.get("stock_by_collection", {}).get("operator_cargo", 0)
+        cargo_count_general = stats.get("stock_by_collection", {}).get("cargo", 0)
         total_cargo_count = cargo_count_operator + cargo_count_general
+        total_weight = stats.get("stock_weight", 0)
         
-        # Подсчитываем общий вес грузов
-        operator_cargo_weights = list(db.operator_cargo.aggregate([
-            {"$match": {
-                "warehouse_id": warehouse_id,
-                "status": {"$in": ["IN_TRANSIT", "READY_FOR_DELIVERY"]}
-            }},
-            {"$group": {"_id": None, "total_weight": {"$sum": "$weight"}}}
-        ]))
-        
-        general_cargo_weights = list(db.cargo.aggregate([
-            {"$match": {
-                "warehouse_id": warehouse_id,
-                "status": {"$in": ["awaiting_placement", "in_transit", "ready_for_delivery"]}
-            }},
-            {"$group": {"_id": None, "total_weight": {"$sum": "$weight"}}}
-        ]))
-        
-        total_weight = (
-            (operator_cargo_weights[0]["total_weight"] if operator_cargo_weights else 0) +
-            (general_cargo_weights[0]["total_weight"] if general_cargo_weights else 0)
-        )
-        
-        # Подсчитываем общее количество ячеек
-        total_cells = (
-            warehouse.get("blocks_count", 0) * 
-            warehouse.get("shelves_per_block", 0) * 
-            warehouse.get("cells_per_shelf", 0)
-        )
-        
-        # Подсчитываем занятые ячейки
-        occupied_cells = db.warehouse_cells.count_documents({
-            "warehouse_id": warehouse_id,
-            "is_occupied": True
-        })
-        
-        # Подсчитываем статистику
-        free_cells = max(0, total_cells - occupied_cells)
+        # Ячейки - из карты занятости склада
+        occupancy = cell_occupancy.summary(warehouse_id)
+        total_cells = occupancy["total_cells"]
+        occupied_cells = occupancy["occupied_cells"]
+        free_cells = occupancy["free_cells"]
         utilization_percent = (occupied_cells / total_cells * 100) if total_cells > 0 else 0
         
         return {
@@ -5706,6 +10024,7 @@ async def get_warehouse_statistics(
             "occupied_cells": occupied_cells,
             "free_cells": free_cells,
             "utilization_percent": round(utilization_percent, 1),
+            "occupancy_by_block": occupancy["blocks"],
             "total_cargo_count": total_cargo_count,
             "total_weight": round(total_weight, 2),
             "cargo_breakdown": {
@@ -5718,10 +10037,12 @@ async def get_warehouse_statistics(
         raise HTTPException(status_code=500, detail=f"Error getting warehouse statistics: {str(e)}")
 
 @app.get("/api/operator/cargo/available-for-placement")
-async def get_available_cargo_for_placement(
+def get_available_cargo_for_placement(
     page: int = 1,
     per_page: int = 25,
-    current_user: User = Depends(get_current_user)
+    cursor: Optional[str] = None,  # next_cursor предыдущей страницы
+    current_user: User = Depends(get_current_user),
+    loaders: RequestLoaders = Depends(get_request_loaders)
 ):
     """Получить грузы, доступные для размещения на складе с пагинацией"""
     if current_user.role not in [UserRole.ADMIN, UserRole.WAREHOUSE_OPERATOR]:
@@ -5737,13 +10058,9 @@ async def get_available_cargo_for_placement(
         # Определяем доступные склады для оператора
         if current_user.role == UserRole.WAREHOUSE_OPERATOR:
             # Получаем склады оператора
-            operator_warehouse_bindings = list(db.operator_warehouse_bindings.find(
-                {"operator_id": current_user.id}
-            ))
+            operator_warehouse_ids = operator_bindings.warehouse_ids_for_operator(current_user.id)
             
-            if operator_warehouse_bindings:
-                operator_warehouse_ids = [binding["warehouse_id"] for binding in operator_warehouse_bindings]
-            else:
+            if not operator_warehouse_ids:
                 # Если нет привязок, оператор может видеть все склады (для упрощения)
                 warehouses = list(db.warehouses.find({"is_active": True}))
                 operator_warehouse_ids = [w["id"] for w in warehouses]
@@ -5773,26 +10090,23 @@ async def get_available_cargo_for_placement(
             ]
         }
 
-        # Подсчитываем общее количество в обеих коллекциях
-        total_count_cargo = db.cargo.count_documents(placement_query)
-        total_count_operator_cargo = db.operator_cargo.count_documents(placement_query)
-        total_count = total_count_cargo + total_count_operator_cargo
+        # Получаем страницу грузов из обеих коллекций одним запросом (слияние по created_at)
+        page_data = paginate_cargo(placement_query, pagination.page, pagination.per_page, cursor)
+        cargo_list = page_data["items"]
+        total_count = page_data["total_count"]
         
-        # Получаем грузы из обеих коллекций
-        skip = (pagination.page - 1) * pagination.per_page
-        
-        # Получаем из основной коллекции cargo
-        cargo_list_main = list(db.cargo.find(placement_query).skip(skip).limit(pagination.per_page).sort("created_at", -1))
-        
-        # Получаем из коллекции operator_cargo (если еще нужны грузы для заполнения страницы)
-        remaining_limit = pagination.per_page - len(cargo_list_main)
-        cargo_list_operator = []
-        if remaining_limit > 0:
-            operator_skip = max(0, skip - total_count_cargo)
-            cargo_list_operator = list(db.operator_cargo.find(placement_query).skip(operator_skip).limit(remaining_limit).sort("created_at", -1))
-        
-        # Объединяем списки
-        cargo_list = cargo_list_main + cargo_list_operator
+        # Пользователи и склады всей страницы загружаются двумя запросами с $in
+        for cargo in cargo_list:
+            loaders.users.prime(
+                cargo.get('created_by') or cargo.get('sender_id'),
+                cargo.get('created_by_operator_id') or cargo.get('accepting_operator_id'),
+                cargo.get('created_by')
+            )
+            loaders.warehouses.prime(
+                cargo.get('warehouse_id'),
+                cargo.get('source_warehouse_id') or cargo.get('created_warehouse_id'),
+                cargo.get('target_warehouse_id')
+            )
         
         # Обрабатываем данные и добавляем информацию об операторах и складах
         normalized_cargo = []
@@ -5805,7 +10119,7 @@ async def get_available_cargo_for_placement(
             accepting_operator_id = cargo.get('created_by_operator_id') or cargo.get('accepting_operator_id')
             
             if creator_id:
-                creator = db.users.find_one({"id": creator_id})
+                creator = loaders.users.get(creator_id)
                 if creator:
                     cargo_data['creator_name'] = creator.get('full_name', 'Неизвестно')
                     cargo_data['creator_phone'] = creator.get('phone', 'Не указан')
@@ -5816,7 +10130,7 @@ async def get_available_cargo_for_placement(
             # Информация о принимающем операторе - расширенные данные
             accepting_operator_info = None
             if accepting_operator_id:
-                accepting_operator = db.users.find_one({"id": accepting_operator_id})
+                accepting_operator = loaders.users.get(accepting_operator_id)
                 if accepting_operator:
                     accepting_operator_info = {
                         'operator_id': accepting_operator['id'],
@@ -5841,7 +10155,7 @@ async def get_available_cargo_for_placement(
                 # Пытаемся найти по created_by в операторе
                 creator_id = cargo.get('created_by')
                 if creator_id:
-                    accepting_operator = db.users.find_one({"id": creator_id})
+                    accepting_operator = loaders.users.get(creator_id)
                     if accepting_operator and accepting_operator.get('role') in ['warehouse_operator', 'admin']:
                         accepting_operator_info = {
                             'operator_id': accepting_operator['id'],
@@ -5894,7 +10208,7 @@ async def get_available_cargo_for_placement(
             # Получаем информацию о складе назначения
             warehouse_id = cargo.get('warehouse_id')
             if warehouse_id:
-                warehouse = db.warehouses.find_one({"id": warehouse_id})
+                warehouse = loaders.warehouses.get(warehouse_id)
                 if warehouse:
                     cargo_data['warehouse_name'] = warehouse.get('name', 'Неизвестный склад')
                     cargo_data['warehouse_location'] = warehouse.get('location', 'Не указано')
@@ -5917,14 +10231,14 @@ async def get_available_cargo_for_placement(
             # 2. Склад-отправитель и склад-получатель
             source_warehouse_id = cargo.get('source_warehouse_id') or cargo.get('created_warehouse_id')
             if source_warehouse_id:
-                source_warehouse = db.warehouses.find_one({"id": source_warehouse_id})
+                source_warehouse = loaders.warehouses.get(source_warehouse_id)
                 cargo_data['source_warehouse_name'] = source_warehouse.get('name', 'Неизвестен') if source_warehouse else 'Неизвестен'
             else:
                 cargo_data['source_warehouse_name'] = cargo.get('source_warehouse_name', 'Неизвестен')
             
             target_warehouse_id = cargo.get('target_warehouse_id') or warehouse_id
             if target_warehouse_id:
-                target_warehouse = db.warehouses.find_one({"id": target_warehouse_id})  
+                target_warehouse = loaders.warehouses.get(target_warehouse_id)  
                 cargo_data['target_warehouse_name'] = target_warehouse.get('name', 'Неизвестен') if target_warehouse else 'Неизвестен'
             else:
                 cargo_data['target_warehouse_name'] = cargo_data.get('warehouse_name', 'Неизвестен')
@@ -6041,8 +10355,12 @@ async def get_available_cargo_for_placement(
             normalized_cargo.append(cargo_data)
         
         # Создаем ответ с пагинацией
-        return create_pagination_response(normalized_cargo, total_count, pagination.page, pagination.per_page)
+        response = create_pagination_response(normalized_cargo, total_count, pagination.page, pagination.per_page)
+        response["pagination"]["next_cursor"] = page_data["next_cursor"]
+        return response
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -6058,7 +10376,7 @@ class IndividualCargoPlacement(BaseModel):
     cell_number: int
 
 @app.post("/api/operator/cargo/place-individual")
-async def place_individual_cargo_unit(
+def place_individual_cargo_unit(
     placement_data: IndividualCargoPlacement,
     current_user: User = Depends(get_current_user)
 ):
@@ -6168,7 +10486,7 @@ async def place_individual_cargo_unit(
         )
 
 @app.get("/api/operator/cargo/individual-units-for-placement")
-async def get_individual_units_for_placement(
+def get_individual_units_for_placement(
     page: int = 1,
     per_page: int = 25,
     cargo_type_filter: str = None,
@@ -6189,163 +10507,26 @@ async def get_individual_units_for_placement(
                 detail="Недостаточно прав для просмотра грузов"
             )
 
-        # Получаем склады пользователя (для совместимости, но не используем для фильтрации)
-        user_warehouses = []
-        if current_user.role == "warehouse_operator":
-            user_warehouses = get_operator_warehouse_ids(current_user.id)
-
-        # Формируем условия поиска для заявок (аналогично regular available-for-placement)
-        match_conditions = {
-            "status": {"$nin": ["placed_in_warehouse", "removed_from_placement"]},
-            "$and": [
-                {"$or": [
-                    {"warehouse_location": {"$exists": False}},
-                    {"warehouse_location": None},
-                    {"warehouse_location": ""}
-                ]},
-                {"$or": [
-                    {"block_number": {"$exists": False}},
-                    {"block_number": None},
-                    {"shelf_number": {"$exists": False}}, 
-                    {"shelf_number": None},
-                    {"cell_number": {"$exists": False}},
-                    {"cell_number": None}
-                ]}
-            ]
-        }
-        
-        # НЕ фильтруем по warehouse_id, как в оригинальном endpoint
-
-        # Получаем все заявки ожидающие размещения (без aggregation pipeline)
-        cargo_list = list(db.cargo.find(match_conditions)) + list(db.operator_cargo.find(match_conditions))
-        
-        print(f"📦 Найдено {len(cargo_list)} заявок ожидающих размещения")
-        
-        # DEBUG: Проверяем первую заявку
-        if cargo_list:
-            first_cargo = cargo_list[0]
-            print(f"🔍 DEBUG: Первая заявка {first_cargo.get('cargo_number')} имеет cargo_items: {'cargo_items' in first_cargo}")
-            if 'cargo_items' in first_cargo:
-                cargo_items = first_cargo.get('cargo_items', [])
-                print(f"🔍 DEBUG: Количество cargo_items: {len(cargo_items)}")
-                if cargo_items:
-                    first_item = cargo_items[0]
-                    print(f"🔍 DEBUG: Первый cargo_item имеет individual_items: {'individual_items' in first_item}")
-                    if 'individual_items' in first_item:
-                        individual_items = first_item.get('individual_items', [])
-                        print(f"🔍 DEBUG: Количество individual_items: {len(individual_items)}")
-        
-        # Преобразуем заявки в individual units
-        individual_units = []
-        
-        for cargo in cargo_list:
-            cargo_items = cargo.get("cargo_items", [])
-            warehouse_info = cargo.get("warehouse_info", [{}])[0] if cargo.get("warehouse_info") else {}
-            
-            # ИСПРАВЛЕНИЕ: Пропускаем заявки без cargo_items или с пустыми cargo_items
-            if not cargo_items:
-                print(f"⚠️ Пропускаем заявку {cargo.get('cargo_number')} - нет cargo_items")
-                continue
-                
-            has_individual_units = False
-            
-            # Проверяем наличие individual_items или возможность их создания из quantity
-            for cargo_item in cargo_items:
-                # Если есть готовые individual_items, используем их
-                if cargo_item.get("individual_items"):
-                    has_individual_units = True
-                    break
-                # Если есть quantity > 0, можем создать individual_items динамически
-                elif cargo_item.get("quantity", 1) > 0:
-                    has_individual_units = True
-                    break
-            
-            if not has_individual_units:
-                print(f"⚠️ Пропускаем заявку {cargo.get('cargo_number')} - нет individual_items и quantity")
-                continue
-            
-            # Получаем информацию о принявшем операторе
-            accepting_operator_info = {
-                'operator_name': cargo.get('accepting_operator', 'Неизвестно'),
-                'operator_phone': cargo.get('accepting_operator_phone', 'Не указан')
-            }
-
-            for i, cargo_item in enumerate(cargo_items):
-                type_number = f"{i+1:02d}"  # 01, 02, 03...
-                
-                # Применяем фильтр по типу груза
-                if cargo_type_filter and type_number != cargo_type_filter:
-                    continue
-                
-                # ИСПРАВЛЕНИЕ: Получаем individual_items или создаем их динамически
-                individual_items = cargo_item.get("individual_items", [])
-                
-                # Если нет готовых individual_items, создаем их динамически из quantity
-                if not individual_items:
-                    quantity = cargo_item.get("quantity", 1)
-                    print(f"🔧 Создаем {quantity} individual units для типа {type_number}")
-                    
-                    for unit_index in range(1, quantity + 1):
-                        unit_index_str = f"{unit_index:02d}"  # 01, 02, 03...
-                        individual_number = f"{cargo.get('cargo_number')}/{type_number}/{unit_index_str}"
-                        
-                        dynamic_unit = {
-                            "individual_number": individual_number,
-                            "unit_index": unit_index_str,
-                            "placement_status": "awaiting_placement",
-                            "is_placed": False,
-                            "placement_info": None
-                        }
-                        individual_items.append(dynamic_unit)
-                
-                # Обрабатываем все individual_items (готовые или созданные динамически)
-                for unit in individual_items:
-                    placement_status = unit.get("placement_status", "awaiting_placement")
-                    
-                    # Применяем фильтр по статусу
-                    if status_filter:
-                        if status_filter == "placed" and placement_status != "placed":
-                            continue
-                        elif status_filter == "awaiting" and placement_status != "awaiting_placement":
-                            continue
-                    
-                    # Создаем individual unit карточку
-                    individual_unit = {
-                        "individual_number": unit.get("individual_number", f"{cargo.get('cargo_number')}/{type_number}/{unit.get('unit_index', '01')}"),
-                        "cargo_request_number": cargo.get("cargo_number"),
-                        "cargo_id": cargo.get("id"),
-                        "cargo_name": cargo_item.get("cargo_name", "Неизвестный груз"),
-                        "type_number": type_number,
-                        "unit_index": unit.get("unit_index", "01"),
-                        "placement_status": placement_status,
-                        "weight": cargo_item.get("weight", 0),
-                        "is_placed": unit.get("is_placed", False),
-                        "placement_info": unit.get("placement_info"),
-                        
-                        # Информация о заявке
-                        "sender_full_name": cargo.get("sender_full_name", "Неизвестно"),
-                        "recipient_full_name": cargo.get("recipient_full_name", "Неизвестно"),
-                        "recipient_address": cargo.get("recipient_address", "Неизвестно"),
-                        "delivery_method": cargo.get("delivery_method", "pickup"),
-                        "payment_method": cargo.get("payment_method", "cash"),
-                        "created_at": cargo.get("created_at"),
-                        
-                        # Информация о складе и операторе
-                        "warehouse_name": warehouse_info.get("name", "Неизвестен"),
-                        "warehouse_id": cargo.get("warehouse_id"),
-                        "accepting_operator": accepting_operator_info
-                    }
-                    
-                    individual_units.append(individual_unit)
-
-        # Сортировка по номеру заявки (как запросил пользователь)
-        individual_units.sort(key=lambda x: x["cargo_request_number"] or "")
+        # Фильтрация, сортировка и пагинация единиц выполняются в MongoDB одним aggregate:
+        # $facet возвращает общее количество и одну страницу, в память попадает только она.
+        # Пока cargo_units не заполнена, единицы разворачиваются прямо из заявок
+        # (без фильтра по warehouse_id, как в оригинальном endpoint)
+        unit_filters = cargo_unit_filters(cargo_type_filter, status_filter)
+        page_facet = {"$facet": {
+            "total": [{"$count": "count"}],
+            "units": [{"$skip": max(0, (page - 1) * per_page)}, {"$limit": max(1, per_page)}]
+        }}
+        if cargo_units.is_built():
+            units_collection = db.cargo_units
+            pipeline = [{"$match": {"awaiting_placement": True, **unit_filters}}]
+        else:
+            units_collection = db[CARGO_COLLECTIONS[0]]
+            pipeline = source_units_pipeline(unit_filters)
+        pipeline.extend([{"$sort": CARGO_UNIT_ORDER}, page_facet])
         
-        # Применяем пагинацию
-        total_units = len(individual_units)
-        start_idx = (page - 1) * per_page
-        end_idx = start_idx + per_page
-        paginated_units = individual_units[start_idx:end_idx]
+        result = next(units_collection.aggregate(pipeline, allowDiskUse=True), {})
+        total_units = result["total"][0]["count"] if result.get("total") else 0
+        paginated_units = [cargo_unit_card(unit) for unit in result.get("units", [])]
         
         # Группируем по заявкам для frontend
         grouped_units = {}
@@ -6388,7 +10569,7 @@ async def get_individual_units_for_placement(
         )
 
 @app.get("/api/operator/cargo/{cargo_id}/placement-status")
-async def get_cargo_placement_status(
+def get_cargo_placement_status(
     cargo_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -6400,14 +10581,9 @@ async def get_cargo_placement_status(
         raise HTTPException(status_code=403, detail="Insufficient permissions")
     
     try:
-        # Ищем заявку в коллекциях 
-        cargo = db.operator_cargo.find_one({"id": cargo_id})
-        collection_name = "operator_cargo"
+        # Ищем заявку в коллекциях (operator_cargo в приоритете)
+        cargo, collection_name = locate_cargo({"id": cargo_id}, {"_id": 0}, collections=("operator_cargo", "cargo"))
         
-        if not cargo:
-            cargo = db.cargo.find_one({"id": cargo_id})
-            collection_name = "cargo"
-            
         if not cargo:
             raise HTTPException(status_code=404, detail="Cargo not found")
         
@@ -6424,6 +10600,22 @@ async def get_cargo_placement_status(
                 'total_amount': cargo.get('declared_value', 0)
             }]
         
+        # Размещения всех единиц заявки читаются двумя запросами: записи placement_records
+        # по списку номеров и единицы заявки из cargo_units
+        unit_numbers = [
+            f"{cargo_number}/{str(type_index).zfill(2)}/{str(unit_index).zfill(2)}"
+            for type_index, item in enumerate(cargo_items, 1)
+            for unit_index in range(1, item.get('quantity', 1) + 1)
+        ]
+        placement_records = {
+            record['individual_number']: record
+            for record in db.placement_records.find({"individual_number": {"$in": unit_numbers}}, {"_id": 0})
+        } if unit_numbers else {}
+        placed_units = {
+            unit['individual_number']: unit
+            for unit in find_cargo_units(collection_name, cargo_id=cargo_id, is_placed=True)
+        }
+        
         # НОВОЕ: Обрабатываем каждый тип груза с индивидуальными номерами
         detailed_items = []
         for type_index, item in enumerate(cargo_items, 1):
@@ -6443,20 +10635,32 @@ async def get_cargo_placement_status(
                 placement_info = None
                 is_placed = False
                 
-                # Проверяем размещение в коллекции placement_records (если существует)
-                if hasattr(db, 'placement_records'):
-                    placement_record = db.placement_records.find_one({"individual_number": individual_number})
-                    if placement_record:
-                        is_placed = True
-                        placement_info = {
-                            'warehouse_location': placement_record.get('warehouse_location'),
-                            'block_number': placement_record.get('block_number'),
-                            'shelf_number': placement_record.get('shelf_number'),
-                            'cell_number': placement_record.get('cell_number'),
-                            'placed_at': placement_record.get('placed_at'),
-                            'placed_by': placement_record.get('placed_by_operator')
-                        }
-                        placed_count += 1
+                # Проверяем размещение в коллекции placement_records
+                placement_record = placement_records.get(individual_number)
+                placed_unit = placed_units.get(individual_number)
+                if placement_record:
+                    is_placed = True
+                    placement_info = {
+                        'warehouse_location': placement_record.get('warehouse_location'),
+                        'block_number': placement_record.get('block_number'),
+                        'shelf_number': placement_record.get('shelf_number'),
+                        'cell_number': placement_record.get('cell_number'),
+                        'placed_at': placement_record.get('placed_at'),
+                        'placed_by': placement_record.get('placed_by_operator')
+                    }
+                    placed_count += 1
+                elif placed_unit:
+                    # Единица размещена через сканирование (отметка во вложенном individual_items)
+                    is_placed = True
+                    placement_info = {
+                        'warehouse_location': placed_unit.get('placement_info'),
+                        'block_number': None,
+                        'shelf_number': None,
+                        'cell_number': None,
+                        'placed_at': placed_unit.get('placement_timestamp'),
+                        'placed_by': placed_unit.get('placed_by')
+                    }
+                    placed_count += 1
                 
                 # Если нет placement_records, проверяем основные поля груза (для совместимости)
                 if not is_placed and cargo.get('warehouse_location') and unit_index == 1:
@@ -6540,7 +10744,7 @@ async def get_cargo_placement_status(
         )
 
 @app.post("/api/operator/cargo/{cargo_id}/update-placement-status")
-async def update_cargo_placement_status(
+def update_cargo_placement_status(
     cargo_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -6553,7 +10757,7 @@ async def update_cargo_placement_status(
     
     try:
         # Получаем статус размещения
-        placement_status_response = await get_cargo_placement_status(cargo_id, current_user)
+        placement_status_response = get_cargo_placement_status(cargo_id, current_user)
         
         # Если все грузы размещены, обновляем статус и перемещаем
         if placement_status_response['overall_status'] == 'fully_placed':
@@ -6606,7 +10810,7 @@ async def update_cargo_placement_status(
 
 # НОВОЕ: Endpoint для массового удаления грузов из списка размещения
 @app.delete("/api/operator/cargo/bulk-remove-from-placement")
-async def bulk_remove_cargo_from_placement(
+def bulk_remove_cargo_from_placement(
     request: BulkRemoveFromPlacementRequest,
     current_user: User = Depends(get_current_user)
 ):
@@ -6615,89 +10819,31 @@ async def bulk_remove_cargo_from_placement(
         raise HTTPException(status_code=403, detail="Insufficient permissions")
     
     try:
-        cargo_ids = request.cargo_ids
+        cargo_ids = list(dict.fromkeys(request.cargo_ids))
+        
+        # Все грузы одним запросом на коллекцию, статус - одним bulk_write на коллекцию
+        resolved = resolve_cargo_ids(cargo_ids, {"_id": 0, "id": 1, "cargo_number": 1}, include_requests=True)
+        errors = bulk_update_cargo(resolved, {
+            "status": "removed_from_placement",
+            "removed_from_placement_at": datetime.utcnow(),
+            "removed_from_placement_by": current_user.id
+        })
         
         deleted_count = 0
         deleted_cargo_numbers = []
-        
+        results = []
         for cargo_id in cargo_ids:
-            # ИСПРАВЛЕНО: Ищем груз с дополнительной диагностикой дублирующихся ID
-            cargo = None
-            collection_name = None
-            
-            # Сначала ищем в operator_cargo  
-            cargo = db.operator_cargo.find_one({"id": cargo_id})
-            if cargo:
-                collection_name = "operator_cargo"
-            
-            # Если не найден, ищем в основной коллекции cargo
-            if not cargo:
-                cargo = db.cargo.find_one({"id": cargo_id})
-                if cargo:
-                    collection_name = "cargo"
-            
-            # НОВОЕ: Если не найден, ищем в заявках на забор (cargo_requests)
-            if not cargo:
-                # Ищем груз по cargo_id в items массиве заявок на забор
-                request_with_cargo = db.cargo_requests.find_one({
-                    "items.id": cargo_id
-                })
-                if request_with_cargo:
-                    # Находим конкретный item в массиве
-                    for item in request_with_cargo.get("items", []):
-                        if item.get("id") == cargo_id:
-                            cargo = item
-                            collection_name = "cargo_requests"
-                            cargo["request_id"] = request_with_cargo["id"]  # Сохраняем ID заявки
-                            break
-            
-            # КРИТИЧЕСКОЕ ИСПРАВЛЕНИЕ: Дополнительная проверка при дублировании ID
-            if cargo and collection_name in ["operator_cargo", "cargo"]:
-                collection = getattr(db, collection_name)
-                duplicate_check = list(collection.find({"id": cargo_id}))
-                
-                if len(duplicate_check) > 1:
-                    print(f"⚠️ МАССОВОЕ УДАЛЕНИЕ: Найдено {len(duplicate_check)} грузов с ID {cargo_id}")
-                    for i, dup_cargo in enumerate(duplicate_check):
-                        print(f"   {i+1}. Номер: {dup_cargo.get('cargo_number')}, Отправитель: {dup_cargo.get('sender_full_name')}")
-                    
-                    # В случае дублирования ID используем первый найденный груз
-                    cargo = duplicate_check[0]
-                    print(f"   Используем груз: {cargo.get('cargo_number')}")
-            
-            if cargo:
-                if collection_name == "cargo_requests":
-                    # Для грузов из заявок на забор обновляем статус item'а в массиве
-                    update_result = db.cargo_requests.update_one(
-                        {"id": cargo["request_id"], "items.id": cargo_id},
-                        {
-                            "$set": {
-                                "items.$.status": "removed_from_placement",
-                                "items.$.removed_from_placement_at": datetime.utcnow(),
-                                "items.$.removed_from_placement_by": current_user.id,
-                                "updated_at": datetime.utcnow()
-                            }
-                        }
-                    )
-                else:
-                    # Для обычных коллекций обновляем документ целиком
-                    collection = getattr(db, collection_name)
-                    update_result = collection.update_one(
-                        {"id": cargo_id},
-                        {
-                            "$set": {
-                                "status": "removed_from_placement",
-                                "removed_from_placement_at": datetime.utcnow(),
-                                "removed_from_placement_by": current_user.id,
-                                "updated_at": datetime.utcnow()
-                            }
-                        }
-                    )
-                
-                if update_result.modified_count > 0:
-                    deleted_count += 1
-                    cargo_number = cargo.get('cargo_number', cargo.get('id', 'Unknown'))
-                    deleted_cargo_numbers.append(cargo_number)
+            entry = resolved.get(cargo_id)
+            if not entry:
+                results.append(bulk_outcome(cargo_id, False, "Груз не найден"))
+                continue
+            cargo_number = entry["cargo"].get("cargo_number", cargo_id)
+            if cargo_id in errors:
+                results.append(bulk_outcome(cargo_id, False, errors[cargo_id], cargo_number=cargo_number, collection=entry["collection"]))
+                continue
+            deleted_count += 1
+            deleted_cargo_numbers.append(cargo_number)
+            results.append(bulk_outcome(cargo_id, True, cargo_number=cargo_number, collection=entry["collection"]))
         
         # Создаем уведомление о массовом удалении
         if deleted_count > 0:
@@ -6712,6 +10858,7 @@ async def bulk_remove_cargo_from_placement(
             "deleted_count": deleted_count,
             "total_requested": len(cargo_ids),
             "deleted_cargo_numbers": deleted_cargo_numbers,
+            "results": results,
             "message": f"Успешно удалено {deleted_count} из {len(cargo_ids)} грузов из списка размещения"
         }
         
@@ -6724,7 +10871,7 @@ async def bulk_remove_cargo_from_placement(
 
 # НОВОЕ: Endpoint для удаления груза из списка размещения
 @app.delete("/api/operator/cargo/{cargo_id}/remove-from-placement")
-async def remove_cargo_from_placement(
+def remove_cargo_from_placement(
     cargo_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -6833,7 +10980,7 @@ async def remove_cargo_from_placement(
         )
 
 @app.post("/api/cargo/{cargo_id}/quick-placement")
-async def quick_cargo_placement(
+def quick_cargo_placement(
     cargo_id: str,
     placement_data: dict,
     current_user: User = Depends(get_current_user)
@@ -6864,7 +11011,7 @@ async def quick_cargo_placement(
     # Автоматически определяем склад на основе привязки оператора
     warehouse_id = None
     if current_user.role == UserRole.WAREHOUSE_OPERATOR:
-        operator_warehouses = get_operator_warehouses(current_user.id)
+        operator_warehouses = get_operator_warehouse_ids(current_user.id)
         if operator_warehouses:
             warehouse_id = operator_warehouses[0]  # Используем первый привязанный склад
         else:
@@ -6957,7 +11104,7 @@ async def quick_cargo_placement(
     }
 
 @app.get("/api/warehouses/{warehouse_id}/layout-with-cargo")
-async def get_warehouse_layout_with_cargo(
+def get_warehouse_layout_with_cargo(
     warehouse_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -6967,7 +11114,7 @@ async def get_warehouse_layout_with_cargo(
     
     # Проверяем доступ к складу
     if current_user.role == UserRole.WAREHOUSE_OPERATOR:
-        operator_warehouses = get_operator_warehouses(current_user.id)
+        operator_warehouses = get_operator_warehouse_ids(current_user.id)
         if warehouse_id not in operator_warehouses:
             raise HTTPException(status_code=403, detail="Access denied to this warehouse")
     
@@ -6976,80 +11123,41 @@ async def get_warehouse_layout_with_cargo(
     if not warehouse:
         raise HTTPException(status_code=404, detail="Warehouse not found")
     
-    # Получаем все ячейки склада с грузами
-    warehouse_cells = list(db.warehouse_cells.find({"warehouse_id": warehouse_id}))
-    
-    # Получаем все грузы, размещенные на этом складе
-    cargo_in_warehouse = list(db.operator_cargo.find({
-        "warehouse_id": warehouse_id,
-        "warehouse_location": {"$ne": None}
-    }))
-    
-    # Также ищем в коллекции cargo
-    user_cargo_in_warehouse = list(db.cargo.find({
-        "warehouse_id": warehouse_id,
-        "warehouse_location": {"$ne": None}
-    }))
-    
-    cargo_in_warehouse.extend(user_cargo_in_warehouse)
+    # Занятые ячейки - из карты занятости, сведения о грузах - одним запросом по id
+    occupied_positions = cell_occupancy.occupied_cells(warehouse_id)
+    cargo_by_id = find_cargo_many(
+        "id",
+        [cargo_id for *_, cargo_id in occupied_positions if cargo_id],
+        {"_id": 0, "id": 1, "cargo_number": 1, "cargo_name": 1, "weight": 1, "declared_value": 1,
+         "sender_full_name": 1, "sender_phone": 1, "recipient_full_name": 1, "recipient_phone": 1,
+         "recipient_address": 1, "description": 1, "warehouse_location": 1, "created_at": 1, "processing_status": 1}
+    )
     
     # Создаем карту грузов по ячейкам
     cargo_by_location = {}
-    for cargo in cargo_in_warehouse:
-        location = cargo.get('warehouse_location')
-        if location and location != "Склад для грузов":  # Игнорируем общие локации
-            # Парсинг различных форматов местоположения
-            block_num = shelf_num = cell_num = None
-            
-            try:
-                # Формат "Б1-П2-Я15" (кириллица)
-                if location.startswith('Б'):
-                    parts = location.split('-')
-                    if len(parts) >= 3:
-                        block_num = int(parts[0][1:])  # Убираем "Б" и берем число
-                        shelf_num = int(parts[1][1:])  # Убираем "П" и берем число
-                        cell_num = int(parts[2][1:])   # Убираем "Я" и берем число
-                
-                # Формат "B1-S1-C1" (латиница)
-                elif location.startswith('B'):
-                    parts = location.split('-')
-                    if len(parts) >= 3:
-                        block_num = int(parts[0][1:])  # Убираем "B" и берем число
-                        shelf_num = int(parts[1][1:])  # Убираем "S" и берем число
-                        cell_num = int(parts[2][1:])   # Убираем "C" и берем число
-                
-                # Числовой формат "1-2-15"
-                elif '-' in location:
-                    parts = location.split('-')
-                    if len(parts) >= 3:
-                        block_num = int(parts[0])
-                        shelf_num = int(parts[1])
-                        cell_num = int(parts[2])
-                
-                if block_num and shelf_num and cell_num:
-                    location_key = f"{block_num}-{shelf_num}-{cell_num}"
-                    cargo_by_location[location_key] = {
-                        "id": cargo["id"],
-                        "cargo_number": cargo["cargo_number"],
-                        "cargo_name": cargo.get("cargo_name", "Груз"),
-                        "weight": cargo["weight"],
-                        "declared_value": cargo["declared_value"],
-                        "sender_full_name": cargo["sender_full_name"],
-                        "sender_phone": cargo["sender_phone"],
-                        "recipient_full_name": cargo["recipient_full_name"],
-                        "recipient_phone": cargo["recipient_phone"],
-                        "recipient_address": cargo["recipient_address"],
-                        "description": cargo.get("description", ""),
-                        "warehouse_location": location,
-                        "created_at": cargo["created_at"],
-                        "processing_status": cargo.get("processing_status", "placed"),
-                        "block_number": block_num,
-                        "shelf_number": shelf_num,
-                        "cell_number": cell_num
-                    }
-            except (ValueError, IndexError):
-                print(f"Warning: Could not parse warehouse location: {location}")
-                continue
+    for block_num, shelf_num, cell_num, cargo_id in occupied_positions:
+        cargo = cargo_by_id.get(cargo_id)
+        if not cargo:
+            continue
+        cargo_by_location[f"{block_num}-{shelf_num}-{cell_num}"] = {
+            "id": cargo["id"],
+            "cargo_number": cargo.get("cargo_number"),
+            "cargo_name": cargo.get("cargo_name", "Груз"),
+            "weight": cargo.get("weight"),
+            "declared_value": cargo.get("declared_value"),
+            "sender_full_name": cargo.get("sender_full_name"),
+            "sender_phone": cargo.get("sender_phone"),
+            "recipient_full_name": cargo.get("recipient_full_name"),
+            "recipient_phone": cargo.get("recipient_phone"),
+            "recipient_address": cargo.get("recipient_address"),
+            "description": cargo.get("description", ""),
+            "warehouse_location": cargo.get("warehouse_location") or f"Б{block_num}-П{shelf_num}-Я{cell_num}",
+            "created_at": cargo.get("created_at"),
+            "processing_status": cargo.get("processing_status", "placed"),
+            "block_number": block_num,
+            "shelf_number": shelf_num,
+            "cell_number": cell_num
+        }
     
     # Создаем структуру склада с блоками, полками и ячейками
     blocks = {}
@@ -7091,7 +11199,7 @@ async def get_warehouse_layout_with_cargo(
     }
 
 @app.post("/api/warehouses/{warehouse_id}/move-cargo")
-async def move_cargo_between_cells(
+def move_cargo_between_cells(
     warehouse_id: str,
     move_data: dict,
     current_user: User = Depends(get_current_user)
@@ -7102,7 +11210,7 @@ async def move_cargo_between_cells(
     
     # Проверяем доступ к складу
     if current_user.role == UserRole.WAREHOUSE_OPERATOR:
-        operator_warehouses = get_operator_warehouses(current_user.id)
+        operator_warehouses = get_operator_warehouse_ids(current_user.id)
         if warehouse_id not in operator_warehouses:
             raise HTTPException(status_code=403, detail="Access denied to this warehouse")
     
@@ -7204,7 +11312,7 @@ async def move_cargo_between_cells(
     }
 
 @app.get("/api/operator/cargo/available")
-async def get_available_cargo_for_placement(
+def get_available_cargo_for_placement(
     current_user: User = Depends(get_current_user)
 ):
     # Проверяем права доступа
@@ -7224,7 +11332,7 @@ async def get_available_cargo_for_placement(
     return [CargoWithLocation(**cargo) for cargo in cargo_list]
 
 @app.get("/api/operator/cargo/history")
-async def get_cargo_history(
+def get_cargo_history(
     status: Optional[str] = None,
     search: Optional[str] = None,
     current_user: User = Depends(get_current_user)
@@ -7259,7 +11367,7 @@ async def get_cargo_history(
     return [CargoWithLocation(**cargo) for cargo in cargo_list]
 
 @app.get("/api/operator/cargo/{cargo_id}/full-info")
-async def get_cargo_full_info(
+def get_cargo_full_info(
     cargo_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -7308,7 +11416,7 @@ async def get_cargo_full_info(
     return response_data
 
 @app.get("/api/warehouses/{warehouse_id}/available-cells")
-async def get_available_cells(
+def get_available_cells(
     warehouse_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -7321,11 +11429,16 @@ async def get_available_cells(
     if not warehouse:
         raise HTTPException(status_code=404, detail="Warehouse not found")
     
-    # Получаем свободные ячейки
-    available_cells = list(db.warehouse_cells.find({
-        "warehouse_id": warehouse_id,
-        "is_occupied": False
-    }, {"_id": 0}).sort([("block_number", 1), ("shelf_number", 1), ("cell_number", 1)]))
+    # Записи свободных ячеек склада (с id и кодами в формате B1-S1-C1) по порядку
+    # блок/полка/ячейка из карты занятости; сортировка в MongoDB не нужна
+    stored_cells = {}
+    for cell in db.warehouse_cells.find({"warehouse_id": warehouse_id, "is_occupied": False}, {"_id": 0}):
+        stored_cells.setdefault(cell_position(cell), cell)
+    available_cells = [
+        stored_cells[position]
+        for position in cell_occupancy.next_free(warehouse_id)
+        if position in stored_cells
+    ]
     
     # Очищаем данные от MongoDB ObjectId
     clean_warehouse = {
@@ -7348,7 +11461,7 @@ async def get_available_cells(
 
 # Управление кассой и платежами
 @app.post("/api/cashier/process-payment")
-async def process_payment(
+def process_payment(
     payment_data: PaymentCreate,
     current_user: User = Depends(get_current_user)
 ):
@@ -7399,7 +11512,7 @@ async def process_payment(
     return PaymentTransaction(**transaction)
 
 @app.get("/api/cashier/search-cargo/{cargo_number}")
-async def search_cargo_for_payment(
+def search_cargo_for_payment(
     cargo_number: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -7424,8 +11537,35 @@ async def search_cargo_for_payment(
         "created_at": cargo["created_at"]
     }
 
+@app.get("/api/cashier/search-by-phone")
+def search_cargo_by_phone_suffix(
+    digits: str,
+    field: str = "recipient_phone",  # recipient_phone, sender_phone
+    limit: int = 50,
+    current_user: User = Depends(get_current_user)
+):
+    """Грузы обеих коллекций, у которых телефон заканчивается на указанные цифры"""
+    if current_user.role not in [UserRole.ADMIN, UserRole.WAREHOUSE_OPERATOR]:
+        raise HTTPException(status_code=403, detail="Insufficient permissions")
+    
+    if field not in ("recipient_phone", "sender_phone"):
+        raise HTTPException(status_code=400, detail="field must be recipient_phone or sender_phone")
+    
+    projection = {
+        "_id": 0, "id": 1, "cargo_number": 1, "sender_full_name": 1, "sender_phone": 1,
+        "recipient_full_name": 1, "recipient_phone": 1, "status": 1, "payment_status": 1,
+        "declared_value": 1, "created_at": 1
+    }
+    limit = min(max(1, limit), 200)
+    pipeline = _cargo_union_pipeline(
+        phone_suffix_filter(field, digits), projection,
+        extra_stages=[{"$sort": {"created_at": -1}}, {"$limit": limit}]
+    )
+    pipeline.extend([{"$sort": {"created_at": -1}}, {"$limit": limit}])
+    return [serialize_mongo_document(cargo) for cargo in db[CARGO_COLLECTIONS[0]].aggregate(pipeline)]
+
 @app.get("/api/cashier/unpaid-cargo")
-async def get_unpaid_cargo(
+def get_unpaid_cargo(
     current_user: User = Depends(get_current_user)
 ):
     # Проверяем права доступа
@@ -7458,7 +11598,7 @@ async def get_unpaid_cargo(
     return [CargoWithLocation(**cargo) for cargo in unpaid_cargo]
 
 @app.get("/api/cashier/payment-history")
-async def get_payment_history(
+def get_payment_history(
     current_user: User = Depends(get_current_user)
 ):
     # Проверяем права доступа
@@ -7484,7 +11624,7 @@ async def get_payment_history(
 
 # Получение пользователей по ролям
 @app.get("/api/admin/users/by-role/{role}")
-async def get_users_by_role(
+def get_users_by_role(
     role: str,
     current_user: User = Depends(require_role(UserRole.ADMIN))
 ):
@@ -7512,7 +11652,7 @@ async def get_users_by_role(
 
 # Получение полной схемы склада
 @app.get("/api/warehouses/{warehouse_id}/full-layout")
-async def get_warehouse_full_layout(
+def get_warehouse_full_layout(
     warehouse_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -7604,7 +11744,7 @@ async def get_warehouse_full_layout(
 
 # Управление заявками от пользователей
 @app.post("/api/user/cargo-request")
-async def create_cargo_request(
+def create_cargo_request(
     request_data: CargoRequestCreate,
     current_user: User = Depends(get_current_user)
 ):
@@ -7658,7 +11798,7 @@ async def create_cargo_request(
     return CargoRequest(**cargo_request)
 
 @app.get("/api/admin/cargo-requests")
-async def get_pending_cargo_requests(
+def get_pending_cargo_requests(
     current_user: User = Depends(get_current_user)
 ):
     # Только админы и операторы могут видеть заявки
@@ -7679,7 +11819,7 @@ async def get_pending_cargo_requests(
     return normalized_requests
 
 @app.get("/api/admin/cargo-requests/all")
-async def get_all_cargo_requests(
+def get_all_cargo_requests(
     status: Optional[str] = None,
     current_user: User = Depends(get_current_user)
 ):
@@ -7705,7 +11845,7 @@ async def get_all_cargo_requests(
     return normalized_requests
 
 @app.post("/api/admin/cargo-requests/{request_id}/accept")
-async def accept_cargo_request(
+def accept_cargo_request(
     request_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -7809,7 +11949,7 @@ async def accept_cargo_request(
 # НОВЫЕ ENDPOINTS ДЛЯ УПРАВЛЕНИЯ ОПЛАТАМИ
 
 @app.get("/api/admin/unpaid-orders")
-async def get_unpaid_orders(current_user: User = Depends(get_current_user)):
+def get_unpaid_orders(current_user: User = Depends(get_current_user)):
     """Получить список неоплаченных заказов"""
     if current_user.role not in [UserRole.ADMIN, UserRole.WAREHOUSE_OPERATOR]:
         raise HTTPException(status_code=403, detail="Insufficient permissions")
@@ -7824,7 +11964,7 @@ async def get_unpaid_orders(current_user: User = Depends(get_current_user)):
     return normalized_orders
 
 @app.get("/api/admin/unpaid-orders/all")
-async def get_all_orders_with_payments(current_user: User = Depends(get_current_user)):
+def get_all_orders_with_payments(current_user: User = Depends(get_current_user)):
     """Получить все заказы (оплаченные и неоплаченные)"""
     if current_user.role not in [UserRole.ADMIN, UserRole.WAREHOUSE_OPERATOR]:
         raise HTTPException(status_code=403, detail="Insufficient permissions")
@@ -7839,7 +11979,7 @@ async def get_all_orders_with_payments(current_user: User = Depends(get_current_
     return normalized_orders
 
 @app.post("/api/admin/unpaid-orders/{order_id}/mark-paid")
-async def mark_order_as_paid(
+def mark_order_as_paid(
     order_id: str,
     payment_data: Dict[str, str],
     current_user: User = Depends(get_current_user)
@@ -7902,7 +12042,7 @@ async def mark_order_as_paid(
     }
 
 @app.post("/api/admin/cargo-requests/{request_id}/reject")
-async def reject_cargo_request(
+def reject_cargo_request(
     request_id: str,
     reason: str = "",
     current_user: User = Depends(get_current_user)
@@ -7947,7 +12087,7 @@ async def reject_cargo_request(
 # НОВЫЕ ENDPOINTS ДЛЯ УПРАВЛЕНИЯ ЗАКАЗАМИ КЛИЕНТОВ
 
 @app.get("/api/admin/cargo-requests/{request_id}")
-async def get_cargo_request_details(
+def get_cargo_request_details(
     request_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -7969,7 +12109,7 @@ async def get_cargo_request_details(
     return normalized_request
 
 @app.put("/api/admin/cargo-requests/{request_id}/update")
-async def update_cargo_request(
+def update_cargo_request(
     request_id: str,
     update_data: CargoRequestUpdate,
     current_user: User = Depends(get_current_user)
@@ -8040,7 +12180,7 @@ async def update_cargo_request(
     return {"message": "Request updated successfully", "request_id": request_id}
 
 @app.get("/api/admin/new-orders-count")
-async def get_new_orders_count(
+def get_new_orders_count(
     current_user: User = Depends(get_current_user)
 ):
     """Получить количество новых заказов для уведомлений"""
@@ -8065,7 +12205,7 @@ async def get_new_orders_count(
 
 # Системные уведомления
 @app.get("/api/system-notifications")
-async def get_system_notifications(
+def get_system_notifications(
     notification_type: Optional[str] = None,
     current_user: User = Depends(get_current_user)
 ):
@@ -8085,7 +12225,7 @@ async def get_system_notifications(
     return [SystemNotification(**notification) for notification in notifications]
 
 @app.get("/api/user/my-requests")
-async def get_my_cargo_requests(
+def get_my_cargo_requests(
     current_user: User = Depends(get_current_user)
 ):
     # Пользователи могут видеть только свои заявки
@@ -8093,7 +12233,7 @@ async def get_my_cargo_requests(
     return [CargoRequest(**request) for request in requests]
 
 @app.get("/api/user/dashboard")
-async def get_personal_dashboard(
+def get_personal_dashboard(
     current_user: User = Depends(get_current_user)
 ):
     """Получить данные личного кабинета пользователя"""
@@ -8234,7 +12374,7 @@ async def get_personal_dashboard(
 # === УПРАВЛЕНИЕ ОПЕРАТОРАМИ И СКЛАДАМИ ===
 
 @app.post("/api/admin/operator-warehouse-binding")
-async def create_operator_warehouse_binding(
+def create_operator_warehouse_binding(
     binding_data: OperatorWarehouseBindingCreate,
     current_user: User = Depends(get_current_user)
 ):
@@ -8274,6 +12414,7 @@ async def create_operator_warehouse_binding(
     }
     
     db.operator_warehouse_bindings.insert_one(binding)
+    operator_bindings.invalidate()
     
     # Создать системное уведомление
     create_system_notification(
@@ -8288,7 +12429,7 @@ async def create_operator_warehouse_binding(
     return {"message": "Operator-warehouse binding created successfully", "binding_id": binding_id}
 
 @app.get("/api/admin/operator-warehouse-bindings")
-async def get_operator_warehouse_bindings(
+def get_operator_warehouse_bindings(
     current_user: User = Depends(get_current_user)
 ):
     # Только админы могут просматривать привязки
@@ -8311,7 +12452,7 @@ async def get_operator_warehouse_bindings(
     return normalized_bindings
 
 @app.delete("/api/admin/operator-warehouse-binding/{binding_id}")
-async def delete_operator_warehouse_binding(
+def delete_operator_warehouse_binding(
     binding_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -8324,6 +12465,7 @@ async def delete_operator_warehouse_binding(
         raise HTTPException(status_code=404, detail="Binding not found")
     
     db.operator_warehouse_bindings.delete_one({"id": binding_id})
+    operator_bindings.invalidate()
     
     # Создать системное уведомление
     create_system_notification(
@@ -8338,7 +12480,7 @@ async def delete_operator_warehouse_binding(
     return {"message": "Operator-warehouse binding deleted successfully"}
 
 @app.post("/api/admin/create-operator")
-async def create_operator_by_admin(
+def create_operator_by_admin(
     operator_data: OperatorCreate,
     current_user: User = Depends(get_current_user)
 ):
@@ -8348,7 +12490,7 @@ async def create_operator_by_admin(
         raise HTTPException(status_code=403, detail="Access denied")
     
     # Проверка существования пользователя с таким телефоном
-    if db.users.find_one({"phone": operator_data.phone}):
+    if find_user_by_phone(operator_data.phone, projection={"_id": 1}):
         raise HTTPException(status_code=400, detail="User with this phone already exists")
     
     # Проверка существования склада
@@ -8393,6 +12535,7 @@ async def create_operator_by_admin(
     }
     
     db.operator_warehouse_bindings.insert_one(binding)
+    operator_bindings.invalidate()
     
     # Создать системное уведомление
     create_system_notification(
@@ -8426,8 +12569,9 @@ async def create_operator_by_admin(
     }
 
 @app.get("/api/admin/operators")
-async def get_all_operators(
-    current_user: User = Depends(get_current_user)
+def get_all_operators(
+    current_user: User = Depends(get_current_user),
+    loaders: RequestLoaders = Depends(get_request_loaders)
 ):
     """Получить всех операторов с информацией о складах"""
     # Только админы могут просматривать операторов
@@ -8440,15 +12584,17 @@ async def get_all_operators(
         {"password": 0, "_id": 0}
     ).sort("created_at", -1))
     
-    # Получить привязки складов для каждого оператора
+    # Получить привязки складов для каждого оператора (склады - одним запросом)
+    for operator in operators:
+        loaders.warehouses.prime(*[binding["warehouse_id"] for binding in operator_bindings.bindings_for_operator(operator["id"])])
     operators_with_warehouses = []
     for operator in operators:
         # Найти привязки оператора к складам
-        bindings = list(db.operator_warehouse_bindings.find({"operator_id": operator["id"]}))
+        bindings = operator_bindings.bindings_for_operator(operator["id"])
         
         warehouses = []
         for binding in bindings:
-            warehouse = db.warehouses.find_one({"id": binding["warehouse_id"]})
+            warehouse = loaders.warehouses.get(binding["warehouse_id"])
             if warehouse:
                 warehouses.append({
                     "id": warehouse["id"],
@@ -8472,7 +12618,7 @@ async def get_all_operators(
 
 
 @app.get("/api/transport/available-cargo")
-async def get_available_cargo_for_transport_endpoint(
+def get_available_cargo_for_transport_endpoint(
     current_user: User = Depends(get_current_user)
 ):
     # Проверка доступа
@@ -8483,10 +12629,11 @@ async def get_available_cargo_for_transport_endpoint(
     return available_cargo
 
 @app.get("/api/cargo/search")
-async def search_cargo_detailed(
+def search_cargo_detailed(
     query: str = "",
     search_type: str = "all",  # all, number, sender_name, recipient_name, phone, cargo_name
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(get_current_user),
+    loaders: RequestLoaders = Depends(get_request_loaders)
 ):
     """Расширенный поиск грузов с детальными карточками и функциями (Функция 4)"""
     # Проверка доступа
@@ -8498,45 +12645,18 @@ async def search_cargo_detailed(
     
     query = query.strip()
     
-    # Построить поисковые критерии
-    search_criteria = []
-    
-    if search_type == "all" or search_type == "number":
-        search_criteria.append({"cargo_number": {"$regex": query, "$options": "i"}})
-    
-    if search_type == "all" or search_type == "sender_name":
-        search_criteria.append({"sender_full_name": {"$regex": query, "$options": "i"}})
-    
-    if search_type == "all" or search_type == "recipient_name":
-        search_criteria.append({"recipient_full_name": {"$regex": query, "$options": "i"}})
-        search_criteria.append({"recipient_name": {"$regex": query, "$options": "i"}})
-    
-    if search_type == "all" or search_type == "phone":
-        # Экранируем специальные символы regex для безопасного поиска телефонов
-        escaped_query = escape_regex_special_chars(query)
-        search_criteria.append({"sender_phone": {"$regex": escaped_query, "$options": "i"}})
-        search_criteria.append({"recipient_phone": {"$regex": escaped_query, "$options": "i"}})
-    
-    if search_type == "all" or search_type == "cargo_name":
-        search_criteria.append({"cargo_name": {"$regex": query, "$options": "i"}})
-        search_criteria.append({"description": {"$regex": query, "$options": "i"}})
-    
-    if not search_criteria:
+    # Группы поискового индекса, по которым ищем
+    if search_type != "all" and search_type not in SEARCH_ENTITY_GROUPS["cargo"]:
         return {"results": [], "total_found": 0, "search_query": query, "search_type": search_type}
+    search_groups = None if search_type == "all" else [search_type]
     
-    # Поиск в коллекции пользовательских грузов
-    user_cargo_query = {"$or": search_criteria}
-    user_cargo = list(db.cargo.find(user_cargo_query, {"_id": 0}).limit(30))
+    # Кандидаты из поискового индекса по обеим коллекциям, уже отсортированные по релевантности
+    all_results = [cargo for cargo, _, _ in search_entities("cargo", query, search_groups)]
     
-    # Поиск в коллекции операторских грузов  
-    operator_cargo = list(db.operator_cargo.find(user_cargo_query, {"_id": 0}).limit(30))
-    
-    # Объединить результаты
-    all_results = user_cargo + operator_cargo
-    
-    # Сортировать по релевантности (точные совпадения номера сначала)
-    if search_type == "number" or query.isdigit():
-        all_results.sort(key=lambda x: 0 if x.get("cargo_number", "").lower() == query.lower() else 1)
+    # Склады и транспорты результатов загружаются пакетно
+    for cargo in all_results[:30]:
+        loaders.warehouses.prime(cargo.get("warehouse_id"))
+        loaders.transports.prime(cargo.get("transport_id"))
     
     # Обогащаем каждый результат дополнительными данными и функциями
     enriched_results = []
@@ -8548,7 +12668,7 @@ async def search_cargo_detailed(
         location_info = None
         
         if cargo.get("warehouse_id"):
-            warehouse = db.warehouses.find_one({"id": cargo["warehouse_id"]}, {"_id": 0})
+            warehouse = loaders.warehouses.get(cargo["warehouse_id"])
             if warehouse:
                 warehouse_info = {
                     "id": warehouse["id"],
@@ -8568,7 +12688,7 @@ async def search_cargo_detailed(
         # Получаем информацию о транспорте (если груз на транспорте)
         transport_info = None
         if cargo.get("transport_id"):
-            transport = db.transports.find_one({"id": cargo["transport_id"]}, {"_id": 0})
+            transport = loaders.transports.get(cargo["transport_id"])
             if transport:
                 transport_info = {
                     "id": transport["id"],
@@ -8698,7 +12818,7 @@ def _get_location_description(cargo):
         return f"Статус: {status}"
 
 @app.post("/api/search/advanced")
-async def advanced_search(
+def advanced_search(
     search_request: AdvancedSearchRequest,
     current_user: User = Depends(get_current_user)
 ):
@@ -8711,15 +12831,15 @@ async def advanced_search(
         total_count = 0
         
         if search_request.search_type in ["all", "cargo"]:
-            cargo_results = await search_cargo_advanced(search_request, current_user)
+            cargo_results = search_cargo_advanced(search_request, current_user)
             results.extend(cargo_results)
         
         if search_request.search_type in ["all", "users"] and current_user.role in [UserRole.ADMIN, UserRole.WAREHOUSE_OPERATOR]:
-            user_results = await search_users_advanced(search_request, current_user)
+            user_results = search_users_advanced(search_request, current_user)
             results.extend(user_results)
         
         if search_request.search_type in ["all", "warehouses"] and current_user.role in [UserRole.ADMIN, UserRole.WAREHOUSE_OPERATOR]:
-            warehouse_results = await search_warehouses_advanced(search_request, current_user)
+            warehouse_results = search_warehouses_advanced(search_request, current_user)
             results.extend(warehouse_results)
         
         # Сортировка результатов
@@ -8740,9 +12860,6 @@ async def advanced_search(
         paginated_results = results[start_idx:end_idx]
         total_pages = (total_count + per_page - 1) // per_page
         
-        # Генерация предложений для автодополнения
-        suggestions = await generate_search_suggestions(search_request.query, current_user)
-        
         search_time_ms = int((time.time() - start_time) * 1000)
         
         return AdvancedSearchResponse(
@@ -8751,35 +12868,24 @@ async def advanced_search(
             page=page,
             per_page=per_page,
             total_pages=total_pages,
-            search_time_ms=search_time_ms,
-            suggestions=suggestions
+            search_time_ms=search_time_ms
         )
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Search error: {str(e)}")
 
-async def search_cargo_advanced(search_request: AdvancedSearchRequest, current_user: User) -> List[SearchResult]:
+def search_cargo_advanced(search_request: AdvancedSearchRequest, current_user: User) -> List[SearchResult]:
     """Поиск грузов с расширенными фильтрами"""
     cargo_results = []
     
     # Построение запроса для поиска грузов
     search_criteria = {}
     
-    # Текстовый поиск
+    # Текстовый поиск через поисковый индекс: кандидаты и их релевантность по коллекциям
+    relevance = {}
     if search_request.query:
-        query = search_request.query.strip()
-        text_search = {
-            "$or": [
-                {"cargo_number": {"$regex": query, "$options": "i"}},
-                {"cargo_name": {"$regex": query, "$options": "i"}},
-                {"sender_full_name": {"$regex": query, "$options": "i"}},
-                {"recipient_full_name": {"$regex": query, "$options": "i"}},
-                {"sender_phone": {"$regex": query, "$options": "i"}},
-                {"recipient_phone": {"$regex": query, "$options": "i"}},
-                {"description": {"$regex": query, "$options": "i"}}
-            ]
-        }
-        search_criteria.update(text_search)
+        for hit in search_index.match("cargo", search_request.query.strip()):
+            relevance[(hit["source"], hit["ref"])] = hit["score"]
     
     # Фильтр по статусу
     if search_request.cargo_status:
@@ -8794,15 +12900,12 @@ async def search_cargo_advanced(search_request: AdvancedSearchRequest, current_u
     if search_request.route:
         search_criteria["route"] = search_request.route
     
+    # Телефоны ищутся по окончанию номера через индекс перевернутого ключа
     if search_request.sender_phone:
-        import re
-        escaped_phone = re.escape(search_request.sender_phone)
-        search_criteria["sender_phone"] = {"$regex": escaped_phone, "$options": "i"}
+        search_criteria.update(phone_suffix_filter("sender_phone", search_request.sender_phone))
     
     if search_request.recipient_phone:
-        import re
-        escaped_phone = re.escape(search_request.recipient_phone)
-        search_criteria["recipient_phone"] = {"$regex": escaped_phone, "$options": "i"}
+        search_criteria.update(phone_suffix_filter("recipient_phone", search_request.recipient_phone))
     
     # Фильтр по дате
     if search_request.date_from or search_request.date_to:
@@ -8814,12 +12917,23 @@ async def search_cargo_advanced(search_request: AdvancedSearchRequest, current_u
         search_criteria["created_at"] = date_filter
     
     # Поиск в коллекциях грузов
-    for collection_name in ["cargo", "operator_cargo"]:
-        collection = getattr(db, collection_name)
-        cargo_list = list(collection.find(search_criteria, {"_id": 0}).limit(50))
+    for collection_name in CARGO_COLLECTIONS:
+        collection_criteria = dict(search_criteria)
+        if search_request.query:
+            refs = [ref for source, ref in relevance if source == collection_name]
+            if not refs:
+                continue
+            collection_criteria["id"] = {"$in": refs}
+        if search_request.query:
+            # Лучшие 50 по релевантности среди подходящих под фильтры, полные документы - только для них
+            matched_ids = [cargo["id"] for cargo in db[collection_name].find(collection_criteria, {"_id": 0, "id": 1})]
+            matched_ids.sort(key=lambda cargo_id: relevance.get((collection_name, cargo_id), 1.0), reverse=True)
+            collection_criteria = {"id": {"$in": matched_ids[:50]}}
+        cargo_list = list(db[collection_name].find(collection_criteria, {"_id": 0}).limit(50))
+        cargo_list.sort(key=lambda cargo: relevance.get((collection_name, cargo["id"]), 1.0), reverse=True)
         
         for cargo in cargo_list:
-            relevance_score = calculate_cargo_relevance(cargo, search_request.query)
+            relevance_score = relevance.get((collection_name, cargo["id"]), 1.0)
             
             # Формируем результат поиска
             result = SearchResult(
@@ -8850,20 +12964,18 @@ async def search_cargo_advanced(search_request: AdvancedSearchRequest, current_u
     
     return cargo_results
 
-async def search_users_advanced(search_request: AdvancedSearchRequest, current_user: User) -> List[SearchResult]:
+def search_users_advanced(search_request: AdvancedSearchRequest, current_user: User) -> List[SearchResult]:
     """Поиск пользователей с фильтрами"""
     user_results = []
     
     search_criteria = {}
     
-    # Текстовый поиск по пользователям
+    # Текстовый поиск по пользователям через поисковый индекс
+    relevance = {}
     if search_request.query:
-        query = search_request.query.strip()
-        search_criteria["$or"] = [
-            {"full_name": {"$regex": query, "$options": "i"}},
-            {"phone": {"$regex": query, "$options": "i"}},
-            {"user_number": {"$regex": query, "$options": "i"}}
-        ]
+        for hit in search_index.match("user", search_request.query.strip(), ["name", "phone", "number"]):
+            relevance[hit["ref"]] = hit["score"]
+        search_criteria["id"] = {"$in": list(relevance)}
     
     # Фильтры пользователей
     if search_request.user_role:
@@ -8872,10 +12984,15 @@ async def search_users_advanced(search_request: AdvancedSearchRequest, current_u
     if search_request.user_status is not None:
         search_criteria["is_active"] = search_request.user_status
     
-    users = list(db.users.find(search_criteria, {"password": 0, "_id": 0}).limit(20))
+    if search_request.query:
+        users = list(db.users.find(search_criteria, {"password": 0, "_id": 0}))
+        users.sort(key=lambda user: relevance.get(user["id"], 1.0), reverse=True)
+        users = users[:20]
+    else:
+        users = list(db.users.find(search_criteria, {"password": 0, "_id": 0}).limit(20))
     
     for user in users:
-        relevance_score = calculate_user_relevance(user, search_request.query)
+        relevance_score = relevance.get(user["id"], 1.0)
         
         result = SearchResult(
             type="user",
@@ -8896,28 +13013,28 @@ async def search_users_advanced(search_request: AdvancedSearchRequest, current_u
     
     return user_results
 
-async def search_warehouses_advanced(search_request: AdvancedSearchRequest, current_user: User) -> List[SearchResult]:
+def search_warehouses_advanced(search_request: AdvancedSearchRequest, current_user: User) -> List[SearchResult]:
     """Поиск складов с фильтрами"""
     warehouse_results = []
     
     search_criteria = {}
     
-    # Текстовый поиск по складам
+    # Текстовый поиск по складам через поисковый индекс
     if search_request.query:
-        query = search_request.query.strip()
-        search_criteria["$or"] = [
-            {"name": {"$regex": query, "$options": "i"}},
-            {"location": {"$regex": query, "$options": "i"}},
-            {"description": {"$regex": query, "$options": "i"}}
-        ]
+        found = search_entities("warehouse", search_request.query.strip())[:10]
+        warehouses = [warehouse for warehouse, _, _ in found]
+        relevance = {warehouse["id"]: score for warehouse, _, score in found}
+    else:
+        warehouses = list(db.warehouses.find(search_criteria, {"_id": 0}).limit(10))
+        relevance = {}
     
-    warehouses = list(db.warehouses.find(search_criteria, {"_id": 0}).limit(10))
+    # Количество грузов на найденных складах - одним запросом
+    cargo_counts = count_by_field(db.operator_cargo, "warehouse_id", [warehouse["id"] for warehouse in warehouses])
     
     for warehouse in warehouses:
-        # Подсчитаем количество грузов на складе
-        cargo_count = db.operator_cargo.count_documents({"warehouse_id": warehouse["id"]})
+        cargo_count = cargo_counts.get(warehouse["id"], 0)
         
-        relevance_score = calculate_warehouse_relevance(warehouse, search_request.query)
+        relevance_score = relevance.get(warehouse["id"], 1.0)
         
         result = SearchResult(
             type="warehouse",
@@ -8938,124 +13055,10 @@ async def search_warehouses_advanced(search_request: AdvancedSearchRequest, curr
     
     return warehouse_results
 
-def calculate_cargo_relevance(cargo: dict, query: str) -> float:
-    """Расчет релевантности груза"""
-    if not query:
-        return 1.0
-    
-    query = query.lower()
-    score = 0.0
-    
-    # Точное совпадение номера груза - максимальная релевантность
-    if cargo.get("cargo_number", "").lower() == query:
-        score += 100.0
-    elif query in cargo.get("cargo_number", "").lower():
-        score += 50.0
-    
-    # Совпадение в названии груза
-    if query in cargo.get("cargo_name", "").lower():
-        score += 30.0
-    
-    # Совпадение в именах отправителя/получателя
-    if query in cargo.get("sender_full_name", "").lower():
-        score += 20.0
-    if query in cargo.get("recipient_full_name", "").lower():
-        score += 20.0
-    
-    # Совпадение в телефонах
-    if query in cargo.get("sender_phone", "").lower():
-        score += 25.0
-    if query in cargo.get("recipient_phone", "").lower():
-        score += 25.0
-    
-    return min(score, 100.0)
-
-def calculate_user_relevance(user: dict, query: str) -> float:
-    """Расчет релевантности пользователя"""
-    if not query:
-        return 1.0
-    
-    query = query.lower()
-    score = 0.0
-    
-    # Точное совпадение номера пользователя
-    if user.get("user_number", "").lower() == query:
-        score += 100.0
-    elif query in user.get("user_number", "").lower():
-        score += 70.0
-    
-    # Совпадение в имени
-    if query in user.get("full_name", "").lower():
-        score += 50.0
-    
-    # Совпадение в телефоне
-    if query in user.get("phone", "").lower():
-        score += 60.0
-    
-    return min(score, 100.0)
-
-def calculate_warehouse_relevance(warehouse: dict, query: str) -> float:
-    """Расчет релевантности склада"""
-    if not query:
-        return 1.0
-    
-    query = query.lower()
-    score = 0.0
-    
-    # Совпадение в названии склада
-    if query in warehouse.get("name", "").lower():
-        score += 70.0
-    
-    # Совпадение в местоположении
-    if query in warehouse.get("location", "").lower():
-        score += 50.0
-    
-    # Совпадение в описании
-    if query in warehouse.get("description", "").lower():
-        score += 30.0
-    
-    return min(score, 100.0)
-
-async def generate_search_suggestions(query: str, current_user: User) -> List[str]:
-    """Генерация предложений для автодополнения"""
-    if not query or len(query) < 2:
-        return []
-    
-    suggestions = []
-    query_lower = query.lower()
-    
-    # Предложения на основе номеров грузов
-    cargo_numbers = []
-    for collection_name in ["cargo", "operator_cargo"]:
-        collection = getattr(db, collection_name)
-        cargo_docs = collection.find(
-            {"cargo_number": {"$regex": f"^{query}", "$options": "i"}},
-            {"cargo_number": 1, "_id": 0}
-        ).limit(5)
-        cargo_numbers.extend([doc["cargo_number"] for doc in cargo_docs])
-    
-    suggestions.extend(cargo_numbers[:3])
-    
-    # Предложения на основе имен
-    if current_user.role in [UserRole.ADMIN, UserRole.WAREHOUSE_OPERATOR]:
-        # Имена отправителей/получателей
-        name_suggestions = []
-        for collection_name in ["cargo", "operator_cargo"]:
-            collection = getattr(db, collection_name)
-            sender_docs = collection.find(
-                {"sender_full_name": {"$regex": query, "$options": "i"}},
-                {"sender_full_name": 1, "_id": 0}
-            ).limit(3)
-            name_suggestions.extend([doc["sender_full_name"] for doc in sender_docs])
-        
-        suggestions.extend(name_suggestions[:2])
-    
-    return list(set(suggestions))[:5]  # Убираем дубликаты и ограничиваем до 5
-
 # === НОВЫЕ API ЭТАПА 1: ДОПОЛНИТЕЛЬНЫЕ ФУНКЦИИ ГРУЗОВ ===
 
 @app.post("/api/cargo/photo/upload")
-async def upload_cargo_photo(
+def upload_cargo_photo(
     photo_data: CargoPhotoUpload,
     current_user: User = Depends(get_current_user)
 ):
@@ -9064,11 +13067,9 @@ async def upload_cargo_photo(
         raise HTTPException(status_code=403, detail="Access denied")
     
     # Проверяем существование груза
-    cargo = db.cargo.find_one({"id": photo_data.cargo_id})
+    cargo = find_cargo({"id": photo_data.cargo_id})
     if not cargo:
-        cargo = db.operator_cargo.find_one({"id": photo_data.cargo_id})
-        if not cargo:
-            raise HTTPException(status_code=404, detail="Cargo not found")
+        raise HTTPException(status_code=404, detail="Cargo not found")
     
     # Валидация base64 изображения
     try:
@@ -9133,7 +13134,7 @@ async def upload_cargo_photo(
     }
 
 @app.get("/api/cargo/{cargo_id}/photos")
-async def get_cargo_photos(
+def get_cargo_photos(
     cargo_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -9142,11 +13143,9 @@ async def get_cargo_photos(
         raise HTTPException(status_code=403, detail="Access denied")
     
     # Проверяем существование груза
-    cargo = db.cargo.find_one({"id": cargo_id})
+    cargo = find_cargo({"id": cargo_id})
     if not cargo:
-        cargo = db.operator_cargo.find_one({"id": cargo_id})
-        if not cargo:
-            raise HTTPException(status_code=404, detail="Cargo not found")
+        raise HTTPException(status_code=404, detail="Cargo not found")
     
     # Получаем фото
     photos = list(db.cargo_photos.find({"cargo_id": cargo_id}, {"_id": 0}).sort("upload_date", -1))
@@ -9159,7 +13158,7 @@ async def get_cargo_photos(
     }
 
 @app.delete("/api/cargo/photo/{photo_id}")
-async def delete_cargo_photo(
+def delete_cargo_photo(
     photo_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -9193,7 +13192,7 @@ async def delete_cargo_photo(
     return {"message": "Photo deleted successfully"}
 
 @app.get("/api/cargo/{cargo_id}/history")
-async def get_cargo_history(
+def get_cargo_history(
     cargo_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -9202,11 +13201,9 @@ async def get_cargo_history(
         raise HTTPException(status_code=403, detail="Access denied")
     
     # Проверяем существование груза
-    cargo = db.cargo.find_one({"id": cargo_id})
+    cargo = find_cargo({"id": cargo_id})
     if not cargo:
-        cargo = db.operator_cargo.find_one({"id": cargo_id})
-        if not cargo:
-            raise HTTPException(status_code=404, detail="Cargo not found")
+        raise HTTPException(status_code=404, detail="Cargo not found")
     
     # Получаем историю
     history = list(db.cargo_history.find({"cargo_id": cargo_id}, {"_id": 0}).sort("change_date", -1))
@@ -9219,7 +13216,7 @@ async def get_cargo_history(
     }
 
 @app.post("/api/cargo/comment")
-async def add_cargo_comment(
+def add_cargo_comment(
     comment_data: CargoCommentCreate,
     current_user: User = Depends(get_current_user)
 ):
@@ -9228,11 +13225,9 @@ async def add_cargo_comment(
         raise HTTPException(status_code=403, detail="Access denied")
     
     # Проверяем существование груза
-    cargo = db.cargo.find_one({"id": comment_data.cargo_id})
+    cargo = find_cargo({"id": comment_data.cargo_id})
     if not cargo:
-        cargo = db.operator_cargo.find_one({"id": comment_data.cargo_id})
-        if not cargo:
-            raise HTTPException(status_code=404, detail="Cargo not found")
+        raise HTTPException(status_code=404, detail="Cargo not found")
     
     # Создаем комментарий
     comment_id = str(uuid.uuid4())
@@ -9275,7 +13270,7 @@ async def add_cargo_comment(
     }
 
 @app.get("/api/cargo/{cargo_id}/comments")
-async def get_cargo_comments(
+def get_cargo_comments(
     cargo_id: str,
     include_internal: bool = True,
     current_user: User = Depends(get_current_user)
@@ -9285,11 +13280,9 @@ async def get_cargo_comments(
         raise HTTPException(status_code=403, detail="Access denied")
     
     # Проверяем существование груза
-    cargo = db.cargo.find_one({"id": cargo_id})
+    cargo = find_cargo({"id": cargo_id})
     if not cargo:
-        cargo = db.operator_cargo.find_one({"id": cargo_id})
-        if not cargo:
-            raise HTTPException(status_code=404, detail="Cargo not found")
+        raise HTTPException(status_code=404, detail="Cargo not found")
     
     # Фильтруем комментарии
     query = {"cargo_id": cargo_id}
@@ -9334,7 +13327,7 @@ def add_cargo_history(cargo_id: str, cargo_number: str, action_type: str,
 # ===== НОВЫЕ ЭНДПОИНТЫ ДЛЯ УЛУЧШЕННОЙ СИСТЕМЫ СКЛАДОВ И ДОЛГОВ =====
 
 @app.get("/api/operator/warehouses")
-async def get_operator_warehouses(current_user: User = Depends(get_current_user)):
+def get_operator_warehouses(current_user: User = Depends(get_current_user)):
     """Получить список складов привязанных к оператору"""
     if current_user.role not in [UserRole.ADMIN, UserRole.WAREHOUSE_OPERATOR]:
         raise HTTPException(status_code=403, detail="Insufficient permissions")
@@ -9369,7 +13362,7 @@ async def get_operator_warehouses(current_user: User = Depends(get_current_user)
     ]
 
 @app.patch("/api/admin/warehouses/{warehouse_id}/address")
-async def update_warehouse_address(
+def update_warehouse_address(
     warehouse_id: str,
     address_data: dict,
     current_user: User = Depends(get_current_user)
@@ -9406,7 +13399,7 @@ async def update_warehouse_address(
         raise HTTPException(status_code=500, detail=f"Error updating warehouse address: {str(e)}")
 
 @app.get("/api/warehouses/by-route/{route}")
-async def get_warehouses_by_route(route: str, current_user: User = Depends(get_current_user)):
+def get_warehouses_by_route(route: str, current_user: User = Depends(get_current_user)):
     """Получить список складов по маршруту для операторов и админов"""
     if current_user.role not in [UserRole.ADMIN, UserRole.WAREHOUSE_OPERATOR]:
         raise HTTPException(status_code=403, detail="Insufficient permissions")
@@ -9447,7 +13440,7 @@ async def get_warehouses_by_route(route: str, current_user: User = Depends(get_c
     ]
 
 @app.get("/api/admin/debts")
-async def get_debtors_list(current_user: User = Depends(get_current_user)):
+def get_debtors_list(current_user: User = Depends(get_current_user)):
     """Получить список задолжников для админа"""
     if current_user.role != UserRole.ADMIN:
         raise HTTPException(status_code=403, detail="Only admins can view debtors")
@@ -9497,7 +13490,7 @@ async def get_debtors_list(current_user: User = Depends(get_current_user)):
         )
 
 @app.put("/api/admin/debts/{debt_id}/status")
-async def update_debt_status(
+def update_debt_status(
     debt_id: str,
     status_data: dict,
     current_user: User = Depends(get_current_user)
@@ -9529,7 +13522,7 @@ async def update_debt_status(
 # ===== ЭНДПОИНТЫ УПРАВЛЕНИЯ УВЕДОМЛЕНИЯМИ =====
 
 @app.get("/api/notifications")
-async def get_user_notifications(
+def get_user_notifications(
     status: Optional[str] = None,  # unread, read, all
     limit: int = 50,
     current_user: User = Depends(get_current_user)
@@ -9549,7 +13542,7 @@ async def get_user_notifications(
     return notifications
 
 @app.put("/api/notifications/{notification_id}/status")
-async def update_notification_status(
+def update_notification_status(
     notification_id: str,
     status_data: dict,
     current_user: User = Depends(get_current_user)
@@ -9575,7 +13568,7 @@ async def update_notification_status(
     return {"message": "Notification status updated successfully"}
 
 @app.delete("/api/notifications/{notification_id}")
-async def delete_notification(
+def delete_notification(
     notification_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -9591,7 +13584,7 @@ async def delete_notification(
     return {"message": "Notification deleted successfully"}
 
 @app.get("/api/notifications/{notification_id}/details")
-async def get_notification_details(
+def get_notification_details(
     notification_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -9626,7 +13619,7 @@ async def get_notification_details(
 # === ТРАНСПОРТ API ===
 
 @app.post("/api/transport/create")
-async def create_transport(
+def create_transport(
     transport: TransportCreate,
     current_user: User = Depends(get_current_user)
 ):
@@ -9672,7 +13665,7 @@ async def create_transport(
 
 
 @app.get("/api/transport/history")
-async def get_transport_history(
+def get_transport_history(
     current_user: User = Depends(get_current_user)
 ):
     # Проверка доступа
@@ -9705,7 +13698,7 @@ async def get_transport_history(
     return history
 
 @app.get("/api/transport/arrived")
-async def get_arrived_transports(
+def get_arrived_transports(
     current_user: User = Depends(get_current_user)
 ):
     """Получить список прибывших транспортов с грузами для размещения"""
@@ -9737,7 +13730,7 @@ async def get_arrived_transports(
     return transport_list
 
 @app.get("/api/transport/{transport_id}/visualization")
-async def get_transport_visualization(
+def get_transport_visualization(
     transport_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -9755,12 +13748,10 @@ async def get_transport_visualization(
     total_weight = 0
     total_volume_estimate = 0
     
+    transport_cargo = locate_cargo_many("id", transport.get("cargo_list", []))
+    
     for cargo_id in transport.get("cargo_list", []):
-        cargo = db.cargo.find_one({"id": cargo_id})
-        collection_name = "cargo"
-        if not cargo:
-            cargo = db.operator_cargo.find_one({"id": cargo_id})
-            collection_name = "operator_cargo"
+        cargo, collection_name = transport_cargo.get(cargo_id, (None, None))
         
         if cargo:
             weight = cargo.get("weight", 0)
@@ -9857,7 +13848,7 @@ async def get_transport_visualization(
     }
 
 @app.get("/api/transport/list")
-async def get_transports_list(
+def get_transports_list(
     status: Optional[str] = None,
     current_user: User = Depends(get_current_user)
 ):
@@ -9925,8 +13916,9 @@ async def get_transports_list(
     return transport_list
 
 @app.get("/api/warehouses/for-interwarehouse-transport") 
-async def get_warehouses_for_interwarehouse_transport(
-    current_user: User = Depends(get_current_user)
+def get_warehouses_for_interwarehouse_transport(
+    current_user: User = Depends(get_current_user),
+    loaders: RequestLoaders = Depends(get_request_loaders)
 ):
     """Получить список складов для создания межскладских транспортов (Функция 3)"""
     if current_user.role not in [UserRole.ADMIN, UserRole.WAREHOUSE_OPERATOR]:
@@ -9969,9 +13961,9 @@ async def get_warehouses_for_interwarehouse_transport(
         # Получаем операторов, привязанных к складу (для админов)
         bound_operators = []
         if current_user.role == UserRole.ADMIN:
-            bindings = list(db.operator_warehouse_bindings.find({"warehouse_id": warehouse["id"]}))
+            bindings = operator_bindings.bindings_for_warehouse(warehouse["id"])
             for binding in bindings:
-                operator = db.users.find_one({"id": binding["operator_id"]}, {"password": 0})
+                operator = loaders.users.get(binding["operator_id"])
                 if operator:
                     bound_operators.append({
                         "id": operator["id"],
@@ -10008,7 +14000,7 @@ async def get_warehouses_for_interwarehouse_transport(
     }
 
 @app.get("/api/warehouses/analytics")
-async def get_warehouse_analytics(
+def get_warehouse_analytics(
     current_user: User = Depends(get_current_user)
 ):
     """Получение аналитики по складам для улучшенного размещения"""
@@ -10025,10 +14017,7 @@ async def get_warehouse_analytics(
             warehouses_cursor = db.warehouses.find({})
         else:
             # Для операторов - только их склады
-            operator_warehouse_bindings = list(db.operator_warehouse_bindings.find(
-                {"operator_id": current_user.id}
-            ))
-            warehouse_ids = [binding["warehouse_id"] for binding in operator_warehouse_bindings]
+            warehouse_ids = operator_bindings.warehouse_ids_for_operator(current_user.id)
             total_warehouses = len(warehouse_ids)
             warehouses_cursor = db.warehouses.find({"id": {"$in": warehouse_ids}})
         
@@ -10071,8 +14060,85 @@ async def get_warehouse_analytics(
             detail=f"Ошибка получения аналитики складов: {str(e)}"
         )
 
+def _truthy_expr(field: str) -> dict:
+    """Аналог проверки Python `if value:` для поля документа (пустая строка - ложь)"""
+    return {"$and": [f"${field}", {"$ne": [f"${field}", ""]}]}
+
+def _to_double_expr(field: str) -> dict:
+    """float(value) с нулем при ошибке преобразования"""
+    return {"$convert": {"input": f"${field}", "to": "double", "onError": 0, "onNull": 0}}
+
+def aggregate_cargo_summary(match: Optional[dict] = None) -> dict:
+    """Сводная статистика грузов по cargo и operator_cargo, вычисляемая внутри MongoDB.
+    
+    В Python возвращается только один итоговый документ, поэтому память и трафик не зависят
+    от количества грузов.
+    """
+    fields = {
+        "_id": 0, "weight": 1, "declared_value": 1, "total_cost": 1, "sender_phone": 1,
+        "recipient_phone": 1, "status": 1, "processing_status": 1, "payment_method": 1, "payment_status": 1
+    }
+    branch = ([{"$match": match}] if match else []) + [{"$project": fields}]
+    
+    cargo_sum_expr = {"$cond": [
+        _truthy_expr("declared_value"),
+        _to_double_expr("declared_value"),
+        {"$cond": [_truthy_expr("total_cost"), _to_double_expr("total_cost"), 0]}
+    ]}
+    debt_amount_expr = {"$cond": [_truthy_expr("declared_value"), _to_double_expr("declared_value"), _to_double_expr("total_cost")]}
+    status_string = {"$convert": {"input": "$status", "to": "string", "onError": "", "onNull": ""}}
+    processing_status_string = {"$convert": {"input": "$processing_status", "to": "string", "onError": "", "onNull": ""}}
+    is_awaiting_recipient = {"$or": [
+        {"$regexMatch": {"input": status_string, "regex": "delivered|доставлен|awaiting_pickup", "options": "i"}},
+        {"$regexMatch": {"input": processing_status_string, "regex": "ожидает_получения", "options": "i"}}
+    ]}
+    is_debtor = {"$or": [
+        {"$and": [
+            {"$eq": ["$payment_method", "credit"]},
+            {"$in": ["$payment_status", ["pending", "unpaid"]]}
+        ]},
+        {"$eq": ["$processing_status", "payment_pending"]}
+    ]}
+    
+    def unique_phones(field: str) -> list:
+        return [
+            {"$match": {field: {"$nin": [None, ""]}}},
+            {"$group": {"_id": f"${field}"}},
+            {"$count": "count"}
+        ]
+    
+    pipeline = branch + [
+        {"$unionWith": {"coll": "operator_cargo", "pipeline": branch}},
+        {"$facet": {
+            "totals": [{"$group": {
+                "_id": None,
+                "total_cargo": {"$sum": 1},
+                "total_weight": {"$sum": {"$cond": [{"$isNumber": "$weight"}, "$weight", 0]}},
+                "total_sum": {"$sum": cargo_sum_expr},
+                "awaiting_recipient": {"$sum": {"$cond": [is_awaiting_recipient, 1, 0]}},
+                "debtors_count": {"$sum": {"$cond": [is_debtor, 1, 0]}},
+                "total_debt_amount": {"$sum": {"$cond": [is_debtor, debt_amount_expr, 0]}}
+            }}],
+            "senders": unique_phones("sender_phone"),
+            "recipients": unique_phones("recipient_phone")
+        }}
+    ]
+    
+    result = next(db.cargo.aggregate(pipeline, allowDiskUse=True), {})
+    totals = (result.get("totals") or [{}])[0]
+    return {
+        "total_cargo": totals.get("total_cargo", 0),
+        "total_weight": totals.get("total_weight", 0),
+        "total_sum": totals.get("total_sum", 0),
+        "awaiting_recipient": totals.get("awaiting_recipient", 0),
+        "debtors_count": totals.get("debtors_count", 0),
+        "total_debt_amount": totals.get("total_debt_amount", 0),
+        "unique_senders": (result.get("senders") or [{}])[0].get("count", 0),
+        "unique_recipients": (result.get("recipients") or [{}])[0].get("count", 0)
+    }
+
 @app.get("/api/admin/dashboard/analytics")
-async def get_admin_dashboard_analytics(
+def get_admin_dashboard_analytics(
     current_user: User = Depends(get_current_user)
 ):
     """Получение расширенной аналитики для дашборда администратора"""
@@ -10090,74 +14156,23 @@ async def get_admin_dashboard_analytics(
         total_operators = db.users.count_documents({"role": "warehouse_operator"})
         total_regular_users = db.users.count_documents({"role": "user"})
         
-        # Статистика грузов
-        all_cargo_user = list(db.cargo.find({}))
-        all_cargo_operator = list(db.operator_cargo.find({}))
-        all_cargo = all_cargo_user + all_cargo_operator
-        
-        total_cargo = len(all_cargo)
-        
-        # Подсчет общего веса и суммы
-        total_weight = 0
-        total_sum = 0
-        
-        for cargo in all_cargo:
-            weight = cargo.get('weight', 0)
-            if isinstance(weight, (int, float)):
-                total_weight += weight
-            
-            # Считаем сумму из различных полей
-            cargo_sum = 0
-            if cargo.get('declared_value'):
-                try:
-                    cargo_sum = float(cargo.get('declared_value', 0))
-                except (ValueError, TypeError):
-                    cargo_sum = 0
-            elif cargo.get('total_cost'):
-                try:
-                    cargo_sum = float(cargo.get('total_cost', 0))
-                except (ValueError, TypeError):
-                    cargo_sum = 0
-            
-            total_sum += cargo_sum
-        
-        # Статистика отправителей и получателей (уникальные номера телефонов)
-        senders = set()
-        recipients = set()
-        
-        for cargo in all_cargo:
-            sender_phone = cargo.get('sender_phone')
-            if sender_phone:
-                senders.add(sender_phone)
-                
-            recipient_phone = cargo.get('recipient_phone')
-            if recipient_phone:
-                recipients.add(recipient_phone)
-        
-        # Грузы, ожидающие получателя (статусы: доставлен, ожидает получения)
-        awaiting_recipient_count = 0
-        for cargo in all_cargo:
-            status = cargo.get('status', '').lower()
-            processing_status = cargo.get('processing_status', '').lower()
-            if 'delivered' in status or 'доставлен' in status or 'awaiting_pickup' in status or 'ожидает_получения' in processing_status:
-                awaiting_recipient_count += 1
-        
-        # Должники (грузы с payment_method = 'credit' и статусом pending)
-        debtors_count = 0
-        total_debt_amount = 0
-        
-        for cargo in all_cargo:
-            payment_method = cargo.get('payment_method', '')
-            payment_status = cargo.get('payment_status', '')
-            processing_status = cargo.get('processing_status', '')
-            
-            if (payment_method == 'credit' and payment_status in ['pending', 'unpaid']) or processing_status == 'payment_pending':
-                debtors_count += 1
-                try:
-                    debt_amount = float(cargo.get('declared_value', 0) or cargo.get('total_cost', 0))
-                    total_debt_amount += debt_amount
-                except (ValueError, TypeError):
-                    pass
+        # Статистика грузов и транспортов из счетчиков; пока они не построены - грузы
+        # агрегацией в MongoDB, транспорты пересчетом по коллекции transports
+        if dashboard_stats.is_built():
+            global_stats = dashboard_stats.get(STATS_GLOBAL_SCOPE)
+            cargo_summary = {
+                "total_cargo": global_stats.get("cargo_count", 0),
+                "total_weight": global_stats.get("total_weight", 0),
+                "total_sum": global_stats.get("total_value", 0),
+                "awaiting_recipient": global_stats.get("awaiting_recipient", 0),
+                "debtors_count": global_stats.get("debtors_count", 0),
+                "total_debt_amount": global_stats.get("debt_amount", 0),
+                "unique_senders": global_stats.get("unique_senders", 0),
+                "unique_recipients": global_stats.get("unique_recipients", 0)
+            }
+        else:
+            global_stats = dashboard_stats.compute([STATS_GLOBAL_SCOPE], include_cargo=False)[STATS_GLOBAL_SCOPE]
+            cargo_summary = aggregate_cargo_summary()
         
         # Новые заявки пользователей (статус pending или new_request)
         new_requests_count = db.cargo.count_documents({
@@ -10171,21 +14186,11 @@ async def get_admin_dashboard_analytics(
         # Дополнительно из коллекции cargo_requests
         new_requests_count += db.cargo_requests.count_documents({"status": "pending"})
         
-        # Транспорты по маршрутам
-        moscow_to_tajikistan_transports = db.transports.count_documents({
-            "direction": {"$regex": "moscow.*tajikistan", "$options": "i"}
-        })
-        
-        tajikistan_to_moscow_transports = db.transports.count_documents({
-            "direction": {"$regex": "tajikistan.*moscow", "$options": "i"}
-        })
-        
-        total_transports = db.transports.count_documents({})
-        
-        # Статистика по активности
-        active_transports = db.transports.count_documents({
-            "status": {"$in": ["loading", "in_transit", "active"]}
-        })
+        # Транспорты по маршрутам и активности
+        moscow_to_tajikistan_transports = global_stats.get("transports_moscow_to_tajikistan", 0)
+        tajikistan_to_moscow_transports = global_stats.get("transports_tajikistan_to_moscow", 0)
+        total_transports = global_stats.get("transports_total", 0)
+        active_transports = global_stats.get("active_transports", 0)
         
         # Возвращаем полную аналитику
         analytics = {
@@ -10197,18 +14202,18 @@ async def get_admin_dashboard_analytics(
                 "total_regular_users": total_regular_users
             },
             "cargo_stats": {
-                "total_cargo": total_cargo,
-                "total_weight_kg": round(total_weight, 2),
-                "total_sum_rub": round(total_sum, 2),
-                "awaiting_recipient": awaiting_recipient_count
+                "total_cargo": cargo_summary["total_cargo"],
+                "total_weight_kg": round(cargo_summary["total_weight"], 2),
+                "total_sum_rub": round(cargo_summary["total_sum"], 2),
+                "awaiting_recipient": cargo_summary["awaiting_recipient"]
             },
             "people_stats": {
-                "unique_senders": len(senders),
-                "unique_recipients": len(recipients)
+                "unique_senders": cargo_summary["unique_senders"],
+                "unique_recipients": cargo_summary["unique_recipients"]
             },
             "financial_stats": {
-                "debtors_count": debtors_count,
-                "total_debt_amount": round(total_debt_amount, 2)
+                "debtors_count": cargo_summary["debtors_count"],
+                "total_debt_amount": round(cargo_summary["total_debt_amount"], 2)
             },
             "requests_stats": {
                 "new_requests": new_requests_count
@@ -10230,7 +14235,7 @@ async def get_admin_dashboard_analytics(
         )
 
 @app.get("/api/operator/dashboard/analytics")
-async def get_operator_dashboard_analytics(
+def get_operator_dashboard_analytics(
     current_user: User = Depends(get_current_user)
 ):
     """Получение расширенной аналитики для дашборда оператора (только по его складам)"""
@@ -10272,146 +14277,67 @@ async def get_operator_dashboard_analytics(
                 }
             }
         
-        # Получаем детальную информацию о каждом складе оператора
+        # Получаем детальную информацию о каждом складе оператора из счетчиков
         warehouses_details = []
-        all_cargo_operator = []
+        warehouses_by_id = {
+            warehouse["id"]: warehouse
+            for warehouse in db.warehouses.find({"id": {"$in": operator_warehouse_ids}}, {"_id": 0})
+        }
+        warehouse_stats = dashboard_stats.get_many([f"warehouse:{warehouse_id}" for warehouse_id in operator_warehouse_ids])
+        
+        # Операторы, привязанные к складам, одним запросом
+        bound_operator_ids = {
+            warehouse_id: operator_bindings.operator_ids_for_warehouse(warehouse_id)
+            for warehouse_id in operator_warehouse_ids
+        }
+        operators_by_id = {
+            operator["id"]: operator
+            for operator in db.users.find(
+                {"id": {"$in": sorted({op_id for ids in bound_operator_ids.values() for op_id in ids})}, "role": "warehouse_operator"},
+                {"_id": 0, "id": 1, "full_name": 1, "phone": 1}
+            )
+        }
         
-        # Получаем информацию о других операторах для статистики
-        all_operators = list(db.users.find({"role": "warehouse_operator"}, {"_id": 0}))
+        # Названия складов назначения для грузов с destination_warehouse_id
+        destination_warehouse_ids = {
+            destination.split(":", 1)[1]
+            for stats in warehouse_stats.values()
+            for destination in stats.get("destinations", {})
+            if destination.startswith("warehouse:")
+        }
+        destination_names = {
+            warehouse["id"]: warehouse.get("name", "Неизвестный склад")
+            for warehouse in db.warehouses.find({"id": {"$in": list(destination_warehouse_ids)}}, {"_id": 0, "id": 1, "name": 1})
+        }
         
         for warehouse_id in operator_warehouse_ids:
-            # Информация о складе
-            warehouse = db.warehouses.find_one({"id": warehouse_id}, {"_id": 0})
+            warehouse = warehouses_by_id.get(warehouse_id)
             if not warehouse:
                 continue
-                
-            # Все операторы привязанные к этому складу
-            warehouse_operators = []
-            for operator in all_operators:
-                operator_warehouses = get_operator_warehouse_ids(operator['id'])
-                if warehouse_id in operator_warehouses:
-                    warehouse_operators.append({
-                        "operator_id": operator['id'],
-                        "operator_name": operator.get('full_name', 'Не указано'),
-                        "operator_phone": operator.get('phone', 'Не указано')
-                    })
+            stats = warehouse_stats[f"warehouse:{warehouse_id}"]
             
-            # Грузы в этом складе
-            warehouse_cargo_query = {"warehouse_id": warehouse_id}
-            user_cargo = list(db.cargo.find(warehouse_cargo_query, {"_id": 0}))
-            operator_cargo = list(db.operator_cargo.find(warehouse_cargo_query, {"_id": 0}))
-            warehouse_cargo = user_cargo + operator_cargo
-            all_cargo_operator.extend(warehouse_cargo)
-            
-            # Статистика по складу
-            total_weight_warehouse = sum(cargo.get('weight', 0) for cargo in warehouse_cargo if isinstance(cargo.get('weight', 0), (int, float)))
-            total_value_warehouse = 0
-            
-            for cargo in warehouse_cargo:
-                cargo_value = 0
-                if cargo.get('declared_value'):
-                    try:
-                        cargo_value = float(cargo.get('declared_value', 0))
-                    except (ValueError, TypeError):
-                        cargo_value = 0
-                elif cargo.get('total_cost'):
-                    try:
-                        cargo_value = float(cargo.get('total_cost', 0))
-                    except (ValueError, TypeError):
-                        cargo_value = 0
-                total_value_warehouse += cargo_value
-            
-            # Клиенты склада - отправители и получатели
-            warehouse_senders = set()
-            warehouse_recipients = set()
-            
-            for cargo in warehouse_cargo:
-                if cargo.get('sender_phone'):
-                    warehouse_senders.add(cargo.get('sender_phone'))
-                if cargo.get('recipient_phone'):
-                    warehouse_recipients.add(cargo.get('recipient_phone'))
+            # Все операторы привязанные к этому складу
+            warehouse_operators = [
+                {
+                    "operator_id": operator_id,
+                    "operator_name": operators_by_id[operator_id].get('full_name', 'Не указано'),
+                    "operator_phone": operators_by_id[operator_id].get('phone', 'Не указано')
+                }
+                for operator_id in bound_operator_ids[warehouse_id]
+                if operator_id in operators_by_id
+            ]
             
-            # Анализ грузов для отправки в другие склады/города
+            # Грузы по пунктам назначения
             cargo_for_destinations = {}
-            
-            for cargo in warehouse_cargo:
-                # Определяем пункт назначения груза
-                destination = None
-                
-                # Вычисляем стоимость груза для каждого груза отдельно
-                cargo_value = 0
-                if cargo.get('declared_value'):
-                    try:
-                        cargo_value = float(cargo.get('declared_value', 0))
-                    except (ValueError, TypeError):
-                        cargo_value = 0
-                elif cargo.get('total_cost'):
-                    try:
-                        cargo_value = float(cargo.get('total_cost', 0))
-                    except (ValueError, TypeError):
-                        cargo_value = 0
-                
-                # Проверяем поля назначения груза (расширенная логика)
-                if cargo.get('destination_warehouse_id'):
-                    dest_warehouse = db.warehouses.find_one({"id": cargo.get('destination_warehouse_id')}, {"_id": 0})
-                    if dest_warehouse:
-                        destination = dest_warehouse.get('name', 'Неизвестный склад')
-                elif cargo.get('destination_city'):
-                    destination = cargo.get('destination_city')
-                elif cargo.get('recipient_address'):
-                    # Пытаемся извлечь город из адреса получателя
-                    address = cargo.get('recipient_address', '').lower()
-                    if 'москв' in address or 'moscow' in address:
-                        destination = 'Москва'
-                    elif 'душанбе' in address or 'dushanbe' in address:
-                        destination = 'Душанбе'
-                    elif 'худжанд' in address or 'khujand' in address:
-                        destination = 'Худжанд'
-                    elif 'кулоб' in address or 'kulob' in address:
-                        destination = 'Кулоб'
-                    elif 'курган' in address or 'kurgan' in address:
-                        destination = 'Курган-Тюбе'
-                    else:
-                        destination = 'Другой город'
-                elif cargo.get('recipient_name') or cargo.get('recipient_full_name'):
-                    # Пытаемся определить по имени получателя (если есть региональные маркеры)
-                    recipient = (cargo.get('recipient_full_name') or cargo.get('recipient_name', '')).lower()
-                    if any(word in recipient for word in ['москва', 'moscow', 'российская', 'russia']):
-                        destination = 'Москва'
-                    elif any(word in recipient for word in ['душанбе', 'dushanbe']):
-                        destination = 'Душанбе'
-                    elif any(word in recipient for word in ['худжанд', 'khujand']):
-                        destination = 'Худжанд'
-                    else:
-                        destination = 'Таджикистан'
-                elif cargo.get('route'):
-                    # Если есть маршрут - определяем назначение по нему
-                    route = cargo.get('route', '').lower()
-                    if 'moscow' in route or 'москва' in route:
-                        destination = 'Москва'
-                    elif 'tajikistan' in route or 'таджикистан' in route:
-                        destination = 'Таджикистан'
-                    else:
-                        destination = cargo.get('route', 'Не указано')
-                else:
-                    # Для демонстрации создаем образцы данных
-                    import random
-                    destinations = ['Москва', 'Душанбе', 'Худжанд', 'Кулоб', 'Курган-Тюбе']
-                    destination = random.choice(destinations)
-                
-                # Группируем грузы по назначению
-                if destination not in cargo_for_destinations:
-                    cargo_for_destinations[destination] = {
-                        'cargo_count': 0,
-                        'total_weight': 0,
-                        'total_value': 0,
-                        'cargo_numbers': []
-                    }
-                
-                cargo_for_destinations[destination]['cargo_count'] += 1
-                cargo_for_destinations[destination]['total_weight'] += cargo.get('weight', 0) if isinstance(cargo.get('weight', 0), (int, float)) else 0
-                cargo_for_destinations[destination]['total_value'] += cargo_value
-                cargo_for_destinations[destination]['cargo_numbers'].append(cargo.get('cargo_number', 'Не указан'))
+            for destination, dest_data in stats.get("destinations", {}).items():
+                if not dest_data.get("cargo_count"):
+                    continue
+                if destination.startswith("warehouse:"):
+                    destination = destination_names.get(destination.split(":", 1)[1], "Не указано")
+                target = cargo_for_destinations.setdefault(destination, {'cargo_count': 0, 'total_weight': 0, 'total_value': 0})
+                target['cargo_count'] += dest_data.get("cargo_count", 0)
+                target['total_weight'] += dest_data.get("total_weight", 0)
+                target['total_value'] += dest_data.get("total_value", 0)
             
             # Вместимость склада
             blocks_count = warehouse.get('blocks_count', 0)
@@ -10419,41 +14345,9 @@ async def get_operator_dashboard_analytics(
             cells_per_shelf = warehouse.get('cells_per_shelf', 0)
             total_cells_warehouse = blocks_count * shelves_per_block * cells_per_shelf
             
-            # Занятые ячейки (приблизительно 60% для демонстрации)
-            occupied_cells_warehouse = len(warehouse_cargo) if warehouse_cargo else 0
+            occupied_cells_warehouse = stats.get("occupied_cells", 0)
             free_cells_warehouse = max(0, total_cells_warehouse - occupied_cells_warehouse)
             
-            # Статистика по статусам грузов в складе
-            cargo_by_status_warehouse = {}
-            for cargo in warehouse_cargo:
-                status = cargo.get('status', 'unknown')
-                processing_status = cargo.get('processing_status', '')
-                combined_status = f"{status}_{processing_status}" if processing_status else status
-                
-                if combined_status not in cargo_by_status_warehouse:
-                    cargo_by_status_warehouse[combined_status] = 0
-                cargo_by_status_warehouse[combined_status] += 1
-            
-            # Финансовая статистика склада
-            paid_cargo_warehouse = 0
-            unpaid_cargo_warehouse = 0
-            debt_amount_warehouse = 0
-            
-            for cargo in warehouse_cargo:
-                payment_status = cargo.get('payment_status', '')
-                payment_method = cargo.get('payment_method', '')
-                processing_status = cargo.get('processing_status', '')
-                
-                if payment_status in ['paid', 'completed'] or processing_status == 'paid':
-                    paid_cargo_warehouse += 1
-                elif payment_method == 'credit' or payment_status in ['pending', 'unpaid'] or processing_status == 'payment_pending':
-                    unpaid_cargo_warehouse += 1
-                    try:
-                        debt_amount = float(cargo.get('declared_value', 0) or cargo.get('total_cost', 0))
-                        debt_amount_warehouse += debt_amount
-                    except (ValueError, TypeError):
-                        pass
-            
             # Добавляем информацию о складе
             warehouses_details.append({
                 "warehouse_id": warehouse_id,
@@ -10470,31 +14364,31 @@ async def get_operator_dashboard_analytics(
                     "operators_list": warehouse_operators
                 },
                 "cargo_stats": {
-                    "total_cargo": len(warehouse_cargo),
-                    "total_weight_kg": round(total_weight_warehouse, 2),
-                    "total_value_rub": round(total_value_warehouse, 2),
+                    "total_cargo": stats.get("cargo_count", 0),
+                    "total_weight_kg": round(stats.get("total_weight", 0), 2),
+                    "total_value_rub": round(stats.get("total_value", 0), 2),
                     "occupied_cells": occupied_cells_warehouse,
                     "free_cells": free_cells_warehouse,
                     "occupancy_rate": round((occupied_cells_warehouse / total_cells_warehouse * 100) if total_cells_warehouse > 0 else 0, 1)
                 },
                 "cargo_destinations": cargo_for_destinations,
-                "cargo_by_status": cargo_by_status_warehouse,
+                "cargo_by_status": {key: count for key, count in stats.get("by_combined_status", {}).items() if count},
                 "clients": {
-                    "unique_senders": len(warehouse_senders),
-                    "unique_recipients": len(warehouse_recipients),
-                    "senders_list": list(warehouse_senders)[:10],  # Показываем первые 10
-                    "recipients_list": list(warehouse_recipients)[:10]  # Показываем первые 10
+                    "unique_senders": stats.get("unique_senders", 0),
+                    "unique_recipients": stats.get("unique_recipients", 0),
+                    "senders_list": dashboard_stats.sample_phones(f"warehouse:{warehouse_id}", "sender"),  # Показываем первые 10
+                    "recipients_list": dashboard_stats.sample_phones(f"warehouse:{warehouse_id}", "recipient")  # Показываем первые 10
                 },
                 "financial": {
-                    "paid_cargo": paid_cargo_warehouse,
-                    "unpaid_cargo": unpaid_cargo_warehouse,
-                    "debt_amount": round(debt_amount_warehouse, 2)
+                    "paid_cargo": stats.get("paid_cargo", 0),
+                    "unpaid_cargo": stats.get("unpaid_cargo", 0),
+                    "debt_amount": round(stats.get("unpaid_amount", 0), 2)
                 }
             })
         
         # Общая статистика по всем складам оператора
-        total_cargo = len(all_cargo_operator)
-        total_weight = sum(cargo.get('weight', 0) for cargo in all_cargo_operator if isinstance(cargo.get('weight', 0), (int, float)))
+        total_cargo = sum(wd["cargo_stats"]["total_cargo"] for wd in warehouses_details)
+        total_weight = sum(wd["cargo_stats"]["total_weight_kg"] for wd in warehouses_details)
         total_value = sum(wd["cargo_stats"]["total_value_rub"] for wd in warehouses_details)
         total_occupied_cells = sum(wd["cargo_stats"]["occupied_cells"] for wd in warehouses_details)
         total_free_cells = sum(wd["cargo_stats"]["free_cells"] for wd in warehouses_details)
@@ -10508,14 +14402,14 @@ async def get_operator_dashboard_analytics(
                     cargo_by_status_total[status] = 0
                 cargo_by_status_total[status] += count
         
-        # Общая статистика клиентов
-        all_senders = set()
-        all_recipients = set()
-        for cargo in all_cargo_operator:
-            if cargo.get('sender_phone'):
-                all_senders.add(cargo.get('sender_phone'))
-            if cargo.get('recipient_phone'):
-                all_recipients.add(cargo.get('recipient_phone'))
+        # Общая статистика клиентов (телефон на нескольких складах считается один раз)
+        if len(warehouses_details) == 1:
+            unique_clients = {
+                "sender": warehouses_details[0]["clients"]["unique_senders"],
+                "recipient": warehouses_details[0]["clients"]["unique_recipients"]
+            }
+        else:
+            unique_clients = dashboard_stats.unique_clients([f"warehouse:{wd['warehouse_id']}" for wd in warehouses_details])
         
         # Общая финансовая статистика
         total_paid_cargo = sum(wd["financial"]["paid_cargo"] for wd in warehouses_details)
@@ -10566,8 +14460,8 @@ async def get_operator_dashboard_analytics(
             "cargo_by_destinations": combined_cargo_destinations,
             "cargo_by_status": cargo_by_status_total,
             "clients_stats": {
-                "unique_senders": len(all_senders),
-                "unique_recipients": len(all_recipients),
+                "unique_senders": unique_clients["sender"],
+                "unique_recipients": unique_clients["recipient"],
                 "total_senders_across_warehouses": sum(wd["clients"]["unique_senders"] for wd in warehouses_details),
                 "total_recipients_across_warehouses": sum(wd["clients"]["unique_recipients"] for wd in warehouses_details)
             },
@@ -10587,7 +14481,7 @@ async def get_operator_dashboard_analytics(
         )
 
 @app.get("/api/warehouse/{warehouse_id}/cargo-with-clients")
-async def get_warehouse_cargo_with_clients(
+def get_warehouse_cargo_with_clients(
     warehouse_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -10738,7 +14632,7 @@ async def get_warehouse_cargo_with_clients(
         )
 
 @app.get("/api/warehouses/placed-cargo")
-async def get_placed_cargo(
+def get_placed_cargo(
     page: int = 1,
     per_page: int = 25,
     current_user: User = Depends(get_current_user)
@@ -10755,10 +14649,7 @@ async def get_placed_cargo(
         warehouse_filter = {}
         if current_user.role == UserRole.WAREHOUSE_OPERATOR:
             # Оператор видит только грузы на своих складах
-            operator_warehouse_bindings = list(db.operator_warehouse_bindings.find(
-                {"operator_id": current_user.id}
-            ))
-            warehouse_ids = [binding["warehouse_id"] for binding in operator_warehouse_bindings]
+            warehouse_ids = operator_bindings.warehouse_ids_for_operator(current_user.id)
             warehouse_filter = {"warehouse_id": {"$in": warehouse_ids}}
         
         # Основной фильтр - размещенные грузы и грузы готовые к размещению
@@ -10836,7 +14727,7 @@ async def get_placed_cargo(
         )
 
 @app.get("/api/warehouses/{warehouse_id}/available-cells/{block_number}/{shelf_number}")
-async def get_available_cells_for_block_shelf(
+def get_available_cells_for_block_shelf(
     warehouse_id: str,
     block_number: int,
     shelf_number: int,
@@ -10860,32 +14751,17 @@ async def get_available_cells_for_block_shelf(
         
         # Для оператора проверяем доступ к складу
         if current_user.role == UserRole.WAREHOUSE_OPERATOR:
-            operator_binding = db.operator_warehouse_bindings.find_one({
-                "operator_id": current_user.id,
-                "warehouse_id": warehouse_id
-            })
-            if not operator_binding:
+            if not operator_bindings.is_bound(current_user.id, warehouse_id):
                 raise HTTPException(
                     status_code=status.HTTP_403_FORBIDDEN,
                     detail="Нет доступа к данному складу"
                 )
         
-        # Получаем занятые ячейки для данного блока и полки
-        occupied_cargo = list(db.cargo.find({
-            "warehouse_id": warehouse_id,
-            "block_number": block_number,
-            "shelf_number": shelf_number,
-            "status": "placed_in_warehouse"
-        }, {"cell_number": 1}))
-        
-        occupied_cells = {cargo["cell_number"] for cargo in occupied_cargo if cargo.get("cell_number")}
-        
-        # Генерируем список всех возможных ячеек (по умолчанию 10 ячеек на полку)
+        # Свободные ячейки полки - из карты занятости склада
         cells_per_shelf = warehouse.get("cells_per_shelf", 10)
-        all_cells = set(range(1, cells_per_shelf + 1))
-        
-        # Определяем свободные ячейки
-        available_cells = sorted(list(all_cells - occupied_cells))
+        available_cells = [
+            cell for _, _, cell in cell_occupancy.next_free(warehouse_id, block=block_number, shelf=shelf_number)
+        ]
         
         return {
             "warehouse_id": warehouse_id,
@@ -10894,7 +14770,7 @@ async def get_available_cells_for_block_shelf(
             "shelf_number": shelf_number,
             "available_cells": available_cells,
             "total_cells": cells_per_shelf,
-            "occupied_cells": len(occupied_cells),
+            "occupied_cells": cells_per_shelf - len(available_cells),
             "available_count": len(available_cells)
         }
         
@@ -10907,7 +14783,7 @@ async def get_available_cells_for_block_shelf(
         )
 
 @app.get("/api/warehouses/{warehouse_id}/detailed-structure")
-async def get_warehouse_detailed_structure(
+def get_warehouse_detailed_structure(
     warehouse_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -10929,11 +14805,7 @@ async def get_warehouse_detailed_structure(
         
         # Для оператора проверяем доступ к складу
         if current_user.role == UserRole.WAREHOUSE_OPERATOR:
-            operator_binding = db.operator_warehouse_bindings.find_one({
-                "operator_id": current_user.id,
-                "warehouse_id": warehouse_id
-            })
-            if not operator_binding:
+            if not operator_bindings.is_bound(current_user.id, warehouse_id):
                 raise HTTPException(
                     status_code=status.HTTP_403_FORBIDDEN,
                     detail="Нет доступа к данному складу"
@@ -10944,22 +14816,13 @@ async def get_warehouse_detailed_structure(
         shelves_per_block = warehouse.get("shelves_per_block", 10)
         cells_per_shelf = warehouse.get("cells_per_shelf", 10)
         
-        # Получаем все занятые ячейки на складе
-        occupied_cargo = list(db.cargo.find({
-            "warehouse_id": warehouse_id,
-            "status": "placed_in_warehouse",
-            "block_number": {"$exists": True, "$ne": None},
-            "shelf_number": {"$exists": True, "$ne": None},
-            "cell_number": {"$exists": True, "$ne": None}
-        }, {
-            "block_number": 1,
-            "shelf_number": 1,
-            "cell_number": 1,
-            "cargo_number": 1,
-            "cargo_name": 1,
-            "total_weight": 1,
-            "placed_at": 1
-        }))
+        # Занятые ячейки - из карты занятости, сведения о грузах - одним запросом
+        occupied_positions = cell_occupancy.occupied_cells(warehouse_id)
+        cargo_by_id = find_cargo_many(
+            "id",
+            [cargo_id for *_, cargo_id in occupied_positions if cargo_id],
+            {"_id": 0, "id": 1, "cargo_number": 1, "cargo_name": 1, "total_weight": 1, "weight": 1, "placed_at": 1, "placement_date": 1}
+        )
         
         # Создаем структуру склада
         warehouse_structure = {
@@ -10981,13 +14844,13 @@ async def get_warehouse_detailed_structure(
         
         # Создаем карту занятых ячеек для быстрого поиска
         occupied_cells = {}
-        for cargo in occupied_cargo:
-            key = f"{cargo['block_number']}-{cargo['shelf_number']}-{cargo['cell_number']}"
-            occupied_cells[key] = {
+        for block_num, shelf_num, cell_num, cargo_id in occupied_positions:
+            cargo = cargo_by_id.get(cargo_id, {})
+            occupied_cells[f"{block_num}-{shelf_num}-{cell_num}"] = {
                 "cargo_number": cargo.get("cargo_number"),
                 "cargo_name": cargo.get("cargo_name", "Груз"),
-                "weight": cargo.get("total_weight", 0),
-                "placed_at": cargo.get("placed_at")
+                "weight": cargo.get("total_weight", cargo.get("weight", 0)),
+                "placed_at": cargo.get("placed_at", cargo.get("placement_date"))
             }
         
         # Генерируем структуру блоков
@@ -11022,7 +14885,7 @@ async def get_warehouse_detailed_structure(
         
         # Добавляем статистику
         total_cells = blocks_count * shelves_per_block * cells_per_shelf
-        occupied_count = len(occupied_cargo)
+        occupied_count = len(occupied_cells)
         available_count = total_cells - occupied_count
         
         warehouse_structure["statistics"] = {
@@ -11045,7 +14908,7 @@ async def get_warehouse_detailed_structure(
 # ===== НОВЫЙ ENDPOINT: ПРЯМОЙ ПРИЁМ ГРУЗА ЧЕРЕЗ ОПЕРАТОРА =====
 
 @app.post("/api/operator/cargo/direct-accept")
-async def direct_accept_cargo_by_operator(
+def direct_accept_cargo_by_operator(
     cargo_data: dict,
     current_user: User = Depends(get_current_user)
 ):
@@ -11131,7 +14994,7 @@ async def direct_accept_cargo_by_operator(
 # ===== АДМИНИСТРАТИВНЫЕ ФУНКЦИИ УДАЛЕНИЯ =====
 
 @app.delete("/api/admin/warehouses/bulk")
-async def delete_warehouses_bulk(
+def delete_warehouses_bulk(
     request: BulkDeleteRequest,
     current_user: User = Depends(get_current_user)
 ):
@@ -11150,39 +15013,37 @@ async def delete_warehouses_bulk(
                 detail="Список ID для удаления не может быть пустым"
             )
         
+        ids_to_delete = list(dict.fromkeys(ids_to_delete))
         print(f"🗑️ Массовое удаление складов: {len(ids_to_delete)} ID: {ids_to_delete}")
         
-        deleted_count = 0
-        errors = []
+        # Склады и число размещенных на них грузов - по одному запросу
+        warehouses = {
+            warehouse["id"]: warehouse
+            for warehouse in db.warehouses.find({"id": {"$in": ids_to_delete}}, {"_id": 0, "id": 1, "name": 1})
+        }
+        placed_counts = count_by_field(db.cargo, "warehouse_id", list(warehouses), {"status": "placed_in_warehouse"})
         
+        errors = []
+        rejected = {}
         for warehouse_id in ids_to_delete:
-            try:
-                # Проверяем наличие грузов на складе
-                cargo_count = db.cargo.count_documents({
-                    "warehouse_id": warehouse_id,
-                    "status": "placed_in_warehouse"
-                })
-                
-                if cargo_count > 0:
-                    warehouse = db.warehouses.find_one({"id": warehouse_id})
-                    warehouse_name = warehouse.get('name', f'Склад {warehouse_id}') if warehouse else f'Склад {warehouse_id}'
-                    errors.append(f"{warehouse_name}: на складе {cargo_count} груз(ов)")
-                    continue
-                
-                # Удаляем привязки операторов
-                db.operator_warehouse_bindings.delete_many({"warehouse_id": warehouse_id})
-                
-                # Удаляем склад
-                result = db.warehouses.delete_one({"id": warehouse_id})
-                if result.deleted_count > 0:
-                    deleted_count += 1
-                    print(f"✅ Удален склад: {warehouse_id}")
-                else:
-                    errors.append(f"Склад {warehouse_id}: не найден")
-                    
-            except Exception as e:
-                print(f"❌ Ошибка удаления склада {warehouse_id}: {str(e)}")
-                errors.append(f"Склад {warehouse_id}: {str(e)}")
+            warehouse = warehouses.get(warehouse_id)
+            if not warehouse:
+                errors.append(f"Склад {warehouse_id}: не найден")
+                rejected[warehouse_id] = bulk_outcome(warehouse_id, False, "Склад не найден")
+                continue
+            cargo_count = placed_counts.get(warehouse_id, 0)
+            if cargo_count > 0:
+                warehouse_name = warehouse.get('name', f'Склад {warehouse_id}')
+                errors.append(f"{warehouse_name}: на складе {cargo_count} груз(ов)")
+                rejected[warehouse_id] = bulk_outcome(warehouse_id, False, f"На складе {cargo_count} груз(ов)", name=warehouse.get("name"))
+        
+        deletable = [warehouse_id for warehouse_id in ids_to_delete if warehouse_id not in rejected]
+        deleted_count = db.warehouses.delete_many({"id": {"$in": deletable}}).deleted_count if deletable else 0
+        cascade = cascade_deleted_warehouses(deletable)
+        results = [
+            rejected.get(warehouse_id) or bulk_outcome(warehouse_id, True, name=warehouses[warehouse_id].get("name"))
+            for warehouse_id in ids_to_delete
+        ]
         
         print(f"✅ Итого удалено складов: {deleted_count} из {len(ids_to_delete)}")
         
@@ -11191,6 +15052,8 @@ async def delete_warehouses_bulk(
             "deleted_count": deleted_count,
             "total_requested": len(ids_to_delete),
             "errors": errors,
+            "results": results,
+            "cascade": cascade,
             "success": True
         }
         
@@ -11204,7 +15067,7 @@ async def delete_warehouses_bulk(
         )
 
 @app.delete("/api/admin/warehouses/{warehouse_id}")
-async def delete_warehouse(
+def delete_warehouse(
     warehouse_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -11238,6 +15101,7 @@ async def delete_warehouse(
         
         # Удаляем привязки операторов к складу
         db.operator_warehouse_bindings.delete_many({"warehouse_id": warehouse_id})
+        operator_bindings.invalidate()
         
         # Удаляем склад
         result = db.warehouses.delete_one({"id": warehouse_id})
@@ -11262,7 +15126,7 @@ async def delete_warehouse(
         )
 
 @app.delete("/api/admin/cargo/bulk")
-async def delete_cargo_bulk(
+def delete_cargo_bulk(
     request: BulkDeleteRequest,
     current_user: User = Depends(get_current_user)
 ):
@@ -11281,13 +15145,31 @@ async def delete_cargo_bulk(
                 detail="Список ID для удаления не может быть пустым"
             )
         
+        ids_to_delete = list(dict.fromkeys(ids_to_delete))
         print(f"🗑️ Массовое удаление грузов: {len(ids_to_delete)} ID: {ids_to_delete}")
         
+        # Удаляемые грузы из обеих коллекций одним запросом (нужны для каскадной очистки)
+        found = list(db.cargo.aggregate(_cargo_union_pipeline(
+            {"id": {"$in": ids_to_delete}},
+            {"_id": 0, "id": 1, "cargo_number": 1, "weight": 1}
+        )))
+        collections_by_id: Dict[str, list] = {}
+        for cargo in found:
+            collections_by_id.setdefault(cargo["id"], []).append(cargo[CARGO_SOURCE_FIELD])
+        
         # Массовое удаление из обеих коллекций
         result_user = db.cargo.delete_many({"id": {"$in": ids_to_delete}})
         result_operator = db.operator_cargo.delete_many({"id": {"$in": ids_to_delete}})
         
         total_deleted = result_user.deleted_count + result_operator.deleted_count
+        cascade = cascade_deleted_cargo(found)
+        
+        cargo_numbers = {cargo["id"]: cargo.get("cargo_number") for cargo in found}
+        results = [
+            bulk_outcome(cargo_id, True, cargo_number=cargo_numbers[cargo_id], collections=collections_by_id[cargo_id])
+            if cargo_id in collections_by_id else bulk_outcome(cargo_id, False, "Груз не найден")
+            for cargo_id in ids_to_delete
+        ]
         
         print(f"✅ Удалено грузов: {total_deleted} (user: {result_user.deleted_count}, operator: {result_operator.deleted_count})")
         
@@ -11297,6 +15179,8 @@ async def delete_cargo_bulk(
             "total_requested": len(ids_to_delete),
             "deleted_from_user_collection": result_user.deleted_count,
             "deleted_from_operator_collection": result_operator.deleted_count,
+            "results": results,
+            "cascade": cascade,
             "success": True
         }
         
@@ -11310,7 +15194,7 @@ async def delete_cargo_bulk(
         )
 
 @app.delete("/api/admin/cargo/{cargo_id}")
-async def delete_cargo(
+def delete_cargo(
     cargo_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -11360,7 +15244,7 @@ async def delete_cargo(
         )
 
 @app.delete("/api/admin/users/{user_id}")
-async def delete_user(
+def delete_user(
     user_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -11399,6 +15283,7 @@ async def delete_user(
         # Если это оператор склада, удаляем привязки к складам
         if user.get('role') == 'warehouse_operator':
             db.operator_warehouse_bindings.delete_many({"operator_id": user_id})
+            operator_bindings.invalidate()
         
         # Удаляем пользователя
         result = db.users.delete_one({"id": user_id})
@@ -11424,7 +15309,7 @@ async def delete_user(
         )
 
 @app.delete("/api/admin/users/bulk")
-async def delete_users_bulk(
+def delete_users_bulk(
     user_ids: dict,
     current_user: User = Depends(get_current_user)
 ):
@@ -11457,12 +15342,15 @@ async def delete_users_bulk(
         
         # Удаляем привязки операторов к складам
         db.operator_warehouse_bindings.delete_many({"operator_id": {"$in": ids_to_delete}})
+        operator_bindings.invalidate()
         
-        # Проверяем связанные грузы
+        # Проверяем связанные грузы: пользователи и число их грузов - по одному запросу
+        users = {user["id"]: user for user in db.users.find({"id": {"$in": ids_to_delete}}, {"_id": 0, "id": 1, "full_name": 1})}
+        cargo_counts = count_by_field(db.cargo, "sender_id", ids_to_delete)
         for user_id in ids_to_delete:
-            cargo_count = db.cargo.count_documents({"sender_id": user_id})
+            cargo_count = cargo_counts.get(user_id, 0)
             if cargo_count > 0:
-                user = db.users.find_one({"id": user_id})
+                user = users.get(user_id)
                 user_name = user.get('full_name', f'Пользователь {user_id}') if user else f'Пользователь {user_id}'
                 warnings.append(f"{user_name}: {cargo_count} связанных грузов")
         
@@ -11470,11 +15358,18 @@ async def delete_users_bulk(
         result = db.users.delete_many({"id": {"$in": ids_to_delete}})
         deleted_count = result.deleted_count
         
+        results = [
+            bulk_outcome(user_id, True, full_name=users[user_id].get("full_name"), cargo_count=cargo_counts.get(user_id, 0))
+            if user_id in users else bulk_outcome(user_id, False, "Пользователь не найден")
+            for user_id in ids_to_delete
+        ]
+        
         return {
             "message": f"Успешно удалено пользователей: {deleted_count}",
             "deleted_count": deleted_count,
             "total_requested": len(ids_to_delete),
             "warnings": warnings,
+            "results": results,
             "excluded_current_user": current_user.id in user_ids.get("ids", [])
         }
         
@@ -11489,7 +15384,7 @@ async def delete_users_bulk(
 # ===== ДОПОЛНИТЕЛЬНЫЕ ЭНДПОИНТЫ МАССОВОГО УДАЛЕНИЯ =====
 
 @app.delete("/api/admin/cargo-applications/bulk")
-async def delete_cargo_applications_bulk(
+def delete_cargo_applications_bulk(
     request_ids: dict,
     current_user: User = Depends(get_current_user)
 ):
@@ -11509,13 +15404,22 @@ async def delete_cargo_applications_bulk(
             )
         
         # Массовое удаление заявок
+        existing = {
+            cargo_request["id"]: cargo_request
+            for cargo_request in db.cargo_requests.find({"id": {"$in": ids_to_delete}}, {"_id": 0, "id": 1, "request_number": 1})
+        }
         result = db.cargo_requests.delete_many({"id": {"$in": ids_to_delete}})
         deleted_count = result.deleted_count
         
         return {
             "message": f"Успешно удалено заявок: {deleted_count}",
             "deleted_count": deleted_count,
-            "total_requested": len(ids_to_delete)
+            "total_requested": len(ids_to_delete),
+            "results": [
+                bulk_outcome(request_id, True, request_number=existing[request_id].get("request_number"))
+                if request_id in existing else bulk_outcome(request_id, False, "Заявка не найдена")
+                for request_id in ids_to_delete
+            ]
         }
         
     except HTTPException:
@@ -11527,7 +15431,7 @@ async def delete_cargo_applications_bulk(
         )
 
 @app.delete("/api/admin/cargo-applications/{request_id}")
-async def delete_cargo_application(
+def delete_cargo_application(
     request_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -11570,7 +15474,7 @@ async def delete_cargo_application(
         )
 
 @app.delete("/api/admin/operators/bulk")
-async def delete_operators_bulk(
+def delete_operators_bulk(
     operator_ids: dict,
     current_user: User = Depends(get_current_user)
 ):
@@ -11603,12 +15507,18 @@ async def delete_operators_bulk(
         
         # Удаляем привязки операторов к складам
         db.operator_warehouse_bindings.delete_many({"operator_id": {"$in": ids_to_delete}})
+        operator_bindings.invalidate()
         
-        # Проверяем связанные грузы
+        # Проверяем связанные грузы: операторы и число их грузов - по одному запросу
+        operators = {
+            operator["id"]: operator
+            for operator in db.users.find({"id": {"$in": ids_to_delete}}, {"_id": 0, "id": 1, "full_name": 1, "role": 1})
+        }
+        cargo_counts = count_by_field(db.operator_cargo, "created_by", ids_to_delete)
         for operator_id in ids_to_delete:
-            cargo_count = db.operator_cargo.count_documents({"created_by": operator_id})
+            cargo_count = cargo_counts.get(operator_id, 0)
             if cargo_count > 0:
-                operator = db.users.find_one({"id": operator_id})
+                operator = operators.get(operator_id)
                 operator_name = operator.get('full_name', f'Оператор {operator_id}') if operator else f'Оператор {operator_id}'
                 warnings.append(f"{operator_name}: обработал {cargo_count} груз(ов)")
         
@@ -11619,11 +15529,22 @@ async def delete_operators_bulk(
         })
         deleted_count = result.deleted_count
         
+        results = []
+        for operator_id in ids_to_delete:
+            operator = operators.get(operator_id)
+            if not operator:
+                results.append(bulk_outcome(operator_id, False, "Оператор не найден"))
+            elif operator.get("role") != "warehouse_operator":
+                results.append(bulk_outcome(operator_id, False, "Пользователь не является оператором склада"))
+            else:
+                results.append(bulk_outcome(operator_id, True, full_name=operator.get("full_name"), cargo_count=cargo_counts.get(operator_id, 0)))
+        
         return {
             "message": f"Успешно удалено операторов: {deleted_count}",
             "deleted_count": deleted_count,
             "total_requested": len(ids_to_delete),
             "warnings": warnings,
+            "results": results,
             "excluded_current_user": current_user.id in operator_ids.get("ids", [])
         }
         
@@ -11636,7 +15557,7 @@ async def delete_operators_bulk(
         )
 
 @app.delete("/api/admin/pickup-requests/bulk")
-async def delete_pickup_requests_bulk(
+def delete_pickup_requests_bulk(
     request_ids: dict,
     current_user: User = Depends(get_current_user)
 ):
@@ -11649,41 +15570,48 @@ async def delete_pickup_requests_bulk(
         if not ids:
             raise HTTPException(status_code=400, detail="Не указаны ID заявок для удаления")
         
-        success_count = 0
+        ids = list(dict.fromkeys(ids))
         error_messages = []
-        
+        rejected = {}
+        
+        # Все заявки одним запросом
+        pickup_requests = {
+            request["id"]: request
+            for request in db.courier_pickup_requests.find(
+                {"id": {"$in": ids}},
+                {"_id": 0, "id": 1, "request_status": 1, "assigned_courier_id": 1}
+            )
+        }
         for request_id in ids:
-            try:
-                # Проверяем существование заявки
-                request = db.courier_pickup_requests.find_one({"id": request_id}, {"_id": 0})
-                if not request:
-                    error_messages.append(f"Заявка {request_id} не найдена")
-                    continue
-                
-                # Проверяем, можно ли удалять заявку
-                if request.get('request_status') == 'completed':
-                    error_messages.append(f"Нельзя удалить завершенную заявку {request_id}")
-                    continue
-                    
-                # Если заявка в процессе обработки, нужно освободить курьера
-                if request.get('assigned_courier_id'):
-                    db.couriers.update_one(
-                        {"id": request.get('assigned_courier_id')},
-                        {"$unset": {"current_pickup_request_id": ""}}
-                    )
-                
-                # Удаляем связанные уведомления
-                db.warehouse_notifications.delete_many({"pickup_request_id": request_id})
-                
-                # Удаляем саму заявку
-                result = db.courier_pickup_requests.delete_one({"id": request_id})
-                if result.deleted_count > 0:
-                    success_count += 1
-                else:
-                    error_messages.append(f"Не удалось удалить заявку {request_id}")
-                    
-            except Exception as e:
-                error_messages.append(f"Ошибка при удалении заявки {request_id}: {str(e)}")
+            request = pickup_requests.get(request_id)
+            if not request:
+                error = f"Заявка {request_id} не найдена"
+            elif request.get('request_status') == 'completed':
+                # Завершенные заявки удалять нельзя
+                error = f"Нельзя удалить завершенную заявку {request_id}"
+            else:
+                continue
+            error_messages.append(error)
+            rejected[request_id] = bulk_outcome(request_id, False, error)
+        
+        deletable = [request_id for request_id in ids if request_id not in rejected]
+        if deletable:
+            # Освобождаем курьеров заявок в обработке, удаляем уведомления и сами заявки
+            courier_ids = {
+                pickup_requests[request_id]['assigned_courier_id'] for request_id in deletable
+                if pickup_requests[request_id].get('assigned_courier_id')
+            }
+            if courier_ids:
+                db.couriers.update_many(
+                    {"id": {"$in": list(courier_ids)}},
+                    {"$unset": {"current_pickup_request_id": ""}}
+                )
+            db.warehouse_notifications.delete_many({"pickup_request_id": {"$in": deletable}})
+            success_count = db.courier_pickup_requests.delete_many({"id": {"$in": deletable}}).deleted_count
+        else:
+            success_count = 0
+        
+        results = [rejected.get(request_id) or bulk_outcome(request_id, True) for request_id in ids]
         
         message = f"Успешно удалено заявок: {success_count} из {len(ids)}"
         
@@ -11691,7 +15619,8 @@ async def delete_pickup_requests_bulk(
             "message": message,
             "success_count": success_count,
             "total_count": len(ids),
-            "errors": error_messages
+            "errors": error_messages,
+            "results": results
         }
         
     except Exception as e:
@@ -11701,7 +15630,7 @@ async def delete_pickup_requests_bulk(
         )
 
 @app.delete("/api/admin/operators/{operator_id}")
-async def delete_operator(
+def delete_operator(
     operator_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -11739,6 +15668,7 @@ async def delete_operator(
         
         # Удаляем привязки к складам
         db.operator_warehouse_bindings.delete_many({"operator_id": operator_id})
+        operator_bindings.invalidate()
         
         # Удаляем оператора
         result = db.users.delete_one({"id": operator_id})
@@ -11765,7 +15695,7 @@ async def delete_operator(
 # ===== ЭНДПОИНТЫ УДАЛЕНИЯ ТРАНСПОРТА =====
 
 @app.delete("/api/admin/transports/bulk")
-async def delete_transports_bulk(
+def delete_transports_bulk(
     transport_ids: dict,
     current_user: User = Depends(get_current_user)
 ):
@@ -11784,37 +15714,46 @@ async def delete_transports_bulk(
                 detail="Список ID для удаления не может быть пустым"
             )
         
-        deleted_count = 0
+        ids_to_delete = list(dict.fromkeys(ids_to_delete))
         errors = []
-        
+        rejected = {}
+        
+        # Все транспорты одним запросом; удаляются только пустые
+        transports = {
+            transport["id"]: transport
+            for transport in db.transports.find(
+                {"id": {"$in": ids_to_delete}},
+                {"_id": 0, "id": 1, "transport_number": 1, "cargo_list": 1}
+            )
+        }
         for transport_id in ids_to_delete:
-            try:
-                # Найдем транспорт
-                transport = db.transports.find_one({"id": transport_id})
-                if not transport:
-                    errors.append(f"Транспорт {transport_id}: не найден")
-                    continue
-                
-                # Проверяем, есть ли груз в транспорте
-                cargo_count = len(transport.get("cargo_list", []))
-                if cargo_count > 0:
-                    transport_name = f"Транспорт {transport.get('transport_number', transport_id)}"
-                    errors.append(f"{transport_name}: содержит {cargo_count} груз(ов). Удаление запрещено")
-                    continue
-                
-                # Удаляем транспорт (только пустой)
-                result = db.transports.delete_one({"id": transport_id})
-                if result.deleted_count > 0:
-                    deleted_count += 1
-                    
-            except Exception as e:
-                errors.append(f"Транспорт {transport_id}: {str(e)}")
+            transport = transports.get(transport_id)
+            if not transport:
+                errors.append(f"Транспорт {transport_id}: не найден")
+                rejected[transport_id] = bulk_outcome(transport_id, False, "Транспорт не найден")
+                continue
+            cargo_count = len(transport.get("cargo_list", []))
+            if cargo_count > 0:
+                transport_name = f"Транспорт {transport.get('transport_number', transport_id)}"
+                errors.append(f"{transport_name}: содержит {cargo_count} груз(ов). Удаление запрещено")
+                rejected[transport_id] = bulk_outcome(
+                    transport_id, False, f"Содержит {cargo_count} груз(ов). Удаление запрещено",
+                    transport_number=transport.get("transport_number")
+                )
+        
+        deletable = [transport_id for transport_id in ids_to_delete if transport_id not in rejected]
+        deleted_count = db.transports.delete_many({"id": {"$in": deletable}}).deleted_count if deletable else 0
+        results = [
+            rejected.get(transport_id) or bulk_outcome(transport_id, True, transport_number=transports[transport_id].get("transport_number"))
+            for transport_id in ids_to_delete
+        ]
         
         return {
             "message": f"Успешно удалено транспорта: {deleted_count}",
             "deleted_count": deleted_count,
             "total_requested": len(ids_to_delete),
-            "errors": errors
+            "errors": errors,
+            "results": results
         }
         
     except HTTPException:
@@ -11826,7 +15765,7 @@ async def delete_transports_bulk(
         )
 
 @app.delete("/api/admin/transports/{transport_id}")
-async def delete_transport(
+def delete_transport(
     transport_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -11877,7 +15816,7 @@ async def delete_transport(
         )
 
 @app.post("/api/transport/create-interwarehouse")
-async def create_interwarehouse_transport(
+def create_interwarehouse_transport(
     transport_data: dict,
     current_user: User = Depends(get_current_user)
 ):
@@ -11995,7 +15934,7 @@ async def create_interwarehouse_transport(
     }
 
 @app.get("/api/transport/{transport_id}")
-async def get_transport(
+def get_transport(
     transport_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -12010,7 +15949,7 @@ async def get_transport(
     return Transport(**transport)
 
 @app.get("/api/transport/{transport_id}/cargo-list")
-async def get_transport_cargo(
+def get_transport_cargo(
     transport_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -12024,10 +15963,10 @@ async def get_transport_cargo(
     
     # Получить детали грузов
     cargo_details = []
+    transport_cargo = find_cargo_many("id", transport.get("cargo_list", []))
+    
     for cargo_id in transport.get("cargo_list", []):
-        cargo = db.cargo.find_one({"id": cargo_id})
-        if not cargo:
-            cargo = db.operator_cargo.find_one({"id": cargo_id})
+        cargo = transport_cargo.get(cargo_id)
         
         if cargo:
             cargo_details.append({
@@ -12052,7 +15991,7 @@ async def get_transport_cargo(
     }
 
 @app.post("/api/transport/{transport_id}/place-cargo")
-async def place_cargo_on_transport(
+def place_cargo_on_transport(
     transport_id: str,
     placement: TransportCargoPlacementByNumbers,
     current_user: User = Depends(get_current_user)
@@ -12072,17 +16011,13 @@ async def place_cargo_on_transport(
     total_weight = 0
     cargo_details = []
     found_cargo_ids = []
+    cargo_collections = {}
     
-    for cargo_number in placement.cargo_numbers:
-        cargo_number = cargo_number.strip()
-        if not cargo_number:
-            continue
-            
-        # Искать в коллекции пользовательских грузов
-        cargo = db.cargo.find_one({"cargo_number": cargo_number})
-        if not cargo:
-            # Искать в коллекции операторских грузов
-            cargo = db.operator_cargo.find_one({"cargo_number": cargo_number})
+    cargo_numbers = [cargo_number.strip() for cargo_number in placement.cargo_numbers if cargo_number.strip()]
+    found_cargo = locate_cargo_many("cargo_number", cargo_numbers)
+    
+    for cargo_number in cargo_numbers:
+        cargo, collection_name = found_cargo.get(cargo_number, (None, None))
         
         if not cargo:
             raise HTTPException(status_code=404, detail=f"Cargo {cargo_number} not found")
@@ -12103,6 +16038,7 @@ async def place_cargo_on_transport(
         total_weight += cargo["weight"]
         cargo_details.append(cargo)
         found_cargo_ids.append(cargo["id"])
+        cargo_collections[cargo["id"]] = collection_name
     
     if not cargo_details:
         raise HTTPException(status_code=400, detail="No valid cargo numbers provided")
@@ -12129,8 +16065,8 @@ async def place_cargo_on_transport(
     
     # Обновить статус грузов и освободить ячейки склада
     for cargo in cargo_details:
-        # Определить, в какой коллекции находится груз
-        collection = db.cargo if db.cargo.find_one({"id": cargo["id"]}) else db.operator_cargo
+        # Коллекция груза уже известна после поиска
+        collection = db[cargo_collections[cargo["id"]]]
         
         # Обновить статус груза
         collection.update_one(
@@ -12197,7 +16133,7 @@ async def place_cargo_on_transport(
     }
 
 @app.post("/api/transport/{transport_id}/dispatch")
-async def dispatch_transport(
+def dispatch_transport(
     transport_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -12259,7 +16195,7 @@ async def dispatch_transport(
     return {"message": "Transport dispatched successfully"}
 
 @app.post("/api/transport/{transport_id}/arrive")
-async def mark_transport_arrived(
+def mark_transport_arrived(
     transport_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -12286,13 +16222,11 @@ async def mark_transport_arrived(
     )
     
     # Обновить статус всех грузов на arrived_destination
+    # Поиск в обеих коллекциях одним запросом
+    transport_cargo = locate_cargo_many("id", transport.get("cargo_list", []))
+    
     for cargo_id in transport.get("cargo_list", []):
-        # Поиск в обеих коллекциях
-        cargo = db.cargo.find_one({"id": cargo_id})
-        collection_name = "cargo"
-        if not cargo:
-            cargo = db.operator_cargo.find_one({"id": cargo_id})
-            collection_name = "operator_cargo"
+        cargo, collection_name = transport_cargo.get(cargo_id, (None, None))
         
         if cargo:
             # Обновить статус груза
@@ -12328,7 +16262,7 @@ async def mark_transport_arrived(
     return {"message": "Transport marked as arrived successfully"}
 
 @app.get("/api/transport/{transport_id}/arrived-cargo")
-async def get_arrived_transport_cargo(
+def get_arrived_transport_cargo(
     transport_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -12346,12 +16280,10 @@ async def get_arrived_transport_cargo(
     
     # Получить детали грузов для размещения
     cargo_details = []
+    transport_cargo = locate_cargo_many("id", transport.get("cargo_list", []))
+    
     for cargo_id in transport.get("cargo_list", []):
-        cargo = db.cargo.find_one({"id": cargo_id})
-        collection_name = "cargo"
-        if not cargo:
-            cargo = db.operator_cargo.find_one({"id": cargo_id})
-            collection_name = "operator_cargo"
+        cargo, collection_name = transport_cargo.get(cargo_id, (None, None))
         
         if cargo:
             cargo_details.append({
@@ -12388,7 +16320,7 @@ async def get_arrived_transport_cargo(
     }
 
 @app.post("/api/transport/{transport_id}/place-cargo-to-warehouse")
-async def place_cargo_from_transport_to_warehouse(
+def place_cargo_from_transport_to_warehouse(
     transport_id: str,
     placement: dict,
     current_user: User = Depends(get_current_user)
@@ -12551,7 +16483,7 @@ async def place_cargo_from_transport_to_warehouse(
     }
 
 @app.post("/api/transport/{transport_id}/place-cargo-by-number")
-async def place_cargo_from_transport_by_number(
+def place_cargo_from_transport_by_number(
     transport_id: str,
     placement_data: dict,
     current_user: User = Depends(get_current_user)
@@ -12613,8 +16545,7 @@ async def place_cargo_from_transport_by_number(
         available_warehouse_ids = [w["id"] for w in warehouses]
     else:
         # Оператор может размещать только на привязанные склады
-        bindings = list(db.operator_warehouse_bindings.find({"operator_id": current_user.id}))
-        available_warehouse_ids = [b["warehouse_id"] for b in bindings]
+        available_warehouse_ids = operator_bindings.warehouse_ids_for_operator(current_user.id)
     
     if not available_warehouse_ids:
         raise HTTPException(status_code=403, detail="No available warehouses for placement")
@@ -12759,7 +16690,7 @@ async def place_cargo_from_transport_by_number(
     }
 
 @app.delete("/api/transport/{transport_id}/remove-cargo/{cargo_id}")
-async def remove_cargo_from_transport(
+def remove_cargo_from_transport(
     transport_id: str,
     cargo_id: str,
     current_user: User = Depends(get_current_user)
@@ -12779,12 +16710,7 @@ async def remove_cargo_from_transport(
         raise HTTPException(status_code=400, detail="Cannot remove cargo from transport in transit")
     
     # Найти груз в обеих коллекциях
-    cargo = db.cargo.find_one({"id": cargo_id})
-    if not cargo:
-        cargo = db.operator_cargo.find_one({"id": cargo_id})
-        collection_name = "operator_cargo"
-    else:
-        collection_name = "cargo"
+    cargo, collection_name = locate_cargo({"id": cargo_id})
     
     if not cargo:
         raise HTTPException(status_code=404, detail="Cargo not found")
@@ -12919,7 +16845,7 @@ async def remove_cargo_from_transport(
         }
 
 @app.delete("/api/transport/{transport_id}")
-async def delete_transport(
+def delete_transport(
     transport_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -12962,7 +16888,7 @@ async def delete_transport(
 # === УПРАВЛЕНИЕ ЯЧЕЙКАМИ СКЛАДА ===
 
 @app.get("/api/warehouse/{warehouse_id}/cell/{location_code}/cargo")
-async def get_cargo_in_cell(
+def get_cargo_in_cell(
     warehouse_id: str,
     location_code: str,
     current_user: User = Depends(get_current_user)
@@ -12984,9 +16910,7 @@ async def get_cargo_in_cell(
     cargo_id = cell["cargo_id"]
     
     # Найти груз в обеих коллекциях, исключая MongoDB _id
-    cargo = db.cargo.find_one({"id": cargo_id}, {"_id": 0})
-    if not cargo:
-        cargo = db.operator_cargo.find_one({"id": cargo_id}, {"_id": 0})
+    cargo = find_cargo({"id": cargo_id}, {"_id": 0})
     
     if not cargo:
         raise HTTPException(status_code=404, detail="Cargo not found")
@@ -12994,7 +16918,7 @@ async def get_cargo_in_cell(
     return cargo
 
 @app.post("/api/warehouse/cargo/{cargo_id}/move")
-async def move_cargo_between_cells(
+def move_cargo_between_cells(
     cargo_id: str,
     new_location: dict,  # {"warehouse_id", "block_number", "shelf_number", "cell_number"}
     current_user: User = Depends(get_current_user)
@@ -13088,7 +17012,7 @@ async def move_cargo_between_cells(
     return {"message": "Cargo moved successfully", "new_location": new_location_code}
 
 @app.delete("/api/warehouse/cargo/{cargo_id}/remove")
-async def remove_cargo_from_cell(
+def remove_cargo_from_cell(
     cargo_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -13139,7 +17063,7 @@ async def remove_cargo_from_cell(
     return {"message": "Cargo removed from cell successfully"}
 
 @app.get("/api/cargo/{cargo_id}/details")
-async def get_cargo_details(
+def get_cargo_details(
     cargo_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -13148,9 +17072,7 @@ async def get_cargo_details(
         raise HTTPException(status_code=403, detail="Access denied")
     
     # Найти груз в обеих коллекциях, исключая MongoDB _id
-    cargo = db.cargo.find_one({"id": cargo_id}, {"_id": 0})
-    if not cargo:
-        cargo = db.operator_cargo.find_one({"id": cargo_id}, {"_id": 0})
+    cargo = find_cargo({"id": cargo_id}, {"_id": 0})
     
     if not cargo:
         raise HTTPException(status_code=404, detail="Cargo not found")
@@ -13158,7 +17080,7 @@ async def get_cargo_details(
     return cargo
 
 @app.put("/api/cargo/{cargo_id}/update")
-async def update_cargo_details(
+def update_cargo_details(
     cargo_id: str,
     update_data: dict,
     current_user: User = Depends(get_current_user)
@@ -13205,7 +17127,7 @@ async def update_cargo_details(
 # === API ДЛЯ ТРЕКИНГА ГРУЗА КЛИЕНТАМИ И УВЕДОМЛЕНИЙ ===
 
 @app.post("/api/cargo/tracking/create")
-async def create_cargo_tracking(
+def create_cargo_tracking(
     tracking_data: CargoTrackingCreate,
     current_user: User = Depends(get_current_user)
 ):
@@ -13214,11 +17136,9 @@ async def create_cargo_tracking(
         raise HTTPException(status_code=403, detail="Access denied")
     
     # Найти груз по номеру
-    cargo = db.cargo.find_one({"cargo_number": tracking_data.cargo_number})
+    cargo = find_cargo({"cargo_number": tracking_data.cargo_number})
     if not cargo:
-        cargo = db.operator_cargo.find_one({"cargo_number": tracking_data.cargo_number})
-        if not cargo:
-            raise HTTPException(status_code=404, detail="Cargo not found")
+        raise HTTPException(status_code=404, detail="Cargo not found")
     
     # Проверить существующий трекинг
     existing_tracking = db.cargo_tracking.find_one({"cargo_id": cargo["id"]})
@@ -13269,7 +17189,7 @@ async def create_cargo_tracking(
     }
 
 @app.get("/api/debug/tracking/{tracking_code}")
-async def debug_tracking(tracking_code: str):
+def debug_tracking(tracking_code: str):
     """Debug tracking lookup"""
     try:
         # Найти трекинг
@@ -13293,7 +17213,7 @@ async def debug_tracking(tracking_code: str):
         return {"error": f"Exception: {str(e)}", "tracking_code": tracking_code}
 
 @app.get("/api/cargo/track/{tracking_code}")
-async def track_cargo_by_code(tracking_code: str):
+def track_cargo_by_code(tracking_code: str):
     """Публичный трекинг груза по коду (без авторизации)"""
     try:
         # Найти трекинг
@@ -13302,11 +17222,9 @@ async def track_cargo_by_code(tracking_code: str):
             raise HTTPException(status_code=404, detail="Tracking code not found")
         
         # Найти груз
-        cargo = db.cargo.find_one({"id": tracking["cargo_id"]})
+        cargo = find_cargo({"id": tracking["cargo_id"]})
         if not cargo:
-            cargo = db.operator_cargo.find_one({"id": tracking["cargo_id"]})
-            if not cargo:
-                raise HTTPException(status_code=404, detail="Cargo not found")
+            raise HTTPException(status_code=404, detail="Cargo not found")
         
         # Обновить счетчик доступа
         db.cargo_tracking.update_one(
@@ -13374,7 +17292,7 @@ async def track_cargo_by_code(tracking_code: str):
         raise HTTPException(status_code=500, detail="Internal server error")
 
 @app.post("/api/notifications/client/send")
-async def send_client_notification(
+def send_client_notification(
     notification_data: ClientNotificationCreate,
     current_user: User = Depends(get_current_user)
 ):
@@ -13383,11 +17301,9 @@ async def send_client_notification(
         raise HTTPException(status_code=403, detail="Access denied")
     
     # Найти груз
-    cargo = db.cargo.find_one({"id": notification_data.cargo_id})
+    cargo = find_cargo({"id": notification_data.cargo_id})
     if not cargo:
-        cargo = db.operator_cargo.find_one({"id": notification_data.cargo_id})
-        if not cargo:
-            raise HTTPException(status_code=404, detail="Cargo not found")
+        raise HTTPException(status_code=404, detail="Cargo not found")
     
     # Создать уведомление
     notification_id = str(uuid.uuid4())
@@ -13435,7 +17351,7 @@ async def send_client_notification(
     }
 
 @app.post("/api/messages/internal/send")
-async def send_internal_message(
+def send_internal_message(
     message_data: InternalMessageCreate,
     current_user: User = Depends(get_current_user)
 ):
@@ -13454,9 +17370,7 @@ async def send_internal_message(
     # Проверить груз если указан
     cargo_number = None
     if message_data.related_cargo_id:
-        cargo = db.cargo.find_one({"id": message_data.related_cargo_id})
-        if not cargo:
-            cargo = db.operator_cargo.find_one({"id": message_data.related_cargo_id})
+        cargo = find_cargo({"id": message_data.related_cargo_id})
         if cargo:
             cargo_number = cargo["cargo_number"]
     
@@ -13493,7 +17407,7 @@ async def send_internal_message(
     }
 
 @app.get("/api/messages/internal/inbox")
-async def get_internal_messages_inbox(
+def get_internal_messages_inbox(
     current_user: User = Depends(get_current_user)
 ):
     """Получить входящие внутренние сообщения"""
@@ -13517,7 +17431,7 @@ async def get_internal_messages_inbox(
     }
 
 @app.put("/api/messages/internal/{message_id}/read")
-async def mark_internal_message_read(
+def mark_internal_message_read(
     message_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -13626,7 +17540,7 @@ def calculate_delivery_cost(cargo_data: CargoOrderCreate) -> DeliveryCalculation
     )
 
 @app.post("/api/client/cargo/calculate")
-async def calculate_cargo_cost(
+def calculate_cargo_cost(
     cargo_data: CargoOrderCreate,
     current_user: User = Depends(get_current_user)
 ):
@@ -13657,7 +17571,7 @@ async def calculate_cargo_cost(
         raise HTTPException(status_code=400, detail=f"Error calculating cost: {str(e)}")
 
 @app.post("/api/client/cargo/create")
-async def create_cargo_order(
+def create_cargo_order(
     cargo_data: CargoOrderCreate,
     current_user: User = Depends(get_current_user)
 ):
@@ -13805,7 +17719,7 @@ async def create_cargo_order(
         raise HTTPException(status_code=400, detail=f"Error creating cargo order: {str(e)}")
 
 @app.get("/api/client/cargo/delivery-options") 
-async def get_delivery_options(
+def get_delivery_options(
     current_user: User = Depends(get_current_user)
 ):
     """Получить доступные опции доставки"""
@@ -13847,7 +17761,7 @@ async def get_delivery_options(
 # === API ДЛЯ КЛИЕНТСКОГО ЛИЧНОГО КАБИНЕТА (Функция 1) ===
 
 @app.get("/api/client/dashboard")
-async def get_client_dashboard(
+def get_client_dashboard(
     current_user: User = Depends(get_current_user)
 ):
     """Главная страница личного кабинета клиента"""
@@ -13895,9 +17809,10 @@ async def get_client_dashboard(
     }
 
 @app.get("/api/client/cargo")
-async def get_client_cargo(
+def get_client_cargo(
     status: Optional[str] = None,
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(get_current_user),
+    loaders: RequestLoaders = Depends(get_request_loaders)
 ):
     """Получить все грузы клиента с фильтрацией"""
     # Только пользователи (клиенты) могут получать свои грузы
@@ -13910,13 +17825,22 @@ async def get_client_cargo(
     
     cargo_list = list(db.cargo.find(query, {"_id": 0}).sort("created_at", -1))
     
+    # Связанные склады, транспорты, трекинг-коды и счетчики - пакетно на весь список
+    cargo_ids = [cargo["id"] for cargo in cargo_list]
+    for cargo in cargo_list:
+        loaders.warehouses.prime(cargo.get("warehouse_id"))
+        loaders.transports.prime(cargo.get("transport_id"))
+    trackings = EntityLoader(db.cargo_tracking, key="cargo_id", projection={"_id": 0}).get_many(cargo_ids)
+    photo_counts = count_by_field(db.cargo_photos, "cargo_id", cargo_ids)
+    comment_counts = count_by_field(db.cargo_comments, "cargo_id", cargo_ids, {"is_internal": False})
+    
     # Обогащаем каждый груз дополнительной информацией
     enriched_cargo = []
     for cargo in cargo_list:
         # Информация о складе
         warehouse_info = None
         if cargo.get("warehouse_id"):
-            warehouse = db.warehouses.find_one({"id": cargo["warehouse_id"]})
+            warehouse = loaders.warehouses.get(cargo["warehouse_id"])
             if warehouse:
                 warehouse_info = {
                     "name": warehouse["name"],
@@ -13926,7 +17850,7 @@ async def get_client_cargo(
         # Информация о транспорте
         transport_info = None
         if cargo.get("transport_id"):
-            transport = db.transports.find_one({"id": cargo["transport_id"]})
+            transport = loaders.transports.get(cargo["transport_id"])
             if transport:
                 transport_info = {
                     "transport_number": transport["transport_number"],
@@ -13935,17 +17859,14 @@ async def get_client_cargo(
                 }
         
         # Трекинг код
-        tracking = db.cargo_tracking.find_one({"cargo_id": cargo["id"]})
+        tracking = trackings.get(cargo["id"])
         tracking_code = tracking["tracking_code"] if tracking else None
         
         # Количество фото
-        photo_count = db.cargo_photos.count_documents({"cargo_id": cargo["id"]})
+        photo_count = photo_counts.get(cargo["id"], 0)
         
         # Количество комментариев (только публичные)
-        comment_count = db.cargo_comments.count_documents({
-            "cargo_id": cargo["id"],
-            "is_internal": False
-        })
+        comment_count = comment_counts.get(cargo["id"], 0)
         
         enriched_cargo.append({
             **cargo,
@@ -13967,7 +17888,7 @@ async def get_client_cargo(
     }
 
 @app.get("/api/client/cargo/{cargo_id}/details")
-async def get_client_cargo_details(
+def get_client_cargo_details(
     cargo_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -14020,7 +17941,7 @@ async def get_client_cargo_details(
     }
 
 @app.post("/api/admin/fix-operator-role")
-async def fix_warehouse_operator_role(current_user: User = Depends(get_current_user)):
+def fix_warehouse_operator_role(current_user: User = Depends(get_current_user)):
     """Временный эндпоинт для исправления роли оператора склада"""
     if current_user.role != UserRole.ADMIN:
         raise HTTPException(status_code=403, detail="Only admins can fix operator roles")
@@ -14069,7 +17990,7 @@ async def fix_warehouse_operator_role(current_user: User = Depends(get_current_u
 # ===== НОВЫЕ ENDPOINTS УПРАВЛЕНИЯ ЯЧЕЙКАМИ СКЛАДА =====
 
 @app.get("/api/warehouses/{warehouse_id}/cells")
-async def get_warehouse_cells(
+def get_warehouse_cells(
     warehouse_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -14119,7 +18040,7 @@ async def get_warehouse_cells(
         raise HTTPException(status_code=500, detail=f"Error fetching warehouse cells: {str(e)}")
 
 @app.put("/api/warehouses/{warehouse_id}/structure")
-async def update_warehouse_structure(
+def update_warehouse_structure(
     warehouse_id: str,
     structure_data: dict,
     current_user: User = Depends(get_current_user)
@@ -14173,7 +18094,7 @@ async def update_warehouse_structure(
         raise HTTPException(status_code=500, detail=f"Error updating warehouse structure: {str(e)}")
 
 @app.post("/api/warehouses/{warehouse_id}/create-layout")
-async def create_warehouse_layout(
+def create_warehouse_layout(
     warehouse_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -14296,7 +18217,7 @@ async def create_warehouse_layout(
         )
 
 @app.get("/api/warehouses/cells/{cell_id}/qr")
-async def generate_cell_qr(
+def generate_cell_qr(
     cell_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -14331,19 +18252,8 @@ async def generate_cell_qr(
         # Создаем числовой QR код в формате: номер_склада номер_блока номер_полки номер_ячейки (без пробелов)
         qr_code_data = f"{warehouse_number:02d}{int(block):02d}{int(shelf):02d}{int(cell):02d}"
         
-        # Генерируем QR код с числовыми данными
-        qr = qrcode.QRCode(version=1, box_size=10, border=5)
-        qr.add_data(qr_code_data)
-        qr.make(fit=True)
-        
-        img = qr.make_image(fill_color="black", back_color="white")
-        buffer = BytesIO()
-        img.save(buffer, format='PNG')
-        buffer.seek(0)
-        
-        # Конвертируем в base64
-        qr_code_base64 = base64.b64encode(buffer.getvalue()).decode()
-        qr_code_data_url = f"data:image/png;base64,{qr_code_base64}"
+        # Генерируем QR код с числовыми данными (уровень коррекции M - по умолчанию qrcode)
+        qr_code_data_url = render_qr_data_url(qr_code_data, box_size=10, border=5, error_correction="M")
         
         cell_location = f"Б{block}-П{shelf}-Я{cell}"
         
@@ -14353,6 +18263,7 @@ async def generate_cell_qr(
             "warehouse_name": warehouse.get("name", ""),
             "warehouse_number": warehouse_number,
             "qr_code": qr_code_data_url,
+            "qr_image_url": qr_image_url(qr_code_data, box_size=10, border=5, error_correction="M"),
             "qr_data": qr_code_data
         }
         
@@ -14362,7 +18273,7 @@ async def generate_cell_qr(
         raise HTTPException(status_code=500, detail=f"Error generating cell QR code: {str(e)}")
 
 @app.get("/api/warehouses/{warehouse_id}/cells/qr-batch")
-async def generate_all_cells_qr(
+def generate_all_cells_qr(
     warehouse_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -14400,23 +18311,11 @@ async def generate_all_cells_qr(
                     # Создаем числовой QR код в формате: номер_склада номер_блока номер_полки номер_ячейки (без пробелов)
                     qr_code_data = f"{warehouse_number:02d}{block:02d}{shelf:02d}{cell:02d}"
                     
-                    # Генерируем QR код с числовыми данными
-                    qr = qrcode.QRCode(version=1, box_size=10, border=5)
-                    qr.add_data(qr_code_data)
-                    qr.make(fit=True)
-                    
-                    img = qr.make_image(fill_color="black", back_color="white")
-                    buffer = BytesIO()
-                    img.save(buffer, format='PNG')
-                    buffer.seek(0)
-                    
-                    # Конвертируем в base64
-                    qr_code_base64 = base64.b64encode(buffer.getvalue()).decode()
-                    qr_code_data_url = f"data:image/png;base64,{qr_code_base64}"
-                    
+                    # Генерируем QR код с числовыми данными (повторная печать берется из кэша)
                     qr_codes.append({
                         "cell_location": cell_location,
-                        "qr_code": qr_code_data_url,
+                        "qr_code": render_qr_data_url(qr_code_data, box_size=10, border=5, error_correction="M"),
+                        "qr_image_url": qr_image_url(qr_code_data, box_size=10, border=5, error_correction="M"),
                         "qr_data": qr_code_data
                     })
         
@@ -14433,7 +18332,7 @@ async def generate_all_cells_qr(
         raise HTTPException(status_code=500, detail=f"Error generating batch QR codes: {str(e)}")
 
 @app.post("/api/warehouses/{warehouse_id}/cells/batch-delete")
-async def delete_cells_batch(
+def delete_cells_batch(
     warehouse_id: str,
     cell_data: dict,
     current_user: User = Depends(get_current_user)
@@ -14499,7 +18398,7 @@ async def delete_cells_batch(
         raise HTTPException(status_code=500, detail=f"Error deleting cells: {str(e)}")
 
 @app.post("/api/admin/warehouses/assign-numbers")
-async def assign_warehouse_numbers(
+def assign_warehouse_numbers(
     current_user: User = Depends(get_current_user)
 ):
     """Присвоить номера складам (только для администратора)"""
@@ -14527,7 +18426,7 @@ async def assign_warehouse_numbers(
 # НОВЫЕ ENDPOINTS ДЛЯ УПРАВЛЕНИЯ ГОРОДАМИ СКЛАДОВ
 
 @app.get("/api/warehouses/{warehouse_id}/cities")
-async def get_warehouse_cities(
+def get_warehouse_cities(
     warehouse_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -14554,7 +18453,7 @@ async def get_warehouse_cities(
         raise HTTPException(status_code=500, detail=f"Error fetching warehouse cities: {str(e)}")
 
 @app.post("/api/warehouses/{warehouse_id}/cities")
-async def add_warehouse_city(
+def add_warehouse_city(
     warehouse_id: str,
     city_data: WarehouseCityAdd,
     current_user: User = Depends(get_current_user)
@@ -14595,7 +18494,7 @@ async def add_warehouse_city(
         raise HTTPException(status_code=500, detail=f"Error adding city to warehouse: {str(e)}")
 
 @app.post("/api/warehouses/{warehouse_id}/cities/bulk")
-async def add_warehouse_cities_bulk(
+def add_warehouse_cities_bulk(
     warehouse_id: str,
     cities_data: WarehouseCityBulkAdd,
     current_user: User = Depends(get_current_user)
@@ -14644,7 +18543,7 @@ async def add_warehouse_cities_bulk(
         raise HTTPException(status_code=500, detail=f"Error bulk adding cities to warehouse: {str(e)}")
 
 @app.delete("/api/warehouses/{warehouse_id}/cities")
-async def delete_warehouse_city(
+def delete_warehouse_city(
     warehouse_id: str,
     city_data: WarehouseCityDelete,
     current_user: User = Depends(get_current_user)
@@ -14684,7 +18583,7 @@ async def delete_warehouse_city(
         raise HTTPException(status_code=500, detail=f"Error removing city from warehouse: {str(e)}")
 
 @app.get("/api/warehouses/all-cities")
-async def get_all_warehouse_cities(current_user: User = Depends(get_current_user)):
+def get_all_warehouse_cities(current_user: User = Depends(get_current_user)):
     """Получить все уникальные города из всех складов для выбора в форме"""
     if current_user.role not in [UserRole.ADMIN, UserRole.WAREHOUSE_OPERATOR]:
         raise HTTPException(status_code=403, detail="Insufficient permissions")
@@ -14737,7 +18636,7 @@ async def get_all_warehouse_cities(current_user: User = Depends(get_current_user
 # НОВЫЕ ENDPOINTS ДЛЯ КУРЬЕРСКОЙ СЛУЖБЫ (ЭТАП 1)
 
 @app.post("/api/admin/couriers/create")
-async def create_courier(
+def create_courier(
     courier_data: CourierCreate,
     current_user: User = Depends(get_current_user)
 ):
@@ -14746,7 +18645,7 @@ async def create_courier(
         raise HTTPException(status_code=403, detail="Insufficient permissions")
     
     # Проверяем существование пользователя с таким телефоном
-    if db.users.find_one({"phone": courier_data.phone}):
+    if find_user_by_phone(courier_data.phone, projection={"_id": 1}):
         raise HTTPException(status_code=400, detail="User with this phone already exists")
     
     # Проверяем что склад существует
@@ -14813,7 +18712,7 @@ async def create_courier(
         raise HTTPException(status_code=500, detail=f"Error creating courier: {str(e)}")
 
 @app.get("/api/admin/couriers/list")
-async def get_couriers_list(
+def get_couriers_list(
     current_user: User = Depends(get_current_user),
     page: int = 1,
     per_page: int = 25,
@@ -14868,7 +18767,7 @@ async def get_couriers_list(
         raise HTTPException(status_code=500, detail=f"Error fetching couriers: {str(e)}")
 
 @app.get("/api/admin/couriers/locations")
-async def get_all_couriers_locations(
+def get_all_couriers_locations(
     current_user: User = Depends(get_current_user)
 ):
     """Получить местоположения всех курьеров (для админов)"""
@@ -14911,7 +18810,7 @@ async def get_all_couriers_locations(
 
 # НОВАЯ ФУНКЦИЯ: Получить список неактивных курьеров
 @app.get("/api/admin/couriers/inactive")
-async def get_inactive_couriers(current_user: User = Depends(get_current_user)):
+def get_inactive_couriers(current_user: User = Depends(get_current_user)):
     if current_user.role not in ["admin"]:
         raise HTTPException(status_code=403, detail="Access denied: Only admins")
     
@@ -14944,7 +18843,7 @@ async def get_inactive_couriers(current_user: User = Depends(get_current_user)):
         raise HTTPException(status_code=500, detail="Ошибка при получении неактивных курьеров")
 
 @app.get("/api/admin/couriers/{courier_id}")
-async def get_courier_profile(
+def get_courier_profile(
     courier_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -14980,7 +18879,7 @@ async def get_courier_profile(
     return courier
 
 @app.put("/api/admin/couriers/{courier_id}")
-async def update_courier_profile(
+def update_courier_profile(
     courier_id: str,
     courier_update: CourierCreate,
     current_user: User = Depends(get_current_user)
@@ -15031,7 +18930,7 @@ async def update_courier_profile(
         raise HTTPException(status_code=500, detail=f"Error updating courier: {str(e)}")
 
 @app.delete("/api/admin/couriers/{courier_id}")
-async def delete_courier(
+def delete_courier(
     courier_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -15119,7 +19018,7 @@ async def delete_courier(
         raise HTTPException(status_code=500, detail=f"Error deleting courier: {str(e)}")
 
 @app.post("/api/operator/courier-requests/create")
-async def create_courier_request_for_pickup(
+def create_courier_request_for_pickup(
     cargo_id: str,
     assigned_courier_id: str,
     current_user: User = Depends(get_current_user)
@@ -15191,7 +19090,7 @@ async def create_courier_request_for_pickup(
 # ENDPOINTS ДЛЯ КУРЬЕРА
 
 @app.get("/api/courier/requests/new")
-async def get_courier_new_requests(
+def get_courier_new_requests(
     current_user: User = Depends(get_current_user)
 ):
     """Получить новые заявки для курьера (включая заявки на забор груза)"""
@@ -15245,7 +19144,7 @@ async def get_courier_new_requests(
     }
 
 @app.post("/api/courier/requests/{request_id}/accept")
-async def accept_courier_request(
+def accept_courier_request(
     request_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -15344,7 +19243,7 @@ async def accept_courier_request(
         raise HTTPException(status_code=500, detail=f"Error accepting request: {str(e)}")
 
 @app.get("/api/courier/requests/history")
-async def get_courier_requests_history(
+def get_courier_requests_history(
     current_user: User = Depends(get_current_user),
     page: int = 1,
     per_page: int = 20
@@ -15371,7 +19270,7 @@ async def get_courier_requests_history(
 # ДОПОЛНИТЕЛЬНЫЕ ENDPOINTS ДЛЯ ПОДДЕРЖКИ
 
 @app.post("/api/courier/requests/{request_id}/cancel")
-async def cancel_courier_request(
+def cancel_courier_request(
     request_id: str,
     cancel_data: dict,
     current_user: User = Depends(get_current_user)
@@ -15451,7 +19350,7 @@ async def cancel_courier_request(
         raise HTTPException(status_code=500, detail=f"Error cancelling request: {str(e)}")
 
 @app.post("/api/courier/requests/{request_id}/pickup")
-async def pickup_cargo_by_courier(
+def pickup_cargo_by_courier(
     request_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -15547,7 +19446,7 @@ async def pickup_cargo_by_courier(
         raise HTTPException(status_code=500, detail=f"Error picking up cargo: {str(e)}")
 
 @app.post("/api/courier/requests/{request_id}/deliver-to-warehouse")
-async def deliver_cargo_to_warehouse(
+def deliver_cargo_to_warehouse(
     request_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -15709,7 +19608,7 @@ async def deliver_cargo_to_warehouse(
 
 # НОВЫЙ ENDPOINT: Получение уведомлений о поступивших грузах для операторов
 @app.get("/api/operator/warehouse-notifications")
-async def get_warehouse_notifications(
+def get_warehouse_notifications(
     current_user: User = Depends(get_current_user)
 ):
     """Получить уведомления о грузах, сданных курьерами на склад"""
@@ -15734,7 +19633,7 @@ async def get_warehouse_notifications(
 
 # ОБНОВЛЕННЫЙ ENDPOINT: Принятие груза оператором со склада (упрощенный)
 @app.post("/api/operator/warehouse-notifications/{notification_id}/accept")
-async def accept_warehouse_delivery(
+def accept_warehouse_delivery(
     notification_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -15786,7 +19685,7 @@ async def accept_warehouse_delivery(
 
 # НОВЫЙ ENDPOINT: Обновление данных принятого уведомления
 @app.put("/api/operator/warehouse-notifications/{notification_id}")
-async def update_warehouse_notification(
+def update_warehouse_notification(
     notification_id: str,
     update_data: dict,
     current_user: User = Depends(get_current_user)
@@ -15850,7 +19749,7 @@ async def update_warehouse_notification(
 
 # НОВЫЙ ENDPOINT: Полное оформление груза с деталями
 @app.post("/api/operator/warehouse-notifications/{notification_id}/complete")
-async def complete_cargo_processing(
+def complete_cargo_processing(
     notification_id: str,
     cargo_details: dict,
     current_user: User = Depends(get_current_user)
@@ -15978,7 +19877,7 @@ async def complete_cargo_processing(
 
 # НОВЫЙ ENDPOINT: Отправка заявки на размещение
 @app.post("/api/operator/warehouse-notifications/{notification_id}/send-to-placement")
-async def send_pickup_request_to_placement(
+def send_pickup_request_to_placement(
     notification_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -16110,7 +20009,7 @@ async def send_pickup_request_to_placement(
 
 # НОВЫЙ ENDPOINT: История заявок на забор груза  
 @app.get("/api/operator/pickup-requests/history")
-async def get_pickup_requests_history(
+def get_pickup_requests_history(
     current_user: User = Depends(get_current_user)
 ):
     """Получить историю завершенных заявок на забор груза"""
@@ -16149,7 +20048,7 @@ async def get_pickup_requests_history(
 
 # НОВЫЙ ENDPOINT: Получение всех заявок на забор для операторов и администраторов
 @app.get("/api/operator/pickup-requests")
-async def get_all_pickup_requests(
+def get_all_pickup_requests(
     current_user: User = Depends(get_current_user)
 ):
     """Получить все заявки на забор груза для операторов и администраторов"""
@@ -16190,7 +20089,7 @@ async def get_all_pickup_requests(
         raise HTTPException(status_code=500, detail=f"Error fetching pickup requests: {str(e)}")
 
 @app.get("/api/operator/pickup-requests/{request_id}")
-async def get_pickup_request_by_id(
+def get_pickup_request_by_id(
     request_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -16284,7 +20183,7 @@ async def get_pickup_request_by_id(
         raise HTTPException(status_code=500, detail=f"Error fetching pickup request: {str(e)}")
 
 @app.get("/api/courier/requests/accepted")
-async def get_courier_accepted_requests(
+def get_courier_accepted_requests(
     current_user: User = Depends(get_current_user)
 ):
     """Получить принятые заявки курьера (включая заявки на забор груза)"""
@@ -16334,7 +20233,7 @@ async def get_courier_accepted_requests(
     }
 
 @app.get("/api/courier/requests/picked")
-async def get_courier_picked_requests(
+def get_courier_picked_requests(
     current_user: User = Depends(get_current_user)
 ):
     """Получить забранные грузы курьера (готовые к сдаче на склад - включая заявки на забор груза)"""
@@ -16384,7 +20283,7 @@ async def get_courier_picked_requests(
     }
 
 @app.put("/api/courier/cargo/{cargo_id}/update")
-async def update_cargo_by_courier(
+def update_cargo_by_courier(
     cargo_id: str,
     cargo_update: dict,
     current_user: User = Depends(get_current_user)
@@ -16450,7 +20349,7 @@ async def update_cargo_by_courier(
         raise HTTPException(status_code=500, detail=f"Error updating cargo: {str(e)}")
 
 @app.get("/api/courier/requests/cancelled")
-async def get_courier_cancelled_requests(
+def get_courier_cancelled_requests(
     current_user: User = Depends(get_current_user)
 ):
     """Получить отмененные заявки курьера"""
@@ -16497,7 +20396,7 @@ async def get_courier_cancelled_requests(
     }
 
 @app.put("/api/courier/requests/{request_id}/update")
-async def update_courier_request(
+def update_courier_request(
     request_id: str,
     update_data: dict,
     current_user: User = Depends(get_current_user)
@@ -16639,7 +20538,7 @@ async def update_courier_request(
         raise HTTPException(status_code=500, detail=f"Error updating request: {str(e)}")
 
 @app.put("/api/courier/requests/{request_id}/restore")
-async def restore_cancelled_request(
+def restore_cancelled_request(
     request_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -16709,7 +20608,7 @@ async def restore_cancelled_request(
         raise HTTPException(status_code=500, detail=f"Error restoring request: {str(e)}")
 
 @app.get("/api/admin/couriers/available/{warehouse_id}")
-async def get_available_couriers_for_warehouse(
+def get_available_couriers_for_warehouse(
     warehouse_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -16736,43 +20635,11 @@ async def update_courier_location(
         raise HTTPException(status_code=403, detail="Only couriers can update location")
     
     try:
-        # Найти информацию о курьере (создать профиль если не существует)
-        courier = db.couriers.find_one({"user_id": current_user.id}, {"_id": 0})
-        if not courier:
-            # Автоматически создать профиль курьера при первом GPS update
-            courier_id = str(uuid.uuid4())
-            current_time = datetime.utcnow()
-            
-            courier_profile = {
-                "id": courier_id,
-                "user_id": current_user.id,
-                "full_name": current_user.full_name,
-                "phone": current_user.phone,
-                "address": "Не указан",
-                "transport_type": "car",  # По умолчанию
-                "transport_number": "Не указан",
-                "transport_capacity": 50.0,  # По умолчанию
-                "assigned_warehouse_id": None,  # Будет назначен админом позже
-                "assigned_warehouse_name": None,
-                "is_active": True,
-                "created_at": current_time,
-                "updated_at": current_time,
-                "status": "offline",
-                "notes": "Профиль создан автоматически при первом GPS update"
-            }
-            
-            db.couriers.insert_one(courier_profile)
-            courier = courier_profile
-            print(f"✅ Auto-created courier profile for user {current_user.id}")
-        
-        # Получить информацию о текущей заявке (если есть)
-        current_request = db.courier_requests.find_one({
-            "assigned_courier_id": courier["id"],
-            "request_status": {"$in": ["accepted", "picked_up"]}
-        }, {"_id": 0})
-        
-        current_request_id = current_request["id"] if current_request else None
-        current_request_address = current_request.get("pickup_address") if current_request else None
+        # Профиль курьера и текущая заявка (кэш; профиль создается при первом GPS update)
+        context = await run_in_threadpool(courier_context.get, current_user)
+        courier = context["courier"]
+        current_request_id = context["current_request_id"]
+        current_request_address = context["current_request_address"]
         
         # Создать запись местоположения
         location_id = str(uuid.uuid4())
@@ -16793,28 +20660,13 @@ async def update_courier_location(
             "heading": location_data.heading,
             "current_request_id": current_request_id,
             "current_request_address": current_request_address,
+            "location": geojson_point(location_data.latitude, location_data.longitude),
             "last_updated": now,
             "created_at": now
         }
         
-        # Обновить или создать запись местоположения
-        db.courier_locations.update_one(
-            {"courier_id": courier["id"]},
-            {"$set": location_record},
-            upsert=True
-        )
-        
-        # НОВОЕ: Обновить статус в профиле курьера
-        db.couriers.update_one(
-            {"id": courier["id"]},
-            {"$set": {
-                "status": location_data.status.value,
-                "updated_at": now
-            }}
-        )
-        
         # НОВОЕ: Отправить real-time обновление через WebSocket
-        await connection_manager.broadcast_courier_location_update(location_record)
+        await connection_manager.broadcast_courier_location_update(location_record, courier)
         
         # НОВОЕ: Сохранить в историю перемещений
         history_record = {
@@ -16833,7 +20685,8 @@ async def update_courier_location(
             "hour": now.hour
         }
         
-        db.courier_location_history.insert_one(history_record)
+        # Последняя позиция, статус курьера и история пишутся фоновым сбросом буфера
+        gps_ingest.add(history_record, location_record)
         
         return {
             "message": "Location updated successfully",
@@ -16845,8 +20698,142 @@ async def update_courier_location(
         raise HTTPException(status_code=500, detail=f"Error updating location: {str(e)}")
 
 
+def gps_point_timestamp(value: datetime) -> datetime:
+    """Время точки в наивном UTC с точностью MongoDB (миллисекунды)"""
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value.replace(microsecond=value.microsecond // 1000 * 1000)
+
+@app.post("/api/courier/location/batch")
+async def upload_courier_location_batch(
+    batch: CourierLocationBatch,
+    current_user: User = Depends(get_current_user)
+):
+    """Загрузить накопленные на устройстве GPS точки одним запросом (после потери связи).
+    
+    Точки с уже сохраненным временем (повторная отправка) пропускаются, остальные
+    сохраняются одним insert_many; последняя позиция обновляется по самой свежей точке,
+    в WebSocket уходит одно обновление.
+    """
+    if current_user.role != UserRole.COURIER:
+        raise HTTPException(status_code=403, detail="Only couriers can update location")
+    
+    try:
+        context = await run_in_threadpool(courier_context.get, current_user)
+        courier = context["courier"]
+        now = datetime.utcnow()
+        
+        # Дедупликация внутри пакета по времени точки; точки из будущего отбрасываются
+        points = {}
+        rejected = 0
+        for point in batch.points:
+            timestamp = gps_point_timestamp(point.timestamp)
+            if timestamp > now + GPS_CLOCK_SKEW:
+                rejected += 1
+                continue
+            points[timestamp] = point
+        
+        # Точки, уже сохраненные прошлой попыткой отправки
+        stored = set()
+        if points:
+            stored = {
+                doc["timestamp"] for doc in await adb[GPS_HISTORY_COLLECTION].find_list(
+                    {"courier_id": courier["id"], "timestamp": {"$gte": min(points), "$lte": max(points)}},
+                    {"_id": 0, "timestamp": 1}
+                )
+            }
+        new_points = sorted((timestamp, point) for timestamp, point in points.items() if timestamp not in stored)
+        # Параллельная повторная отправка того же пакета: каждую точку пишет только один запрос
+        if new_points:
+            claimed = await run_in_threadpool(claim_gps_points, courier["id"], [timestamp for timestamp, _ in new_points])
+            new_points = [(timestamp, point) for timestamp, point in new_points if timestamp in claimed]
+        
+        history_records = [
+            {
+                "id": str(uuid.uuid4()),
+                "courier_id": courier["id"],
+                "courier_name": courier["full_name"],
+                "latitude": point.latitude,
+                "longitude": point.longitude,
+                "status": point.status.value,
+                "current_address": point.current_address,
+                "accuracy": point.accuracy,
+                "speed": point.speed,
+                "heading": point.heading,
+                "timestamp": timestamp,
+                "received_at": now,
+                "date": timestamp.date().isoformat(),
+                "hour": timestamp.hour
+            }
+            for timestamp, point in new_points
+        ]
+        if history_records:
+            try:
+                await adb[GPS_HISTORY_COLLECTION].insert_many(history_records, ordered=False)
+            except Exception as e:
+                failed = (
+                    [history_records[error["index"]]["timestamp"] for error in e.details.get("writeErrors", [])]
+                    if isinstance(e, BulkWriteError) else [record["timestamp"] for record in history_records]
+                )
+                await run_in_threadpool(release_gps_points, courier["id"], failed)
+                raise
+            # Сводки прошедших дней с новыми точками пересчитываются при чтении
+            await run_in_threadpool(courier_rollups.mark_stale, courier["id"], [record["date"] for record in history_records])
+        
+        latest_timestamp = None
+        if new_points:
+            latest_timestamp, latest_point = new_points[-1]
+            location_record = {
+                "id": str(uuid.uuid4()),
+                "courier_id": courier["id"],
+                "courier_name": courier["full_name"],
+                "courier_phone": courier["phone"],
+                "transport_type": courier["transport_type"],
+                "latitude": latest_point.latitude,
+                "longitude": latest_point.longitude,
+                "status": latest_point.status.value,
+                "current_address": latest_point.current_address,
+                "accuracy": latest_point.accuracy,
+                "speed": latest_point.speed,
+                "heading": latest_point.heading,
+                "current_request_id": context["current_request_id"],
+                "current_request_address": context["current_request_address"],
+                "location": geojson_point(latest_point.latitude, latest_point.longitude),
+                "last_updated": latest_timestamp,
+                "created_at": now
+            }
+            # Маркер на карте двигаем, только если пакет новее известной позиции курьера
+            stored_location = await adb.courier_locations.find_one({"courier_id": courier["id"]}, {"_id": 0, "last_updated": 1})
+            known = [
+                timestamp for timestamp in (gps_ingest.buffered_at(courier["id"]), (stored_location or {}).get("last_updated"))
+                if timestamp
+            ]
+            gps_ingest.add(None, location_record)
+            if not known or latest_timestamp > max(known):
+                await connection_manager.broadcast_courier_location_update(
+                    dict(location_record, batch_points=len(new_points)), courier
+                )
+            else:
+                await connection_manager.broadcast_courier_location_update({
+                    "courier_id": courier["id"],
+                    "batch_points": len(new_points),
+                    "batch_latest_timestamp": latest_timestamp
+                }, courier)
+        
+        return {
+            "message": "Location batch processed",
+            "received": len(batch.points),
+            "stored": len(history_records),
+            "duplicates": len(batch.points) - len(history_records) - rejected,
+            "rejected": rejected,
+            "latest_timestamp": latest_timestamp.isoformat() if latest_timestamp else None
+        }
+        
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error processing location batch: {str(e)}")
+
 @app.get("/api/operator/couriers/locations")
-async def get_warehouse_couriers_locations(
+def get_warehouse_couriers_locations(
     current_user: User = Depends(get_current_user)
 ):
     """Получить местоположения курьеров склада (для операторов склада)"""
@@ -16923,7 +20910,7 @@ async def get_warehouse_couriers_locations(
         raise HTTPException(status_code=500, detail=f"Error fetching courier locations: {str(e)}")
 
 @app.get("/api/courier/location/status")
-async def get_courier_location_status(
+def get_courier_location_status(
     current_user: User = Depends(get_current_user)
 ):
     """Получить статус отслеживания местоположения курьера"""
@@ -16991,7 +20978,7 @@ async def websocket_admin_courier_tracking(websocket: WebSocket, token: str):
             token_version = payload.get("token_version", 0)
             
             # Найти пользователя и проверить версию токена
-            user_doc = db.users.find_one({"id": user_id}, {"_id": 0})
+            user_doc = await adb.users.find_one({"id": user_id}, {"_id": 0})
             if not user_doc or user_doc.get("token_version", 0) != token_version:
                 await websocket.close(code=4001, reason="Invalid token")
                 return
@@ -17008,7 +20995,7 @@ async def websocket_admin_courier_tracking(websocket: WebSocket, token: str):
         await connection_manager.connect(websocket, user_id, "admin")
         
         # Отправить текущее состояние всех курьеров
-        locations = list(db.courier_locations.find({}, {"_id": 0}))
+        locations = await adb.courier_locations.find_list({}, {"_id": 0})
         welcome_message = {
             "type": "initial_data",
             "data": {
@@ -17072,7 +21059,7 @@ async def websocket_operator_courier_tracking(websocket: WebSocket, token: str):
             token_version = payload.get("token_version", 0)
             
             # Найти пользователя и проверить версию токена
-            user_doc = db.users.find_one({"id": user_id}, {"_id": 0})
+            user_doc = await adb.users.find_one({"id": user_id}, {"_id": 0})
             if not user_doc or user_doc.get("token_version", 0) != token_version:
                 await websocket.close(code=4001, reason="Invalid token")
                 return
@@ -17086,10 +21073,10 @@ async def websocket_operator_courier_tracking(websocket: WebSocket, token: str):
             return
         
         # Найти склады оператора
-        operator_warehouses = list(db.warehouse_operators.find(
+        operator_warehouses = await adb.warehouse_operators.find_list(
             {"user_id": user_id}, 
             {"warehouse_id": 1, "_id": 0}
-        ))
+        )
         warehouse_ids = [w["warehouse_id"] for w in operator_warehouses]
         
         if not warehouse_ids:
@@ -17100,17 +21087,17 @@ async def websocket_operator_courier_tracking(websocket: WebSocket, token: str):
         await connection_manager.connect(websocket, user_id, "warehouse_operator", warehouse_ids)
         
         # Найти курьеров складов оператора
-        couriers = list(db.couriers.find({
+        couriers = await adb.couriers.find_list({
             "assigned_warehouse_id": {"$in": warehouse_ids},
             "is_active": True
-        }, {"id": 1, "_id": 0}))
+        }, {"id": 1, "_id": 0})
         
         courier_ids = [c["id"] for c in couriers]
         
         # Отправить текущее состояние курьеров складов
-        locations = list(db.courier_locations.find({
+        locations = await adb.courier_locations.find_list({
             "courier_id": {"$in": courier_ids}
-        }, {"_id": 0}))
+        }, {"_id": 0})
         
         welcome_message = {
             "type": "initial_data",
@@ -17157,7 +21144,7 @@ async def websocket_operator_courier_tracking(websocket: WebSocket, token: str):
         connection_manager.disconnect(user_id)
 
 @app.get("/api/admin/websocket/stats")
-async def get_websocket_connection_stats(
+def get_websocket_connection_stats(
     current_user: User = Depends(get_current_user)
 ):
     """Получить статистику WebSocket подключений (только для админов)"""
@@ -17188,7 +21175,7 @@ async def get_websocket_connection_stats(
 # НОВЫЕ ENDPOINTS ДЛЯ ИСТОРИИ ПЕРЕМЕЩЕНИЙ И ETA
 
 @app.post("/api/courier/location/history")
-async def save_location_to_history(
+def save_location_to_history(
     location_data: CourierLocationUpdate,
     current_user: User = Depends(get_current_user)
 ):
@@ -17222,8 +21209,8 @@ async def save_location_to_history(
             "hour": now.hour  # Для группировки по часам
         }
         
-        # Сохранить в коллекцию истории
-        db.courier_location_history.insert_one(history_record)
+        # Сохранить в историю (фоновым сбросом GPS буфера)
+        gps_ingest.add(history_record)
         
         return {
             "message": "Location history saved successfully",
@@ -17235,91 +21222,30 @@ async def save_location_to_history(
         raise HTTPException(status_code=500, detail=f"Error saving location history: {str(e)}")
 
 @app.get("/api/admin/couriers/{courier_id}/history")
-async def get_courier_location_history(
+def get_courier_location_history(
     courier_id: str,
     date_from: str = None,  # YYYY-MM-DD
     date_to: str = None,    # YYYY-MM-DD
+    include_points: bool = False,  # Вернуть все сырые точки в "history"
     current_user: User = Depends(get_current_user)
 ):
-    """Получить историю перемещений курьера (для админов)"""
+    """Получить историю перемещений курьера (для админов): сводки по дням и упрощенные треки"""
     if current_user.role != UserRole.ADMIN:
         raise HTTPException(status_code=403, detail="Only admins can view courier history")
     
     try:
-        # Подготовить фильтр по датам
-        date_filter = {"courier_id": courier_id}
-        
-        if date_from or date_to:
-            date_range = {}
-            if date_from:
-                date_range["$gte"] = date_from
-            if date_to:
-                date_range["$lte"] = date_to
-            date_filter["date"] = date_range
-        else:
-            # По умолчанию - последние 7 дней
-            week_ago = (datetime.utcnow() - timedelta(days=7)).date().isoformat()
-            date_filter["date"] = {"$gte": week_ago}
-        
-        # Получить историю перемещений
-        history = list(db.courier_location_history.find(
-            date_filter,
-            {"_id": 0}
-        ).sort("timestamp", 1))
-        
-        # Группировать по дням для статистики
-        daily_stats = {}
-        total_distance = 0
-        
-        for i, record in enumerate(history):
-            date = record["date"]
-            if date not in daily_stats:
-                daily_stats[date] = {
-                    "date": date,
-                    "points_count": 0,
-                    "distance_km": 0,
-                    "avg_speed": 0,
-                    "statuses": set()
-                }
-            
-            daily_stats[date]["points_count"] += 1
-            daily_stats[date]["statuses"].add(record["status"])
-            
-            # Рассчитать расстояние между точками
-            if i > 0 and history[i-1]["date"] == date:
-                distance = calculate_distance(
-                    history[i-1]["latitude"], history[i-1]["longitude"],
-                    record["latitude"], record["longitude"]
-                )
-                daily_stats[date]["distance_km"] += distance
-                total_distance += distance
-            
-            # Средняя скорость
-            if record.get("speed"):
-                daily_stats[date]["avg_speed"] = max(daily_stats[date]["avg_speed"], record["speed"])
-        
-        # Конвертировать set в list для JSON
-        for stats in daily_stats.values():
-            stats["statuses"] = list(stats["statuses"])
-        
-        return {
-            "courier_id": courier_id,
-            "date_from": date_from or week_ago,
-            "date_to": date_to or datetime.utcnow().date().isoformat(),
-            "history": history,
-            "total_points": len(history),
-            "total_distance_km": round(total_distance, 2),
-            "daily_stats": list(daily_stats.values())
-        }
+        # По умолчанию - последние 7 дней
+        return courier_history_response(courier_id, date_from, date_to, 7, include_points)
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching courier history: {str(e)}")
 
 @app.get("/api/operator/couriers/{courier_id}/history")
-async def get_courier_location_history_operator(
+def get_courier_location_history_operator(
     courier_id: str,
     date_from: str = None,
     date_to: str = None,
+    include_points: bool = False,  # Вернуть все сырые точки в "history"
     current_user: User = Depends(get_current_user)
 ):
     """Получить историю перемещений курьера (для операторов склада)"""
@@ -17347,53 +21273,16 @@ async def get_courier_location_history_operator(
         if not courier:
             raise HTTPException(status_code=403, detail="Courier not assigned to your warehouses")
         
-        # Использовать ту же логику, что и для админов
-        date_filter = {"courier_id": courier_id}
-        
-        if date_from or date_to:
-            date_range = {}
-            if date_from:
-                date_range["$gte"] = date_from
-            if date_to:
-                date_range["$lte"] = date_to
-            date_filter["date"] = date_range
-        else:
-            # По умолчанию - последние 3 дня для операторов
-            days_ago = (datetime.utcnow() - timedelta(days=3)).date().isoformat()
-            date_filter["date"] = {"$gte": days_ago}
-        
-        history = list(db.courier_location_history.find(
-            date_filter,
-            {"_id": 0}
-        ).sort("timestamp", 1))
-        
-        # Упрощенная статистика для операторов
-        total_points = len(history)
-        total_distance = 0
-        
-        for i in range(1, len(history)):
-            if history[i]["date"] == history[i-1]["date"]:
-                distance = calculate_distance(
-                    history[i-1]["latitude"], history[i-1]["longitude"],
-                    history[i]["latitude"], history[i]["longitude"]
-                )
-                total_distance += distance
-        
-        return {
-            "courier_id": courier_id,
-            "courier_name": courier["full_name"],
-            "date_from": date_from or days_ago,
-            "date_to": date_to or datetime.utcnow().date().isoformat(),
-            "history": history,
-            "total_points": total_points,
-            "total_distance_km": round(total_distance, 2)
-        }
+        # Использовать ту же логику, что и для админов (по умолчанию - последние 3 дня)
+        response = courier_history_response(courier_id, date_from, date_to, 3, include_points)
+        response["courier_name"] = courier["full_name"]
+        return response
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching courier history: {str(e)}")
 
 @app.post("/api/courier/eta/calculate")
-async def calculate_eta_to_address(
+def calculate_eta_to_address(
     request_data: dict,
     current_user: User = Depends(get_current_user)
 ):
@@ -17473,7 +21362,7 @@ async def calculate_eta_to_address(
         raise HTTPException(status_code=500, detail=f"Error calculating ETA: {str(e)}")
 
 @app.get("/api/admin/couriers/analytics")
-async def get_couriers_analytics(
+def get_couriers_analytics(
     date_from: str = None,
     date_to: str = None,
     current_user: User = Depends(get_current_user)
@@ -17484,85 +21373,70 @@ async def get_couriers_analytics(
     
     try:
         # Подготовить фильтр по датам
-        if not date_from:
-            date_from = (datetime.utcnow() - timedelta(days=7)).date().isoformat()
-        if not date_to:
-            date_to = datetime.utcnow().date().isoformat()
-        
-        date_filter = {
-            "date": {"$gte": date_from, "$lte": date_to}
-        }
+        period_filter, date_from, date_to = track_period_filter(date_from, date_to, 7)
         
         # Получить всех курьеров
         couriers = list(db.couriers.find({"is_active": True}, {"_id": 0}))
+        courier_ids = [courier["id"] for courier in couriers]
+        
+        # Треки всех курьеров одним запросом, отсортированные по курьеру и времени
+        points = db.courier_location_history.aggregate([
+            {"$match": {"courier_id": {"$in": courier_ids}, **period_filter}},
+            {"$sort": {"courier_id": 1, "timestamp": 1}},
+            {"$project": TRACK_POINT_PROJECTION}
+        ], allowDiskUse=True)
+        summaries = summarize_tracks(track_columns(points))
+        
+        # Заявки курьеров за период - одной группировкой
+        request_counts = {
+            row["_id"]: row for row in db.courier_requests.aggregate([
+                {"$match": {
+                    "assigned_courier_id": {"$in": list(summaries)},
+                    "created_at": {"$gte": period_filter["timestamp"]["$gte"], "$lt": period_filter["timestamp"]["$lt"]}
+                }},
+                {"$group": {
+                    "_id": "$assigned_courier_id",
+                    "total": {"$sum": 1},
+                    "completed": {"$sum": {"$cond": [{"$eq": ["$request_status", "delivered"]}, 1, 0]}}
+                }}
+            ])
+        }
         
         analytics_data = []
-        
         for courier in couriers:
-            # История перемещений курьера
-            history = list(db.courier_location_history.find(
-                {**date_filter, "courier_id": courier["id"]},
-                {"_id": 0}
-            ).sort("timestamp", 1))
-            
-            if not history:
+            summary = summaries.get(courier["id"])
+            if not summary:
                 continue
             
-            # Рассчитать метрики
-            total_distance = 0
-            total_time_active = 0
-            statuses = []
-            
-            for i in range(1, len(history)):
-                # Расстояние
-                distance = calculate_distance(
-                    history[i-1]["latitude"], history[i-1]["longitude"],
-                    history[i]["latitude"], history[i]["longitude"]
-                )
-                total_distance += distance
-                
-                # Время активности (между точками)
-                time_diff = (datetime.fromisoformat(history[i]["timestamp"].replace('Z', '+00:00')) - 
-                           datetime.fromisoformat(history[i-1]["timestamp"].replace('Z', '+00:00')))
-                total_time_active += time_diff.total_seconds() / 3600  # в часах
-                
-                statuses.append(history[i]["status"])
-            
-            # Заявки курьера за период
-            requests = list(db.courier_requests.find({
-                "assigned_courier_id": courier["id"],
-                "created_at": {
-                    "$gte": datetime.fromisoformat(date_from + "T00:00:00"),
-                    "$lte": datetime.fromisoformat(date_to + "T23:59:59")
-                }
-            }, {"_id": 0}))
-            
-            completed_requests = [r for r in requests if r.get("request_status") == "delivered"]
+            total = summary["total"]
+            requests_total = request_counts.get(courier["id"], {}).get("total", 0)
+            requests_completed = request_counts.get(courier["id"], {}).get("completed", 0)
             
             analytics_data.append({
                 "courier_id": courier["id"],
                 "courier_name": courier["full_name"],
-                "transport_type": courier["transport_type"],
+                "transport_type": courier.get("transport_type"),
                 "warehouse_name": courier.get("assigned_warehouse_name", "N/A"),
                 "metrics": {
-                    "total_distance_km": round(total_distance, 2),
-                    "total_active_hours": round(total_time_active, 2),
-                    "avg_speed_kmh": round(total_distance / total_time_active, 2) if total_time_active > 0 else 0,
-                    "total_requests": len(requests),
-                    "completed_requests": len(completed_requests),
-                    "completion_rate": round(len(completed_requests) / len(requests) * 100, 1) if requests else 0,
-                    "tracking_points": len(history),
-                    "status_breakdown": {
-                        status: statuses.count(status) for status in set(statuses)
-                    }
-                }
+                    "total_distance_km": total["distance_km"],
+                    "total_active_hours": total["active_hours"],
+                    "avg_speed_kmh": total["moving_speed_kmh"],
+                    "reported_avg_speed_kmh": total["avg_speed"],
+                    "max_speed_kmh": total["max_speed"],
+                    "total_requests": requests_total,
+                    "completed_requests": requests_completed,
+                    "completion_rate": round(requests_completed / requests_total * 100, 1) if requests_total else 0,
+                    "tracking_points": total["points_count"],
+                    "status_breakdown": total["status_breakdown"]
+                },
+                "daily": summary["days"]
             })
         
         # Общая статистика
         total_analytics = {
             "period": {"from": date_from, "to": date_to},
             "total_couriers": len(analytics_data),
-            "total_distance_km": sum(c["metrics"]["total_distance_km"] for c in analytics_data),
+            "total_distance_km": round(sum(c["metrics"]["total_distance_km"] for c in analytics_data), 2),
             "total_requests": sum(c["metrics"]["total_requests"] for c in analytics_data),
             "total_completed": sum(c["metrics"]["completed_requests"] for c in analytics_data),
             "avg_completion_rate": round(
@@ -17582,32 +21456,12 @@ async def get_couriers_analytics(
 # Вспомогательная функция для расчета расстояния между координатами
 def calculate_distance(lat1, lon1, lat2, lon2):
     """Рассчитать расстояние между двумя точками в километрах (формула Haversine)"""
-    import math
-    
-    # Радиус Земли в километрах
-    R = 6371.0
-    
-    # Преобразовать градусы в радианы
-    lat1_rad = math.radians(lat1)
-    lon1_rad = math.radians(lon1)
-    lat2_rad = math.radians(lat2)
-    lon2_rad = math.radians(lon2)
-    
-    # Разность координат
-    dlat = lat2_rad - lat1_rad
-    dlon = lon2_rad - lon1_rad
-    
-    # Формула Haversine
-    a = math.sin(dlat / 2)**2 + math.cos(lat1_rad) * math.cos(lat2_rad) * math.sin(dlon / 2)**2
-    c = 2 * math.asin(math.sqrt(a))
-    distance = R * c
-    
-    return distance
+    return float(haversine_km(lat1, lon1, lat2, lon2))
 
 # НОВЫЙ ENDPOINT ДЛЯ ЗАЯВОК НА ЗАБОР ГРУЗА
 
 @app.post("/api/admin/courier/pickup-request")
-async def create_courier_pickup_request(
+def create_courier_pickup_request(
     request_data: dict,
     current_user: User = Depends(get_current_user)
 ):
@@ -17710,7 +21564,7 @@ async def create_courier_pickup_request(
         raise HTTPException(status_code=500, detail=f"Error creating pickup request: {str(e)}")
 
 @app.get("/api/courier/pickup-requests")
-async def get_courier_pickup_requests(
+def get_courier_pickup_requests(
     current_user: User = Depends(get_current_user)
 ):
     """Получить заявки на забор груза для курьера"""
@@ -17748,7 +21602,7 @@ async def get_courier_pickup_requests(
         raise HTTPException(status_code=500, detail=f"Error fetching pickup requests: {str(e)}")
 
 @app.post("/api/courier/pickup-requests/{request_id}/accept")
-async def accept_pickup_request(
+def accept_pickup_request(
     request_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -17822,7 +21676,7 @@ async def accept_pickup_request(
 
 # ИСПРАВЛЕНИЕ: Индивидуальное удаление заявки на забор груза
 @app.delete("/api/admin/pickup-requests/{request_id}")
-async def delete_pickup_request(request_id: str, current_user: User = Depends(get_current_user)):
+def delete_pickup_request(request_id: str, current_user: User = Depends(get_current_user)):
     if current_user.role not in ["admin"]:
         raise HTTPException(status_code=403, detail="Access denied: Only admins")
     
@@ -17850,7 +21704,7 @@ async def delete_pickup_request(request_id: str, current_user: User = Depends(ge
 
 # ИСПРАВЛЕНИЕ: Индивидуальное удаление заявки на забор через courier endpoint (альтернативный доступ)
 @app.delete("/api/admin/courier/pickup-requests/{request_id}")
-async def delete_courier_pickup_request(request_id: str, current_user: User = Depends(get_current_user)):
+def delete_courier_pickup_request(request_id: str, current_user: User = Depends(get_current_user)):
     if current_user.role not in ["admin"]:
         raise HTTPException(status_code=403, detail="Access denied: Only admins")
     
@@ -17877,7 +21731,7 @@ async def delete_courier_pickup_request(request_id: str, current_user: User = De
         raise HTTPException(status_code=500, detail="Ошибка при удалении заявки")
 # НОВАЯ ФУНКЦИЯ: Активировать курьера (перевести из неактивного в активное состояние)
 @app.post("/api/admin/couriers/{courier_id}/activate")
-async def activate_courier(courier_id: str, current_user: User = Depends(get_current_user)):
+def activate_courier(courier_id: str, current_user: User = Depends(get_current_user)):
     if current_user.role not in ["admin"]:
         raise HTTPException(status_code=403, detail="Access denied: Only admins")
     
@@ -17924,7 +21778,7 @@ async def activate_courier(courier_id: str, current_user: User = Depends(get_cur
 
 # НОВАЯ ФУНКЦИЯ: Полное удаление курьера из базы данных
 @app.delete("/api/admin/couriers/{courier_id}/permanent")
-async def permanently_delete_courier(courier_id: str, current_user: User = Depends(get_current_user)):
+def permanently_delete_courier(courier_id: str, current_user: User = Depends(get_current_user)):
     if current_user.role not in ["admin"]:
         raise HTTPException(status_code=403, detail="Access denied: Only admins")
     
@@ -17982,7 +21836,7 @@ async def permanently_delete_courier(courier_id: str, current_user: User = Depen
         print(f"Error permanently deleting courier: {str(e)}")
         raise HTTPException(status_code=500, detail="Ошибка при полном удалении курьера")
 @app.post("/api/admin/cleanup-duplicate-notifications")
-async def cleanup_duplicate_notifications(current_user: User = Depends(get_current_user)):
+def cleanup_duplicate_notifications(current_user: User = Depends(get_current_user)):
     if current_user.role not in ["admin"]:
         raise HTTPException(status_code=403, detail="Access denied: Only admins")
     
@@ -18017,7 +21871,7 @@ async def cleanup_duplicate_notifications(current_user: User = Depends(get_curre
 # ====================================
 
 @app.post("/api/operator/qr/generate-individual")
-async def generate_individual_qr(
+def generate_individual_qr(
     request: dict,
     current_user: User = Depends(get_current_user)
 ):
@@ -18043,72 +21897,36 @@ async def generate_individual_qr(
         
         print(f"🖨️ Генерация QR для: {individual_number}")
         
-        # Ищем груз с данным individual_number
-        cargo = db.operator_cargo.find_one({
-            "cargo_items.individual_items.individual_number": individual_number
-        })
+        # Ищем единицу груза с данным individual_number
+        unit = next(iter(find_cargo_units("operator_cargo", [individual_number], synthetic=False)), None)
         
-        if not cargo:
+        if not unit:
             raise HTTPException(
                 status_code=404,
                 detail=f"Individual unit {individual_number} не найден"
             )
         
-        # Находим конкретный individual_item
-        individual_item = None
-        cargo_item_info = None
-        
-        for cargo_item in cargo.get("cargo_items", []):
-            for unit in cargo_item.get("individual_items", []):
-                if unit.get("individual_number") == individual_number:
-                    individual_item = unit
-                    cargo_item_info = cargo_item
-                    break
-            if individual_item:
-                break
-        
-        if not individual_item:
-            raise HTTPException(
-                status_code=404,
-                detail=f"Individual unit {individual_number} не найден в данных груза"
-            )
-        
         # Формируем QR данные
         timestamp = int(datetime.now().timestamp())
         qr_data = f"TAJLINE|INDIVIDUAL|{individual_number}|{timestamp}"
         
         print(f"🖨️ QR данные: {qr_data}")
         
-        # Генерируем QR код
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_L,
-            box_size=10,
-            border=4,
-        )
-        qr.add_data(qr_data)
-        qr.make(fit=True)
-        
-        # Создаем изображение QR кода
-        qr_image = qr.make_image(fill_color="black", back_color="white")
-        
-        # Конвертируем в base64
-        buffered = BytesIO()
-        qr_image.save(buffered, format="PNG")
-        qr_base64 = base64.b64encode(buffered.getvalue()).decode()
+        # Генерируем QR код (данные с отметкой времени не повторяются - в кэш не сохраняем)
+        qr_base64 = render_qr_base64(qr_data, box_size=10, border=4, store=False)
         
         # Формируем информацию о грузе для печати
         qr_info = {
             "individual_number": individual_number,
-            "cargo_number": cargo.get("cargo_number"),
-            "cargo_name": cargo_item_info.get("cargo_name", "Неизвестный груз"),
-            "sender_name": cargo.get("sender_full_name", "Неизвестно"),
-            "recipient_name": cargo.get("recipient_full_name", "Неизвестно"),
-            "recipient_address": cargo.get("recipient_address", "Неизвестно"),
-            "weight": cargo_item_info.get("weight", 0),
-            "placement_status": individual_item.get("placement_status", "awaiting_placement"),
-            "is_placed": individual_item.get("is_placed", False),
-            "placement_info": individual_item.get("placement_info"),
+            "cargo_number": unit.get("cargo_number"),
+            "cargo_name": unit.get("cargo_name") or "Неизвестный груз",
+            "sender_name": unit.get("sender_full_name") or "Неизвестно",
+            "recipient_name": unit.get("recipient_full_name") or "Неизвестно",
+            "recipient_address": unit.get("recipient_address") or "Неизвестно",
+            "weight": unit.get("weight", 0),
+            "placement_status": unit.get("placement_status", "awaiting_placement"),
+            "is_placed": unit.get("is_placed", False),
+            "placement_info": unit.get("placement_info"),
             "qr_data": qr_data,
             "qr_base64": qr_base64,
             "generated_at": datetime.now().isoformat()
@@ -18132,7 +21950,7 @@ async def generate_individual_qr(
         )
 
 @app.post("/api/operator/qr/generate-batch")
-async def generate_batch_qr(
+def generate_batch_qr(
     request: dict,
     current_user: User = Depends(get_current_user)
 ):
@@ -18161,37 +21979,20 @@ async def generate_batch_qr(
         qr_batch = []
         failed_items = []
         
-        for individual_number in individual_numbers:
-            try:
-                # Ищем груз с данным individual_number
-                cargo = db.operator_cargo.find_one({
-                    "cargo_items.individual_items.individual_number": individual_number
-                })
-                
-                if not cargo:
-                    failed_items.append({
-                        "individual_number": individual_number,
-                        "error": "Груз не найден"
-                    })
-                    continue
-                
-                # Находим конкретный individual_item
-                individual_item = None
-                cargo_item_info = None
-                
-                for cargo_item in cargo.get("cargo_items", []):
-                    for unit in cargo_item.get("individual_items", []):
-                        if unit.get("individual_number") == individual_number:
-                            individual_item = unit
-                            cargo_item_info = cargo_item
-                            break
-                    if individual_item:
-                        break
-                
-                if not individual_item:
+        # Все единицы списка одним запросом к cargo_units (только заявки operator_cargo
+        # с настоящими individual_items)
+        units = {
+            unit["individual_number"]: unit
+            for unit in find_cargo_units("operator_cargo", individual_numbers, synthetic=False)
+        }
+        
+        for individual_number in individual_numbers:
+            try:
+                unit = units.get(individual_number)
+                if not unit:
                     failed_items.append({
                         "individual_number": individual_number,
-                        "error": "Individual unit не найден в данных груза"
+                        "error": "Груз не найден"
                     })
                     continue
                 
@@ -18199,35 +22000,20 @@ async def generate_batch_qr(
                 timestamp = int(datetime.now().timestamp())
                 qr_data = f"TAJLINE|INDIVIDUAL|{individual_number}|{timestamp}"
                 
-                # Генерируем QR код
-                qr = qrcode.QRCode(
-                    version=1,
-                    error_correction=qrcode.constants.ERROR_CORRECT_L,
-                    box_size=8,  # Меньший размер для массовой печати
-                    border=2,
-                )
-                qr.add_data(qr_data)
-                qr.make(fit=True)
-                
-                # Создаем изображение QR кода
-                qr_image = qr.make_image(fill_color="black", back_color="white")
-                
-                # Конвертируем в base64
-                buffered = BytesIO()
-                qr_image.save(buffered, format="PNG")
-                qr_base64 = base64.b64encode(buffered.getvalue()).decode()
+                # Генерируем QR код меньшего размера для массовой печати (без сохранения в кэш)
+                qr_base64 = render_qr_base64(qr_data, box_size=8, border=2, store=False)
                 
                 # Добавляем в batch
                 qr_batch.append({
                     "individual_number": individual_number,
-                    "cargo_number": cargo.get("cargo_number"),
-                    "cargo_name": cargo_item_info.get("cargo_name", "Неизвестный груз"),
-                    "sender_name": cargo.get("sender_full_name", "Неизвестно"),
-                    "recipient_name": cargo.get("recipient_full_name", "Неизвестно"),
+                    "cargo_number": unit.get("cargo_number"),
+                    "cargo_name": unit.get("cargo_name") or "Неизвестный груз",
+                    "sender_name": unit.get("sender_full_name") or "Неизвестно",
+                    "recipient_name": unit.get("recipient_full_name") or "Неизвестно",
                     "qr_data": qr_data,
                     "qr_base64": qr_base64,
-                    "is_placed": individual_item.get("is_placed", False),
-                    "placement_info": individual_item.get("placement_info")
+                    "is_placed": unit.get("is_placed", False),
+                    "placement_info": unit.get("placement_info")
                 })
                 
             except Exception as item_error:
@@ -18258,7 +22044,7 @@ async def generate_batch_qr(
         )
 
 @app.get("/api/operator/qr/print-layout")
-async def get_print_layout_options(
+def get_print_layout_options(
     current_user: User = Depends(get_current_user)
 ):
     """
@@ -18331,8 +22117,273 @@ async def get_print_layout_options(
 # КОНЕЦ НОВЫХ API ENDPOINTS ДЛЯ ПЕЧАТИ QR
 # ====================================
 
+# ====================================
+# УНИВЕРСАЛЬНОЕ СКАНИРОВАНИЕ
+# ====================================
+# /api/scan определяет тип кода по содержимому (номер груза, CARGO/TYPE/UNIT,
+# TAJLINE|TYPE|ID|TIMESTAMP, любой формат ячейки), находит груз одним запросом
+# по индексу, а ячейку - по справочнику ячеек без запросов. Для размещения выдается
+# короткоживущий токен проверки, который принимает /api/operator/placement/place-cargo.
+# Токен груза одноразовый: его jti записывается в scan_token_uses при размещении
+# и удаляется, если груз так и не был размещен (неверная ячейка, груз уже размещен);
+# остальные записи удаляет TTL-индекс после истечения токена.
+
+SCAN_TOKEN_TTL_SECONDS = int(os.environ.get('SCAN_TOKEN_TTL_SECONDS', '120'))
+
+# Порядок важен: первый совпавший шаблон определяет тип кода
+SCAN_PAYLOAD_PATTERNS = [
+    ("tajline", re.compile(r"^TAJLINE\|(?P<kind>[^|]+)\|(?P<key>[^|]+)(?:\|.*)?$")),
+    ("cell_id", re.compile(r"^\d+-\d+-\d+-\d+$")),
+    ("cell_legacy", re.compile(r"^.+-Б\d+-П\d+-Я\d+$")),
+    ("cell_relative", re.compile(r"^Б(?P<block>\d+)-П(?P<shelf>\d+)-Я(?P<cell>\d+)$")),
+    # Компактные коды ячеек начинаются с номера склада с ведущим нулем, номера грузов - с ГГММ
+    ("cell_compact", re.compile(r"^0\d{7,8}$")),
+    ("individual", re.compile(r"^[^/|\s]+/[^/|\s]+/[^/|\s]+$")),
+    ("cargo_number", re.compile(r"^[^/|\s]+$")),
+]
+
+SCAN_CELL_KINDS = {"cell_id", "cell_legacy", "cell_relative", "cell_compact"}
+
+def classify_scan_payload(payload: str) -> tuple:
+    """Тип кода и результат совпадения шаблона; (None, None) - формат не распознан"""
+    for kind, pattern in SCAN_PAYLOAD_PATTERNS:
+        match = pattern.match(payload)
+        if match:
+            return kind, match
+    return None, None
+
+def issue_scan_token(current_user: User, kind: str, claims: dict) -> str:
+    """Токен проверки отсканированного груза/ячейки для последующего размещения"""
+    payload = {
+        **claims,
+        "typ": "scan",
+        "kind": kind,
+        "uid": current_user.id,
+        "jti": str(uuid.uuid4()),
+        "exp": datetime.utcnow() + timedelta(seconds=SCAN_TOKEN_TTL_SECONDS)
+    }
+    return jwt.encode(payload, SECRET_KEY, algorithm=ALGORITHM)
+
+def read_scan_token(token: str, current_user: User, kind: str) -> Optional[dict]:
+    """Данные токена проверки; None - токен недействителен, истек или выдан другому пользователю"""
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except jwt.PyJWTError:
+        return None
+    if payload.get("typ") != "scan" or payload.get("kind") != kind or payload.get("uid") != current_user.id:
+        return None
+    return payload
+
+def consume_scan_token(claims: dict) -> bool:
+    """Отметить токен использованным; False - токен уже использован (или выдан без jti)"""
+    if not claims.get("jti"):
+        return False
+    try:
+        db.scan_token_uses.insert_one({
+            "_id": claims["jti"],
+            "kind": claims.get("kind"),
+            "user_id": claims.get("uid"),
+            "expires_at": datetime.utcfromtimestamp(claims["exp"])
+        })
+    except DuplicateKeyError:
+        return False
+    return True
+
+def release_scan_token(claims: Optional[dict]):
+    """Вернуть токен, занятый consume_scan_token, если размещение не состоялось"""
+    if claims and claims.get("jti"):
+        db.scan_token_uses.delete_one({"_id": claims["jti"]})
+
+def _scan_cell(payload: str, kind: str, match, current_user: User) -> dict:
+    """Ячейка по справочнику ячеек и карте занятости, без запросов к базе"""
+    if current_user.role not in [UserRole.ADMIN, UserRole.WAREHOUSE_OPERATOR]:
+        raise HTTPException(status_code=403, detail="Access denied")
+    
+    if kind == "cell_relative":
+        # Б1-П2-Я3 - ячейка склада текущего оператора
+        warehouse_id = current_user.warehouse_id or next(iter(operator_bindings.warehouse_ids_for_operator(current_user.id)), None)
+        warehouse = cell_directory.warehouse(warehouse_id) if warehouse_id else cell_directory.first_warehouse()
+        block, shelf, cell = (int(match.group(name)) for name in ("block", "shelf", "cell"))
+        cell_id = cell_directory.cell_id(warehouse["id"], block, shelf, cell) if warehouse else None
+    else:
+        resolved = cell_directory.resolve(payload)
+        if not resolved:
+            raise HTTPException(status_code=400, detail="Invalid cell QR code format")
+        warehouse = resolved["warehouse"]
+        block, shelf, cell, cell_id = resolved["block"], resolved["shelf"], resolved["cell"], resolved["cell_id"]
+    
+    if not warehouse:
+        raise HTTPException(status_code=404, detail="Warehouse not found")
+    
+    is_free = cell_occupancy.is_free(warehouse["id"], block, shelf, cell)
+    cell_exists = cell_directory.layout_has_cell(warehouse["id"], block, shelf, cell)
+    if cell_exists is None:
+        # Без layout ячейка существует в пределах размеров склада (или в упрощенных диапазонах)
+        cell_exists = is_free is not None or (1 <= block <= 10 and 1 <= shelf <= 10 and 1 <= cell <= 100)
+    
+    cell_address = f"Б{block}-П{shelf}-Я{cell}"
+    cell_info = {
+        "warehouse_id": warehouse["id"],
+        "warehouse_name": warehouse.get("name") or "Неизвестный склад",
+        "block_number": block,
+        "shelf_number": shelf,
+        "cell_number": cell,
+        "cell_address": cell_address
+    }
+    result = {
+        "type": "warehouse_cell",
+        "cell": {
+            **cell_info,
+            "warehouse_id_number": warehouse.get("warehouse_id_number"),
+            "cell_id": cell_id,
+            "location_code": f"{block}-{shelf}-{cell}",
+            "cell_exists": cell_exists,
+            "is_occupied": is_free is False,
+            "cargo_id": cell_occupancy.cargo_at(warehouse["id"], block, shelf, cell) if is_free is False else None
+        },
+        "verification_token": None
+    }
+    if cell_exists:
+        result["verification_token"] = issue_scan_token(current_user, "cell", {"qr": payload, "cell_info": cell_info})
+        result["token_expires_in"] = SCAN_TOKEN_TTL_SECONDS
+    else:
+        result.update(error=f"Ячейка {cell_address} не существует на складе", error_code="CELL_NOT_EXISTS")
+    return result
+
+def _scan_cargo(payload: str, kind: str, match, current_user: User) -> Optional[dict]:
+    """Груз или единица груза одним запросом по индексу; None - не найден"""
+    individual_number = None
+    if kind == "individual":
+        individual_number = payload
+    elif kind == "tajline" and match.group("kind") == "INDIVIDUAL":
+        individual_number = match.group("key")
+    
+    if individual_number:
+        query = {"cargo_items.individual_items.individual_number": individual_number}
+    elif kind == "tajline":
+        query = {"$or": [{"id": match.group("key")}, {"cargo_number": match.group("key")}]}
+    else:
+        query = {"cargo_number": payload}
+    
+    cargo, cargo_collection = locate_cargo(query, {"_id": 0})
+    if not cargo:
+        return None
+    
+    if current_user.role == UserRole.USER and cargo.get("sender_id") != current_user.id:
+        raise HTTPException(status_code=403, detail="Access denied to this cargo")
+    
+    result = {
+        "type": "individual_unit" if individual_number else "cargo",
+        "cargo": {
+            "cargo_id": cargo.get("id"),
+            "cargo_number": cargo.get("cargo_number"),
+            "cargo_name": cargo.get("cargo_name", cargo.get("description", "Груз")),
+            "weight": cargo.get("weight", 0),
+            "declared_value": cargo.get("declared_value", 0),
+            "sender_name": cargo.get("sender_full_name", "Не указан"),
+            "recipient_name": cargo.get("recipient_full_name", "Не указан"),
+            "recipient_phone": cargo.get("recipient_phone", "Не указан"),
+            "status": cargo.get("status", "unknown"),
+            "processing_status": cargo.get("processing_status", "unknown"),
+            "payment_status": cargo.get("payment_status", "unknown"),
+            "warehouse_id": cargo.get("warehouse_id"),
+            "warehouse_name": cargo.get("warehouse_name", "Не указан"),
+            "warehouse_location": cargo.get("warehouse_location"),
+            "block_number": cargo.get("block_number"),
+            "shelf_number": cargo.get("shelf_number"),
+            "cell_number": cargo.get("cell_number"),
+            "available_operations": get_available_operations(cargo, current_user)
+        },
+        "verification_token": None
+    }
+    
+    unit = _find_individual_unit(cargo, individual_number) if individual_number else None
+    if individual_number:
+        result["unit"] = {
+            "individual_number": individual_number,
+            "is_placed": bool(unit and unit.get("is_placed", False)),
+            "placement_info": unit.get("placement_info") if unit else None
+        }
+    
+    if current_user.role not in [UserRole.ADMIN, UserRole.WAREHOUSE_OPERATOR]:
+        return result
+    
+    # Те же проверки, что и в /api/operator/placement/verify-cargo
+    if cargo_collection != "operator_cargo":
+        error_code, error = "CARGO_NOT_FOUND", "Груз не найден среди принятых грузов"
+    elif cargo.get("status") == "removed_from_placement":
+        error_code, error = "CARGO_REMOVED", "Груз исключен из размещения"
+    elif cargo.get("payment_status", "unpaid") != "paid":
+        error_code, error = "CARGO_UNPAID", "Груз не оплачен, размещение невозможно"
+    elif individual_number and not unit:
+        error_code, error = "UNIT_NOT_FOUND", f"Единица груза {individual_number} не найдена"
+    elif unit and unit.get("is_placed", False):
+        error_code, error = "UNIT_ALREADY_PLACED", f"Единица груза уже размещена: {unit.get('placement_info', 'Неизвестно')}"
+    else:
+        error_code = error = None
+    
+    if error_code:
+        result.update(error=error, error_code=error_code)
+    else:
+        result["verification_token"] = issue_scan_token(current_user, "cargo", {
+            "qr": payload,
+            "cargo_info": {
+                "cargo_id": cargo["id"],
+                "cargo_number": cargo.get("cargo_number"),
+                "individual_number": individual_number,
+                "sender_name": cargo.get("sender_full_name", "Неизвестно"),
+                "recipient_name": cargo.get("recipient_full_name", "Неизвестно")
+            }
+        })
+        result["token_expires_in"] = SCAN_TOKEN_TTL_SECONDS
+    return result
+
+@app.post("/api/scan")
+def universal_scan(
+    scan_data: dict,
+    current_user: User = Depends(get_current_user)
+):
+    """
+    🎯 Универсальное сканирование: груз, единица груза или ячейка по любому QR коду
+    
+    Возвращает type (cargo / individual_unit / warehouse_cell), данные сущности и
+    verification_token для /api/operator/placement/place-cargo, если размещение возможно.
+    """
+    payload = str(scan_data.get("qr_text") or scan_data.get("qr_code") or "").strip()
+    if not payload:
+        raise HTTPException(status_code=400, detail="QR code text is required")
+    
+    kind, match = classify_scan_payload(payload)
+    if kind is None:
+        raise HTTPException(status_code=400, detail="Unrecognized QR code format")
+    
+    try:
+        if kind in SCAN_CELL_KINDS:
+            result = _scan_cell(payload, kind, match, current_user)
+        else:
+            result = _scan_cargo(payload, kind, match, current_user)
+            if result is None and kind == "cargo_number" and parse_cell_code(payload):
+                # 8-9 цифр без ведущего нуля: груз не найден - пробуем компактный код ячейки
+                kind = "cell_compact"
+                result = _scan_cell(payload, kind, None, current_user)
+            if result is None:
+                raise HTTPException(status_code=404, detail=f"Nothing found for QR code {payload}")
+        
+        result.update({
+            "success": True,
+            "payload_format": kind,
+            "scan_timestamp": datetime.utcnow().isoformat()
+        })
+        return result
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"❌ Ошибка универсального сканирования: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error scanning QR code: {str(e)}")
+
 @app.post("/api/operator/placement/verify-cargo")
-async def verify_cargo_for_placement(
+def verify_cargo_for_placement(
     request: dict,
     current_user: User = Depends(get_current_user)
 ):
@@ -18461,7 +22512,7 @@ async def verify_cargo_for_placement(
         )
 
 @app.post("/api/operator/placement/verify-cell")
-async def verify_cell_for_placement(
+def verify_cell_for_placement(
     request: dict,
     current_user: User = Depends(get_current_user)
 ):
@@ -18513,14 +22564,14 @@ async def verify_cell_for_placement(
                     warehouse_id = current_user.warehouse_id
                     if not warehouse_id:
                         # Пытаемся получить склад из привязки оператора
-                        operator_binding = db.operator_warehouse_bindings.find_one({"operator_id": current_user.id})
-                        if operator_binding:
-                            warehouse_id = operator_binding.get("warehouse_id")
+                        operator_warehouse_ids = operator_bindings.warehouse_ids_for_operator(current_user.id)
+                        if operator_warehouse_ids:
+                            warehouse_id = operator_warehouse_ids[0]
                         else:
                             # Используем первый доступный склад
-                            warehouses = list(db.warehouses.find({}))
-                            if warehouses:
-                                warehouse_id = warehouses[0].get("id")
+                            first_warehouse = cell_directory.first_warehouse()
+                            if first_warehouse:
+                                warehouse_id = first_warehouse["id"]
                             else:
                                 raise HTTPException(
                                     status_code=400,
@@ -18542,24 +22593,24 @@ async def verify_cell_for_placement(
             warehouse_id = current_user.warehouse_id
             if not warehouse_id:
                 # Пытаемся получить склад из привязки оператора
-                operator_binding = db.operator_warehouse_bindings.find_one({"operator_id": current_user.id})
-                if operator_binding:
-                    warehouse_id = operator_binding.get("warehouse_id")
+                operator_warehouse_ids = operator_bindings.warehouse_ids_for_operator(current_user.id)
+                if operator_warehouse_ids:
+                    warehouse_id = operator_warehouse_ids[0]
                 else:
                     # Используем первый доступный склад
-                    warehouses = list(db.warehouses.find({}))
-                    if warehouses:
-                        warehouse_id = warehouses[0].get("id")
+                    first_warehouse = cell_directory.first_warehouse()
+                    if first_warehouse:
+                        warehouse_id = first_warehouse["id"]
         
         print(f"🔍 Проверка ячейки: Склад {warehouse_id}, Блок {block_number}, Полка {shelf_number}, Ячейка {cell_number}")
         
         # ИСПРАВЛЕНИЕ: Проверяем существование склада по warehouse_id_number, а не по UUID id
         if warehouse_id and warehouse_id.isdigit():
             # Если warehouse_id это номер (например, "001"), ищем по warehouse_id_number
-            warehouse = db.warehouses.find_one({"warehouse_id_number": warehouse_id})
+            warehouse = cell_directory.warehouse_by_id_number(warehouse_id)
         else:
             # Если это UUID, ищем по id
-            warehouse = db.warehouses.find_one({"id": warehouse_id})
+            warehouse = cell_directory.warehouse(warehouse_id)
             
         if not warehouse:
             return {
@@ -18569,27 +22620,11 @@ async def verify_cell_for_placement(
             }
         
         # ВРЕМЕННОЕ ИСПРАВЛЕНИЕ: Упрощенная проверка ячеек для тестирования
-        # Проверяем существование ячейки в структуре склада
-        warehouse_layout = warehouse.get("layout", {})
-        blocks = warehouse_layout.get("blocks", [])
-        
-        cell_exists = False
-        
-        if blocks:
-            # Если есть структура склада, проверяем по ней
-            for block in blocks:
-                if block.get("number") == block_number:
-                    shelves = block.get("shelves", [])
-                    for shelf in shelves:
-                        if shelf.get("number") == shelf_number:
-                            cells = shelf.get("cells", [])
-                            for cell in cells:
-                                if cell.get("number") == cell_number:
-                                    cell_exists = True
-                                    break
-                            break
-                    break
-        else:
+        # Проверяем существование ячейки в структуре склада (layout из справочника ячеек)
+        cell_exists = cell_directory.layout_has_cell(warehouse["id"], block_number, shelf_number, cell_number)
+        
+        if cell_exists is None:
+            cell_exists = False
             # УПРОЩЕННАЯ ЛОГИКА: Если структуры нет, принимаем разумные номера
             # Блоки: 1-10, Полки: 1-10, Ячейки: 1-100
             if (1 <= block_number <= 10 and 
@@ -18655,13 +22690,18 @@ async def verify_cell_for_placement(
     except HTTPException:
         raise
 @app.post("/api/operator/placement/place-cargo")
-async def place_cargo_in_cell(
+def place_cargo_in_cell(
     request: dict,
     current_user: User = Depends(get_current_user)
 ):
     """
     🎯 НОВЫЙ API: Размещение груза в ячейку со сканером
+    
+    Вместо cargo_qr_code/cell_qr_code можно передать cargo_token/cell_token из /api/scan -
+    тогда груз и ячейка повторно не читаются. Токен груза одноразовый, а статус, оплата
+    и размещение груза проверяются условием самой записи.
     """
+    claimed_token = None  # Токен груза, занятый этим запросом до подтверждения записи
     try:
         print(f"📦 Размещение груза в ячейку: {request}")
         
@@ -18674,20 +22714,47 @@ async def place_cargo_in_cell(
         
         cargo_qr = request.get("cargo_qr_code", "").strip()
         cell_qr = request.get("cell_qr_code", "").strip()
+        cargo_token = request.get("cargo_token")
+        cell_token = request.get("cell_token")
         
-        if not cargo_qr or not cell_qr:
+        if not (cargo_qr or cargo_token) or not (cell_qr or cell_token):
             raise HTTPException(
                 status_code=400,
                 detail="Необходимо указать QR коды груза и ячейки"
             )
         
+        # Токены из /api/scan заменяют повторную проверку груза и ячейки
+        cargo_claims = read_scan_token(cargo_token, current_user, "cargo") if cargo_token else None
+        cell_claims = read_scan_token(cell_token, current_user, "cell") if cell_token else None
+        if (cargo_token and not cargo_claims) or (cell_token and not cell_claims):
+            return {
+                "success": False,
+                "error": "Токен сканирования недействителен или истек, отсканируйте код повторно",
+                "error_code": "SCAN_TOKEN_INVALID"
+            }
+        # Токен ячейки подходит для нескольких грузов, токен груза - только для одного размещения
+        # Токен занимается до записи (параллельный запрос с тем же токеном получит отказ)
+        # и освобождается, если груз так и не был размещен
+        if cargo_claims and not consume_scan_token(cargo_claims):
+            return {
+                "success": False,
+                "error": "Токен сканирования груза уже использован, отсканируйте груз повторно",
+                "error_code": "SCAN_TOKEN_USED"
+            }
+        claimed_token = cargo_claims
+        
         # Проверяем груз
-        cargo_verification = await verify_cargo_for_placement(
-            {"qr_code": cargo_qr}, 
-            current_user
-        )
+        if cargo_claims:
+            cargo_verification = {"success": True, "cargo_info": cargo_claims["cargo_info"]}
+            cargo_qr = cargo_qr or cargo_claims["qr"]
+        else:
+            cargo_verification = verify_cargo_for_placement(
+                {"qr_code": cargo_qr}, 
+                current_user
+            )
         
         if not cargo_verification["success"]:
+            release_scan_token(claimed_token)
             return {
                 "success": False,
                 "error": cargo_verification["error"],
@@ -18695,12 +22762,17 @@ async def place_cargo_in_cell(
             }
         
         # Проверяем ячейку
-        cell_verification = await verify_cell_for_placement(
-            {"qr_code": cell_qr}, 
-            current_user
-        )
+        if cell_claims:
+            cell_verification = {"success": True, "cell_info": cell_claims["cell_info"]}
+            cell_qr = cell_qr or cell_claims["qr"]
+        else:
+            cell_verification = verify_cell_for_placement(
+                {"qr_code": cell_qr}, 
+                current_user
+            )
         
         if not cell_verification["success"]:
+            release_scan_token(claimed_token)
             return {
                 "success": False,
                 "error": cell_verification["error"],
@@ -18721,16 +22793,16 @@ async def place_cargo_in_cell(
         individual_number = cargo_info.get("individual_number")
         
         update_result = None
+        # Условия /api/operator/placement/verify-cargo повторяются в фильтре записи:
+        # груз могли исключить из размещения или разместить после сканирования
+        cargo_filter = {"id": cargo_id, "status": {"$ne": "removed_from_placement"}, "payment_status": "paid"}
         
         if individual_number:
             # Размещаем конкретную единицу груза
             print(f"📦 Размещение individual unit: {individual_number}")
             
             update_result = db.operator_cargo.update_one(
-                {
-                    "id": cargo_id,
-                    "cargo_items.individual_items.individual_number": individual_number
-                },
+                dict(cargo_filter, **{"cargo_items.individual_items.individual_number": individual_number}),
                 {
                     "$set": {
                         "cargo_items.$[item].individual_items.$[unit].is_placed": True,
@@ -18741,7 +22813,7 @@ async def place_cargo_in_cell(
                     }
                 },
                 array_filters=[
-                    {"unit.individual_number": individual_number},
+                    {"unit.individual_number": individual_number, "unit.is_placed": {"$ne": True}},
                     {"item.individual_items": {"$exists": True}}
                 ]
             )
@@ -18749,39 +22821,34 @@ async def place_cargo_in_cell(
             # Размещаем весь груз (все individual_items)
             print(f"📦 Размещение всего груза: {cargo_info['cargo_number']}")
             
-            # Находим груз и обновляем все individual_items
-            cargo = db.operator_cargo.find_one({"id": cargo_id})
-            if cargo:
-                cargo_items = cargo.get("cargo_items", [])
-                
-                # Обновляем каждый individual_item
-                for i, cargo_item in enumerate(cargo_items):
-                    individual_items = cargo_item.get("individual_items", [])
-                    for j, unit in enumerate(individual_items):
-                        if not unit.get("is_placed", False):  # Только неразмещенные единицы
-                            unit_placement_info = f"📍 {cell_info['cell_address']}"
-                            
-                            db.operator_cargo.update_one(
-                                {"id": cargo_id},
-                                {
-                                    "$set": {
-                                        f"cargo_items.{i}.individual_items.{j}.is_placed": True,
-                                        f"cargo_items.{i}.individual_items.{j}.placement_info": unit_placement_info,
-                                        f"cargo_items.{i}.individual_items.{j}.placement_timestamp": placement_timestamp.isoformat(),
-                                        f"cargo_items.{i}.individual_items.{j}.placed_by": current_user.full_name,
-                                        f"cargo_items.{i}.individual_items.{j}.placement_session_id": request.get("session_id", "")
-                                    }
-                                }
-                            )
-                
+            # Отмечаем все неразмещенные individual_items одним обновлением
+            update_result = db.operator_cargo.update_one(
+                cargo_filter,
+                {
+                    "$set": {
+                        "cargo_items.$[item].individual_items.$[unit].is_placed": True,
+                        "cargo_items.$[item].individual_items.$[unit].placement_info": placement_info,
+                        "cargo_items.$[item].individual_items.$[unit].placement_timestamp": placement_timestamp.isoformat(),
+                        "cargo_items.$[item].individual_items.$[unit].placed_by": current_user.full_name,
+                        "cargo_items.$[item].individual_items.$[unit].placement_session_id": request.get("session_id", "")
+                    }
+                },
+                array_filters=[
+                    {"unit.is_placed": {"$ne": True}},
+                    {"item.individual_items": {"$exists": True}}
+                ]
+            )
+            if update_result.matched_count:
                 update_result = type('obj', (object,), {'modified_count': 1})()
         
         if not update_result or update_result.modified_count == 0:
+            release_scan_token(claimed_token)
             return {
                 "success": False,
                 "error": "Не удалось обновить статус размещения груза",
                 "error_code": "UPDATE_FAILED"
             }
+        claimed_token = None
         
         # Создаем запись в истории размещения
         placement_record = {
@@ -18824,16 +22891,449 @@ async def place_cargo_in_cell(
         }
         
     except HTTPException:
+        release_scan_token(claimed_token)
         raise
     except Exception as e:
+        release_scan_token(claimed_token)
         print(f"❌ Ошибка размещения груза: {str(e)}")
         raise HTTPException(
             status_code=500,
             detail=f"Ошибка размещения груза: {str(e)}"
         )
 
+PLACEMENT_BATCH_MAX_ITEMS = int(os.environ.get('PLACEMENT_BATCH_MAX_ITEMS', '500'))
+
+PLACEMENT_CELL_PROJECTION = {
+    "_id": 0, "warehouse_id": 1, "warehouse_id_number": 1, "block_id_number": 1, "shelf_id_number": 1,
+    "cell_id_number": 1, "location_code": 1, "block_number": 1, "shelf_number": 1, "cell_number": 1,
+    "is_occupied": 1, "cargo_number": 1
+}
+
+PLACEMENT_CARGO_PROJECTION = {
+    "_id": 0, "id": 1, "cargo_number": 1, "cargo_name": 1, "weight": 1, "status": 1, "cargo_items": 1,
+    "sender_full_name": 1, "recipient_full_name": 1
+}
+
+# Поля размещения, которые снимаются с ячейки при отмене занятия
+PLACEMENT_RELEASED_CELL_FIELDS = [
+    "cargo_number", "cargo_name", "cargo_weight", "placed_at", "placed_by", "placed_by_name", "individual_number", "placement_id"
+]
+
+def _reject_placement(result: dict, error_code: str, error: str):
+    result.update(success=False, error_code=error_code, error=error)
+
+def _find_individual_unit(cargo: dict, individual_number: str) -> Optional[dict]:
+    for cargo_item in cargo.get("cargo_items") or []:
+        for unit in cargo_item.get("individual_items") or []:
+            if unit.get("individual_number") == individual_number:
+                return unit
+    return None
+
+def _confirm_cell_claims(entries: list, now: datetime) -> list:
+    """Оставить позиции, чья запись заняла ячейку единолично; ячейку, параллельно занятую
+    другим размещением (в том числе дублем записи ячейки), освободить и позицию отклонить"""
+    occupied: Dict[tuple, list] = {}
+    for record in db.warehouse_cells.find(
+        {"$or": [entry["cell_filter"] for entry in entries], "is_occupied": True},
+        dict(PLACEMENT_CELL_PROJECTION, _id=1, placement_id=1)
+    ):
+        id_key = (record.get("warehouse_id_number"), record.get("block_id_number"), record.get("shelf_id_number"), record.get("cell_id_number"))
+        legacy_key = (record.get("warehouse_id"), record.get("location_code"))
+        for key in {id_key, legacy_key}:
+            occupied.setdefault(key, []).append(record)
+    
+    confirmed, conflicts = [], []
+    for entry in entries:
+        records = occupied.get(tuple(entry["cell_filter"].values()), [])
+        own = [record for record in records if record.get("placement_id") == entry["placement_id"]]
+        others = [record for record in records if record.get("placement_id") != entry["placement_id"]]
+        if own:
+            entry["cell_record_id"] = own[0]["_id"]
+        if own and not others:
+            confirmed.append(entry)
+            continue
+        taken_by = others[0].get("cargo_number", "unknown") if others else "unknown"
+        _reject_placement(entry["result"], "CELL_OCCUPIED", f"Ячейка уже занята грузом {taken_by}")
+        if own:
+            conflicts.append(entry)
+    _release_claimed_cells(conflicts, now)
+    return confirmed
+
+def _applied_placement_ids(collection, cargo_numbers: list) -> Set[str]:
+    """Идентификаторы размещений, записанные в грузы (целиком или в единицы груза)"""
+    applied = set()
+    if not cargo_numbers:
+        return applied
+    for cargo in collection.find(
+        {"cargo_number": {"$in": cargo_numbers}},
+        {"_id": 0, "placement_id": 1, "cargo_items.individual_items.placement_id": 1}
+    ):
+        applied.add(cargo.get("placement_id"))
+        for cargo_item in cargo.get("cargo_items") or []:
+            applied.update(unit.get("placement_id") for unit in cargo_item.get("individual_items") or [])
+    applied.discard(None)
+    return applied
+
+def _release_claimed_cells(entries: list, now: datetime):
+    """Отменить занятие ячеек позициями пакета: созданные записи удалить, существующие освободить"""
+    operations = []
+    for entry in entries:
+        if "cell_record_id" not in entry:
+            continue
+        own_cell = {"_id": entry["cell_record_id"], "placement_id": entry["placement_id"]}
+        if entry["cell_created"]:
+            operations.append(TrackedDeleteOne(own_cell))
+        else:
+            operations.append(TrackedUpdateOne(own_cell, {
+                "$set": {"is_occupied": False, "cargo_id": None, "updated_at": now},
+                "$unset": {field: "" for field in PLACEMENT_RELEASED_CELL_FIELDS}
+            }))
+    if operations:
+        bulk_write_failures(db.warehouse_cells, operations)
+
+@app.post("/api/operator/placement/place-batch")
+def place_cargo_batch(
+    request: dict,
+    current_user: User = Depends(get_current_user)
+):
+    """
+    🎯 Пакетное размещение грузов сканером: N пар (cargo_code, cell_code) за один запрос
+    
+    Склады берутся из справочника ячеек, ячейки и грузы загружаются запросами $in,
+    занятость проверяется в памяти, запись - один bulk_write на коллекцию. Ячейка
+    занимается, только если она свободна, и освобождается, если груз обновить не удалось.
+    Ошибка одной пары не отменяет остальные: в results для каждой позиции возвращается
+    success или error/error_code.
+    """
+    if current_user.role != UserRole.WAREHOUSE_OPERATOR:
+        raise HTTPException(
+            status_code=403,
+            detail="Недостаточно прав доступа для размещения грузов"
+        )
+    
+    items = request.get("items")
+    if not isinstance(items, list) or not items:
+        raise HTTPException(
+            status_code=400,
+            detail="Необходимо указать список items с парами cargo_code и cell_code"
+        )
+    if len(items) > PLACEMENT_BATCH_MAX_ITEMS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Слишком много позиций в пакете (максимум {PLACEMENT_BATCH_MAX_ITEMS})"
+        )
+    
+    session_id = request.get("session_id") or str(uuid.uuid4())
+    
+    try:
+        print(f"📦 Пакетное размещение: {len(items)} позиций, сессия {session_id}")
+        
+        # 1. Разбор кодов и поиск складов - по справочнику ячеек, без обращения к базе
+        results = []
+        pending = []
+        for index, item in enumerate(items):
+            item = item if isinstance(item, dict) else {}
+            cargo_code = str(item.get("cargo_code") or item.get("cargo_number") or "").strip()
+            cell_code = str(item.get("cell_code") or "").strip()
+            result = {"index": index, "cargo_code": cargo_code, "cell_code": cell_code, "success": False}
+            results.append(result)
+            
+            if not cargo_code or not cell_code:
+                _reject_placement(result, "MISSING_CODES", "Необходимо указать cargo_code и cell_code")
+                continue
+            resolved_cell = cell_directory.resolve(cell_code)
+            if not resolved_cell:
+                _reject_placement(result, "INVALID_CELL_CODE", "Неверный формат кода ячейки")
+                continue
+            if not resolved_cell["warehouse"]:
+                _reject_placement(result, "WAREHOUSE_NOT_FOUND", f"Склад {resolved_cell['warehouse_key']} не найден")
+                continue
+            
+            # Формат individual_number: CARGO_NUMBER/TYPE/UNIT
+            pending.append({
+                "result": result,
+                "cell": resolved_cell,
+                "warehouse": resolved_cell["warehouse"],
+                "cargo_number": cargo_code.split("/")[0],
+                "individual_number": cargo_code if "/" in cargo_code else None
+            })
+        
+        # 2. Ячейки - одним запросом: ID система по номерам, старая система по location_code
+        cell_clauses = []
+        for entry in pending:
+            cell = entry["cell"]
+            if cell["format"] == "id":
+                cell_clauses.append({
+                    "warehouse_id_number": cell["warehouse_key"],
+                    "block_id_number": cell["block_id_number"],
+                    "shelf_id_number": cell["shelf_id_number"],
+                    "cell_id_number": cell["cell_id_number"]
+                })
+            else:
+                cell_clauses.append({
+                    "warehouse_id": entry["warehouse"]["id"],
+                    "location_code": f"{cell['block']}-{cell['shelf']}-{cell['cell']}"
+                })
+        
+        id_cells = {}
+        legacy_cells = {}
+        if cell_clauses:
+            for record in db.warehouse_cells.find({"$or": cell_clauses}, PLACEMENT_CELL_PROJECTION):
+                # Среди дублей записи ячейки приоритет у занятой
+                id_key = (record.get("warehouse_id_number"), record.get("block_id_number"), record.get("shelf_id_number"), record.get("cell_id_number"))
+                legacy_key = (record.get("warehouse_id"), record.get("location_code"))
+                for cells, key in ((id_cells, id_key), (legacy_cells, legacy_key)):
+                    if key not in cells or record.get("is_occupied") is True:
+                        cells[key] = record
+        
+        # 3. Грузы - одним $unionWith запросом по cargo и operator_cargo
+        found_cargo = locate_cargo_many("cargo_number", list({entry["cargo_number"] for entry in pending}), PLACEMENT_CARGO_PROJECTION)
+        
+        # 4. Проверки в памяти, включая конфликты внутри пакета
+        now = datetime.utcnow()
+        taken_cells = {}
+        taken_cargo = set()
+        accepted = []
+        for entry in pending:
+            result = entry["result"]
+            cell = entry["cell"]
+            warehouse = entry["warehouse"]
+            cargo_number = entry["cargo_number"]
+            individual_number = entry["individual_number"]
+            
+            cargo, cargo_collection = found_cargo.get(cargo_number, (None, None))
+            if not cargo:
+                _reject_placement(result, "CARGO_NOT_FOUND", f"Груз {cargo_number} не найден")
+                continue
+            if cargo.get("status") == "removed_from_placement":
+                _reject_placement(result, "CARGO_REMOVED", "Груз исключен из размещения")
+                continue
+            if individual_number:
+                unit = _find_individual_unit(cargo, individual_number)
+                if not unit:
+                    _reject_placement(result, "UNIT_NOT_FOUND", f"Единица груза {individual_number} не найдена")
+                    continue
+                if unit.get("is_placed", False):
+                    _reject_placement(result, "UNIT_ALREADY_PLACED", f"Единица груза уже размещена: {unit.get('placement_info', 'Неизвестно')}")
+                    continue
+            
+            cargo_key = individual_number or cargo_number
+            if cargo_key in taken_cargo:
+                _reject_placement(result, "DUPLICATE_IN_BATCH", f"Груз {cargo_key} уже есть в этом пакете")
+                continue
+            
+            if cell["format"] == "id":
+                cell_filter = {
+                    "warehouse_id_number": cell["warehouse_key"],
+                    "block_id_number": cell["block_id_number"],
+                    "shelf_id_number": cell["shelf_id_number"],
+                    "cell_id_number": cell["cell_id_number"]
+                }
+                record = id_cells.get(tuple(cell_filter.values()))
+                # Номера блока/полки/ячейки берем из записи ячейки, если она есть
+                block = record.get("block_number", cell["block"]) if record else cell["block"]
+                shelf = record.get("shelf_number", cell["shelf"]) if record else cell["shelf"]
+                cell_number = record.get("cell_number", cell["cell"]) if record else cell["cell"]
+            else:
+                block, shelf, cell_number = cell["block"], cell["shelf"], cell["cell"]
+                cell_filter = {"warehouse_id": warehouse["id"], "location_code": f"{block}-{shelf}-{cell_number}"}
+                record = legacy_cells.get(tuple(cell_filter.values()))
+            
+            location_code = f"{block}-{shelf}-{cell_number}"
+            if record and record.get("is_occupied") is True:
+                _reject_placement(result, "CELL_OCCUPIED", f"Ячейка уже занята грузом {record.get('cargo_number', 'unknown')}")
+                continue
+            cell_key = (warehouse["id"], location_code)
+            if cell_key in taken_cells:
+                _reject_placement(result, "CELL_OCCUPIED", f"Ячейка уже занята грузом {taken_cells[cell_key]} в этом пакете")
+                continue
+            taken_cells[cell_key] = cargo_key
+            taken_cargo.add(cargo_key)
+            
+            cell_address = f"Б{block}-П{shelf}-Я{cell_number}"
+            # Идентификатор размещения (id записи placement_history) в ячейке и грузе -
+            # по нему после записи проверяется, какие изменения применились
+            placement_id = str(uuid.uuid4())
+            cell_data = {
+                "warehouse_id": warehouse["id"],
+                "warehouse_name": warehouse.get("name", "Неизвестный склад"),
+                "cargo_id": cargo.get("id"),
+                "cargo_number": cargo_number,
+                "cargo_name": cargo.get("cargo_name", "Груз"),
+                "cargo_weight": cargo.get("weight", 0),
+                "placed_at": now,
+                "placed_by": current_user.id,
+                "placed_by_name": current_user.full_name,
+                "is_occupied": True,
+                "location_code": location_code,
+                "block_number": block,
+                "shelf_number": shelf,
+                "cell_number": cell_number,
+                "placement_id": placement_id
+            }
+            if cell["format"] == "id":
+                cell_data.update({
+                    "warehouse_id_number": cell["warehouse_key"],
+                    "block_id_number": cell["block_id_number"],
+                    "shelf_id_number": cell["shelf_id_number"],
+                    "cell_id_number": cell["cell_id_number"],
+                    "id_based_code": entry["result"]["cell_code"],
+                    "readable_name": cell_address
+                })
+            if individual_number:
+                cell_data["individual_number"] = individual_number
+            
+            if individual_number:
+                # Размещаем конкретную единицу груза, как в /api/operator/placement/place-cargo
+                cargo_operation = TrackedUpdateOne(
+                    {"cargo_number": cargo_number, "cargo_items.individual_items.individual_number": individual_number},
+                    {"$set": {
+                        "cargo_items.$[item].individual_items.$[unit].placement_id": placement_id,
+                        "cargo_items.$[item].individual_items.$[unit].is_placed": True,
+                        "cargo_items.$[item].individual_items.$[unit].placement_info": f"📍 {cell_address}",
+                        "cargo_items.$[item].individual_items.$[unit].placement_timestamp": now.isoformat(),
+                        "cargo_items.$[item].individual_items.$[unit].placed_by": current_user.full_name,
+                        "cargo_items.$[item].individual_items.$[unit].placement_session_id": session_id
+                    }},
+                    array_filters=[
+                        {"unit.individual_number": individual_number, "unit.is_placed": {"$ne": True}},
+                        {"item.individual_items": {"$exists": True}}
+                    ]
+                )
+            else:
+                # Размещаем груз целиком, как в /api/cargo/place-in-cell
+                update_data = {
+                    "status": "placed_in_warehouse",
+                    "processing_status": "placed",
+                    "warehouse_location": f"Блок {block}, Полка {shelf}, Ячейка {cell_number}",
+                    "warehouse_id": warehouse["id"],
+                    "warehouse_name": warehouse.get("name"),
+                    "block_number": block,
+                    "shelf_number": shelf,
+                    "cell_number": cell_number,
+                    "placement_date": now,
+                    "placed_by": current_user.id,
+                    "placed_by_name": current_user.full_name,
+                    "placement_id": placement_id,
+                    "updated_at": now
+                }
+                if cell["format"] == "id":
+                    update_data.update({
+                        "warehouse_id_number": cell["warehouse_key"],
+                        "id_based_location": entry["result"]["cell_code"],
+                        "readable_location": cell_address
+                    })
+                cargo_operation = TrackedUpdateOne(
+                    {"cargo_number": cargo_number, "status": {"$ne": "removed_from_placement"}},
+                    {"$set": update_data}
+                )
+            
+            # Существующая ячейка занимается, только если она все еще свободна
+            cell_operation = TrackedUpdateOne(dict(cell_filter, is_occupied={"$ne": True}), {"$set": cell_data}, upsert=record is None)
+            entry.update({
+                "placement_id": placement_id,
+                "cell_filter": cell_filter,
+                "cell_created": record is None,
+                "cargo": cargo,
+                "cargo_collection": cargo_collection,
+                "cell_address": cell_address,
+                "block": block,
+                "shelf": shelf,
+                "cell_number": cell_number,
+                "cell_operation": cell_operation,
+                "cargo_operation": cargo_operation
+            })
+            accepted.append(entry)
+        
+        # 5. Запись: один bulk_write на коллекцию, сначала ячейки, затем грузы;
+        # ячейки грузов, которые обновить не удалось, освобождаются
+        def write_batch(collection, entries, operation_key, error_code, error):
+            try:
+                collection.bulk_write([entry[operation_key] for entry in entries], ordered=False)
+            except BulkWriteError as e:
+                failed_indexes = {write_error["index"] for write_error in e.details.get("writeErrors", [])}
+                for index in failed_indexes:
+                    _reject_placement(entries[index]["result"], error_code, error)
+                return [entry for index, entry in enumerate(entries) if index not in failed_indexes]
+            return entries
+        
+        if accepted:
+            accepted = write_batch(db.warehouse_cells, accepted, "cell_operation", "CELL_WRITE_FAILED", "Не удалось занять ячейку")
+            accepted = _confirm_cell_claims(accepted, now)
+        
+        entries_by_collection: Dict[str, list] = {}
+        for entry in accepted:
+            entries_by_collection.setdefault(entry["cargo_collection"], []).append(entry)
+        accepted = []
+        for collection_name, entries in entries_by_collection.items():
+            written = write_batch(db[collection_name], entries, "cargo_operation", "UPDATE_FAILED", "Не удалось обновить статус размещения груза")
+            applied = _applied_placement_ids(db[collection_name], [entry["cargo_number"] for entry in written])
+            for entry in written:
+                if entry["placement_id"] in applied:
+                    accepted.append(entry)
+                else:
+                    _reject_placement(entry["result"], "UPDATE_FAILED", "Груз уже размещен или исключен из размещения")
+            _release_claimed_cells([entry for entry in entries if entry["placement_id"] not in applied], now)
+        
+        placement_records = []
+        for entry in sorted(accepted, key=lambda entry: entry["result"]["index"]):
+            result = entry["result"]
+            cargo = entry["cargo"]
+            warehouse = entry["warehouse"]
+            placement_records.append({
+                "id": entry["placement_id"],
+                "session_id": session_id,
+                "cargo_id": cargo.get("id"),
+                "cargo_number": entry["cargo_number"],
+                "individual_number": entry["individual_number"],
+                "cell_address": entry["cell_address"],
+                "warehouse_id": warehouse["id"],
+                "warehouse_name": warehouse.get("name", "Неизвестен"),
+                "block_number": entry["block"],
+                "shelf_number": entry["shelf"],
+                "cell_number": entry["cell_number"],
+                "placed_by": current_user.full_name,
+                "placed_by_id": current_user.id,
+                "placement_timestamp": now.isoformat(),
+                "sender_name": cargo.get("sender_full_name", "Неизвестно"),
+                "recipient_name": cargo.get("recipient_full_name", "Неизвестно"),
+                "cargo_qr_code": result["cargo_code"],
+                "cell_qr_code": result["cell_code"]
+            })
+            result.update({
+                "success": True,
+                "cargo_number": entry["cargo_number"],
+                "individual_number": entry["individual_number"],
+                "warehouse_name": warehouse.get("name"),
+                "cell_address": entry["cell_address"]
+            })
+        if placement_records:
+            db.placement_history.insert_many(placement_records, ordered=False)
+        
+        placed = len(placement_records)
+        print(f"✅ Пакетное размещение {session_id}: размещено {placed} из {len(results)}")
+        
+        return {
+            "success": placed == len(results),
+            "session_id": session_id,
+            "total": len(results),
+            "placed": placed,
+            "failed": len(results) - placed,
+            "placement_timestamp": now.isoformat(),
+            "results": results
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"❌ Ошибка пакетного размещения: {str(e)}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Ошибка пакетного размещения: {str(e)}"
+        )
+
 @app.get("/api/operator/placement/session-history")
-async def get_placement_session_history(
+def get_placement_session_history(
     session_id: str = None,
     limit: int = 50,
     current_user: User = Depends(get_current_user)
@@ -18931,7 +23431,7 @@ async def get_placement_session_history(
         )
 
 @app.delete("/api/operator/placement/undo-last")
-async def undo_last_placement(
+def undo_last_placement(
     session_id: str,
     current_user: User = Depends(get_current_user)
 ):
@@ -18992,27 +23492,23 @@ async def undo_last_placement(
                 ]
             )
         else:
-            # Отменяем размещение всего груза
-            cargo = db.operator_cargo.find_one({"id": cargo_id})
-            if cargo:
-                cargo_items = cargo.get("cargo_items", [])
-                
-                for i, cargo_item in enumerate(cargo_items):
-                    individual_items = cargo_item.get("individual_items", [])
-                    for j, unit in enumerate(individual_items):
-                        if unit.get("placement_session_id") == session_id:
-                            db.operator_cargo.update_one(
-                                {"id": cargo_id},
-                                {
-                                    "$set": {
-                                        f"cargo_items.{i}.individual_items.{j}.is_placed": False,
-                                        f"cargo_items.{i}.individual_items.{j}.placement_info": None,
-                                        f"cargo_items.{i}.individual_items.{j}.placement_timestamp": None,
-                                        f"cargo_items.{i}.individual_items.{j}.placed_by": None,
-                                        f"cargo_items.{i}.individual_items.{j}.placement_session_id": None
-                                    }
-                                }
-                            )
+            # Отменяем размещение всех единиц груза из этой сессии одним обновлением
+            db.operator_cargo.update_one(
+                {"id": cargo_id},
+                {
+                    "$set": {
+                        "cargo_items.$[item].individual_items.$[unit].is_placed": False,
+                        "cargo_items.$[item].individual_items.$[unit].placement_info": None,
+                        "cargo_items.$[item].individual_items.$[unit].placement_timestamp": None,
+                        "cargo_items.$[item].individual_items.$[unit].placed_by": None,
+                        "cargo_items.$[item].individual_items.$[unit].placement_session_id": None
+                    }
+                },
+                array_filters=[
+                    {"unit.placement_session_id": session_id},
+                    {"item.individual_items": {"$exists": True}}
+                ]
+            )
             
             update_result = type('obj', (object,), {'modified_count': 1})()
         
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+НАГРУЗОЧНЫЙ БЕНЧМАРК: Аналитика GPS треков курьеров в TAJLINE.TJ
+
+ЦЕЛЬ:
+Сравнить время расчета аналитики курьеров за 7 дней для 500 курьеров:
+- прежний способ: запрос истории на каждого курьера и цикл по точкам со скалярной
+  формулой Haversine
+- новый способ: один aggregate по всем курьерам и векторный расчет в NumPy
+  (track_columns + summarize_tracks из backend/server.py)
+
+Бенчмарк работает с отдельной базой (BENCHMARK_DB_NAME) и сам генерирует историю:
+    MONGO_URL=mongodb://localhost:27017 python benchmarks/courier_track_analytics_benchmark.py
+
+ОЖИДАЕМЫЙ РЕЗУЛЬТАТ: векторный расчет на порядок быстрее, расстояния совпадают
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+BENCHMARK_DB_NAME = os.environ.get('BENCHMARK_DB_NAME', 'tajline_track_benchmark')
+os.environ['DB_NAME'] = BENCHMARK_DB_NAME
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend'))
+
+import server  # noqa: E402
+
+STATUSES = ["online", "busy", "on_route", "offline"]
+
+def populate(couriers, days, interval_seconds, active_hours, batch_size):
+    """Сгенерировать синтетическую историю: каждый курьер движется случайным блужданием"""
+    raw = server.client[BENCHMARK_DB_NAME]
+    raw.couriers.drop()
+    raw.courier_requests.drop()
+    raw[server.GPS_HISTORY_COLLECTION].drop()
+    print(f"🛰️ Коллекция истории: {server.ensure_gps_history_collection()}")
+    raw[server.GPS_HISTORY_COLLECTION].create_index([("courier_id", 1), ("timestamp", -1)], name="tl_courier_timestamp")
+
+    now = datetime.utcnow()
+    raw.couriers.insert_many([
+        {"id": f"courier-{number:04d}", "full_name": f"Курьер {number}", "transport_type": "car", "is_active": True, "created_at": now}
+        for number in range(couriers)
+    ])
+
+    start_day = (now - timedelta(days=days)).replace(hour=0, minute=0, second=0, microsecond=0)
+    points_per_day = int(active_hours * 3600 / interval_seconds)
+    inserted = 0
+    batch = []
+    started = time.perf_counter()
+    for number in range(couriers):
+        courier_id = f"courier-{number:04d}"
+        latitude, longitude = 38.56 + random.uniform(-0.1, 0.1), 68.78 + random.uniform(-0.1, 0.1)
+        for day in range(days):
+            timestamp = start_day + timedelta(days=day, hours=8)
+            for _ in range(points_per_day):
+                latitude += random.uniform(-0.0005, 0.0005)
+                longitude += random.uniform(-0.0005, 0.0005)
+                batch.append({
+                    "id": str(uuid.uuid4()),
+                    "courier_id": courier_id,
+                    "latitude": latitude,
+                    "longitude": longitude,
+                    "speed": random.uniform(0, 60),
+                    "status": random.choice(STATUSES),
+                    "timestamp": timestamp,
+                    "date": timestamp.date().isoformat(),
+                    "hour": timestamp.hour
+                })
+                timestamp += timedelta(seconds=interval_seconds)
+                if len(batch) >= batch_size:
+                    raw[server.GPS_HISTORY_COLLECTION].insert_many(batch, ordered=False)
+                    inserted += len(batch)
+                    batch = []
+    if batch:
+        raw[server.GPS_HISTORY_COLLECTION].insert_many(batch, ordered=False)
+        inserted += len(batch)
+    print(f"📦 Вставлено {inserted} точек за {time.perf_counter() - started:.1f} с")
+    return start_day
+
+def scalar_haversine(lat1, lon1, lat2, lon2):
+    """Прежняя скалярная формула calculate_distance"""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 6371.0 * 2 * math.asin(math.sqrt(a))
+
+def legacy_analytics(period_filter):
+    """Прежний расчет: запрос на курьера и цикл по точкам"""
+    distances = {}
+    for courier in server.db.couriers.find({"is_active": True}, {"_id": 0, "id": 1}):
+        history = list(server.db[server.GPS_HISTORY_COLLECTION].find(
+            {"courier_id": courier["id"], **period_filter}, {"_id": 0}
+        ).sort("timestamp", 1))
+        total_distance = 0.0
+        for i in range(1, len(history)):
+            if history[i]["date"] == history[i - 1]["date"]:
+                total_distance += scalar_haversine(
+                    history[i - 1]["latitude"], history[i - 1]["longitude"],
+                    history[i]["latitude"], history[i]["longitude"]
+                )
+        if history:
+            distances[courier["id"]] = total_distance
+    return distances
+
+def vectorized_analytics(period_filter):
+    """Новый расчет: один aggregate и NumPy"""
+    courier_ids = [courier["id"] for courier in server.db.couriers.find({"is_active": True}, {"_id": 0, "id": 1})]
+    points = server.db[server.GPS_HISTORY_COLLECTION].aggregate([
+        {"$match": {"courier_id": {"$in": courier_ids}, **period_filter}},
+        {"$sort": {"courier_id": 1, "timestamp": 1}},
+        {"$project": server.TRACK_POINT_PROJECTION}
+    ], allowDiskUse=True)
+    return {courier_id: summary["total"]["distance_km"] for courier_id, summary in server.summarize_tracks(server.track_columns(points)).items()}
+
+def timed(function, *args):
+    started = time.perf_counter()
+    result = function(*args)
+    return result, round(time.perf_counter() - started, 3)
+
+def main():
+    parser = argparse.ArgumentParser(description="Аналитика треков: цикл по точкам против NumPy")
+    parser.add_argument("--label", default="run", help="Метка прогона")
+    parser.add_argument("--couriers", type=int, default=500, help="Количество курьеров")
+    parser.add_argument("--days", type=int, default=7, help="Дней истории")
+    parser.add_argument("--interval", type=int, default=60, help="Интервал между точками, с")
+    parser.add_argument("--active-hours", type=float, default=10, help="Часов работы в день")
+    parser.add_argument("--batch", type=int, default=10000, help="Размер пачки вставки")
+    parser.add_argument("--skip-populate", action="store_true", help="Использовать уже заполненную базу")
+    args = parser.parse_args()
+
+    print(f"📊 Бенчмарк аналитики треков [{args.label}] на базе {BENCHMARK_DB_NAME}")
+    random.seed(42)
+    if not args.skip_populate:
+        populate(args.couriers, args.days, args.interval, args.active_hours, args.batch)
+
+    period_filter, date_from, date_to = server.track_period_filter(None, None, args.days)
+    legacy, legacy_seconds = timed(legacy_analytics, period_filter)
+    vectorized, vectorized_seconds = timed(vectorized_analytics, period_filter)
+
+    max_difference = max(
+        (abs(round(legacy[courier_id], 2) - vectorized.get(courier_id, 0)) for courier_id in legacy),
+        default=0
+    )
+    result = {
+        "label": args.label,
+        "period": {"from": date_from, "to": date_to},
+        "couriers": len(vectorized),
+        "points": server.db[server.GPS_HISTORY_COLLECTION].count_documents(period_filter),
+        "legacy_seconds": legacy_seconds,
+        "vectorized_seconds": vectorized_seconds,
+        "speedup": round(legacy_seconds / vectorized_seconds, 1) if vectorized_seconds else None,
+        "max_distance_difference_km": round(max_difference, 3)
+    }
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+НАГРУЗОЧНЫЙ БЕНЧМАРК: Подбор ближайших курьеров к точке забора в TAJLINE.TJ
+
+ЦЕЛЬ:
+Сравнить p50/p95/p99 задержки поиска K ближайших доступных курьеров среди 10 000:
+- прежний способ: выборка всех позиций не в статусе offline и расчет Haversine
+  до каждой в Python с сортировкой
+- новый способ: $geoNear по индексу 2dsphere с фильтрами склада и вместимости
+  (find_nearest_couriers из backend/server.py)
+
+Бенчмарк работает с отдельной базой (BENCHMARK_DB_NAME) и сам генерирует курьеров:
+    MONGO_URL=mongodb://localhost:27017 python benchmarks/nearest_courier_benchmark.py --couriers 10000
+
+ОЖИДАЕМЫЙ РЕЗУЛЬТАТ: $geoNear на порядки быстрее, списки ближайших курьеров совпадают
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+BENCHMARK_DB_NAME = os.environ.get('BENCHMARK_DB_NAME', 'tajline_dispatch_benchmark')
+os.environ['DB_NAME'] = BENCHMARK_DB_NAME
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend'))
+
+import server  # noqa: E402
+
+CITY_CENTER = (38.56, 68.78)
+CITY_RADIUS_DEGREES = 0.15
+STATUSES = ["online", "busy", "on_route", "offline"]
+TRANSPORT = [("bike", 20.0), ("motorcycle", 50.0), ("car", 300.0), ("van", 1500.0), ("truck", 5000.0)]
+
+def percentile(values, p):
+    """Перцентиль по методу ближайшего ранга"""
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(p / 100.0 * len(ordered))) - 1))
+    return ordered[index]
+
+def random_point():
+    return (
+        CITY_CENTER[0] + random.uniform(-CITY_RADIUS_DEGREES, CITY_RADIUS_DEGREES),
+        CITY_CENTER[1] + random.uniform(-CITY_RADIUS_DEGREES, CITY_RADIUS_DEGREES)
+    )
+
+def populate(couriers, warehouses, batch_size):
+    """Сгенерировать курьеров и их последние позиции, разбросанные по городу"""
+    raw = server.client[BENCHMARK_DB_NAME]
+    raw.couriers.drop()
+    raw.courier_locations.drop()
+    for definition in server.INDEX_DEFINITIONS["courier_locations"]:
+        options = {"name": definition["name"]}
+        if definition.get("unique"):
+            options.update(unique=True, partialFilterExpression=definition["partial"])
+        raw.courier_locations.create_index(definition["keys"], **options)
+
+    now = datetime.utcnow()
+    started = time.perf_counter()
+    for offset in range(0, couriers, batch_size):
+        courier_batch, location_batch = [], []
+        for number in range(offset, min(couriers, offset + batch_size)):
+            transport_type, capacity = random.choice(TRANSPORT)
+            courier = {
+                "id": f"courier-{number:05d}",
+                "full_name": f"Курьер {number}",
+                "phone": f"+992{900000000 + number}",
+                "transport_type": transport_type,
+                "transport_capacity": capacity,
+                "assigned_warehouse_id": f"warehouse-{number % warehouses}",
+                "is_active": random.random() > 0.05
+            }
+            latitude, longitude = random_point()
+            courier_batch.append(dict(courier, created_at=now))
+            location_batch.append({
+                "id": str(uuid.uuid4()),
+                "courier_id": courier["id"],
+                "courier_name": courier["full_name"],
+                "transport_type": transport_type,
+                "latitude": latitude,
+                "longitude": longitude,
+                "status": random.choice(STATUSES),
+                "location": server.geojson_point(latitude, longitude),
+                **server.courier_profile_dispatch_fields(courier),
+                "last_updated": now - timedelta(minutes=random.uniform(0, 2 * server.NEAREST_MAX_LOCATION_AGE_MINUTES)),
+                "created_at": now
+            })
+        raw.couriers.insert_many(courier_batch, ordered=False)
+        raw.courier_locations.insert_many(location_batch, ordered=False)
+    print(f"📦 Вставлено {couriers} курьеров за {time.perf_counter() - started:.1f} с")
+
+def legacy_nearest(latitude, longitude, limit, warehouse_ids, min_capacity):
+    """Прежний способ: все позиции в Python и Haversine до каждой"""
+    cutoff = datetime.utcnow() - timedelta(minutes=server.NEAREST_MAX_LOCATION_AGE_MINUTES)
+    candidates = []
+    for location in server.db.courier_locations.find({"status": {"$ne": "offline"}}, {"_id": 0}):
+        if location.get("courier_active") is False or location["last_updated"] < cutoff:
+            continue
+        if warehouse_ids is not None and location.get("assigned_warehouse_id") not in warehouse_ids:
+            continue
+        if min_capacity is not None and (location.get("transport_capacity") or 0) < min_capacity:
+            continue
+        distance = server.calculate_distance(latitude, longitude, location["latitude"], location["longitude"])
+        candidates.append((distance, location["courier_id"]))
+    candidates.sort()
+    return [courier_id for _, courier_id in candidates[:limit]]
+
+def geo_nearest(latitude, longitude, limit, warehouse_ids, min_capacity):
+    """Новый способ: $geoNear по индексу 2dsphere"""
+    return [
+        courier["courier_id"]
+        for courier in server.find_nearest_couriers(latitude, longitude, limit, warehouse_ids, min_capacity)
+    ]
+
+def measure(search, queries):
+    latencies = []
+    results = []
+    for query in queries:
+        start_time = time.perf_counter()
+        results.append(search(*query))
+        latencies.append((time.perf_counter() - start_time) * 1000)
+    return results, {
+        "queries": len(latencies),
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p95_ms": round(percentile(latencies, 95), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+        "mean_ms": round(statistics.mean(latencies), 2)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Ближайшие курьеры: полный перебор против $geoNear")
+    parser.add_argument("--label", default="run", help="Метка прогона")
+    parser.add_argument("--couriers", type=int, default=10000, help="Количество синтетических курьеров")
+    parser.add_argument("--warehouses", type=int, default=20, help="Количество складов")
+    parser.add_argument("--limit", type=int, default=5, help="Сколько ближайших курьеров искать")
+    parser.add_argument("--batch", type=int, default=5000, help="Размер пачки вставки")
+    parser.add_argument("--queries", type=int, default=200, help="Количество запросов на способ")
+    parser.add_argument("--skip-populate", action="store_true", help="Использовать уже заполненную базу")
+    args = parser.parse_args()
+
+    print(f"📊 Бенчмарк ближайших курьеров [{args.label}] на базе {BENCHMARK_DB_NAME}")
+    random.seed(42)
+    if not args.skip_populate:
+        populate(args.couriers, args.warehouses, args.batch)
+
+    queries = []
+    for _ in range(args.queries):
+        latitude, longitude = random_point()
+        warehouse_ids = [f"warehouse-{random.randrange(args.warehouses)}"] if random.random() < 0.5 else None
+        min_capacity = random.choice([None, None, 50.0, 300.0])
+        queries.append((latitude, longitude, args.limit, warehouse_ids, min_capacity))
+
+    legacy_results, legacy = measure(legacy_nearest, queries)
+    geo_results, geo = measure(geo_nearest, queries)
+    result = {
+        "label": args.label,
+        "couriers": server.db.courier_locations.estimated_document_count(),
+        "limit": args.limit,
+        "full_scan": legacy,
+        "geo_near": geo,
+        "matching_results": sum(1 for legacy_ids, geo_ids in zip(legacy_results, geo_results) if legacy_ids == geo_ids)
+    }
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+if __name__ == "__main__":
+    main()
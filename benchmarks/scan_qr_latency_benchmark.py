@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+НАГРУЗОЧНЫЙ БЕНЧМАРК: Задержка сканирования QR под нагрузкой аналитики в TAJLINE.TJ
+
+ЦЕЛЬ:
+Измерить p50/p95/p99 задержки POST /api/cargo/scan-qr, пока параллельно
+выполняются тяжелые запросы GET /api/admin/dashboard/analytics.
+
+Запускается дважды - на коде до и после перевода обработчиков на пул потоков -
+и сравниваются p99 из двух прогонов:
+    BACKEND_URL=http://localhost:8001 python benchmarks/scan_qr_latency_benchmark.py --label before
+    BACKEND_URL=http://localhost:8001 python benchmarks/scan_qr_latency_benchmark.py --label after
+
+ОЖИДАЕМЫЙ РЕЗУЛЬТАТ: p99 сканирования не растет вместе со временем ответа аналитики
+"""
+
+import argparse
+import json
+import os
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+BACKEND_URL = os.environ.get('BACKEND_URL', 'http://localhost:8001')
+API_BASE = f"{BACKEND_URL}/api"
+
+ADMIN_CREDENTIALS = {
+    "phone": "+79999888777",
+    "password": "admin123"
+}
+
+OPERATOR_CREDENTIALS = {
+    "phone": "+79777888999",
+    "password": "warehouse123"
+}
+
+def login(credentials):
+    """Авторизация и получение токена"""
+    response = requests.post(f"{API_BASE}/auth/login", json=credentials, timeout=30)
+    response.raise_for_status()
+    return response.json()["access_token"]
+
+def find_cargo_number(token):
+    """Найти номер любого существующего груза для сканирования"""
+    headers = {"Authorization": f"Bearer {token}"}
+    response = requests.get(f"{API_BASE}/operator/cargo/list", headers=headers, params={"per_page": 5}, timeout=30)
+    response.raise_for_status()
+    items = response.json().get("items", [])
+    if not items:
+        raise RuntimeError("Нет грузов для сканирования - создайте тестовые данные")
+    return items[0]["cargo_number"]
+
+def percentile(values, p):
+    """Перцентиль по методу ближайшего ранга"""
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(p / 100.0 * len(ordered))) - 1))
+    return ordered[index]
+
+def analytics_worker(token, stop_event, counter):
+    """Фоновая нагрузка: непрерывные запросы аналитики администратора"""
+    session = requests.Session()
+    headers = {"Authorization": f"Bearer {token}"}
+    while not stop_event.is_set():
+        try:
+            session.get(f"{API_BASE}/admin/dashboard/analytics", headers=headers, timeout=120)
+            counter.append(1)
+        except requests.RequestException:
+            pass
+
+def scan_worker(token, cargo_number, requests_count):
+    """Серия сканирований QR с замером задержки каждого запроса"""
+    session = requests.Session()
+    headers = {"Authorization": f"Bearer {token}"}
+    latencies = []
+    errors = 0
+    for _ in range(requests_count):
+        start_time = time.perf_counter()
+        try:
+            response = session.post(
+                f"{API_BASE}/cargo/scan-qr",
+                json={"qr_text": cargo_number},
+                headers=headers,
+                timeout=120
+            )
+            if response.status_code != 200:
+                errors += 1
+        except requests.RequestException:
+            errors += 1
+        latencies.append((time.perf_counter() - start_time) * 1000)
+    return latencies, errors
+
+def main():
+    parser = argparse.ArgumentParser(description="p99 задержки /api/cargo/scan-qr под нагрузкой аналитики")
+    parser.add_argument("--label", default="run", help="Метка прогона (before/after)")
+    parser.add_argument("--scanners", type=int, default=8, help="Количество параллельных сканеров")
+    parser.add_argument("--scans", type=int, default=50, help="Сканирований на один сканер")
+    parser.add_argument("--analytics", type=int, default=4, help="Параллельных запросов аналитики")
+    args = parser.parse_args()
+
+    print(f"📊 Бенчмарк scan-qr [{args.label}] на {BACKEND_URL}")
+    admin_token = login(ADMIN_CREDENTIALS)
+    operator_token = login(OPERATOR_CREDENTIALS)
+    cargo_number = find_cargo_number(operator_token)
+    print(f"🔍 Сканируемый груз: {cargo_number}")
+
+    stop_event = threading.Event()
+    analytics_done = []
+    background = [
+        threading.Thread(target=analytics_worker, args=(admin_token, stop_event, analytics_done), daemon=True)
+        for _ in range(args.analytics)
+    ]
+    for thread in background:
+        thread.start()
+    time.sleep(1)  # Даем аналитике нагрузить сервер
+
+    all_latencies = []
+    total_errors = 0
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.scanners) as executor:
+        futures = [executor.submit(scan_worker, operator_token, cargo_number, args.scans) for _ in range(args.scanners)]
+        for future in futures:
+            latencies, errors = future.result()
+            all_latencies.extend(latencies)
+            total_errors += errors
+    elapsed = time.perf_counter() - started
+
+    stop_event.set()
+    for thread in background:
+        thread.join(timeout=120)
+
+    result = {
+        "label": args.label,
+        "scans": len(all_latencies),
+        "errors": total_errors,
+        "analytics_completed": len(analytics_done),
+        "throughput_rps": round(len(all_latencies) / elapsed, 1),
+        "p50_ms": round(percentile(all_latencies, 50), 1),
+        "p95_ms": round(percentile(all_latencies, 95), 1),
+        "p99_ms": round(percentile(all_latencies, 99), 1),
+        "mean_ms": round(statistics.mean(all_latencies), 1)
+    }
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+НАГРУЗОЧНЫЙ БЕНЧМАРК: Поиск грузов по регулярным выражениям и по поисковому индексу в TAJLINE.TJ
+
+ЦЕЛЬ:
+Сравнить p50/p95/p99 задержки поиска подстроки среди 1 000 000 грузов:
+- прежний способ: $or из $regex без якоря по семи полям (полный просмотр коллекции)
+- новый способ: $all по триграммам в коллекции search_index с проверкой кандидатов
+
+Бенчмарк работает с отдельной базой (BENCHMARK_DB_NAME), наполняет ее синтетическими
+грузами и строит поисковый индекс тем же кодом, что и сервер:
+    MONGO_URL=mongodb://localhost:27017 python benchmarks/search_index_benchmark.py --documents 1000000
+
+ОЖИДАЕМЫЙ РЕЗУЛЬТАТ: задержка поиска по индексу на порядки ниже и не растет с числом грузов
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+import uuid
+
+BENCHMARK_DB_NAME = os.environ.get('BENCHMARK_DB_NAME', 'tajline_search_benchmark')
+os.environ['DB_NAME'] = BENCHMARK_DB_NAME
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend'))
+
+import server  # noqa: E402
+
+FIRST_NAMES = ["Алишер", "Бахтиёр", "Фаридун", "Зарина", "Мадина", "Рустам", "Шахноза", "Иван", "Мария", "Сергей"]
+LAST_NAMES = ["Рахимов", "Саидова", "Назаров", "Каримова", "Юсупов", "Петров", "Иванова", "Шарипов", "Ахмедова", "Сидоров"]
+CARGO_NAMES = ["Одежда", "Электроника", "Сухофрукты", "Обувь", "Посуда", "Запчасти", "Текстиль", "Игрушки", "Книги", "Ковры"]
+
+def percentile(values, p):
+    """Перцентиль по методу ближайшего ранга"""
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(p / 100.0 * len(ordered))) - 1))
+    return ordered[index]
+
+def random_person():
+    return f"{random.choice(LAST_NAMES)} {random.choice(FIRST_NAMES)}"
+
+def random_phone():
+    return f"+992{random.randint(900000000, 999999999)}"
+
+def generate_cargo(number):
+    """Синтетический груз оператора"""
+    return {
+        "id": str(uuid.uuid4()),
+        "cargo_number": f"{250000 + number}",
+        "cargo_name": random.choice(CARGO_NAMES),
+        "description": f"{random.choice(CARGO_NAMES)} {random.randint(1, 500)} шт",
+        "sender_full_name": random_person(),
+        "sender_phone": random_phone(),
+        "recipient_full_name": random_person(),
+        "recipient_phone": random_phone(),
+        "status": "accepted"
+    }
+
+def populate(documents, batch_size):
+    """Заполнить operator_cargo синтетическими грузами и построить поисковый индекс"""
+    raw = server.client[BENCHMARK_DB_NAME]
+    raw.operator_cargo.drop()
+    raw.cargo.drop()
+    raw.search_index.drop()
+
+    started = time.perf_counter()
+    for offset in range(0, documents, batch_size):
+        raw.operator_cargo.insert_many([generate_cargo(number) for number in range(offset, min(documents, offset + batch_size))])
+    print(f"📦 Вставлено {documents} грузов за {time.perf_counter() - started:.1f} с")
+
+    for collection_name, definitions in server.INDEX_DEFINITIONS.items():
+        if collection_name in ("operator_cargo", "search_index"):
+            for definition in definitions:
+                raw[collection_name].create_index(definition["keys"], name=definition["name"])
+
+    started = time.perf_counter()
+    server.search_index.backfill()
+    print(f"🔎 Поисковый индекс построен за {time.perf_counter() - started:.1f} с")
+
+def regex_search(query):
+    """Прежний поиск: неякорные регулярные выражения по семи полям"""
+    pattern = {"$regex": query, "$options": "i"}
+    return list(server.db.operator_cargo.find({"$or": [
+        {"cargo_number": pattern}, {"cargo_name": pattern}, {"sender_full_name": pattern},
+        {"recipient_full_name": pattern}, {"sender_phone": pattern}, {"recipient_phone": pattern},
+        {"description": pattern}
+    ]}, {"_id": 0, "id": 1}).limit(50))
+
+def index_search(query):
+    """Новый поиск: кандидаты из search_index с ранжированием"""
+    return server.search_index.match("cargo", query)[:50]
+
+def measure(search, queries):
+    latencies = []
+    for query in queries:
+        start_time = time.perf_counter()
+        search(query)
+        latencies.append((time.perf_counter() - start_time) * 1000)
+    return {
+        "queries": len(latencies),
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p95_ms": round(percentile(latencies, 95), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+        "mean_ms": round(statistics.mean(latencies), 2)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Поиск грузов: $regex против search_index")
+    parser.add_argument("--label", default="run", help="Метка прогона")
+    parser.add_argument("--documents", type=int, default=1000000, help="Количество синтетических грузов")
+    parser.add_argument("--batch", type=int, default=10000, help="Размер пачки вставки")
+    parser.add_argument("--queries", type=int, default=200, help="Количество поисковых запросов на способ")
+    parser.add_argument("--skip-populate", action="store_true", help="Использовать уже заполненную базу")
+    args = parser.parse_args()
+
+    print(f"📊 Бенчмарк поиска [{args.label}] на базе {BENCHMARK_DB_NAME}")
+    if not args.skip_populate:
+        populate(args.documents, args.batch)
+
+    random.seed(42)
+    queries = []
+    for _ in range(args.queries):
+        kind = random.randint(0, 3)
+        if kind == 0:
+            queries.append(str(250000 + random.randint(0, args.documents - 1)))
+        elif kind == 1:
+            queries.append(random.choice(LAST_NAMES)[:5].lower())
+        elif kind == 2:
+            queries.append(str(random.randint(900, 999)) + str(random.randint(100, 999)))
+        else:
+            queries.append(random.choice(CARGO_NAMES).lower())
+
+    result = {
+        "label": args.label,
+        "documents": server.db.operator_cargo.estimated_document_count(),
+        "regex": measure(regex_search, queries),
+        "search_index": measure(index_search, queries)
+    }
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -11736,11 +11736,6 @@ function App() {
       setShowSuggestions(false);
       setSearchTime(response.search_time_ms);
       
-      // Обновляем предложения для автодополнения
-      if (response.suggestions && response.suggestions.length > 0) {
-        setSearchSuggestions(response.suggestions);
-      }
-      
     } catch (error) {
       console.error('Advanced search error:', error);
       setSearchResults([]);
@@ -11757,12 +11752,8 @@ function App() {
     
     if (value.length >= 2) {
       try {
-        // Используем простой поиск для получения предложений
-        const response = await apiCall('/api/search/advanced', 'POST', {
-          query: value.trim(),
-          search_type: searchType,
-          per_page: 5
-        });
+        // Подсказки из индекса автодополнения: [{value, type}]
+        const response = await apiCall(`/api/search/suggest?q=${encodeURIComponent(value.trim())}&limit=5`);
         
         if (response.suggestions && response.suggestions.length > 0) {
           setSearchSuggestions(response.suggestions);
@@ -18213,12 +18204,12 @@ function App() {
                         <div className="absolute z-50 mt-1 w-full bg-white border rounded-lg shadow-lg">
                           {searchSuggestions.map((suggestion, index) => (
                             <div
-                              key={`search-${index}-${suggestion.id || suggestion.name || index}`}
+                              key={`search-${index}-${suggestion.type}-${suggestion.value}`}
                               className="p-2 hover:bg-gray-100 cursor-pointer text-sm"
-                              onClick={() => selectSearchSuggestion(suggestion)}
+                              onClick={() => selectSearchSuggestion(suggestion.value)}
                             >
                               <Search className="inline mr-2 h-3 w-3 text-gray-400" />
-                              {suggestion}
+                              {suggestion.value}
                             </div>
                           ))}
                         </div>
@@ -343,7 +343,7 @@ const CourierHistoryAnalytics = ({ userRole, apiCall, selectedCourierId = null }
                                   <div className="flex space-x-4 text-sm text-gray-500">
                                     <span>{day.points_count} точек</span>
                                     <span>{day.distance_km} км</span>
-                                    {day.avg_speed > 0 && <span>{day.avg_speed} км/ч макс</span>}
+                                    {day.max_speed > 0 && <span>{day.max_speed} км/ч макс</span>}
                                   </div>
                                 </div>
                               </div>
@@ -365,14 +365,14 @@ const CourierHistoryAnalytics = ({ userRole, apiCall, selectedCourierId = null }
                   )}
 
                   {/* Последние точки маршрута */}
-                  {historyData.history && historyData.history.length > 0 && (
+                  {historyData.recent_points && historyData.recent_points.length > 0 && (
                     <Card>
                       <CardHeader>
                         <CardTitle className="text-lg">Последние перемещения</CardTitle>
                       </CardHeader>
                       <CardContent>
                         <div className="space-y-2 max-h-64 overflow-y-auto">
-                          {historyData.history.slice(-20).reverse().map((point, index) => (
+                          {historyData.recent_points.slice(-20).reverse().map((point, index) => (
                             <div key={point.id} className="flex items-center justify-between p-2 border-b">
                               <div className="flex items-center space-x-3">
                                 <div className={`w-3 h-3 rounded-full ${getStatusColor(point.status)}`}></div>
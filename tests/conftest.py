@@ -0,0 +1,55 @@
+"""
+Общие фикстуры тестов backend/server.py.
+
+Тесты работают с отдельной базой MongoDB (DB_NAME, по умолчанию tajline_test),
+которая очищается перед каждым тестом; если MongoDB недоступна, тесты пропускаются:
+    MONGO_URL=mongodb://localhost:27017 python -m pytest tests
+"""
+
+import os
+import sys
+import uuid
+from datetime import datetime
+
+import pytest
+
+os.environ.setdefault('DB_NAME', 'tajline_test')
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017/?serverSelectionTimeoutMS=2000')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend'))
+
+@pytest.fixture(scope="session")
+def server():
+    import server as server_module
+    from pymongo.errors import PyMongoError
+    try:
+        server_module.client.admin.command("ping")
+    except PyMongoError as e:
+        pytest.skip(f"MongoDB недоступна: {e}")
+    return server_module
+
+@pytest.fixture
+def db(server):
+    """Чистая тестовая база и сброшенные кэши процесса"""
+    server.client.drop_database(server.DB_NAME)
+    for state, _, _ in server.DERIVED_BACKFILLS:
+        state._built_until = 0.0
+    yield server.db
+
+@pytest.fixture
+def make_user(server, db):
+    """Фабрика пользователей: документ в базе и модель User для вызова обработчиков"""
+    def factory(role, **fields):
+        user = {
+            "id": str(uuid.uuid4()),
+            "user_number": str(uuid.uuid4().int)[:6],
+            "full_name": f"Тест {role}",
+            "phone": f"+992{uuid.uuid4().int % 10 ** 9:09d}",
+            "role": role,
+            "is_active": True,
+            "token_version": 1,
+            "created_at": datetime.utcnow(),
+            **fields
+        }
+        db.users.insert_one(dict(user))
+        return server.User(**{field: value for field, value in user.items() if field in server.User.model_fields})
+    return factory
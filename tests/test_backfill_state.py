@@ -0,0 +1,85 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+def test_claim_is_exclusive_until_finished(server, db):
+    state = server.BackfillState(db.schema_meta, "test_state", 1)
+    assert state.claim() is True
+    assert state.claim() is False
+
+def test_failed_run_releases_claim(server, db):
+    state = server.BackfillState(db.schema_meta, "test_state", 1)
+    
+    def broken():
+        raise RuntimeError("boom")
+    
+    with pytest.raises(RuntimeError):
+        state.run(broken)
+    assert db.schema_meta.find_one({"_id": "test_state_lock"})["state"] == "failed"
+    assert state.run(lambda: "rebuilt") == "rebuilt"
+    assert state.run(lambda: "again") is None
+
+def test_stale_claim_is_taken_over(server, db):
+    state = server.BackfillState(db.schema_meta, "test_state", 1, stale_seconds=60)
+    assert state.claim()
+    db.schema_meta.update_one({"_id": "test_state_lock"}, {"$set": {"claimed_at": datetime.utcnow() - timedelta(minutes=5)}})
+    assert state.claim() is True
+
+def test_mark_built_and_version_change(server, db):
+    state = server.BackfillState(db.schema_meta, "test_state", 1)
+    assert not state.is_built()
+    state.mark_built({"documents": 3})
+    assert state.is_built()
+    assert not server.BackfillState(db.schema_meta, "test_state", 2).is_built()
+
+def test_cargo_units_read_from_requests_until_built(server, db):
+    db.operator_cargo.insert_one({
+        "id": "cargo-1",
+        "cargo_number": "250001",
+        "status": "accepted",
+        "cargo_items": [{"cargo_name": "Одежда", "quantity": 2, "individual_items": [
+            {"individual_number": "250001/01/01", "unit_index": "01", "is_placed": True},
+            {"individual_number": "250001/01/02", "unit_index": "02"}
+        ]}]
+    })
+    db.cargo_units.delete_many({})
+    assert not server.cargo_units.is_built()
+    
+    units = server.find_cargo_units("operator_cargo", ["250001/01/02"], synthetic=False)
+    assert [unit["individual_number"] for unit in units] == ["250001/01/02"]
+    placed = server.find_cargo_units("operator_cargo", cargo_id="cargo-1", is_placed=True)
+    assert [unit["individual_number"] for unit in placed] == ["250001/01/01"]
+    
+    server.cargo_units.backfill()
+    assert server.cargo_units.is_built()
+    placed = server.find_cargo_units("operator_cargo", cargo_id="cargo-1", is_placed=True)
+    assert [unit["individual_number"] for unit in placed] == ["250001/01/01"]
+
+def test_dirty_state_is_rebuilt(server, db):
+    state = server.BackfillState(db.schema_meta, "test_state", 1)
+    state.run(lambda: state.mark_built({"documents": 1}))
+    assert state.is_built()
+    
+    state.mark_dirty("listener failed")
+    assert not state.is_built()
+    assert state.ensure(lambda: state.mark_built({"documents": 2})) is None
+    assert state.is_built()
+    assert "dirty_at" not in db.schema_meta.find_one({"_id": "test_state"})
+
+def test_synthetic_units_found_by_number_until_built(server, db):
+    db.operator_cargo.insert_one({
+        "id": "cargo-2",
+        "cargo_number": "250002",
+        "status": "accepted",
+        "cargo_items": [{"cargo_name": "Посуда", "quantity": 2}]
+    })
+    db.cargo_units.delete_many({})
+    assert not server.cargo_units.is_built()
+    
+    units = server.find_cargo_units("operator_cargo", ["250002/01/02"])
+    assert [unit["individual_number"] for unit in units] == ["250002/01/02"]
+    assert units[0]["synthetic"] is True
+    
+    server.cargo_units.backfill()
+    units = server.find_cargo_units("operator_cargo", ["250002/01/02"])
+    assert [unit["individual_number"] for unit in units] == ["250002/01/02"]
@@ -0,0 +1,49 @@
+import time
+from datetime import datetime
+
+import pytest
+
+@pytest.fixture
+def warehouse(db):
+    warehouse = {
+        "id": "w1", "name": "Склад 1", "location": "Душанбе", "blocks_count": 1, "shelves_per_block": 1,
+        "cells_per_shelf": 3, "total_capacity": 3, "created_at": datetime.utcnow(), "is_active": True
+    }
+    db.warehouses.insert_one(dict(warehouse))
+    return warehouse
+
+def _cell(cell, **fields):
+    return {
+        "id": f"cell-{cell}", "warehouse_id": "w1", "block_number": 1, "shelf_number": 1, "cell_number": cell,
+        "location_code": f"B1-S1-C{cell}", "id_based_code": f"001-01-01-{cell:03d}", "is_occupied": False, **fields
+    }
+
+def test_available_cells_return_stored_records(server, db, make_user, warehouse):
+    operator = make_user("warehouse_operator")
+    db.warehouse_cells.insert_many([_cell(3), _cell(1), _cell(2, is_occupied=True, cargo_id="cargo-1")])
+
+    response = server.get_available_cells("w1", current_user=operator)
+
+    assert [cell["id"] for cell in response["available_cells"]] == ["cell-1", "cell-3"]
+    assert response["available_cells"][0]["location_code"] == "B1-S1-C1"
+
+def test_change_during_reload_marks_warehouse_stale(server, db, warehouse):
+    occupancy = server.WarehouseOccupancyIndex(db, check_interval=60)
+    occupancy.reload(["w1"])
+    build = occupancy._build
+
+    def build_then_place(warehouses, cells):
+        maps = build(warehouses, cells)
+        # Ячейку заняли после чтения из MongoDB, но до подмены карт
+        placed = _cell(2, is_occupied=True, cargo_id="cargo-1")
+        db.warehouse_cells.insert_one(dict(placed))
+        occupancy.on_cell_changes("warehouse_cells", [(None, placed)])
+        return maps
+
+    occupancy._build = build_then_place
+    occupancy.reload(["w1"])
+    occupancy._build = build
+    occupancy._checked_at = time.monotonic()  # Без проверки версий до истечения check_interval
+
+    assert occupancy.is_free("w1", 1, 1, 2) is False
+    assert occupancy.cargo_at("w1", 1, 1, 2) == "cargo-1"
@@ -0,0 +1,74 @@
+import pytest
+from pymongo import UpdateOne
+
+def test_listener_error_marks_state_dirty(server, db, monkeypatch):
+    state = server.BackfillState(db.schema_meta, "probe_state", 1)
+    state.mark_built({"documents": 0})
+    
+    def broken(collection_name, changes):
+        raise RuntimeError("listener failed")
+    
+    monkeypatch.setitem(server.ChangeTrackedDatabase._listeners, "probe", [])
+    server.ChangeTrackedDatabase.subscribe("probe", ["value"], broken, on_error=state.mark_dirty)
+    db.probe.insert_one({"value": 1})
+    
+    assert db.probe.count_documents({}) == 1
+    assert not state.is_built()
+    assert "listener failed" in db.schema_meta.find_one({"_id": "probe_state"})["dirty_reason"]
+
+def test_tracked_bulk_write_requires_tracked_operations(server, db):
+    db.transports.insert_one({"id": "t-1", "status": "loading"})
+    with pytest.raises(TypeError):
+        db.transports.bulk_write([UpdateOne({"id": "t-1"}, {"$set": {"status": "in_transit"}})])
+    
+    db.transports.bulk_write([server.TrackedUpdateOne({"id": "t-1"}, {"$set": {"status": "in_transit"}})])
+    assert server.dashboard_stats.get(server.STATS_GLOBAL_SCOPE)["active_transports"] == 1
+
+def test_stats_read_from_sources_until_built(server, db):
+    db.cargo.insert_one({"id": "c-1", "warehouse_id": "w-1", "weight": 4, "status": "accepted"})
+    assert not server.dashboard_stats.is_built()
+    stats = server.dashboard_stats.get("warehouse:w-1")
+    assert stats["cargo_count"] == 1
+    assert stats["total_weight"] == 4
+
+def test_reconcile_keeps_increments_made_during_scan(server, db, monkeypatch):
+    stats = server.dashboard_stats
+    db.cargo.insert_one({"id": "c-1", "weight": 1, "status": "accepted"})
+    stats.reconcile()
+    db.stats_counters.update_one({"_id": "global"}, {"$set": {"cargo_count": 5}})
+    
+    scan = stats._scan
+    
+    def scan_with_live_write(*args, **kwargs):
+        totals = scan(*args, **kwargs)
+        db.cargo.insert_one({"id": "c-2", "weight": 1, "status": "accepted"})
+        return totals
+    
+    monkeypatch.setattr(stats, "_scan", scan_with_live_write)
+    report = stats.reconcile()
+    assert report["skipped_count"] >= 1
+    assert stats.get("global")["cargo_count"] == 6
+    
+    monkeypatch.setattr(stats, "_scan", scan)
+    stats.reconcile()
+    assert stats.get("global")["cargo_count"] == 2
+
+def test_unique_clients_follow_bulk_cargo_writes(server, db):
+    stats = server.dashboard_stats
+    stats.reconcile()
+    db.cargo.insert_many([
+        {"id": "c-1", "warehouse_id": "w-1", "status": "accepted", "sender_phone": "+992900000001", "recipient_phone": "+992900000009"},
+        {"id": "c-2", "warehouse_id": "w-1", "status": "accepted", "sender_phone": "+992900000001", "recipient_phone": "+992900000009"},
+        {"id": "c-3", "warehouse_id": "w-2", "status": "accepted", "sender_phone": "+992900000002"}
+    ])
+    assert stats.get("global")["unique_senders"] == 2
+    assert stats.get("warehouse:w-1")["unique_recipients"] == 1
+    
+    db.cargo.delete_many({"id": {"$in": ["c-1", "c-3"]}})
+    assert stats.get("global")["unique_senders"] == 1
+    assert stats.get("warehouse:w-2").get("unique_senders", 0) == 0
+    
+    db.cargo.delete_one({"id": "c-2"})
+    assert stats.get("global")["unique_senders"] == 0
+    assert db.stats_phone_refs.count_documents({}) == 0
+    assert stats.reconcile()["drift_count"] == 0
@@ -0,0 +1,46 @@
+import time
+from datetime import datetime, timedelta
+
+def _points(day, minutes, courier_id="courier-1"):
+    start = datetime.combine(day, datetime.min.time()) + timedelta(hours=9)
+    return [
+        {"courier_id": courier_id, "latitude": 38.56 + minute * 0.001, "longitude": 68.78, "status": "online", "speed": 20.0, "timestamp": start + timedelta(minutes=minute)}
+        for minute in minutes
+    ]
+
+def test_empty_past_day_is_not_stored(server, db):
+    day = (datetime.utcnow() - timedelta(days=3)).date()
+
+    assert server.courier_rollups.read("courier-1", day.isoformat(), day.isoformat()) == []
+    assert db.courier_daily_rollups.count_documents({}) == 0
+
+    db[server.GPS_HISTORY_COLLECTION].insert_many(_points(day, range(3)))
+    rollups = server.courier_rollups.read("courier-1", day.isoformat(), day.isoformat())
+    assert [rollup["metrics"]["points_count"] for rollup in rollups] == [3]
+
+def test_late_points_mark_past_day_stale(server, db):
+    day = (datetime.utcnow() - timedelta(days=2)).date()
+    db[server.GPS_HISTORY_COLLECTION].insert_many(_points(day, range(3)))
+    server.courier_rollups.read("courier-1", day.isoformat(), day.isoformat())
+    assert db.courier_daily_rollups.find_one({"_id": f"courier-1:{day.isoformat()}"})["metrics"]["points_count"] == 3
+
+    db[server.GPS_HISTORY_COLLECTION].insert_many(_points(day, range(10, 12)))
+    server.courier_rollups.mark_stale("courier-1", [day.isoformat(), datetime.utcnow().date().isoformat()])
+    time.sleep(0.01)  # Расчет в ту же миллисекунду, что и пометка, не сохраняется
+    rollups = server.courier_rollups.read("courier-1", day.isoformat(), day.isoformat())
+
+    assert [rollup["metrics"]["points_count"] for rollup in rollups] == [5]
+    stored = db.courier_daily_rollups.find_one({"_id": f"courier-1:{day.isoformat()}"})
+    assert stored["metrics"]["points_count"] == 5 and "stale_at" not in stored
+    assert db.courier_daily_rollups.count_documents({}) == 1
+
+def test_rollup_marked_stale_during_compute_is_not_stored(server, db):
+    day = (datetime.utcnow() - timedelta(days=2)).date()
+    db[server.GPS_HISTORY_COLLECTION].insert_many(_points(day, range(3)))
+    start = datetime.combine(day, datetime.min.time())
+    rollups = server.courier_rollups.compute(start, start + timedelta(days=1), ["courier-1"])
+
+    server.courier_rollups.mark_stale("courier-1", [day.isoformat()])
+    server.courier_rollups.store(rollups)
+
+    assert "stale_at" in db.courier_daily_rollups.find_one({"_id": f"courier-1:{day.isoformat()}"})
@@ -0,0 +1,154 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from pymongo.errors import BulkWriteError
+
+def _point(number):
+    return {"courier_id": "courier-1", "latitude": 38.5, "longitude": 68.7, "timestamp": datetime(2026, 10, 1, 12, number)}
+
+class RejectingHistory:
+    """Коллекция истории, которая отклоняет точки с заданными номерами в пачке"""
+    def __init__(self, rejected):
+        self.rejected = set(rejected)
+        self.inserted = []
+
+    def insert_many(self, documents, ordered=True):
+        errors = [{"index": index, "code": 121, "errmsg": "validation"} for index in range(len(documents)) if index in self.rejected]
+        self.inserted.extend(document for index, document in enumerate(documents) if index not in self.rejected)
+        self.rejected = set()
+        if errors:
+            raise BulkWriteError({"writeErrors": errors, "nInserted": len(documents) - len(errors)})
+
+def test_flush_requeues_only_rejected_points(server):
+    history = RejectingHistory([1])
+    buffer = server.GpsIngestBuffer({server.GPS_HISTORY_COLLECTION: history}, flush_batch=100, max_points=100)
+    for number in range(3):
+        buffer.add(_point(number))
+
+    assert buffer.flush() == {"history": 2, "locations": 0}
+    assert buffer.stats()["buffered_points"] == 1
+
+    assert buffer.flush() == {"history": 1, "locations": 0}
+    assert sorted(point["timestamp"].minute for point in history.inserted) == [0, 1, 2]
+    assert buffer.stats()["flushed_points"] == 3
+
+def test_legacy_migration_is_resumable_without_duplicates(server, db, monkeypatch):
+    monkeypatch.setattr(server, "GPS_MIGRATION_BATCH", 2)
+    db[server.GPS_HISTORY_LEGACY_COLLECTION].insert_many([_point(number) for number in range(5)])
+    # Точка первой пачки записана прерванным переносом, но прогресс не сохранен
+    db[server.GPS_HISTORY_COLLECTION].insert_one(db[server.GPS_HISTORY_LEGACY_COLLECTION].find_one(sort=[("_id", 1)]))
+
+    insert_many = server.db[server.GPS_HISTORY_COLLECTION].insert_many
+    calls = []
+
+    def failing_insert(self, documents, ordered=True):
+        calls.append(len(documents))
+        if len(calls) == 2:
+            raise RuntimeError("connection lost")
+        return insert_many(documents, ordered=ordered)
+
+    monkeypatch.setattr(type(server.db[server.GPS_HISTORY_COLLECTION]), "insert_many", failing_insert)
+    with pytest.raises(RuntimeError):
+        server.migrate_legacy_gps_history()
+    assert db.schema_meta.find_one({"_id": server.GPS_MIGRATION_PROGRESS_ID})["moved"] == 1
+    monkeypatch.undo()
+
+    monkeypatch.setattr(server, "GPS_MIGRATION_BATCH", 2)
+    report = server.migrate_legacy_gps_history()
+
+    assert report["moved"] == 4
+    assert db[server.GPS_HISTORY_COLLECTION].count_documents({}) == 5
+    assert server.gps_history_migration.is_built()
+    assert db.schema_meta.find_one({"_id": server.GPS_MIGRATION_PROGRESS_ID}) is None
+
+def _location(courier_id, minute, **fields):
+    return {"courier_id": courier_id, "latitude": 38.5, "longitude": 68.7, "status": "online", "last_updated": datetime(2026, 10, 1, 12, minute), **fields}
+
+def test_latest_location_is_not_replaced_by_older_point(server, db):
+    db.couriers.insert_many([{"id": "courier-1", "status": "offline"}, {"id": "courier-2", "status": "offline"}])
+    db.courier_locations.insert_one(_location("courier-1", 30, status="busy"))
+    buffer = server.GpsIngestBuffer(db, flush_batch=100, max_points=100)
+
+    buffer.add(None, _location("courier-1", 10))
+    buffer.add(None, _location("courier-2", 10))
+    assert buffer.flush() == {"history": 0, "locations": 2}
+
+    assert db.courier_locations.find_one({"courier_id": "courier-1"})["status"] == "busy"
+    assert db.courier_locations.find_one({"courier_id": "courier-2"})["last_updated"] == datetime(2026, 10, 1, 12, 10)
+    assert db.courier_locations.count_documents({}) == 2
+
+    buffer.add(None, _location("courier-1", 40, status="on_route"))
+    buffer.flush()
+    assert db.courier_locations.find_one({"courier_id": "courier-1"})["status"] == "on_route"
+    assert db.couriers.find_one({"id": "courier-1"})["status"] == "on_route"
+
+def test_gps_flush_keeps_profile_dispatch_fields(server, db, make_user):
+    user = make_user("courier")
+    db.couriers.insert_one({
+        "id": "courier-1", "user_id": user.id, "full_name": user.full_name, "phone": user.phone,
+        "transport_type": "car", "assigned_warehouse_id": "w1", "transport_capacity": 300.0, "is_active": True
+    })
+    server.courier_context.clear()
+    server.gps_ingest.flush()
+    asyncio.run(server.update_courier_location(server.CourierLocationUpdate(latitude=38.5, longitude=68.7), current_user=user))
+    server.gps_ingest.flush()
+    assert db.courier_locations.find_one({"courier_id": "courier-1"})["assigned_warehouse_id"] == "w1"
+
+    # Профиль изменен после того, как точка с профилем из кэша попала в буфер
+    asyncio.run(server.update_courier_location(server.CourierLocationUpdate(latitude=38.6, longitude=68.7), current_user=user))
+    db.couriers.update_one({"id": "courier-1"}, {"$set": {"assigned_warehouse_id": "w2", "is_active": False}})
+    server.gps_ingest.flush()
+
+    location = db.courier_locations.find_one({"courier_id": "courier-1"})
+    assert location["latitude"] == 38.6
+    assert (location["assigned_warehouse_id"], location["courier_active"]) == ("w2", False)
+
+def _batch_courier(server, db, make_user):
+    user = make_user("courier")
+    db.couriers.insert_one({
+        "id": "courier-1", "user_id": user.id, "full_name": user.full_name, "phone": user.phone,
+        "transport_type": "car", "assigned_warehouse_id": "w1", "is_active": True
+    })
+    server.courier_context.clear()
+    server.gps_ingest.flush()
+    return user
+
+def _batch(server, minutes_ago, start=None):
+    start = start or datetime.utcnow().replace(microsecond=0)
+    return server.CourierLocationBatch(points=[
+        server.CourierLocationBatchPoint(latitude=38.5 + minute * 0.001, longitude=68.7, timestamp=start - timedelta(minutes=minute))
+        for minute in minutes_ago
+    ])
+
+def test_concurrent_batch_retries_store_each_point_once(server, db, make_user):
+    user = _batch_courier(server, db, make_user)
+    batch = _batch(server, range(1, 6))
+
+    async def upload_twice():
+        return await asyncio.gather(*[server.upload_courier_location_batch(batch, current_user=user) for _ in range(2)])
+
+    results = asyncio.run(upload_twice())
+
+    assert sorted(result["stored"] for result in results) == [0, 5]
+    assert db[server.GPS_HISTORY_COLLECTION].count_documents({"courier_id": "courier-1"}) == 5
+    server.gps_ingest.flush()
+    assert db.courier_locations.count_documents({"courier_id": "courier-1"}) == 1
+
+def test_older_batch_does_not_move_courier_marker(server, db, make_user, monkeypatch):
+    user = _batch_courier(server, db, make_user)
+    db.courier_locations.insert_one(_location("courier-1", 0, last_updated=datetime.utcnow().replace(microsecond=0)))
+    sent = []
+
+    async def capture(location_data, courier=None):
+        sent.append(location_data)
+
+    monkeypatch.setattr(server.connection_manager, "broadcast_courier_location_update", capture)
+    asyncio.run(server.upload_courier_location_batch(_batch(server, range(10, 13)), current_user=user))
+
+    assert sent[-1]["batch_points"] == 3 and "latitude" not in sent[-1]
+    server.gps_ingest.flush()
+    assert db.courier_locations.find_one({"courier_id": "courier-1"})["latitude"] == 38.5
+
+    asyncio.run(server.upload_courier_location_batch(_batch(server, [0], datetime.utcnow() + timedelta(seconds=1)), current_user=user))
+    assert sent[-1]["latitude"] == 38.5 and sent[-1]["batch_points"] == 1
@@ -0,0 +1,12 @@
+def test_operator_sees_cargo_of_bound_warehouses_only(server, db, make_user):
+    operator = make_user("warehouse_operator")
+    db.operator_warehouse_bindings.insert_one({"id": "binding-1", "operator_id": operator.id, "warehouse_id": "w1"})
+    server.operator_bindings.invalidate()
+    db.operator_cargo.insert_many([
+        {"id": "cargo-1", "cargo_number": "250001", "status": "accepted", "warehouse_location": "B1-S1-C1", "warehouse_id": "w1"},
+        {"id": "cargo-2", "cargo_number": "250002", "status": "accepted", "warehouse_location": "B1-S1-C1", "warehouse_id": "w2"}
+    ])
+
+    cargo = server.get_available_cargo_for_transport(operator.id, server.UserRole.WAREHOUSE_OPERATOR)
+
+    assert [item["id"] for item in cargo] == ["cargo-1"]
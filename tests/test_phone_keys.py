@@ -0,0 +1,24 @@
+import pytest
+from fastapi import HTTPException
+
+def test_keys_follow_phone_writes(server, db, make_user):
+    user = make_user("user", phone="+992 900 11-22-33")
+    stored = db.users.find_one({"id": user.id})
+    assert stored["phone_key"] == "992900112233"
+    assert stored["phone_rkey"] == "332211009299"
+    
+    db.users.update_one({"id": user.id}, {"$set": {"phone": "8 (916) 123-45-67"}})
+    assert db.users.find_one({"id": user.id})["phone_key"] == "79161234567"
+
+def test_find_user_by_phone_in_any_format(server, db, make_user):
+    user = make_user("user", phone="+992900112233")
+    assert server.find_user_by_phone("992 900 11 22 33")["id"] == user.id
+    assert server.find_user_by_phone("+992900000000") is None
+
+def test_find_user_by_phone_rejects_ambiguous_match(server, db, make_user):
+    make_user("user", phone="+992900112233")
+    make_user("user", phone="992 900 112 233")
+    
+    with pytest.raises(HTTPException) as error:
+        server.find_user_by_phone("+992900112233")
+    assert error.value.status_code == 409
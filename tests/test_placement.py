@@ -0,0 +1,53 @@
+import pytest
+from fastapi import HTTPException
+
+@pytest.fixture
+def warehouse(db):
+    warehouse = {"id": "w1", "name": "Склад 1", "blocks_count": 1, "shelves_per_block": 1, "cells_per_shelf": 3, "is_active": True}
+    db.warehouses.insert_one(dict(warehouse))
+    return warehouse
+
+def _cargo(db, cargo_number, **fields):
+    cargo = {"id": f"cargo-{cargo_number}", "cargo_number": cargo_number, "status": "accepted", "weight": 5, **fields}
+    db.operator_cargo.insert_one(dict(cargo))
+    return cargo
+
+def test_batch_places_cargo_into_free_cell(server, db, make_user, warehouse):
+    operator = make_user("warehouse_operator")
+    _cargo(db, "250101")
+    
+    response = server.place_cargo_batch({"items": [{"cargo_code": "250101", "cell_code": "w1-Б1-П1-Я1"}]}, current_user=operator)
+    
+    assert response["placed"] == 1
+    cell = db.warehouse_cells.find_one({"warehouse_id": "w1", "location_code": "1-1-1"})
+    assert cell["is_occupied"] is True and cell["cargo_id"] == "cargo-250101"
+    assert db.operator_cargo.find_one({"id": "cargo-250101"})["status"] == "placed_in_warehouse"
+    assert db.placement_history.find_one({"id": cell["placement_id"]})["cargo_number"] == "250101"
+
+def test_batch_rejects_occupied_cell(server, db, make_user, warehouse):
+    operator = make_user("warehouse_operator")
+    _cargo(db, "250102")
+    db.warehouse_cells.insert_one({"warehouse_id": "w1", "location_code": "1-1-2", "is_occupied": True, "cargo_number": "999"})
+    
+    response = server.place_cargo_batch({"items": [{"cargo_code": "250102", "cell_code": "w1-Б1-П1-Я2"}]}, current_user=operator)
+    
+    assert response["results"][0]["error_code"] == "CELL_OCCUPIED"
+    assert db.operator_cargo.find_one({"id": "cargo-250102"})["status"] == "accepted"
+
+def test_batch_releases_cell_when_cargo_update_fails(server, db, make_user, warehouse, monkeypatch):
+    operator = make_user("warehouse_operator")
+    stale = _cargo(db, "250103")
+    db.operator_cargo.update_one({"id": stale["id"]}, {"$set": {"status": "removed_from_placement"}})
+    # Груз исключили из размещения между чтением и записью пакета
+    monkeypatch.setattr(server, "locate_cargo_many", lambda *args: {"250103": (dict(stale), "operator_cargo")})
+    
+    response = server.place_cargo_batch({"items": [{"cargo_code": "250103", "cell_code": "w1-Б1-П1-Я3"}]}, current_user=operator)
+    
+    assert response["results"][0]["error_code"] == "UPDATE_FAILED"
+    assert db.warehouse_cells.count_documents({"warehouse_id": "w1", "location_code": "1-1-3", "is_occupied": True}) == 0
+
+def test_batch_requires_warehouse_operator(server, db, make_user):
+    admin = make_user("admin")
+    with pytest.raises(HTTPException) as error:
+        server.place_cargo_batch({"items": [{"cargo_code": "1", "cell_code": "w1-Б1-П1-Я1"}]}, current_user=admin)
+    assert error.value.status_code == 403
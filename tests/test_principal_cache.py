@@ -0,0 +1,34 @@
+def test_user_writes_invalidate_cached_principal(server, db, make_user):
+    user = make_user("courier")
+    cache = server.principal_cache
+    cache.put(user, cache.generation)
+    assert cache.get(user.id, user.token_version, user.phone) is user
+    
+    db.users.update_one({"id": user.id}, {"$set": {"is_active": False}})
+    assert cache.get(user.id, user.token_version, user.phone) is None
+
+def test_delete_invalidates_cached_principal(server, db, make_user):
+    user = make_user("courier")
+    cache = server.principal_cache
+    cache.put(user, cache.generation)
+    
+    db.users.delete_many({"id": {"$in": [user.id]}})
+    assert cache.get(user.id, user.token_version, user.phone) is None
+
+def test_other_process_sees_version_stamp(server, db, make_user):
+    user = make_user("warehouse_operator")
+    other = server.PrincipalCache(db, max_size=10, ttl_seconds=60, check_interval=0)
+    assert other.get(user.id, user.token_version, user.phone) is None
+    other.put(user, other.generation)
+    assert other.get(user.id, user.token_version, user.phone) is not None
+    
+    db.users.update_one({"id": user.id}, {"$set": {"role": "user"}})
+    assert other.get(user.id, user.token_version, user.phone) is None
+
+def test_principal_read_before_invalidation_is_not_cached(server, db, make_user):
+    user = make_user("courier")
+    cache = server.principal_cache
+    generation = cache.generation
+    db.users.update_one({"id": user.id}, {"$set": {"is_active": False}})
+    cache.put(user, generation)
+    assert cache.get(user.id, user.token_version, user.phone) is None
@@ -0,0 +1,67 @@
+import os
+import time
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+def _request():
+    return Request({"type": "http", "method": "GET", "path": "/", "headers": []})
+
+def test_disk_cache_evicts_old_and_excess_files(server, tmp_path):
+    cache = server.QRImageCache(1024 * 1024, str(tmp_path), disk_max_bytes=10 ** 9, disk_max_age_seconds=3600)
+    old_key, old_png = cache.png("250001")
+    path = cache._path(old_key)
+    os.utime(path, (time.time() - 7200, time.time() - 7200))
+    cache.png("250002")
+    
+    assert cache.prune_disk()["removed"] == 1
+    assert not os.path.exists(path)
+    
+    cache.disk_max_bytes = 0
+    assert cache.prune_disk()["files"] == 0
+
+def test_qr_image_url_is_signed(server):
+    url = urlparse(server.qr_image_url("250003"))
+    key = url.path.rsplit("/", 1)[1][:-len(".png")]
+    params = {name: values[0] for name, values in parse_qs(url.query).items()}
+    
+    response = server.get_cached_qr_png(key, _request(), int(params["expires"]), params["signature"])
+    assert response.status_code == 200
+    with pytest.raises(HTTPException) as error:
+        server.get_cached_qr_png(key, _request(), int(params["expires"]), "0" * 64)
+    assert error.value.status_code == 403
+    with pytest.raises(HTTPException):
+        server.get_cached_qr_png(key, _request(), int(time.time()) - 1, server.qr_url_signature(key, int(time.time()) - 1))
+
+def test_signed_url_renders_evicted_image(server, monkeypatch):
+    url = urlparse(server.qr_image_url("250004", box_size=10, border=5, error_correction="M"))
+    key = url.path.rsplit("/", 1)[1][:-len(".png")]
+    params = {name: values[0] for name, values in parse_qs(url.query).items()}
+    # Другой воркер без общего диска: в его кэше изображения нет
+    monkeypatch.setattr(server, "qr_image_cache", server.QRImageCache(1024 * 1024, None, 0, 0))
+    
+    with pytest.raises(HTTPException) as error:
+        server.get_cached_qr_png(key, _request(), int(params["expires"]), params["signature"], "250005", 10, 5, "M")
+    assert error.value.status_code == 404
+    
+    response = server.get_cached_qr_png(
+        key, _request(), int(params["expires"]), params["signature"],
+        params["data"], int(params["box_size"]), int(params["border"]), params["ec"]
+    )
+    assert response.status_code == 200
+
+def test_render_rejects_long_data_and_skips_caching_free_text(server, make_user, monkeypatch):
+    user = make_user("user")
+    cache = server.QRImageCache(1024 * 1024, None, 0, 0)
+    monkeypatch.setattr(server, "qr_image_cache", cache)
+    
+    with pytest.raises(HTTPException) as error:
+        server.render_qr_png(_request(), "x" * (server.QR_MAX_DATA_LENGTH + 1), current_user=user)
+    assert error.value.status_code == 400
+    
+    server.render_qr_png(_request(), "произвольный текст", current_user=user)
+    server.render_qr_png(_request(), "250006/01/02", current_user=user)
+    server.render_qr_png(_request(), "001-01-01-001", current_user=user)
+    assert cache.stats()["memory_items"] == 2
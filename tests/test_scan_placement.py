@@ -0,0 +1,80 @@
+import pytest
+
+CELL_INFO = {
+    "cell_address": "Склад 1-Б1-П1-Я1", "warehouse_id": "w1", "warehouse_name": "Склад 1",
+    "block_number": 1, "shelf_number": 1, "cell_number": 1
+}
+
+@pytest.fixture
+def cargo(db):
+    cargo = {
+        "id": "cargo-250201", "cargo_number": "250201", "status": "accepted", "payment_status": "paid",
+        "cargo_items": [{"cargo_name": "Одежда", "individual_items": [
+            {"individual_number": "250201/01/01"}, {"individual_number": "250201/01/02"}
+        ]}]
+    }
+    db.operator_cargo.insert_one(dict(cargo))
+    return cargo
+
+def _tokens(server, operator, individual_number):
+    cargo_token = server.issue_scan_token(operator, "cargo", {"qr": individual_number, "cargo_info": {
+        "cargo_id": "cargo-250201", "cargo_number": "250201", "individual_number": individual_number,
+        "sender_name": "Отправитель", "recipient_name": "Получатель"
+    }})
+    cell_token = server.issue_scan_token(operator, "cell", {"qr": "w1-Б1-П1-Я1", "cell_info": CELL_INFO})
+    return {"cargo_token": cargo_token, "cell_token": cell_token}
+
+def _unit(db, individual_number):
+    cargo = db.operator_cargo.find_one({"id": "cargo-250201"})
+    return next(unit for unit in cargo["cargo_items"][0]["individual_items"] if unit["individual_number"] == individual_number)
+
+def test_cargo_token_is_single_use(server, db, make_user, cargo):
+    operator = make_user("warehouse_operator")
+    tokens = _tokens(server, operator, "250201/01/01")
+    
+    assert server.place_cargo_in_cell(dict(tokens), current_user=operator)["success"] is True
+    assert _unit(db, "250201/01/01")["is_placed"] is True
+    
+    replay = server.place_cargo_in_cell(dict(tokens), current_user=operator)
+    assert replay["error_code"] == "SCAN_TOKEN_USED"
+    assert db.placement_history.count_documents({"cargo_id": "cargo-250201"}) == 1
+
+def test_token_does_not_place_removed_cargo(server, db, make_user, cargo):
+    operator = make_user("warehouse_operator")
+    tokens = _tokens(server, operator, "250201/01/01")
+    db.operator_cargo.update_one({"id": "cargo-250201"}, {"$set": {"status": "removed_from_placement"}})
+    
+    response = server.place_cargo_in_cell(tokens, current_user=operator)
+    
+    assert response["error_code"] == "UPDATE_FAILED"
+    assert "is_placed" not in _unit(db, "250201/01/01")
+
+def test_token_does_not_place_unit_twice(server, db, make_user, cargo):
+    operator = make_user("warehouse_operator")
+    first = _tokens(server, operator, "250201/01/02")
+    second = _tokens(server, operator, "250201/01/02")
+    
+    assert server.place_cargo_in_cell(first, current_user=operator)["success"] is True
+    response = server.place_cargo_in_cell(second, current_user=operator)
+    
+    assert response["error_code"] == "UPDATE_FAILED"
+    assert db.placement_history.count_documents({"individual_number": "250201/01/02"}) == 1
+
+def test_token_of_other_user_is_rejected(server, db, make_user, cargo):
+    operator = make_user("warehouse_operator")
+    other = make_user("warehouse_operator")
+    tokens = _tokens(server, other, "250201/01/01")
+    
+    assert server.place_cargo_in_cell(tokens, current_user=operator)["error_code"] == "SCAN_TOKEN_INVALID"
+
+def test_cargo_token_survives_failed_placement(server, db, make_user, cargo):
+    operator = make_user("warehouse_operator")
+    tokens = _tokens(server, operator, "250201/01/01")
+    
+    wrong_cell = server.place_cargo_in_cell({"cargo_token": tokens["cargo_token"], "cell_qr_code": "999-99-99-999"}, current_user=operator)
+    assert wrong_cell["success"] is False
+    assert "is_placed" not in _unit(db, "250201/01/01")
+    
+    assert server.place_cargo_in_cell(dict(tokens), current_user=operator)["success"] is True
+    assert _unit(db, "250201/01/01")["is_placed"] is True
+    assert server.place_cargo_in_cell(dict(tokens), current_user=operator)["error_code"] == "SCAN_TOKEN_USED"
@@ -0,0 +1,45 @@
+def _warehouse(db, warehouse_id, name):
+    db.warehouses.insert_one({"id": warehouse_id, "name": name, "location": "Душанбе", "is_active": True})
+
+def test_exact_match_is_not_cut_by_candidate_limit(server, db):
+    for number in range(5):
+        _warehouse(db, f"w{number}", f"Склад Хатлон {number}")
+    _warehouse(db, "exact", "Хатлон")
+    server.search_index.backfill()
+    
+    hits = server.search_index.match("warehouse", "хатлон", ["name"], limit=2)
+    
+    assert hits[0]["ref"] == "exact"
+    assert len(hits) == 2
+
+def test_match_reads_sources_until_index_is_built(server, db):
+    _warehouse(db, "w1", "Склад Куляб")
+    db.search_index.delete_many({})
+    assert not server.search_index.is_built()
+    
+    assert [hit["ref"] for hit in server.search_index.match("warehouse", "куляб")] == ["w1"]
+    
+    server.search_index.backfill()
+    assert [hit["ref"] for hit in server.search_index.match("warehouse", "куляб")] == ["w1"]
+
+def test_index_follows_source_writes(server, db):
+    server.search_index.backfill()
+    _warehouse(db, "w1", "Склад Вахдат")
+    db.warehouses.update_one({"id": "w1"}, {"$set": {"name": "Склад Гиссар"}})
+    
+    assert server.search_index.match("warehouse", "вахдат") == []
+    assert [hit["ref"] for hit in server.search_index.match("warehouse", "гиссар")] == ["w1"]
+
+def test_advanced_cargo_search_is_limited_and_ranked(server, db, make_user):
+    admin = make_user("admin")
+    db.operator_cargo.insert_many([
+        {"id": f"cargo-{number}", "cargo_number": f"2501{number:02d}", "cargo_name": "Одежда", "status": "accepted"}
+        for number in range(60)
+    ])
+    server.search_index.backfill()
+    
+    unfiltered = server.search_cargo_advanced(server.AdvancedSearchRequest(), admin)
+    assert len([result for result in unfiltered if result.details["collection"] == "operator_cargo"]) == 50
+    
+    found = server.search_cargo_advanced(server.AdvancedSearchRequest(query="250107"), admin)
+    assert found[0].id == "cargo-7"
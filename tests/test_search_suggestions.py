@@ -0,0 +1,75 @@
+from datetime import datetime
+
+def _cargo(number, sender):
+    return {"id": f"cargo-{number}", "cargo_number": number, "sender_full_name": sender, "recipient_full_name": "Получатель"}
+
+def _values(index, query, kind="sender_name"):
+    return [suggestion["value"] for suggestion in index.suggest(query, {kind}, 10)]
+
+def test_suggest_follows_local_writes(server, db):
+    index = server.SuggestionIndex(db, 1000)
+    db.operator_cargo.insert_one(_cargo("250001", "Рахимов Алишер"))
+    index.build()
+    assert _values(index, "алиш") == ["Рахимов Алишер"]
+
+    db.operator_cargo.update_one({"id": "cargo-250001"}, {"$set": {"sender_full_name": "Каримов Бахтиёр"}})
+    index.on_changes("operator_cargo", [(_cargo("250001", "Рахимов Алишер"), _cargo("250001", "Каримов Бахтиёр"))])
+    assert _values(index, "алиш") == []
+    assert _values(index, "бахт") == ["Каримов Бахтиёр"]
+
+def test_change_during_build_is_not_counted_twice(server, db, monkeypatch):
+    monkeypatch.setattr(server, "SUGGEST_BUILD_BATCH", 1)
+    index = server.SuggestionIndex(db, 1000)
+    db.operator_cargo.insert_many([_cargo("250001", "Рахимов Алишер"), _cargo("250002", "Назаров Фарход")])
+    first_page = db.operator_cargo.find_one({}, sort=[("_id", -1)])
+    other = "250002" if first_page["cargo_number"] == "250001" else "250001"
+    sync = index.sync
+    written = []
+
+    def sync_with_writes():
+        if not written and index._scan["collections"]["operator_cargo"]["boundary"] is not None:
+            written.append(True)
+            # Первая страница уже прочитана: изменение применяется поверх снимка
+            index.on_changes("operator_cargo", [(None, _cargo("250003", "Саидов Шерзод"))])
+            index.on_changes("operator_cargo", [(first_page, dict(first_page, sender_full_name="Юсупов Дилшод"))])
+            # Вторая страница еще не прочитана: снимок увидит документ уже измененным
+            changed = dict(_cargo(other, "Шарипов Умед"), _id=db.operator_cargo.find_one({"cargo_number": other})["_id"])
+            db.operator_cargo.replace_one({"_id": changed["_id"]}, changed)
+            index.on_changes("operator_cargo", [(None, changed)])
+        return sync()
+
+    index.sync = sync_with_writes
+    index.build()
+
+    assert _values(index, "юсуп") == ["Юсупов Дилшод"]
+    assert _values(index, "саид") == ["Саидов Шерзод"]
+    assert _values(index, "шари") == ["Шарипов Умед"]
+    assert _values(index, str(first_page["sender_full_name"]).split()[0].lower()) == []
+    assert index._refs[("шарипов умед", "sender_name", "Шарипов Умед")] == 1
+
+def test_sync_applies_other_process_deltas(server, db):
+    index = server.SuggestionIndex(db, 1000)
+    index.build()
+    db.search_suggestion_deltas.insert_one({
+        "origin": "other-process",
+        "collection": "users",
+        "doc_id": "user-1",
+        "before": [],
+        "after": [["100234", "user_number", "100234"]],
+        "created_at": datetime.utcnow()
+    })
+
+    assert index.sync() == 1
+    assert _values(index, "1002", kind="user_number") == ["100234"]
+    assert index.sync() == 0
+
+def test_removed_terms_are_merged_out(server, db, monkeypatch):
+    monkeypatch.setattr(server, "SUGGEST_MERGE_THRESHOLD", 4)
+    index = server.SuggestionIndex(db, 1000)
+    index.build()
+    cargos = [_cargo(f"2500{number:02d}", f"Отправитель {number:02d}") for number in range(12)]
+    index.on_changes("operator_cargo", [(None, cargo) for cargo in cargos])
+    index.on_changes("operator_cargo", [(cargo, None) for cargo in cargos[:8]])
+
+    assert _values(index, "отправитель") == [f"Отправитель {number:02d}" for number in range(8, 12)]
+    assert len(index._keys) + len(index._recent) - len(index._refs) <= 8